@@ -0,0 +1,55 @@
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from zentral.core.events import event_from_event_d, event_types
+from zentral.core.events.base import EventMetadata, EventObserver, EventRequest, EventRequestUser, EventView
+
+
+class Command(BaseCommand):
+    help = 'Compare the deserialize → serialize round-trips/sec of the event objects and of the event views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20000)
+        parser.add_argument('--rounds', type=int, default=3)
+
+    def build_serialized_events(self, count):
+        event_cls = event_types["base"]
+        observer = EventObserver("zentral.example.com", "Zentral", "benchmark", None, None)
+        request = EventRequest("benchmark/1.0", "10.0.0.1",
+                               EventRequestUser(username="yolo", email="yolo@example.com"))
+        serialized_events = []
+        for i in range(count):
+            metadata = EventMetadata(uuid=uuid.uuid4(), index=i % 3,
+                                     machine_serial_number="0123456789",
+                                     observer=observer, request=request,
+                                     tags=["benchmark"])
+            event = event_cls(metadata, {"idx": i, "name": "value{}".format(i % 20)})
+            serialized_events.append(event.serialize(machine_metadata=False))
+        return serialized_events
+
+    def run(self, serialized_events, func, rounds):
+        best_duration = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for event_d in serialized_events:
+                func(event_d)
+            duration = time.perf_counter() - start
+            if best_duration is None or duration < best_duration:
+                best_duration = duration
+        return len(serialized_events) / best_duration
+
+    def handle(self, *args, **options):
+        serialized_events = self.build_serialized_events(options["events"])
+
+        def event_round_trip(event_d):
+            return event_from_event_d(event_d).serialize(machine_metadata=False)
+
+        def event_view_round_trip(event_d):
+            return EventView(event_d).serialize(machine_metadata=False)
+
+        event_rps = self.run(serialized_events, event_round_trip, options["rounds"])
+        event_view_rps = self.run(serialized_events, event_view_round_trip, options["rounds"])
+        self.stdout.write("event objects {:>10.0f} round-trips/s".format(event_rps))
+        self.stdout.write("event views   {:>10.0f} round-trips/s, x{:.1f}".format(
+            event_view_rps, event_view_rps / event_rps
+        ))
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from zentral.core.events.base import BaseEvent, EventMetadata, EventView, parse_created_at, register_event_type
+from zentral.core.events.pipeline import process_event
+
+
+class TestEvent5(BaseEvent):
+    event_type = "event_type_5"
+
+
+register_event_type(TestEvent5)
+
+
+def make_event_d(probes=None):
+    metadata = EventMetadata(machine_serial_number="0123456789", probes=probes or [])
+    return TestEvent5(metadata, {"un": 1}).serialize(machine_metadata=False)
+
+
+class EventViewTestCase(SimpleTestCase):
+    def test_parse_created_at(self):
+        dt = datetime(2021, 2, 18, 20, 55, 1, 123456)
+        self.assertEqual(parse_created_at(dt.isoformat()), dt)
+        # dateutil fallback
+        self.assertEqual(parse_created_at("Feb 18 2021 20:55:01"), datetime(2021, 2, 18, 20, 55, 1))
+        self.assertEqual(parse_created_at("2021-02-18T20:55:01.123Z"),
+                         datetime(2021, 2, 18, 20, 55, 1, 123000, tzinfo=timezone.utc))
+
+    def test_event_metadata_lazy_machine(self):
+        metadata = EventMetadata.deserialize(make_event_d()["_zentral"])
+        self.assertNotIn("machine", metadata.__dict__)
+        self.assertEqual(metadata.machine.serial_number, "0123456789")
+        self.assertIsNone(EventMetadata().machine)
+
+    def test_event_view_pass_through(self):
+        event_d = make_event_d()
+        event_view = EventView(event_d)
+        self.assertEqual(event_view.event_type, "event_type_5")
+        self.assertEqual(event_view.machine_serial_number, "0123456789")
+        self.assertTrue(datetime.utcnow() - event_view.created_at < timedelta(seconds=10))
+        self.assertIs(event_view.serialize(), event_d)
+        self.assertFalse(hasattr(event_view, "__dict__"))
+
+    def test_event_view_event(self):
+        event_d = make_event_d()
+        event_view = EventView(event_d)
+        event = event_view.event
+        self.assertIsInstance(event, TestEvent5)
+        self.assertIs(event_view.event, event)
+        event.metadata.tags.append("yolo")
+        serialized_event = event_view.serialize(machine_metadata=False)
+        self.assertIsNot(serialized_event, event_d)
+        self.assertEqual(serialized_event["_zentral"]["tags"], ["yolo"])
+
+    def test_event_view_iter_loaded_probes(self):
+        probe = Mock()
+        event_view = EventView(make_event_d(probes=[{"pk": 1, "name": "un"}, {"pk": 2, "name": "deux"}]))
+        with patch("zentral.core.events.base.all_probes_dict", {1: probe}):
+            self.assertEqual(list(event_view.iter_loaded_probes()), [probe])
+
+    @patch("zentral.core.events.base.event_from_event_d")
+    def test_process_event_without_probes(self, event_from_event_d):
+        process_event(make_event_d())
+        event_from_event_d.assert_not_called()
+
+    def test_process_event_with_probes(self):
+        action = Mock()
+        probe = Mock(actions=[(action, {"un": 1})])
+        event_d = make_event_d(probes=[{"pk": 1, "name": "un"}])
+        with patch("zentral.core.events.base.all_probes_dict", {1: probe}):
+            process_event(event_d)
+        action.trigger.assert_called_once()
+        event, triggered_probe, action_config_d = action.trigger.call_args.args
+        self.assertIsInstance(event, TestEvent5)
+        self.assertIs(triggered_probe, probe)
+        self.assertEqual(action_config_d, {"un": 1})
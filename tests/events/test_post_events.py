@@ -0,0 +1,41 @@
+from unittest.mock import call, Mock, patch
+from django.test import SimpleTestCase
+from zentral.core.events.base import BaseEvent, EventMetadata, register_event_type
+from zentral.core.queues.backends.kombu import events_exchange, publish_events
+
+
+class TestEvent4(BaseEvent):
+    event_type = "event_type_4"
+
+
+register_event_type(TestEvent4)
+
+
+class PostEventsTestCase(SimpleTestCase):
+    @patch("zentral.core.events.base.queues")
+    def test_post_machine_request_payloads_one_bulk_post(self, queues):
+        posted_events = []
+        queues.post_events.side_effect = lambda events: posted_events.extend(events)
+        TestEvent4.post_machine_request_payloads("0123456789", "godzilla", "127.0.0.1",
+                                                 [{"un": 1}, {"deux": 2}, {"trois": 3}])
+        queues.post_events.assert_called_once()
+        queues.post_event.assert_not_called()
+        self.assertEqual([e.payload for e in posted_events], [{"un": 1}, {"deux": 2}, {"trois": 3}])
+        self.assertEqual([e.metadata.index for e in posted_events], [0, 1, 2])
+        self.assertEqual(len(set(e.metadata.uuid for e in posted_events)), 1)
+
+    def test_kombu_publish_events_declares_exchange_once(self):
+        producer = Mock()
+        events = [TestEvent4(EventMetadata(machine_serial_number="0123456789", index=i), {"i": i})
+                  for i in range(3)]
+        self.assertEqual(list(publish_events(producer, events)), events)
+        self.assertEqual(producer.publish.call_count, 3)
+        self.assertEqual(
+            [c.kwargs["declare"] for c in producer.publish.call_args_list],
+            [[events_exchange], None, None]
+        )
+        self.assertEqual(producer.publish.call_args_list[1],
+                         call(events[1].serialize(machine_metadata=False),
+                              serializer="json",
+                              exchange=events_exchange,
+                              declare=None))
@@ -0,0 +1,195 @@
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from zentral.core.incidents.models import (OPEN_STATUSES, SEVERITY_CRITICAL, SEVERITY_MAJOR, SEVERITY_MINOR,
+                                           STATUS_OPEN)
+from zentral.core.incidents.utils import IncidentUpdateCoalescer
+
+
+class IncidentUpdateCoalescerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.coalescer = IncidentUpdateCoalescer(window_seconds=5)
+        self.probe_source = Mock(pk=1)
+
+    def _incident(self, pk=1, severity=SEVERITY_MAJOR):
+        return Mock(pk=pk, severity=severity)
+
+    @patch("zentral.core.incidents.utils.Incident")
+    @patch("zentral.core.incidents.utils.time.monotonic")
+    @patch("zentral.core.incidents.utils.update_or_create_open_incident")
+    def test_open_incident_window(self, update_or_create_open_incident, monotonic, incident_model):
+        incident_model.objects.filter.return_value.exists.return_value = True
+        monotonic.return_value = 100
+        incident = self._incident()
+        update_or_create_open_incident.return_value = (incident, [{"action": "created"}])
+        self.assertEqual(self.coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, "id1"),
+                         (incident, [{"action": "created"}]))
+        # same or lower severity → coalesced
+        for severity in (SEVERITY_MAJOR, SEVERITY_MINOR):
+            self.assertEqual(self.coalescer.update_or_create_open_incident(self.probe_source, severity, "id2"),
+                             (incident, []))
+        update_or_create_open_incident.assert_called_once()
+        # higher severity → update
+        updated_incident = self._incident(severity=SEVERITY_CRITICAL)
+        update_or_create_open_incident.return_value = (updated_incident, [{"action": "updated"}])
+        self.assertEqual(self.coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_CRITICAL, "id3"),
+                         (updated_incident, [{"action": "updated"}]))
+        self.assertEqual(update_or_create_open_incident.call_count, 2)
+        # window expired → update
+        monotonic.return_value = 106
+        update_or_create_open_incident.return_value = (updated_incident, [])
+        self.coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_MINOR, "id4")
+        self.assertEqual(update_or_create_open_incident.call_count, 3)
+
+    @patch("zentral.core.incidents.utils.Incident")
+    @patch("zentral.core.incidents.utils.update_or_create_open_incident")
+    def test_closed_incident_not_coalesced(self, update_or_create_open_incident, incident_model):
+        incident = self._incident()
+        update_or_create_open_incident.return_value = (incident, [])
+        self.coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, "id1")
+        # closed by another worker or a user → locked update
+        incident_model.objects.filter.return_value.exists.return_value = False
+        new_incident = self._incident(pk=2)
+        update_or_create_open_incident.return_value = (new_incident, [{"action": "created"}])
+        self.assertEqual(self.coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, "id2"),
+                         (new_incident, [{"action": "created"}]))
+        self.assertEqual(update_or_create_open_incident.call_count, 2)
+
+    @patch("zentral.core.incidents.utils.Incident")
+    @patch("zentral.core.incidents.utils.MachineIncident")
+    @patch("zentral.core.incidents.utils.update_or_create_open_machine_incident")
+    def test_open_machine_incidents(self, update_or_create_open_machine_incident, machine_incident_model,
+                                    incident_model):
+        still_open = machine_incident_model.objects.filter.return_value.exists
+        still_open.return_value = True
+        incident_still_open = incident_model.objects.filter.return_value.exists
+        incident_still_open.return_value = True
+        incident = self._incident()
+        machine_incident1 = Mock(pk=1, incident=incident, incident_id=incident.pk)
+        update_or_create_open_machine_incident.return_value = (machine_incident1, [{"action": "created"}])
+        self.assertEqual(
+            self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR, "SN1", "id1"),
+            (machine_incident1, [{"action": "created"}])
+        )
+        # same machine → coalesced, once the machine incident and incident are confirmed open
+        self.assertEqual(
+            self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MINOR, "SN1", "id2"),
+            (machine_incident1, [])
+        )
+        update_or_create_open_machine_incident.assert_called_once()
+        self.assertEqual(machine_incident_model.objects.filter.call_args.kwargs,
+                         {"pk": 1, "status__in": OPEN_STATUSES, "incident__status__in": OPEN_STATUSES})
+        # other machine, same incident severity → machine incident created without locking the incident
+        machine_incident2 = Mock(pk=2)
+        machine_incident2.serialize_for_event.return_value = {"pk": 2}
+        machine_incident_model.objects.get_or_create.return_value = (machine_incident2, True)
+        self.assertEqual(
+            self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR, "SN2", "id3"),
+            (machine_incident2, [{"pk": 2, "action": "created"}])
+        )
+        update_or_create_open_machine_incident.assert_called_once()
+        machine_incident_model.objects.get_or_create.assert_called_once_with(
+            incident=incident,
+            serial_number="SN2",
+            status__in=OPEN_STATUSES,
+            defaults={"status": STATUS_OPEN, "event_id": "id3"}
+        )
+        self.assertEqual(incident_model.objects.filter.call_args.kwargs,
+                         {"pk": 1, "status__in": OPEN_STATUSES})
+        self.assertIs(machine_incident2.incident, incident)
+        # higher severity → locked update
+        update_or_create_open_machine_incident.return_value = (machine_incident1, [])
+        self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_CRITICAL, "SN1", "id4")
+        self.assertEqual(update_or_create_open_machine_incident.call_count, 2)
+        # closed by another worker or a user → locked update
+        still_open.return_value = False
+        incident_still_open.return_value = False
+        machine_incident3 = Mock(pk=3, incident=incident, incident_id=incident.pk)
+        update_or_create_open_machine_incident.return_value = (machine_incident3, [{"action": "created"}])
+        self.assertEqual(
+            self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR, "SN2", "id5"),
+            (machine_incident3, [{"action": "created"}])
+        )
+        self.assertEqual(update_or_create_open_machine_incident.call_count, 3)
+        machine_incident_model.objects.get_or_create.assert_called_once()
+
+    @patch("zentral.core.incidents.utils.Incident")
+    @patch("zentral.core.incidents.utils.MachineIncident")
+    @patch("zentral.core.incidents.utils.update_or_create_open_machine_incident")
+    def test_many_machine_incidents_one_probe(self, update_or_create_open_machine_incident, machine_incident_model,
+                                              incident_model):
+        incident_model.objects.filter.return_value.exists.return_value = True
+        machine_incident_model.objects.filter.return_value.exists.return_value = True
+        incident = self._incident()
+        update_or_create_open_machine_incident.return_value = (
+            Mock(pk=0, incident=incident, incident_id=incident.pk),
+            [{"type": "incident", "action": "created"}, {"action": "created"}]
+        )
+        self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR, "SN0", "id0")
+
+        def get_or_create(**kwargs):
+            machine_incident = Mock(pk=kwargs["serial_number"])
+            machine_incident.serialize_for_event.return_value = {"serial_number": kwargs["serial_number"]}
+            return machine_incident, True
+
+        machine_incident_model.objects.get_or_create.side_effect = get_or_create
+        serial_numbers = ["SN{}".format(i) for i in range(1, 101)]
+        for serial_number in serial_numbers:
+            machine_incident, event_payloads = self.coalescer.update_or_create_open_machine_incident(
+                self.probe_source, SEVERITY_MAJOR, serial_number, "id1"
+            )
+            self.assertIs(machine_incident.incident, incident)
+            self.assertEqual(event_payloads, [{"serial_number": serial_number, "action": "created"}])
+        # only the first machine incident has locked the incident
+        update_or_create_open_machine_incident.assert_called_once()
+        self.assertEqual(machine_incident_model.objects.get_or_create.call_count, 100)
+        # the new machine incidents are remembered
+        for serial_number in serial_numbers:
+            machine_incident, event_payloads = self.coalescer.update_or_create_open_machine_incident(
+                self.probe_source, SEVERITY_MINOR, serial_number, "id2"
+            )
+            self.assertEqual(machine_incident.pk, serial_number)
+            self.assertEqual(event_payloads, [])
+        update_or_create_open_machine_incident.assert_called_once()
+        self.assertEqual(machine_incident_model.objects.get_or_create.call_count, 100)
+
+    @patch("zentral.core.incidents.utils.MachineIncident")
+    @patch("zentral.core.incidents.utils.update_or_create_open_machine_incident")
+    def test_close_machine_incident(self, update_or_create_open_machine_incident, machine_incident_model):
+        still_open = machine_incident_model.objects.filter.return_value.exists
+        closed_machine_incident = Mock(pk=1)
+        update_or_create_open_machine_incident.return_value = (closed_machine_incident, [{"action": "closed"}])
+        self.assertEqual(
+            self.coalescer.update_or_create_open_machine_incident(self.probe_source, 0, "SN1", "id1"),
+            (closed_machine_incident, [{"action": "closed"}])
+        )
+        # no open machine incident → coalesced
+        still_open.return_value = False
+        self.assertEqual(self.coalescer.update_or_create_open_machine_incident(self.probe_source, 0, "SN1", "id2"),
+                         (None, []))
+        update_or_create_open_machine_incident.assert_called_once()
+        # opened by another worker → locked update
+        still_open.return_value = True
+        update_or_create_open_machine_incident.return_value = (closed_machine_incident, [{"action": "closed"}])
+        self.coalescer.update_or_create_open_machine_incident(self.probe_source, 0, "SN1", "id3")
+        self.assertEqual(update_or_create_open_machine_incident.call_count, 2)
+        # the closed machine incident is not coalesced as an open one
+        machine_incident = Mock(pk=2, incident=self._incident())
+        update_or_create_open_machine_incident.return_value = (machine_incident, [{"action": "created"}])
+        self.coalescer.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR, "SN1", "id4")
+        self.assertEqual(update_or_create_open_machine_incident.call_count, 3)
+
+    @patch("zentral.core.incidents.utils.time.monotonic")
+    def test_purge(self, monotonic):
+        monotonic.return_value = 100
+        self.coalescer._set(self.coalescer._incidents, 1, self._incident())
+        monotonic.return_value = 106
+        self.coalescer._set(self.coalescer._incidents, 2, self._incident(pk=2))
+        self.assertEqual(list(self.coalescer._incidents.keys()), [2])
+
+    @patch("zentral.core.incidents.utils.update_or_create_open_incident")
+    def test_no_window(self, update_or_create_open_incident):
+        coalescer = IncidentUpdateCoalescer(window_seconds=0)
+        update_or_create_open_incident.return_value = (self._incident(), [])
+        for _ in range(2):
+            coalescer.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, "id1")
+        self.assertEqual(update_or_create_open_incident.call_count, 2)
@@ -1,7 +1,7 @@
 from django.test import TestCase
 from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
 from zentral.core.events.base import BaseEvent, EventMetadata
-from zentral.core.events.pipeline import enrich_event
+from zentral.core.events.pipeline import enrich_event, incident_coalescer
 from zentral.core.incidents.events import IncidentEvent, MachineIncidentEvent
 from zentral.core.incidents.models import (Incident, MachineIncident,
                                            SEVERITY_CRITICAL,
@@ -39,6 +39,10 @@ class IncidentTestCase(TestCase):
         cls.probe = cls.probe_source.load()
         all_probes.clear()
 
+    def setUp(self):
+        # the incidents are rolled back after each test
+        incident_coalescer.clear()
+
     def _build_match_event(self, payload, machine_serial_number=None):
         event_metadata = EventMetadata(machine_serial_number=machine_serial_number)
         if machine_serial_number:
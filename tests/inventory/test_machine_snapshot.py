@@ -1,5 +1,6 @@
 import copy
 from datetime import datetime, timedelta
+from unittest.mock import patch
 from dateutil import parser
 from django.core.cache import cache
 from django.test import TestCase, override_settings
@@ -11,7 +12,7 @@ from zentral.contrib.inventory.models import (BusinessUnit,
                                               CurrentMachineSnapshot,
                                               MachineSnapshot, MachineSnapshotCommit,
                                               MachineTag,
-                                              MetaBusinessUnitTag,
+                                              MetaBusinessUnit, MetaBusinessUnitTag,
                                               MetaMachine,
                                               Source,
                                               Tag, Taxonomy)
@@ -310,6 +311,113 @@ class MachineSnapshotTestCase(TestCase):
         self.assertEqual(MachineSnapshotCommit.objects.count(), 3)
         self.assertEqual(CurrentMachineSnapshot.objects.count(), 0)
 
+    def test_meta_machine_prefetch_info_for_event(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        tag, _ = Tag.objects.get_or_create(name="tag333")
+        MachineTag.objects.create(tag=tag, serial_number=self.serial_number)
+        unknown_serial_number = get_random_string(12)
+        cache.clear()
+        # 1 query for both machines
+        with self.assertNumQueries(1):
+            self.assertEqual(MetaMachine.prefetch_info_for_event([self.serial_number, unknown_serial_number, None]), 2)
+        # cached
+        with self.assertNumQueries(0):
+            self.assertEqual(MetaMachine.prefetch_info_for_event([self.serial_number, unknown_serial_number]), 0)
+            mm = MetaMachine(self.serial_number)
+            self.assertEqual(mm.cached_probe_filtering_values,
+                             (MACOS, None, {self.meta_business_unit.id}, {tag.id}))
+            self.assertEqual(mm.cached_serialized_info_for_event["tags"], [{"id": tag.id, "name": tag.name}])
+            unknown_mm = MetaMachine(unknown_serial_number)
+            self.assertEqual(unknown_mm.cached_probe_filtering_values, (None, None, set(), set()))
+            self.assertEqual(unknown_mm.cached_serialized_info_for_event, {})
+        # same values as the single machine code path
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual(mm.cached_probe_filtering_values, mm.get_probe_filtering_values())
+        self.assertEqual(mm.cached_serialized_info_for_event, mm.get_serialized_info_for_event())
+
+    @patch("zentral.contrib.inventory.models.transaction.on_commit", side_effect=lambda callback: callback())
+    def test_meta_machine_event_info_cache_invalidation(self, on_commit):
+        cache.clear()
+        tree = copy.deepcopy(self.machine_snapshot2)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        cache_key = "mm-probe-fvs_{}".format(MetaMachine.make_urlsafe_serial_number(self.serial_number))
+        # cache miss
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual(mm.cached_probe_filtering_values, (MACOS, None, {self.meta_business_unit.id}, set()))
+        self.assertEqual(mm.event_info_cache_results, ["miss"])
+        # cache hit
+        mm = MetaMachine(self.serial_number)
+        mm.cached_probe_filtering_values
+        self.assertEqual(mm.event_info_cache_results, ["hit"])
+        # same tree → no invalidation
+        tree = copy.deepcopy(self.machine_snapshot2)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertIsNotNone(cache.get(cache_key))
+        # machine tag → invalidation
+        tag1, _ = Tag.objects.get_or_create(name="tag444")
+        MachineTag.objects.create(tag=tag1, serial_number=self.serial_number)
+        self.assertIsNone(cache.get(cache_key))
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual(mm.cached_probe_filtering_values, (MACOS, None, {self.meta_business_unit.id}, {tag1.id}))
+        # meta business unit tag → invalidation
+        tag2, _ = Tag.objects.get_or_create(name="tag555")
+        MetaBusinessUnitTag.objects.create(tag=tag2, meta_business_unit=self.meta_business_unit)
+        self.assertIsNone(cache.get(cache_key))
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual(mm.cached_probe_filtering_values,
+                         (MACOS, None, {self.meta_business_unit.id}, {tag1.id, tag2.id}))
+        # queryset deletions → invalidation
+        MetaBusinessUnitTag.objects.filter(tag=tag2).delete()
+        self.assertIsNone(cache.get(cache_key))
+        mm = MetaMachine(self.serial_number)
+        mm.cached_probe_filtering_values
+        MachineTag.objects.filter(tag=tag1).delete()
+        self.assertIsNone(cache.get(cache_key))
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual(mm.cached_probe_filtering_values, (MACOS, None, {self.meta_business_unit.id}, set()))
+        # new snapshot → invalidation
+        tree = copy.deepcopy(self.machine_snapshot3)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertIsNone(cache.get(cache_key))
+
+    @patch("zentral.contrib.inventory.models.transaction.on_commit", side_effect=lambda callback: callback())
+    def test_meta_machine_event_info_cache_renames_and_tag_deletions(self, on_commit):
+        cache.clear()
+        tree = copy.deepcopy(self.machine_snapshot2)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        tag = Tag.objects.create(name=get_random_string(12))
+        MachineTag.objects.create(tag=tag, serial_number=self.serial_number)
+        mbu_tag = Tag.objects.create(name=get_random_string(12))
+        MetaBusinessUnitTag.objects.create(tag=mbu_tag, meta_business_unit=self.meta_business_unit)
+        info = MetaMachine(self.serial_number).cached_serialized_info_for_event
+        self.assertEqual(sorted(t["name"] for t in info["tags"]), sorted([tag.name, mbu_tag.name]))
+        # tag renames → invalidation
+        for t in (tag, mbu_tag):
+            t.name = get_random_string(12)
+            t.save()
+            mm = MetaMachine(self.serial_number)
+            self.assertIn({"id": t.pk, "name": t.name}, mm.cached_serialized_info_for_event["tags"])
+            self.assertEqual(mm.event_info_cache_results, ["miss"])
+        # meta business unit rename → invalidation
+        meta_business_unit = MetaBusinessUnit.objects.get(pk=self.meta_business_unit.pk)
+        meta_business_unit.name = get_random_string(12)
+        meta_business_unit.save()
+        self.assertEqual(MetaMachine(self.serial_number).cached_serialized_info_for_event["meta_business_units"],
+                         [{"id": meta_business_unit.pk, "name": meta_business_unit.name}])
+        # business unit rename → invalidation
+        business_unit = BusinessUnit.objects.get(pk=self.business_unit.pk)
+        business_unit.name = get_random_string(12)
+        business_unit.save()
+        info = MetaMachine(self.serial_number).cached_serialized_info_for_event
+        self.assertEqual([bu["name"] for bu in info["zentral"]["business_unit"]], [business_unit.name])
+        # tag deletions, with the machine tags and meta business unit tags deleted in cascade → invalidation
+        tag.delete()
+        info = MetaMachine(self.serial_number).cached_serialized_info_for_event
+        self.assertEqual([t["name"] for t in info["tags"]], [mbu_tag.name])
+        Tag.objects.filter(pk=mbu_tag.pk).delete()
+        self.assertNotIn("tags", MetaMachine(self.serial_number).cached_serialized_info_for_event)
+
     def test_meta_machine_update_taxonomy_tags(self):
         # one machine
         serial_number = get_random_string(13)
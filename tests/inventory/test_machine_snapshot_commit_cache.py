@@ -0,0 +1,144 @@
+import copy
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import (CurrentMachineSnapshot, MachineSnapshot, MachineSnapshotCommit,
+                                              MachineSnapshotCommitManager)
+
+
+def build_tree(serial_number=None, bundle_version_str="1.2.3"):
+    return {
+        "source": {"module": "io.zentral.tests", "name": "zentral"},
+        "serial_number": serial_number or get_random_string(12),
+        "os_version": {"name": "macOS", "major": 11, "minor": 2},
+        "osx_app_instances": [
+            {"app": {"bundle_id": "io.zentral.baller",
+                     "bundle_name": "Baller.app",
+                     "bundle_version_str": bundle_version_str},
+             "bundle_path": "/Applications/Baller.app"}
+        ]
+    }
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MachineSnapshotCommitCacheHelpersTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_commit_cache_key(self):
+        tree = build_tree("0123456789")
+        key = MachineSnapshotCommitManager.get_commit_cache_key(tree)
+        self.assertTrue(key.startswith("msc-last_"))
+        self.assertTrue(key.endswith("_0123456789"))
+        tree2 = copy.deepcopy(tree)
+        tree2["source"] = {"name": "zentral", "module": "io.zentral.tests"}
+        self.assertEqual(MachineSnapshotCommitManager.get_commit_cache_key(tree2), key)
+        tree2["source"]["name"] = "zentral2"
+        self.assertNotEqual(MachineSnapshotCommitManager.get_commit_cache_key(tree2), key)
+        tree2.pop("serial_number")
+        self.assertIsNone(MachineSnapshotCommitManager.get_commit_cache_key(tree2))
+
+    def test_tree_fingerprint(self):
+        tree = build_tree("0123456789")
+        fingerprint = MachineSnapshotCommitManager.get_tree_fingerprint(tree)
+        self.assertEqual(MachineSnapshotCommitManager.get_tree_fingerprint(copy.deepcopy(tree)), fingerprint)
+        self.assertNotEqual(
+            MachineSnapshotCommitManager.get_tree_fingerprint(build_tree("0123456789", bundle_version_str="1.2.4")),
+            fingerprint
+        )
+
+    def test_commit_result_counters(self):
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(), {})
+        MachineSnapshotCommit.objects.incr_commit_result_counter("committed")
+        MachineSnapshotCommit.objects.incr_commit_result_counter("skipped")
+        MachineSnapshotCommit.objects.incr_commit_result_counter("skipped")
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(),
+                         {"committed": 1, "skipped": 2})
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MachineSnapshotCommitCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def commit(self, tree, last_seen, system_uptime=None):
+        tree = copy.deepcopy(tree)
+        tree["last_seen"] = last_seen
+        if system_uptime:
+            tree["system_uptime"] = system_uptime
+        return MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+
+    def test_heartbeat(self):
+        tree = build_tree()
+        last_seen = datetime(2021, 3, 1, 12)
+        msc, ms = self.commit(tree, last_seen)
+        self.assertEqual(msc.version, 1)
+        with CaptureQueriesContext(connection) as ctx:
+            msc2, ms2 = self.commit(tree, last_seen + timedelta(minutes=1))
+        self.assertFalse(any("inventory_machinesnapshot\"" in q["sql"] and "INSERT" in q["sql"]
+                             for q in ctx.captured_queries))
+        self.assertEqual(ms2, ms)
+        self.assertEqual(msc2.version, 2)
+        self.assertEqual(msc2.parent, msc)
+        self.assertEqual(msc2.last_seen, last_seen + timedelta(minutes=1))
+        self.assertEqual(msc2.update_diff(), {"last_seen": {"added": last_seen + timedelta(minutes=1),
+                                                            "removed": last_seen}})
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(),
+                         {"committed": 1, "heartbeat": 1})
+
+    def test_same_last_seen_skipped(self):
+        tree = build_tree()
+        last_seen = datetime(2021, 3, 1, 12)
+        _, ms = self.commit(tree, last_seen, 123)
+        msc, ms2 = self.commit(tree, last_seen, 123)
+        self.assertIsNone(msc)
+        self.assertEqual(ms2, ms)
+        self.assertEqual(MachineSnapshotCommit.objects.filter(serial_number=tree["serial_number"]).count(), 1)
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(),
+                         {"committed": 1, "skipped": 1})
+
+    @patch("zentral.contrib.inventory.models.MachineSnapshotCommitManager.get_heartbeat_resolution")
+    def test_heartbeat_resolution(self, get_heartbeat_resolution):
+        get_heartbeat_resolution.return_value = 300
+        tree = build_tree()
+        last_seen = datetime(2021, 3, 1, 12)
+        self.commit(tree, last_seen)
+        with CaptureQueriesContext(connection) as ctx:
+            msc, ms = self.commit(tree, last_seen + timedelta(minutes=1))
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertIsNone(msc)
+        self.assertEqual(ms.serial_number, tree["serial_number"])
+        msc, _ = self.commit(tree, last_seen + timedelta(minutes=6))
+        self.assertEqual(msc.version, 2)
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(),
+                         {"committed": 1, "heartbeat": 1, "skipped": 1})
+
+    def test_changed_tree(self):
+        tree = build_tree()
+        last_seen = datetime(2021, 3, 1, 12)
+        _, ms = self.commit(tree, last_seen)
+        msc, ms2 = self.commit(build_tree(tree["serial_number"], bundle_version_str="2.0"), last_seen)
+        self.assertNotEqual(ms2, ms)
+        self.assertEqual(msc.version, 2)
+        # back to the first tree → cache updated by the previous commit
+        msc, ms3 = self.commit(tree, last_seen)
+        self.assertEqual(ms3, ms)
+        self.assertEqual(msc.version, 3)
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(), {"committed": 3})
+
+    def test_current_machine_snapshot_deleted(self):
+        tree = build_tree()
+        last_seen = datetime(2021, 3, 1, 12)
+        _, ms = self.commit(tree, last_seen)
+        CurrentMachineSnapshot.objects.filter(serial_number=tree["serial_number"]).delete()
+        msc, ms2 = self.commit(tree, last_seen + timedelta(minutes=1))
+        self.assertEqual(ms2, ms)
+        self.assertEqual(msc.version, 2)
+        self.assertEqual(CurrentMachineSnapshot.objects.get(serial_number=tree["serial_number"]).machine_snapshot,
+                         ms)
+        self.assertEqual(MachineSnapshot.objects.filter(serial_number=tree["serial_number"]).count(), 1)
+        self.assertEqual(MachineSnapshotCommit.objects.get_commit_result_counts(), {"committed": 2})
@@ -0,0 +1,176 @@
+import copy
+from datetime import datetime
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import (Certificate, MachineSnapshot, NetworkInterface,
+                                              OSVersion, OSXApp, OSXAppInstance, Source)
+from zentral.utils.mt_models import MTBulkCommit, MTOError, prepare_commit_tree
+
+
+def build_tree(app_count=3):
+    root_ca = {"common_name": "Root CA",
+               "sha_1": "611e5b662c593a08ff58d14ae22452d198df6c60",
+               "valid_from": datetime(2006, 4, 25, 21, 40, 36),
+               "valid_until": datetime(2035, 2, 9, 21, 40, 36)}
+    certificate = {"common_name": "Developer ID Application: Zentral",
+                   "signed_by": root_ca}
+    return {
+        "source": {"module": "io.zentral.tests", "name": "zentral"},
+        "serial_number": get_random_string(12),
+        "os_version": {"name": "macOS", "major": 11, "minor": 2},
+        "network_interfaces": [{"interface": "en0", "mac": "00:11:22:33:44:55", "address": "10.0.0.1"}],
+        "osx_app_instances": [
+            {"app": {"bundle_id": "io.zentral.app{}".format(i),
+                     "bundle_name": "App{}.app".format(i),
+                     "bundle_version_str": "1.{}".format(i)},
+             "bundle_path": "/Applications/App{}.app".format(i),
+             "signed_by": certificate}
+            for i in range(app_count)
+        ],
+        "certificates": [root_ca],
+    }
+
+
+class RecordingMTBulkCommit(MTBulkCommit):
+    def __init__(self, existing_mt_hashes):
+        super().__init__()
+        self.existing_mt_hashes = existing_mt_hashes
+        self.fetches = []
+        self.creations = []
+
+    def _fetch_pks(self, model, mt_hashes):
+        self.fetches.append((model, len(mt_hashes)))
+        for mt_hash in mt_hashes:
+            if mt_hash in self.existing_mt_hashes:
+                self.pks[(model, mt_hash)] = 1
+
+    def _create_missing_objs(self, model, mt_hashes):
+        self.creations.append((model, len(mt_hashes)))
+        for mt_hash in mt_hashes:
+            self.pks[(model, mt_hash)] = 2
+
+
+class MTBulkCommitPlanTestCase(SimpleTestCase):
+    def test_new_tree(self):
+        tree = build_tree()
+        prepare_commit_tree(tree)
+        bulk_commit = RecordingMTBulkCommit(set())
+        self.assertEqual(bulk_commit.commit(MachineSnapshot, tree), (2, True))
+        # one fetch per model and per level, top → bottom
+        self.assertEqual(bulk_commit.fetches[0], (MachineSnapshot, 1))
+        self.assertEqual(
+            set(bulk_commit.fetches[1:5]),
+            {(Source, 1), (OSVersion, 1), (NetworkInterface, 1), (OSXAppInstance, 3)}
+        )
+        # Certificate root CA → fetched in the first level, with the certificates
+        self.assertIn((Certificate, 1), bulk_commit.fetches[1:6])
+        # one creation per model and per level, bottom → top
+        self.assertEqual(bulk_commit.creations[-1], (MachineSnapshot, 1))
+        created_models = [model for model, _ in bulk_commit.creations]
+        self.assertTrue(created_models.index(OSXApp) < created_models.index(OSXAppInstance))
+        self.assertEqual([count for model, count in bulk_commit.creations if model == Certificate], [1, 1])
+        self.assertEqual(sum(count for model, count in bulk_commit.creations if model == OSXApp), 3)
+
+    def test_existing_tree(self):
+        tree = build_tree()
+        prepare_commit_tree(tree)
+        bulk_commit = RecordingMTBulkCommit({tree["mt_hash"]})
+        self.assertEqual(bulk_commit.commit(MachineSnapshot, tree), (1, False))
+        self.assertEqual(bulk_commit.fetches, [(MachineSnapshot, 1)])
+        self.assertEqual(bulk_commit.creations, [])
+
+    def test_one_new_app(self):
+        tree = build_tree()
+        prepare_commit_tree(tree)
+        existing_mt_hashes = {tree[k]["mt_hash"] for k in ("source", "os_version")}
+        existing_mt_hashes.update(ni["mt_hash"] for ni in tree["network_interfaces"])
+        existing_mt_hashes.update(c["mt_hash"] for c in tree["certificates"])
+        existing_mt_hashes.update(oai["mt_hash"] for oai in tree["osx_app_instances"][1:])
+        bulk_commit = RecordingMTBulkCommit(existing_mt_hashes)
+        self.assertEqual(bulk_commit.commit(MachineSnapshot, tree), (2, True))
+        # the subtrees of the existing nodes are skipped
+        self.assertEqual([count for model, count in bulk_commit.fetches if model == OSXApp], [1])
+        self.assertEqual(sorted((model.__name__, count) for model, count in bulk_commit.creations),
+                         [("Certificate", 1), ("MachineSnapshot", 1), ("OSXApp", 1), ("OSXAppInstance", 1)])
+
+    def test_commit_many(self):
+        trees = [build_tree(), build_tree()]
+        trees.append(copy.deepcopy(trees[0]))
+        for tree in trees:
+            prepare_commit_tree(tree)
+        bulk_commit = RecordingMTBulkCommit({trees[1]["mt_hash"]})
+        self.assertEqual(bulk_commit.commit_many(MachineSnapshot, trees),
+                         {trees[0]["mt_hash"]: (2, True), trees[1]["mt_hash"]: (1, False)})
+        # duplicated trees deduplicated, one fetch for both roots
+        self.assertEqual(bulk_commit.fetches[0], (MachineSnapshot, 2))
+        self.assertEqual(bulk_commit.creations[-1], (MachineSnapshot, 1))
+
+    def test_build_obj_hash_mismatch(self):
+        tree = {"interface": "en0", "mac": "00:11:22:33:44:55", "address": "::ffff:10.0.0.1"}
+        prepare_commit_tree(tree)
+        bulk_commit = MTBulkCommit()
+        key = (NetworkInterface, tree["mt_hash"])
+        bulk_commit.missing_nodes[key] = bulk_commit._parse_node(NetworkInterface, tree)
+        with self.assertRaises(MTOError):
+            bulk_commit._build_obj(*key)
+
+    def test_build_obj(self):
+        tree = {"name": "macOS", "major": 11, "minor": 2}
+        prepare_commit_tree(tree)
+        bulk_commit = MTBulkCommit()
+        key = (OSVersion, tree["mt_hash"])
+        bulk_commit.missing_nodes[key] = bulk_commit._parse_node(OSVersion, tree)
+        obj = bulk_commit._build_obj(*key)
+        self.assertEqual(obj.hash(), tree["mt_hash"])
+
+
+class MTBulkCommitTestCase(TestCase):
+    def _count_queries(self, ctx):
+        return len([q for q in ctx.captured_queries if "SAVEPOINT" not in q["sql"]])
+
+    def test_bulk_commit_same_as_commit(self):
+        tree = build_tree()
+        ms, created = MachineSnapshot.objects.bulk_commit(copy.deepcopy(tree))
+        self.assertTrue(created)
+        self.assertEqual(ms.hash(), ms.mt_hash)
+        self.assertEqual(ms.osx_app_instances.count(), 3)
+        self.assertEqual(ms.certificates.count(), 1)
+        ms2, created = MachineSnapshot.objects.commit(copy.deepcopy(tree))
+        self.assertFalse(created)
+        self.assertEqual(ms, ms2)
+        self.assertEqual(Certificate.objects.count(), 2)
+
+    def test_bulk_commit_existing_subtrees(self):
+        tree = build_tree()
+        ms, _ = MachineSnapshot.objects.commit(copy.deepcopy(tree))
+        new_tree = copy.deepcopy(tree)
+        new_tree["osx_app_instances"].extend(build_tree(5)["osx_app_instances"][3:])
+        with CaptureQueriesContext(connection) as ctx:
+            ms2, created = MachineSnapshot.objects.bulk_commit(new_tree)
+        self.assertTrue(self._count_queries(ctx) < 25)
+        self.assertTrue(created)
+        self.assertNotEqual(ms, ms2)
+        self.assertEqual(ms2.hash(), ms2.mt_hash)
+        self.assertEqual(ms2.osx_app_instances.count(), 5)
+        self.assertEqual(OSXApp.objects.count(), 5)
+
+    def test_bulk_commit_existing_tree(self):
+        tree = build_tree()
+        ms, _ = MachineSnapshot.objects.bulk_commit(copy.deepcopy(tree))
+        with CaptureQueriesContext(connection) as ctx:
+            ms2, created = MachineSnapshot.objects.bulk_commit(copy.deepcopy(tree))
+        # existing snapshot + get
+        self.assertEqual(self._count_queries(ctx), 2)
+        self.assertFalse(created)
+        self.assertEqual(ms, ms2)
+
+    def test_bulk_commit_many(self):
+        trees = [build_tree(), build_tree()]
+        ms, _ = MachineSnapshot.objects.bulk_commit(copy.deepcopy(trees[0]))
+        results = MachineSnapshot.objects.bulk_commit_many(copy.deepcopy(trees + trees))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[ms.mt_hash], (ms.pk, False))
+        self.assertEqual(MachineSnapshot.objects.filter(serial_number__in=[t["serial_number"] for t in trees]).count(),
+                         2)
@@ -34,6 +34,8 @@ class PrometheusViewsTestCase(TestCase):
                                    HTTP_AUTHORIZATION="Bearer CHANGE ME!!!")
         labels_dict = {}
         for family in text_string_to_metric_families(response.content.decode('utf-8')):
+            if family.name == "zentral_inventory_machine_snapshot_commits":
+                continue
             self.assertEqual(len(family.samples), 1)
             sample = family.samples[0]
             self.assertEqual(sample.value, 1)  # only one machine in inventory
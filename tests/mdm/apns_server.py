@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+import ipaddress
+import json
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+import h2.config
+import h2.connection
+import h2.events
+
+
+def build_self_signed_certificate():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"),
+                                                    x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                       critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    return (certificate.public_bytes(serialization.Encoding.PEM),
+            key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.TraditionalOpenSSL,
+                              serialization.NoEncryption()))
+
+
+class FakeAPNSServer:
+    """Local APNs HTTP/2 server
+
+    The responses are delayed, to have concurrent streams.
+    The response for a device token can be set in the responses dict, as a (status, headers, body) tuple.
+    """
+    def __init__(self, response_delay=0.05):
+        self.response_delay = response_delay
+        self.responses = {}
+        self.requests = []
+        self.connection_count = 0
+        self.open_streams = 0
+        self.max_open_streams = 0
+        self._lock = threading.Lock()
+        self.certificate, self.private_key = build_self_signed_certificate()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.certificate_file = os.path.join(self._tmp_dir.name, "cert.pem")
+        with open(self.certificate_file, "wb") as f:
+            f.write(self.certificate)
+        key_file = os.path.join(self._tmp_dir.name, "key.pem")
+        with open(key_file, "wb") as f:
+            f.write(self.private_key)
+        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._ssl_context.load_cert_chain(self.certificate_file, key_file)
+        self._ssl_context.set_alpn_protocols(["h2"])
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen()
+        self.base_url = "https://127.0.0.1:{}".format(self._socket.getsockname()[1])
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def get_client_ssl_context(self):
+        context = ssl.create_default_context(cafile=self.certificate_file)
+        context.set_alpn_protocols(["h2", "http/1.1"])
+        return context
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._socket.close()
+        self._tmp_dir.cleanup()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connection_count += 1
+            threading.Thread(target=self._handle_connection, args=(sock,), daemon=True).start()
+
+    def _respond(self, conn, sock, sock_lock, stream_id, headers, body):
+        token = headers[":path"].rsplit("/", 1)[-1]
+        with self._lock:
+            self.requests.append({"headers": headers, "json": json.loads(body), "token": token})
+        status, response_headers, response_body = self.responses.get(token, (200, {}, None))
+        response_headers = dict(response_headers)
+        response_headers.setdefault("apns-id", "00000000-0000-0000-0000-{:012d}".format(stream_id))
+        data = json.dumps(response_body).encode("utf-8") if response_body else b""
+        with sock_lock:
+            conn.send_headers(stream_id, [(":status", str(status))] + list(response_headers.items()),
+                              end_stream=not data)
+            if data:
+                conn.send_data(stream_id, data, end_stream=True)
+            sock.sendall(conn.data_to_send())
+        with self._lock:
+            self.open_streams -= 1
+
+    def _handle_connection(self, sock):
+        try:
+            sock = self._ssl_context.wrap_socket(sock, server_side=True)
+        except (OSError, ssl.SSLError):
+            return
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False,
+                                                                           header_encoding="utf-8"))
+        sock_lock = threading.Lock()
+        with sock_lock:
+            conn.initiate_connection()
+            sock.sendall(conn.data_to_send())
+        streams = {}
+        while True:
+            try:
+                data = sock.recv(65535)
+            except OSError:
+                return
+            if not data:
+                return
+            with sock_lock:
+                events = conn.receive_data(data)
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].append(event.data)
+                    with sock_lock:
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, chunks = streams.pop(event.stream_id)
+                    with self._lock:
+                        self.open_streams += 1
+                        self.max_open_streams = max(self.max_open_streams, self.open_streams)
+                    threading.Timer(self.response_delay, self._respond,
+                                    (conn, sock, sock_lock, event.stream_id, headers, b"".join(chunks))).start()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+            with sock_lock:
+                data_to_send = conn.data_to_send()
+                if data_to_send:
+                    sock.sendall(data_to_send)
@@ -0,0 +1,152 @@
+from email.utils import formatdate
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.mdm.apns import (APNSClient, APNSTarget,
+                                      deserialize_notification, parse_retry_after, serialize_notification)
+from .apns_server import FakeAPNSServer
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class APNSClientTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeAPNSServer()
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.server.requests = []
+        self.server.responses = {}
+        self.push_certificate = SimpleNamespace(
+            pk=1,
+            topic="com.apple.mgmt.{}".format(get_random_string(12)),
+            certificate=memoryview(self.server.certificate),
+            private_key=memoryview(self.server.private_key),
+        )
+        self.client = APNSClient(self.push_certificate,
+                                 base_url=self.server.base_url,
+                                 verify=self.server.get_client_ssl_context())
+
+    def tearDown(self):
+        self.client.client.close()
+
+    def build_target(self, user_id=None):
+        return APNSTarget(get_random_string(12), get_random_string(36), get_random_string(36),
+                          get_random_string(32).encode("utf-8"), user_id)
+
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_notifications(self, post_event):
+        targets = [self.build_target() for _ in range(30)]
+        targets.append(self.build_target(user_id=get_random_string(36)))
+        connection_count = self.server.connection_count
+        results = self.client.send_notifications(targets, priority=5)
+        self.assertEqual([(r.notification.target, r.status) for r in results],
+                         [(target, "success") for target in targets])
+        # one connection, multiplexed streams
+        self.assertEqual(self.server.connection_count, connection_count + 1)
+        self.assertGreater(self.server.max_open_streams, 1)
+        self.assertEqual(len(self.server.requests), len(targets))
+        request = [r for r in self.server.requests if r["token"] == targets[0].token.hex()][0]
+        self.assertEqual(request["headers"][":method"], "POST")
+        self.assertEqual(request["headers"]["apns-topic"], self.push_certificate.topic)
+        self.assertEqual(request["headers"]["apns-priority"], "5")
+        self.assertEqual(request["json"], {"mdm": targets[0].push_magic})
+        self.assertEqual(request["headers"]["apns-id"], results[0].notification.apns_id)
+        self.assertEqual(post_event.call_count, len(targets))
+        self.assertEqual(cache.get("zentral_mdm_apns_notification_attempts_1_total"), len(targets))
+
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_notifications_per_target_results(self, post_event):
+        targets = [self.build_target() for _ in range(3)]
+        self.server.responses[targets[1].token.hex()] = (400, {}, {"reason": "BadDeviceToken"})
+        results = self.client.send_notifications(targets)
+        self.assertEqual([(r.notification.target, r.status, r.status_code) for r in results],
+                         [(targets[0], "success", 200), (targets[1], "failure", 400), (targets[2], "success", 200)])
+        # no retries for the 4xx
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(cache.get("zentral_mdm_apns_notification_failures_1_total"), 1)
+
+    @patch("zentral.contrib.mdm.apns.time.sleep")
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_notifications_retries(self, post_event, sleep):
+        targets = [self.build_target() for _ in range(3)]
+        self.server.responses[targets[0].token.hex()] = (429, {"retry-after": "120"}, {"reason": "TooManyRequests"})
+        self.server.responses[targets[1].token.hex()] = (503, {}, {"reason": "ServiceUnavailable"})
+        results = self.client.send_notifications(targets)
+        sleep.assert_not_called()
+        self.assertEqual([r.status for r in results], ["retry", "retry", "success"])
+        # Retry-After honoured
+        self.assertGreaterEqual(results[0].retry_delay, 120)
+        self.assertTrue(self.client.retry_base_delay <= results[1].retry_delay <= 2 * self.client.retry_base_delay)
+        # events only for the final statuses
+        self.assertEqual(post_event.call_count, 1)
+        self.assertEqual(cache.get("zentral_mdm_apns_notification_attempts_1_total"), 3)
+        self.assertEqual(cache.get("zentral_mdm_apns_notification_throttles_1_total"), 1)
+        self.assertIsNone(cache.get("zentral_mdm_apns_notification_failures_1_total"))
+        # next attempt, with the serialized notifications, like in the retry task
+        self.server.responses = {}
+        self.server.requests = []
+        notifications = [deserialize_notification(serialize_notification(r.notification._replace(attempt=1)))
+                         for r in results[:2]]
+        self.assertEqual(notifications[0].target, targets[0])
+        retry_results = self.client.send_apns_notifications(notifications)
+        self.assertEqual([r.status for r in retry_results], ["success", "success"])
+        # same apns-id across the attempts
+        self.assertEqual(sorted(r["headers"]["apns-id"] for r in self.server.requests),
+                         sorted(r.notification.apns_id for r in results[:2]))
+        self.assertEqual(post_event.call_count, 3)
+
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_notifications_retries_exhausted(self, post_event):
+        target = self.build_target()
+        self.server.responses[target.token.hex()] = (500, {}, {"reason": "InternalServerError"})
+        notification = self.client.build_notifications([target])[0]._replace(attempt=self.client.max_retries)
+        results = self.client.send_apns_notifications([notification])
+        self.assertEqual(results[0].status, "failure")
+        self.assertEqual(cache.get("zentral_mdm_apns_notification_failures_1_total"), 1)
+        post_event.assert_called_once()
+
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_notifications_retry_after_expiration(self, post_event):
+        target = self.build_target()
+        self.server.responses[target.token.hex()] = (429, {"retry-after": "7200"}, {"reason": "TooManyRequests"})
+        results = self.client.send_notifications([target], expiration_seconds=3600)
+        self.assertEqual(results[0].status, "failure")
+
+    @patch("zentral.contrib.mdm.apns.MDMDeviceNotificationEvent.post")
+    def test_send_single_notification_no_retry(self, post_event):
+        target = self.build_target()
+        self.server.responses[target.token.hex()] = (503, {}, {"reason": "ServiceUnavailable"})
+        self.assertEqual(self.client._send_notification(target, 10, 3600), "failure")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_send_no_notifications(self):
+        self.assertEqual(self.client.send_notifications([]), [])
+
+
+class ParseRetryAfterTestCase(SimpleTestCase):
+    def test_empty(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("30"), 30)
+
+    def test_http_date(self):
+        self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 60, usegmt=True)), 60, delta=2)
+
+    def test_past_http_date(self):
+        self.assertEqual(parse_retry_after(formatdate(time.time() - 60, usegmt=True)), 0)
+
+    def test_invalid(self):
+        self.assertIsNone(parse_retry_after("yolo"))
@@ -0,0 +1,191 @@
+from datetime import datetime
+from unittest.mock import Mock, patch
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from zentral.contrib.mdm.apns import APNSNotification, APNSResult, serialize_notification
+from zentral.contrib.mdm.models import (Artifact, ArtifactType, Blueprint, BlueprintArtifact, Channel,
+                                        EnrolledDevice, EnrolledUser, Platform, PushCertificate)
+from zentral.contrib.mdm.tasks import (get_notification_targets,
+                                       send_blueprints_notifications_task,
+                                       send_enrolled_users_notifications_task,
+                                       send_notifications_retry_task)
+from zentral.contrib.mdm.utils import apns_notification_attempts_counter
+
+
+class MDMNotificationsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.push_certificate_1 = cls.create_push_certificate()
+        cls.push_certificate_2 = cls.create_push_certificate()
+        cls.blueprint_1 = Blueprint.objects.create(name=get_random_string(32))
+        cls.blueprint_2 = Blueprint.objects.create(name=get_random_string(32))
+        cls.artifact = Artifact.objects.create(
+            name=get_random_string(32),
+            type=ArtifactType.Profile.name,
+            channel=Channel.Device.name,
+            platforms=[Platform.macOS.name],
+        )
+        for blueprint in (cls.blueprint_1, cls.blueprint_2):
+            BlueprintArtifact.objects.create(blueprint=blueprint, artifact=cls.artifact)
+        cls.blueprint_3 = Blueprint.objects.create(name=get_random_string(32))
+        cls.enrolled_device_1 = cls.create_enrolled_device(cls.push_certificate_1, cls.blueprint_1)
+        cls.enrolled_user_1 = cls.create_enrolled_user(cls.enrolled_device_1)
+        cls.enrolled_user_2 = cls.create_enrolled_user(cls.enrolled_device_1)
+        cls.enrolled_device_2 = cls.create_enrolled_device(cls.push_certificate_2, cls.blueprint_2)
+        cls.enrolled_device_3 = cls.create_enrolled_device(cls.push_certificate_1, cls.blueprint_3)
+        # cannot be poked
+        cls.create_enrolled_device(cls.push_certificate_1, cls.blueprint_1, checkout_at=datetime.utcnow())
+        cls.create_enrolled_device(cls.push_certificate_1, cls.blueprint_1, token=None)
+
+    @staticmethod
+    def create_push_certificate():
+        return PushCertificate.objects.create(
+            name=get_random_string(64),
+            topic=get_random_string(256),
+            not_before=datetime(2000, 1, 1),
+            not_after=datetime(2050, 1, 1),
+            certificate=get_random_string(64).encode("utf-8"),
+            private_key=get_random_string(64).encode("utf-8")
+        )
+
+    @staticmethod
+    def create_enrolled_device(push_certificate, blueprint, **kwargs):
+        defaults = {"token": get_random_string(32).encode("utf-8")}
+        defaults.update(kwargs)
+        return EnrolledDevice.objects.create(
+            push_certificate=push_certificate,
+            blueprint=blueprint,
+            serial_number=get_random_string(64),
+            platform="macOS",
+            udid=get_random_string(36),
+            push_magic=get_random_string(73),
+            **defaults
+        )
+
+    @staticmethod
+    def create_enrolled_user(enrolled_device):
+        return EnrolledUser.objects.create(
+            enrolled_device=enrolled_device,
+            user_id=get_random_string(36),
+            long_name=get_random_string(12),
+            short_name=get_random_string(12),
+            token=get_random_string(32).encode("utf-8")
+        )
+
+    def get_target_keys(self, targets):
+        return {push_certificate_pk: sorted((t.udid, t.user_id or "") for t in push_certificate_targets)
+                for push_certificate_pk, push_certificate_targets in targets.items()}
+
+    def test_no_targets(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(get_notification_targets(), {})
+
+    def test_artifact_and_blueprint_targets(self):
+        with self.assertNumQueries(1):
+            targets = get_notification_targets(blueprint_pk_list=[self.blueprint_1.pk, self.blueprint_2.pk],
+                                               artifact_pk_list=[self.artifact.pk],
+                                               notify_users=True)
+        self.assertEqual(
+            self.get_target_keys(targets),
+            {self.push_certificate_1.pk: sorted([(self.enrolled_device_1.udid, ""),
+                                                 (self.enrolled_device_1.udid, self.enrolled_user_1.user_id),
+                                                 (self.enrolled_device_1.udid, self.enrolled_user_2.user_id)]),
+             self.push_certificate_2.pk: [(self.enrolled_device_2.udid, "")]}
+        )
+        user_target = [t for t in targets[self.push_certificate_1.pk] if t.user_id == self.enrolled_user_1.user_id][0]
+        self.assertEqual(user_target.token, self.enrolled_user_1.token)
+        self.assertEqual(user_target.push_magic, self.enrolled_device_1.push_magic)
+
+    def test_device_targets_without_users(self):
+        targets = get_notification_targets(enrolled_device_pk_list=[self.enrolled_device_1.pk,
+                                                                    self.enrolled_device_3.pk])
+        self.assertEqual(
+            self.get_target_keys(targets),
+            {self.push_certificate_1.pk: sorted([(self.enrolled_device_1.udid, ""),
+                                                 (self.enrolled_device_3.udid, "")])}
+        )
+
+    @staticmethod
+    def build_results(targets, status="success", retry_delay=None, attempt=0):
+        return [APNSResult(APNSNotification(target, get_random_string(36), 2000000000, attempt),
+                           status, 200 if status == "success" else 429, retry_delay)
+                for target in targets]
+
+    @patch("zentral.contrib.mdm.tasks.send_notifications_retry_task.apply_async")
+    @patch("zentral.contrib.mdm.tasks.get_apns_client")
+    def test_send_blueprints_notifications_task(self, get_apns_client, apply_async):
+        client = Mock()
+        client.send_notifications.side_effect = lambda targets: self.build_results(targets)
+        get_apns_client.return_value = client
+        send_blueprints_notifications_task([self.blueprint_1.pk, self.blueprint_2.pk, self.blueprint_3.pk])
+        self.assertEqual(get_apns_client.call_count, 2)
+        self.assertEqual(sorted(len(c.args[0]) for c in client.send_notifications.call_args_list), [1, 4])
+        apply_async.assert_not_called()
+
+    @patch("zentral.contrib.mdm.tasks.send_notifications_retry_task.apply_async")
+    @patch("zentral.contrib.mdm.tasks.get_apns_client")
+    def test_send_notifications_schedule_retries(self, get_apns_client, apply_async):
+        client = Mock()
+        client.send_notifications.side_effect = lambda targets: (self.build_results(targets[:1], "retry", 12.3)
+                                                                 + self.build_results(targets[1:], "retry", 3.1))
+        get_apns_client.return_value = client
+        send_blueprints_notifications_task([self.blueprint_1.pk])
+        # one delayed batch, with the longest retry delay
+        apply_async.assert_called_once()
+        (push_certificate_pk, serialized_notifications), = apply_async.call_args.args
+        self.assertEqual(push_certificate_pk, self.push_certificate_1.pk)
+        self.assertEqual(len(serialized_notifications), 3)
+        self.assertEqual(set(n["attempt"] for n in serialized_notifications), {1})
+        self.assertEqual(apply_async.call_args.kwargs, {"countdown": 13})
+
+    @patch("zentral.contrib.mdm.tasks.send_notifications_retry_task.apply_async")
+    @patch("zentral.contrib.mdm.tasks.get_apns_client")
+    def test_send_notifications_retry_task(self, get_apns_client, apply_async):
+        client = Mock()
+        client.send_apns_notifications.side_effect = lambda notifications: [
+            APNSResult(n, "success", 200, None) for n in notifications
+        ]
+        get_apns_client.return_value = client
+        notifications = [r.notification for r in self.build_results(
+            get_notification_targets(enrolled_device_pk_list=[self.enrolled_device_1.pk])[self.push_certificate_1.pk],
+            attempt=1
+        )]
+        send_notifications_retry_task(self.push_certificate_1.pk,
+                                      [serialize_notification(n) for n in notifications])
+        get_apns_client.assert_called_once_with(self.push_certificate_1)
+        self.assertEqual(list(client.send_apns_notifications.call_args.args[0]), notifications)
+        apply_async.assert_not_called()
+
+    @patch("zentral.contrib.mdm.tasks.get_apns_client")
+    def test_send_notifications_retry_task_unknown_push_certificate(self, get_apns_client):
+        send_notifications_retry_task(0, [])
+        get_apns_client.assert_not_called()
+
+    @patch("zentral.contrib.mdm.tasks.get_apns_client")
+    def test_send_enrolled_users_notifications_task(self, get_apns_client):
+        client = Mock()
+        client.send_notifications.side_effect = lambda targets: self.build_results(targets)
+        get_apns_client.return_value = client
+        send_enrolled_users_notifications_task([self.enrolled_user_1.pk, self.enrolled_user_2.pk])
+        get_apns_client.assert_called_once_with(self.push_certificate_1)
+        self.assertEqual(sorted(t.user_id for t in client.send_notifications.call_args.args[0]),
+                         sorted([self.enrolled_user_1.user_id, self.enrolled_user_2.user_id]))
+
+    def test_prometheus_metrics_403(self):
+        response = self.client.get(reverse("mdm:prometheus_metrics"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_prometheus_metrics_200(self):
+        cache.clear()
+        apns_notification_attempts_counter.inc(str(self.push_certificate_1.pk), 3)
+        response = self.client.get(reverse("mdm:prometheus_metrics"),
+                                   HTTP_AUTHORIZATION="Bearer CHANGE ME!!!")
+        self.assertContains(
+            response,
+            'zentral_mdm_apns_notification_attempts_total{{push_certificate="{}"}} 3.0'.format(
+                self.push_certificate_1.pk
+            ),
+            status_code=200
+        )
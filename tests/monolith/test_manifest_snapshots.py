@@ -0,0 +1,112 @@
+import plistlib
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
+from zentral.contrib.monolith.models import (Catalog, Manifest, ManifestCatalog, ManifestSnapshot,
+                                             ManifestSubManifest, PkgInfo, PkgInfoName, SubManifest)
+from zentral.contrib.monolith.snapshots import get_effective_tags, get_manifest_snapshot
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ManifestSnapshotsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.meta_business_unit = MetaBusinessUnit.objects.create(name=get_random_string(13))
+        cls.manifest = Manifest.objects.create(meta_business_unit=cls.meta_business_unit, name=get_random_string(13))
+        cls.catalog_1 = Catalog.objects.create(name=get_random_string(13))
+        cls.catalog_2 = Catalog.objects.create(name=get_random_string(13))
+        cls.tag_1 = Tag.objects.create(name=get_random_string(13))
+        cls.tag_2 = Tag.objects.create(name=get_random_string(13))
+        cls.tag_3 = Tag.objects.create(name=get_random_string(13))
+        ManifestCatalog.objects.create(manifest=cls.manifest, catalog=cls.catalog_1)
+        mc = ManifestCatalog.objects.create(manifest=cls.manifest, catalog=cls.catalog_2)
+        mc.tags.set([cls.tag_1])
+        cls.sub_manifest = SubManifest.objects.create(name=get_random_string(13))
+        msm = ManifestSubManifest.objects.create(manifest=cls.manifest, sub_manifest=cls.sub_manifest)
+        msm.tags.set([cls.tag_2])
+        for catalog in (cls.catalog_1, cls.catalog_2):
+            name = PkgInfoName.objects.create(name=get_random_string(13))
+            pkg_info = PkgInfo.objects.create(name=name, version="1.0", data={"name": name.name, "version": "1.0"})
+            pkg_info.catalogs.set([catalog])
+
+    def setUp(self):
+        cache.clear()
+
+    def get_manifest(self):
+        return Manifest.objects.get(pk=self.manifest.pk)
+
+    def test_effective_tags(self):
+        manifest = self.get_manifest()
+        self.assertEqual(get_effective_tags(manifest, [self.tag_3, self.tag_2, self.tag_1]),
+                         [self.tag_1, self.tag_2])
+        self.assertEqual(get_effective_tags(manifest, [self.tag_3]), [])
+
+    def test_catalog_snapshot(self):
+        manifest = self.get_manifest()
+        content, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [self.tag_1])
+        self.assertFalse(materialized)
+        self.assertEqual(content, manifest.serialize_catalog([self.tag_1]))
+        self.assertEqual(len(plistlib.loads(content)), 2)
+        content2, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [self.tag_1, self.tag_3])
+        self.assertTrue(materialized)
+        self.assertEqual(content2, content)
+        snapshot = ManifestSnapshot.objects.get(manifest=manifest)
+        self.assertEqual(snapshot.tag_set, [self.tag_1.pk])
+        self.assertEqual(snapshot.source_version, manifest.catalog_version)
+
+    def test_snapshot_from_db_after_cache_clear(self):
+        manifest = self.get_manifest()
+        content, _ = get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [self.tag_2])
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            content2, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [self.tag_2])
+        self.assertTrue(materialized)
+        self.assertEqual(content2, content)
+        self.assertFalse(any("INSERT" in q["sql"] for q in ctx.captured_queries))
+        self.assertIn(self.sub_manifest.get_munki_name(), plistlib.loads(content)["included_manifests"])
+
+    def test_unrelated_tags_share_the_snapshot(self):
+        manifest = self.get_manifest()
+        get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [])
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [self.tag_3])
+        self.assertTrue(materialized)
+        self.assertEqual(ManifestSnapshot.objects.filter(manifest=manifest).count(), 1)
+
+    def test_catalog_version_bump(self):
+        manifest = self.get_manifest()
+        get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [])
+        self.assertEqual(Manifest.objects.bump_catalog_versions([self.catalog_1]), 1)
+        manifest = self.get_manifest()
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        self.assertFalse(materialized)
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [])
+        self.assertTrue(materialized)
+        # previous catalog snapshot deleted
+        self.assertEqual(
+            list(ManifestSnapshot.objects.filter(manifest=manifest, document_type=ManifestSnapshot.CATALOG)
+                                         .values_list("source_version", flat=True)),
+            [manifest.catalog_version]
+        )
+
+    def test_version_bump_without_catalog(self):
+        manifest = self.get_manifest()
+        get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [])
+        manifest.bump_version(catalog=False)
+        manifest = self.get_manifest()
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        self.assertTrue(materialized)
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, [])
+        self.assertFalse(materialized)
+
+    def test_version_bump(self):
+        manifest = self.get_manifest()
+        get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        manifest.bump_version()
+        manifest = self.get_manifest()
+        _, materialized = get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, [])
+        self.assertFalse(materialized)
@@ -0,0 +1,220 @@
+from django.db import connection, transaction
+from django.test import SimpleTestCase
+from django.utils.crypto import get_random_string
+from hypothesis import HealthCheck, given, settings, strategies as st
+from hypothesis.extra.django import TestCase
+from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
+from zentral.contrib.monolith.models import (Catalog, Manifest, ManifestCatalog, ManifestSubManifest,
+                                             PkgInfo, PkgInfoName, RepositoryGeneration,
+                                             SubManifest, SubManifestPkgInfo)
+from zentral.contrib.monolith.pkginfo_graph import PkgInfoGraph, clear_pkginfo_graph, get_pkginfo_graph
+
+
+@st.composite
+def repositories(draw, max_names=8, max_catalogs=3):
+    name_count = draw(st.integers(1, max_names))
+    catalog_count = draw(st.integers(1, max_catalogs))
+    names = st.integers(0, name_count - 1)
+    pkginfos = draw(st.lists(st.tuples(names, st.integers(0, 3)), min_size=1, max_size=16, unique=True))
+    pkginfo_indexes = st.integers(0, len(pkginfos) - 1)
+    return {
+        "names": name_count,
+        "catalogs": catalog_count,
+        "pkginfos": pkginfos,
+        "requires": draw(st.lists(st.tuples(pkginfo_indexes, names), max_size=12, unique=True)),
+        "update_for": draw(st.lists(st.tuples(pkginfo_indexes, names), max_size=12, unique=True)),
+        "pkginfo_catalogs": draw(st.lists(st.tuples(pkginfo_indexes, st.integers(0, catalog_count - 1)),
+                                          max_size=24, unique=True)),
+    }
+
+
+def naive_deps_and_updates(repository, names, catalogs):
+    """Fixpoint of the recursive SQL query, on the pkginfo indexes"""
+    pkginfos = repository["pkginfos"]
+    rows = {i for i, (name, _) in enumerate(pkginfos) if name in names}
+    while True:
+        new_rows = set(rows)
+        for pkginfo, required_name in repository["requires"]:
+            if pkginfo in rows:
+                new_rows.update(i for i, (name, _) in enumerate(pkginfos) if name == required_name)
+        for pkginfo, updated_name in repository["update_for"]:
+            if any(pkginfos[i][0] == updated_name for i in rows):
+                new_rows.add(pkginfo)
+        if new_rows == rows:
+            break
+        rows = new_rows
+    return {i for i in rows
+            if any((i, catalog) in repository["pkginfo_catalogs"] for catalog in catalogs)}
+
+
+class PkgInfoGraphTestCase(SimpleTestCase):
+    def build_graph(self, repository):
+        # pkginfo id = index + 1, name id = index + 101, catalog id = index + 201
+        return PkgInfoGraph(
+            1,
+            [(i + 1, name + 101, f"name{name}") for i, (name, _) in enumerate(repository["pkginfos"])],
+            [(i + 1, name + 101) for i, name in repository["requires"]],
+            [(i + 1, name + 101) for i, name in repository["update_for"]],
+            [(i + 1, catalog + 201) for i, catalog in repository["pkginfo_catalogs"]],
+        )
+
+    def test_deps_and_updates(self):
+        graph = PkgInfoGraph(
+            1,
+            [(1, 11, "a"), (2, 12, "b"), (3, 12, "b"), (4, 13, "c"), (5, 14, "d")],
+            [(1, 12)],  # a requires b
+            [(4, 12)],  # c is an update for b
+            [(1, 21), (2, 21), (3, 22), (4, 21), (5, 21)],
+        )
+        self.assertEqual(graph.get_name_ids(["a", "z"]), {11})
+        self.assertEqual(graph.pkginfo_ids_with_deps_and_updates({11}, [21]), {1, 2, 4})
+        self.assertEqual(graph.pkginfo_ids_with_deps_and_updates({11}, [21, 22]), {1, 2, 3, 4})
+        self.assertEqual(graph.pkginfo_ids_with_deps_and_updates({13}, [21, 22]), {4})
+        self.assertEqual(graph.pkginfo_ids_with_deps_and_updates({11}, []), set())
+
+    @settings(max_examples=300, database=None)
+    @given(st.data())
+    def test_equivalence_with_naive_fixpoint(self, data):
+        repository = data.draw(repositories())
+        names = data.draw(st.sets(st.integers(0, repository["names"] - 1)))
+        catalogs = data.draw(st.sets(st.integers(0, repository["catalogs"] - 1)))
+        graph = self.build_graph(repository)
+        self.assertEqual(
+            graph.pkginfo_ids_with_deps_and_updates({name + 101 for name in names},
+                                                    [catalog + 201 for catalog in catalogs]),
+            {i + 1 for i in naive_deps_and_updates(repository, names, catalogs)}
+        )
+
+
+# the recursive SQL query previously used in the Manifest model, parametrized
+REFERENCE_QUERY = (
+    "WITH RECURSIVE pkginfos_with_deps_and_updates AS ( "
+    "SELECT pi.id as pi_id, pn.id AS pn_id "
+    "FROM monolith_pkginfo pi "
+    "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
+    "WHERE pn.name = ANY(%(names)s) "
+    "OR (%(sub_manifests)s AND pn.id IN ("
+    "  SELECT sm.pkg_info_name_id "
+    "  FROM monolith_submanifestpkginfo sm "
+    "  JOIN monolith_manifestsubmanifest ms ON (sm.sub_manifest_id=ms.sub_manifest_id) "
+    "  LEFT JOIN monolith_manifestsubmanifest_tags m2mt ON (ms.id=m2mt.manifestsubmanifest_id) "
+    "  WHERE ms.manifest_id = %(manifest_id)s "
+    "  AND (m2mt.tag_id IS NULL OR m2mt.tag_id = ANY(%(tag_ids)s)))) "
+    "UNION "
+    "SELECT pi.id, pn.id "
+    "FROM monolith_pkginfo pi "
+    "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
+    "LEFT JOIN monolith_pkginfo_requires pr ON (pr.pkginfoname_id=pn.id) "
+    "LEFT JOIN monolith_pkginfo_update_for pu ON (pu.pkginfo_id=pi.id) "
+    "JOIN pkginfos_with_deps_and_updates rec ON (pr.pkginfo_id=rec.pi_id OR pu.pkginfoname_id=rec.pn_id) "
+    ") "
+    "SELECT pi_id from pkginfos_with_deps_and_updates "
+    "JOIN monolith_pkginfo_catalogs pc ON (pi_id=pc.pkginfo_id) "
+    "JOIN monolith_manifestcatalog mc ON (pc.catalog_id=mc.catalog_id) "
+    "LEFT JOIN monolith_manifestcatalog_tags m2mt ON (mc.id=m2mt.manifestcatalog_id) "
+    "WHERE mc.manifest_id = %(manifest_id)s "
+    "AND (m2mt.tag_id IS NULL OR m2mt.tag_id = ANY(%(tag_ids)s));"
+)
+
+
+class PkgInfoGraphSQLEquivalenceTestCase(TestCase):
+    def reference_pkginfo_ids(self, manifest, tags, names=None, sub_manifests=False):
+        with connection.cursor() as cursor:
+            cursor.execute(REFERENCE_QUERY, {"names": list(names or []),
+                                             "sub_manifests": sub_manifests,
+                                             "manifest_id": manifest.pk,
+                                             "tag_ids": [t.pk for t in tags]})
+            return {t[0] for t in cursor.fetchall()}
+
+    def create_repository(self, data):
+        repository = data.draw(repositories())
+        names = [PkgInfoName.objects.create(name=get_random_string(13)) for _ in range(repository["names"])]
+        catalogs = [Catalog.objects.create(name=get_random_string(13)) for _ in range(repository["catalogs"])]
+        pkginfos = [PkgInfo.objects.create(name=names[name], version=str(version), data={})
+                    for name, version in repository["pkginfos"]]
+        PkgInfo.requires.through.objects.bulk_create(
+            PkgInfo.requires.through(pkginfo=pkginfos[i], pkginfoname=names[name])
+            for i, name in repository["requires"]
+        )
+        PkgInfo.update_for.through.objects.bulk_create(
+            PkgInfo.update_for.through(pkginfo=pkginfos[i], pkginfoname=names[name])
+            for i, name in repository["update_for"]
+        )
+        PkgInfo.catalogs.through.objects.bulk_create(
+            PkgInfo.catalogs.through(pkginfo=pkginfos[i], catalog=catalogs[catalog])
+            for i, catalog in repository["pkginfo_catalogs"]
+        )
+        # archived pkginfos are part of the graph
+        for i in data.draw(st.sets(st.integers(0, len(pkginfos) - 1))):
+            PkgInfo.objects.filter(pk=pkginfos[i].pk).update(archived_at="2021-01-01T00:00:00")
+        RepositoryGeneration.objects.bump()
+        return names, catalogs
+
+    def create_manifest(self, data, names, catalogs):
+        tags = [Tag.objects.create(name=get_random_string(13)) for _ in range(3)]
+        tag_subsets = st.sets(st.sampled_from(tags), max_size=2)
+        meta_business_unit = MetaBusinessUnit.objects.create(name=get_random_string(13))
+        manifest = Manifest.objects.create(meta_business_unit=meta_business_unit, name=get_random_string(13))
+        for catalog in data.draw(st.sets(st.sampled_from(catalogs))):
+            mc = ManifestCatalog.objects.create(manifest=manifest, catalog=catalog)
+            mc.tags.set(data.draw(tag_subsets))
+        for _ in range(data.draw(st.integers(0, 2))):
+            sub_manifest = SubManifest.objects.create(name=get_random_string(13))
+            for name in data.draw(st.sets(st.sampled_from(names), max_size=3)):
+                SubManifestPkgInfo.objects.create(sub_manifest=sub_manifest, key="managed_installs",
+                                                  pkg_info_name=name)
+            msm = ManifestSubManifest.objects.create(manifest=manifest, sub_manifest=sub_manifest)
+            msm.tags.set(data.draw(tag_subsets))
+        return manifest, list(data.draw(tag_subsets))
+
+    @settings(max_examples=50, deadline=None, database=None, suppress_health_check=[HealthCheck.too_slow])
+    @given(st.data())
+    def test_sub_manifest_pkginfos_equivalence(self, data):
+        # the generation is rolled back with each example
+        clear_pkginfo_graph()
+        names, catalogs = self.create_repository(data)
+        manifest, tags = self.create_manifest(data, names, catalogs)
+        self.assertEqual(
+            {pi.pk for pi in manifest.pkginfos_with_deps_and_updates(tags)},
+            self.reference_pkginfo_ids(manifest, tags, sub_manifests=True)
+        )
+
+    @settings(max_examples=50, deadline=None, database=None, suppress_health_check=[HealthCheck.too_slow])
+    @given(st.data())
+    def test_package_names_equivalence(self, data):
+        clear_pkginfo_graph()
+        names, catalogs = self.create_repository(data)
+        manifest, tags = self.create_manifest(data, names, catalogs)
+        package_names = [n.name for n in data.draw(st.sets(st.sampled_from(names)))] + [get_random_string(13)]
+        self.assertEqual(
+            {pi.pk for pi in manifest._pkginfo_deps_and_updates(tags, package_names=package_names)},
+            self.reference_pkginfo_ids(manifest, tags, names=package_names)
+        )
+
+    def test_graph_generation(self):
+        clear_pkginfo_graph()
+        graph = get_pkginfo_graph()
+        self.assertIs(get_pkginfo_graph(), graph)
+        name = PkgInfoName.objects.create(name=get_random_string(13))
+        PkgInfo.objects.create(name=name, version="1.0", data={})
+        self.assertEqual(get_pkginfo_graph().get_name_ids([name.name]), set())
+        RepositoryGeneration.objects.bump()
+        new_graph = get_pkginfo_graph()
+        self.assertEqual(new_graph.generation, graph.generation + 1)
+        self.assertEqual(new_graph.get_name_ids([name.name]), {name.pk})
+
+    def test_graph_generation_rollback(self):
+        clear_pkginfo_graph()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                RepositoryGeneration.objects.bump()
+                rolled_back_graph = get_pkginfo_graph()
+                raise ValueError("rollback")
+        name = PkgInfoName.objects.create(name=get_random_string(13))
+        PkgInfo.objects.create(name=name, version="1.0", data={})
+        # same generation number as the rolled back one, different content
+        RepositoryGeneration.objects.bump()
+        graph = get_pkginfo_graph()
+        self.assertEqual(graph.generation, rolled_back_graph.generation)
+        self.assertIsNot(graph, rolled_back_graph)
+        self.assertEqual(graph.get_name_ids([name.name]), {name.pk})
@@ -0,0 +1,176 @@
+import os
+import plistlib
+import tempfile
+from unittest.mock import patch
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MetaBusinessUnit
+from zentral.contrib.monolith.models import (Catalog, Manifest, ManifestCatalog, PkgInfo, PkgInfoCategory,
+                                             PkgInfoName, RepositoryGeneration)
+from zentral.contrib.monolith.pkginfo_graph import clear_pkginfo_graph, get_pkginfo_graph
+from zentral.contrib.monolith.repository_backends.local import Repository
+
+
+class Rollback(Exception):
+    pass
+
+
+class MonolithRepositorySyncTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp_dir.name, "catalogs"))
+        self.repository = Repository({"root": self.tmp_dir.name})
+        self.prefix = get_random_string(8)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build_pkg_info_data(self, i, version="1.0", catalogs=None, **kwargs):
+        pkg_info_data = {"name": "{}_{}".format(self.prefix, i),
+                         "version": version,
+                         "catalogs": catalogs or ["{}_production".format(self.prefix)],
+                         "installer_item_location": "{}_{}-{}.pkg".format(self.prefix, i, version)}
+        pkg_info_data.update(kwargs)
+        return pkg_info_data
+
+    def write_repository(self, pkg_info_data_list):
+        with open(self.repository.get_all_catalog_local_path(), "wb") as f:
+            plistlib.dump(pkg_info_data_list, f)
+
+    def sync(self, pkg_info_data_list):
+        self.write_repository(pkg_info_data_list)
+        with patch("zentral.contrib.monolith.repository_backends.base.post_monolith_repository_updates") as post:
+            summary = self.repository.sync_catalogs()
+        self.event_payloads = post.call_args[0][1]
+        return summary
+
+    def build_repository(self, count):
+        return [self.build_pkg_info_data(i,
+                                         requires=["{}_{}".format(self.prefix, i - 1)] if i else [],
+                                         category="{} category".format(self.prefix))
+                for i in range(count)]
+
+    def test_initial_sync(self):
+        generation = RepositoryGeneration.objects.current()
+        summary = self.sync(self.build_repository(10))
+        self.assertEqual(summary["catalogs"], {"added": 1, "unarchived": 0, "archived": 0})
+        self.assertEqual(summary["pkg_infos"], {"added": 10, "updated": 0, "archived": 0, "unchanged": 0})
+        catalog = Catalog.objects.get(name="{}_production".format(self.prefix))
+        self.assertEqual(summary["catalog_ids"], [catalog.pk])
+        self.assertEqual(len(summary["pkg_info_name_ids"]), 10)
+        pkg_info = PkgInfo.objects.get(name__name="{}_3".format(self.prefix), version="1.0")
+        self.assertEqual([c.pk for c in pkg_info.catalogs.all()], [catalog.pk])
+        self.assertEqual([pn.name for pn in pkg_info.requires.all()], ["{}_2".format(self.prefix)])
+        self.assertEqual(pkg_info.category, PkgInfoCategory.objects.get(name="{} category".format(self.prefix)))
+        self.assertEqual(len(pkg_info.data_sha256), 64)
+        self.assertEqual(RepositoryGeneration.objects.current(), generation + 1)
+        self.assertEqual(sorted(p["type"] for p in self.event_payloads),
+                         ["catalog", "category"] + 10 * ["pkg_info"])
+
+    def test_noop_sync(self):
+        pkg_info_data_list = self.build_repository(10)
+        self.sync(pkg_info_data_list)
+        generation = RepositoryGeneration.objects.current()
+        with CaptureQueriesContext(connection) as ctx:
+            summary = self.sync(pkg_info_data_list)
+        self.assertEqual(summary["pkg_infos"], {"added": 0, "updated": 0, "archived": 0, "unchanged": 10})
+        self.assertEqual(summary["catalog_ids"], [])
+        self.assertEqual(summary["pkg_info_name_ids"], [])
+        self.assertEqual(self.event_payloads, [])
+        self.assertEqual(RepositoryGeneration.objects.current(), generation)
+        self.assertFalse(any(q["sql"].startswith(("INSERT", "UPDATE", "DELETE")) for q in ctx.captured_queries))
+
+    def test_sync_query_count_does_not_depend_on_the_repository_size(self):
+        query_counts = []
+        for count in (10, 100):
+            try:
+                with transaction.atomic():
+                    pkg_info_data_list = self.build_repository(count)
+                    with CaptureQueriesContext(connection) as ctx:
+                        self.sync(pkg_info_data_list)
+                    initial_sync_query_count = len(ctx.captured_queries)
+                    for pkg_info_data in pkg_info_data_list[::2]:
+                        pkg_info_data["description"] = "updated"
+                    with CaptureQueriesContext(connection) as ctx:
+                        summary = self.sync(pkg_info_data_list[1:])
+                    self.assertEqual(summary["pkg_infos"]["updated"], count // 2 - 1)
+                    self.assertEqual(summary["pkg_infos"]["archived"], 1)
+                    query_counts.append((initial_sync_query_count, len(ctx.captured_queries)))
+                    raise Rollback
+            except Rollback:
+                pass
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_sync_pkginfo_graph(self):
+        clear_pkginfo_graph()
+        self.sync(self.build_repository(2))
+        graph = get_pkginfo_graph()
+        name = "{}_2".format(self.prefix)
+        self.assertEqual(graph.get_name_ids([name]), set())
+        pkg_info_data_list = self.build_repository(3)
+        self.sync(pkg_info_data_list)
+        new_graph = get_pkginfo_graph()
+        self.assertIsNot(new_graph, graph)
+        self.assertEqual(new_graph.get_name_ids([name]), {PkgInfoName.objects.get(name=name).pk})
+        # no changes, same graph
+        self.sync(pkg_info_data_list)
+        self.assertIs(get_pkginfo_graph(), new_graph)
+
+    def test_update_sync(self):
+        pkg_info_data_list = self.build_repository(5)
+        self.sync(pkg_info_data_list)
+        meta_business_unit = MetaBusinessUnit.objects.create(name=get_random_string(13))
+        manifest = Manifest.objects.create(meta_business_unit=meta_business_unit, name=get_random_string(13))
+        production = Catalog.objects.get(name="{}_production".format(self.prefix))
+        ManifestCatalog.objects.create(manifest=manifest, catalog=production)
+        other_manifest = Manifest.objects.create(meta_business_unit=meta_business_unit, name=get_random_string(13))
+        # new catalog, new requires, new update_for, archived pkg info
+        pkg_info_data_list[1]["catalogs"] = ["{}_testing".format(self.prefix)]
+        pkg_info_data_list[2]["requires"] = ["{}_4".format(self.prefix)]
+        pkg_info_data_list[3]["update_for"] = ["{}_0".format(self.prefix)]
+        summary = self.sync(pkg_info_data_list[:4])
+        self.assertEqual(summary["catalogs"], {"added": 1, "unarchived": 0, "archived": 0})
+        self.assertEqual(summary["pkg_infos"], {"added": 0, "updated": 3, "archived": 1, "unchanged": 1})
+        testing = Catalog.objects.get(name="{}_testing".format(self.prefix))
+        self.assertEqual(summary["catalog_ids"], sorted([production.pk, testing.pk]))
+        pkg_info_1 = PkgInfo.objects.get(name__name="{}_1".format(self.prefix))
+        self.assertEqual(list(pkg_info_1.catalogs.all()), [testing])
+        pkg_info_2 = PkgInfo.objects.get(name__name="{}_2".format(self.prefix))
+        self.assertEqual([pn.name for pn in pkg_info_2.requires.all()], ["{}_4".format(self.prefix)])
+        pkg_info_3 = PkgInfo.objects.get(name__name="{}_3".format(self.prefix))
+        self.assertEqual([pn.name for pn in pkg_info_3.update_for.all()], ["{}_0".format(self.prefix)])
+        pkg_info_4 = PkgInfo.objects.get(name__name="{}_4".format(self.prefix))
+        self.assertIsNotNone(pkg_info_4.archived_at)
+        pkg_info_1_event_payload = [p for p in self.event_payloads
+                                    if p["type"] == "pkg_info" and p["pkg_info"]["name"] == pkg_info_1.name.name][0]
+        self.assertEqual(pkg_info_1_event_payload["action"], "updated")
+        self.assertEqual(pkg_info_1_event_payload["pkg_info"]["diff"]["catalogs"],
+                         {"added": ["{}_testing".format(self.prefix)],
+                          "removed": ["{}_production".format(self.prefix)]})
+        # only the manifests connected to the changed catalogs are bumped
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.catalog_version, 2)
+        other_manifest.refresh_from_db()
+        self.assertEqual(other_manifest.catalog_version, 1)
+
+    def test_unarchive_sync(self):
+        pkg_info_data_list = self.build_repository(3)
+        self.sync(pkg_info_data_list)
+        summary = self.sync(pkg_info_data_list[:2])
+        self.assertEqual(summary["catalogs"], {"added": 0, "unarchived": 0, "archived": 0})
+        self.assertEqual(summary["pkg_infos"], {"added": 0, "updated": 0, "archived": 1, "unchanged": 2})
+        summary = self.sync(pkg_info_data_list)
+        self.assertEqual(summary["pkg_infos"], {"added": 1, "updated": 0, "archived": 0, "unchanged": 2})
+        self.assertIsNone(PkgInfo.objects.get(name__name="{}_2".format(self.prefix)).archived_at)
+        self.assertEqual([(p["type"], p["action"]) for p in self.event_payloads], [("pkg_info", "added")])
+
+    def test_missing_data_sha256(self):
+        pkg_info_data_list = self.build_repository(3)
+        self.sync(pkg_info_data_list)
+        PkgInfo.objects.filter(name__name__startswith=self.prefix).update(data_sha256="")
+        summary = self.sync(pkg_info_data_list)
+        self.assertEqual(summary["pkg_infos"], {"added": 0, "updated": 0, "archived": 0, "unchanged": 3})
+        self.assertEqual(self.event_payloads, [])
+        self.assertFalse(PkgInfo.objects.filter(name__name__startswith=self.prefix, data_sha256="").exists())
@@ -577,6 +577,14 @@ class APIViewsTestCase(TestCase):
                              include_token=True)
         self.assertEqual(response.status_code, 403)
 
+    def test_export_distributed_query_results_unknown_format(self):
+        dq = self._force_distributed_query()
+        self.set_permissions("osquery.view_distributedqueryresult")
+        response = self.post(reverse("osquery_api:export_distributed_query_results", args=(dq.pk,))
+                             + "?export_format=yolo",
+                             include_token=True)
+        self.assertEqual(response.status_code, 400)
+
     def test_export_distributed_query_results_ok(self):
         dq = self._force_distributed_query()
         self.set_permissions("osquery.view_distributedqueryresult")
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from zentral.contrib.osquery.distributed_query_index import IndexedDistributedQuery, ServedDistributedQueries
+
+
+def build_indexed_distributed_query(pk, tag_ids=(), **kwargs):
+    dq_kwargs = {"pk": pk,
+                 "sql": "select 1;",
+                 "valid_from": datetime(2021, 1, 1),
+                 "valid_until": None,
+                 "platforms": [],
+                 "serial_numbers": [],
+                 "tags": SimpleNamespace(all=lambda: [SimpleNamespace(pk=tag_id) for tag_id in tag_ids]),
+                 "minimum_osquery_version_tuple": (0, 0, 0),
+                 "shard": 100}
+    dq_kwargs.update(kwargs)
+    return IndexedDistributedQuery(SimpleNamespace(**dq_kwargs))
+
+
+def build_enrolled_machine(serial_number="0123456789", osquery_version_tuple=(4, 7, 0)):
+    return SimpleNamespace(serial_number=serial_number, osquery_version_tuple=osquery_version_tuple)
+
+
+class IndexedDistributedQueryTestCase(SimpleTestCase):
+    def test_is_active(self):
+        query = build_indexed_distributed_query(1, valid_until=datetime(2021, 2, 1))
+        self.assertFalse(query.is_active(datetime(2020, 12, 31)))
+        self.assertTrue(query.is_active(datetime(2021, 1, 15)))
+        self.assertTrue(query.is_active(datetime(2021, 2, 1)))
+        self.assertFalse(query.is_active(datetime(2021, 2, 1) + timedelta(seconds=1)))
+
+    def test_matches(self):
+        enrolled_machine = build_enrolled_machine()
+
+        def get_machine_tag_ids():
+            return {1}
+
+        self.assertTrue(build_indexed_distributed_query(1).matches(enrolled_machine, {"darwin"}, get_machine_tag_ids))
+        for kwargs in ({"platforms": ["linux"]},
+                       {"serial_numbers": ["abcdef"]},
+                       {"minimum_osquery_version_tuple": (4, 8, 0)},
+                       {"tag_ids": [2]}):
+            self.assertFalse(
+                build_indexed_distributed_query(1, **kwargs).matches(enrolled_machine, {"darwin"}, get_machine_tag_ids)
+            )
+        for kwargs in ({"platforms": ["darwin", "linux"]},
+                       {"serial_numbers": ["0123456789"]},
+                       {"minimum_osquery_version_tuple": (4, 7, 0)},
+                       {"tag_ids": [1, 2]}):
+            self.assertTrue(
+                build_indexed_distributed_query(1, **kwargs).matches(enrolled_machine, {"darwin"}, get_machine_tag_ids)
+            )
+
+    def test_machine_tags_not_fetched(self):
+        def get_machine_tag_ids():
+            raise AssertionError("machine tags fetched")
+
+        query = build_indexed_distributed_query(1, platforms=["linux"], tag_ids=[1])
+        self.assertFalse(query.matches(build_enrolled_machine(), {"darwin"}, get_machine_tag_ids))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ServedDistributedQueriesTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_empty(self):
+        served = ServedDistributedQueries.load("0123456789")
+        self.assertNotIn(1, served)
+        self.assertNotIn(0, served)
+
+    def test_add_save_load(self):
+        served = ServedDistributedQueries.load("0123456789")
+        for pk in (1000, 1002, 998):
+            served.add(pk)
+        self.assertEqual(served.offset, 998)
+        served.save(999)
+        served = ServedDistributedQueries.load("0123456789")
+        self.assertEqual(served.offset, 999)
+        self.assertEqual(served.bitmap, 0b1010)
+        self.assertNotIn(998, served)  # below the offset → to be verified in the DB
+        self.assertNotIn(999, served)
+        self.assertIn(1000, served)
+        self.assertNotIn(1001, served)
+        self.assertIn(1002, served)
+        self.assertNotIn(100000, served)
+        self.assertNotIn(1000, ServedDistributedQueries.load("9876543210"))
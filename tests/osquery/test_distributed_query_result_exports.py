@@ -0,0 +1,69 @@
+import csv
+from datetime import datetime
+import json
+import os
+from unittest import skipIf
+from django.test import TestCase
+from zentral.contrib.osquery.models import DistributedQuery, DistributedQueryResult
+from zentral.contrib.osquery import tasks
+
+
+class DistributedQueryResultExportsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dq = DistributedQuery.objects.create(sql="select * from users;",
+                                                 valid_from=datetime.utcnow(),
+                                                 query_version=1)
+        DistributedQueryResult.objects.bulk_create([
+            DistributedQueryResult(distributed_query=cls.dq, serial_number="0123456789",
+                                   row={"username": "godzilla", "uid": "501"}),
+            DistributedQueryResult(distributed_query=cls.dq, serial_number="9876543210",
+                                   row={"username": "mothra", "shell": "/bin/zsh"}),
+        ])
+        DistributedQuery.objects.add_result_columns(cls.dq.pk, {"username", "uid"})
+        DistributedQuery.objects.add_result_columns(cls.dq.pk, {"username", "shell"})
+        cls.dq.refresh_from_db()
+
+    def read_and_unlink(self, filepath, mode="r"):
+        with open(filepath, mode) as f:
+            content = f.read()
+        os.unlink(filepath)
+        return content
+
+    def test_result_columns(self):
+        self.assertEqual(self.dq.result_columns(), ["shell", "uid", "username"])
+
+    def test_iter_dqr_rows(self):
+        self.assertEqual(list(tasks._iter_dqr_rows(self.dq)),
+                         [("0123456789", {"username": "godzilla", "uid": "501"}),
+                          ("9876543210", {"username": "mothra", "shell": "/bin/zsh"})])
+
+    def test_csv_export(self):
+        content = self.read_and_unlink(tasks._export_dqr_to_tmp_csv_file(self.dq))
+        self.assertEqual(list(csv.reader(content.splitlines())),
+                         [["serial number", "shell", "uid", "username"],
+                          ["0123456789", "", "501", "godzilla"],
+                          ["9876543210", "/bin/zsh", "", "mothra"]])
+
+    def test_ndjson_export(self):
+        content = self.read_and_unlink(tasks._export_dqr_to_tmp_ndjson_file(self.dq))
+        self.assertEqual([json.loads(line) for line in content.splitlines()],
+                         [{"serial_number": "0123456789", "row": {"username": "godzilla", "uid": "501"}},
+                          {"serial_number": "9876543210", "row": {"username": "mothra", "shell": "/bin/zsh"}}])
+
+    @skipIf(tasks.pyarrow is None, "pyarrow not available")
+    def test_parquet_export(self):
+        filepath = tasks._export_dqr_to_tmp_parquet_file(self.dq)
+        table = tasks.pyarrow.parquet.read_table(filepath)
+        os.unlink(filepath)
+        self.assertEqual(table.to_pydict(),
+                         {"serial number": ["0123456789", "9876543210"],
+                          "shell": [None, "/bin/zsh"],
+                          "uid": ["501", None],
+                          "username": ["godzilla", "mothra"]})
+
+    @skipIf(tasks.pyarrow is not None, "pyarrow available")
+    def test_parquet_export_not_available(self):
+        self.assertNotIn("parquet", tasks.DQR_EXPORT_FORMATS)
+        with self.assertRaises(ValueError):
+            tasks._export_distributed_query_results(self.dq, ".parquet")
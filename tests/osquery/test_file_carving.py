@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+import uuid
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.osquery.file_carving import (build_file_carving_session_archive_file,
+                                                  iter_file_carving_session_blocks)
+from zentral.contrib.osquery.models import FileCarvingBlock, FileCarvingSession
+from zentral.contrib.osquery.tasks import build_file_carving_session_archive
+
+
+class FileCarvingArchiveTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def force_file_carving_session(self, block_count=5):
+        session = FileCarvingSession.objects.create(
+            id=uuid.uuid4(),
+            serial_number=get_random_string(),
+            carve_guid=str(uuid.uuid4()),
+            carve_size=block_count * 4,
+            block_size=4,
+            block_count=block_count,
+        )
+        # blocks uploaded out of order
+        for block_id in reversed(range(block_count)):
+            block = FileCarvingBlock(file_carving_session=session, block_id=block_id)
+            block.file.save(str(block_id), ContentFile("{:04d}".format(block_id).encode("utf-8")))
+        return session
+
+    def test_iter_blocks_in_order(self):
+        session = self.force_file_carving_session()
+        self.assertEqual(list(iter_file_carving_session_blocks(session, max_workers=3, window_size=2)),
+                         [b"0000", b"0001", b"0002", b"0003", b"0004"])
+
+    def test_build_archive_file(self):
+        session = self.force_file_carving_session()
+        name, size = build_file_carving_session_archive_file(session, window_size=1)
+        self.assertTrue(name.endswith(f"{session}/archive.tar"))
+        self.assertEqual(size, 20)
+
+    def test_build_file_carving_session_archive(self):
+        session = self.force_file_carving_session()
+        build_file_carving_session_archive(str(session.pk))
+        session.refresh_from_db()
+        self.assertTrue(session.archive.name.endswith(f"{session}/archive.tar"))
+        with session.archive.open("rb") as f:
+            self.assertEqual(f.read(), b"00000001000200030004")
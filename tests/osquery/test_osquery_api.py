@@ -1,13 +1,19 @@
 from datetime import datetime
 import json
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
 from django.urls import reverse
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
-from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot, MetaBusinessUnit
+from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot, MachineTag, MetaBusinessUnit, Tag
 from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
-from zentral.contrib.osquery.models import (Configuration,
+from zentral.contrib.osquery.distributed_query_index import distributed_query_index, ServedDistributedQueries
+from zentral.contrib.osquery.models import (Configuration, ConfigurationPack,
                                             DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
-                                            EnrolledMachine, Enrollment)
+                                            EnrolledMachine, Enrollment, FileCategory, Pack, PackQuery, Query)
+from zentral.contrib.osquery.preprocessors import OsqueryLogPreprocessor
 
 
 INVENTORY_QUERY_SNAPSHOT = [
@@ -147,6 +153,10 @@ class OsqueryAPIViewsTestCase(TestCase):
         cls.enrollment2 = Enrollment.objects.create(configuration=cls.configuration,
                                                     secret=enrollment_secret2)
 
+    def setUp(self):
+        # the DB changes of the previous tests are rolled back
+        distributed_query_index.clear()
+
     # utiliy methods
 
     def post_as_json(self, url_name, data):
@@ -300,6 +310,36 @@ class OsqueryAPIViewsTestCase(TestCase):
         schedule = json_response["schedule"]
         self.assertIn(INVENTORY_QUERY_NAME, schedule)
 
+    def test_config_cached(self):
+        em = self.force_enrolled_machine()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertNotIn("packs", response.json())
+        with CaptureQueriesContext(connection) as ctx:
+            response2 = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual(response2.content, response.content)
+        self.assertFalse(any("osquery_configurationpack" in q["sql"] for q in ctx.captured_queries))
+        # new pack → new configuration
+        pack = Pack.objects.create(name=get_random_string(), slug=get_random_string())
+        query = Query.objects.create(name=get_random_string(), sql="select 1 from processes;")
+        PackQuery.objects.create(pack=pack, query=query, interval=60, slug=get_random_string())
+        ConfigurationPack.objects.create(configuration=self.configuration, pack=pack)
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["packs"].keys()), [pack.configuration_key()])
+        # updated query → new configuration
+        query.sql = "select 2 from processes;"
+        query.save()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual([q["query"] for q in response.json()["packs"][pack.configuration_key()]["queries"].values()],
+                         ["select 2 from processes;"])
+        # new file category → new configuration
+        file_category = FileCategory.objects.create(name=get_random_string(), slug=get_random_string(),
+                                                    file_paths=["/home/%%"])
+        self.configuration.file_categories.add(file_category)
+        file_category.save()
+        response = self.post_as_json("config", {"node_key": em.node_key})
+        self.assertEqual(response.json()["file_paths"], {file_category.slug: ["/home/%%"]})
+
     def test_osx_app_instance_schedule(self):
         em = self.force_enrolled_machine()
         self.post_default_inventory_query_snapshot(em.node_key, platform="macos")
@@ -423,6 +463,53 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {"queries": {}})
         self.assertEqual(dqm_qs.count(), 2)
 
+    def test_distributed_read_no_db_queries(self):
+        em = self.force_enrolled_machine(osquery_version="17.0.0", platform_mask=21)
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        DistributedQuery.objects.create(sql="select username from users;",
+                                        platforms=["linux"],  # wrong platform
+                                        valid_from=datetime.utcnow(),
+                                        query_version=1)
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["queries"].values()), [dq.sql])
+        self.assertIn(dq.pk, ServedDistributedQueries.load(em.serial_number))
+        # index loaded, query already served → no distributed query DB queries
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        self.assertFalse(any("osquery_distributedquery" in q["sql"] for q in ctx.captured_queries))
+        # served queries evicted from the cache → verified in the DB
+        cache.delete(ServedDistributedQueries.get_cache_key(em.serial_number))
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+        self.assertEqual(DistributedQueryMachine.objects.filter(serial_number=em.serial_number).count(), 1)
+
+    def test_distributed_read_tags_and_serial_numbers(self):
+        em = self.force_enrolled_machine()
+        tag = Tag.objects.create(name=get_random_string())
+        dq = DistributedQuery.objects.create(sql="select 1;", valid_from=datetime.utcnow(), query_version=1)
+        dq.tags.add(tag)
+        dq2 = DistributedQuery.objects.create(sql="select 2;", valid_from=datetime.utcnow(), query_version=1,
+                                              serial_numbers=[em.serial_number])
+        DistributedQuery.objects.create(sql="select 3;", valid_from=datetime.utcnow(), query_version=1,
+                                        serial_numbers=[get_random_string()])
+        distributed_query_index.clear()  # tags added after the save
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["queries"].values()), [dq2.sql])
+        MachineTag.objects.create(serial_number=em.serial_number, tag=tag)
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(list(response.json()["queries"].values()), [dq.sql])
+
+    def test_distributed_read_halted_query(self):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select 1;", valid_from=datetime.utcnow(), query_version=1)
+        dq.valid_until = datetime.utcnow()
+        dq.save()
+        response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+        self.assertEqual(response.json(), {"queries": {}})
+
     def test_distributed_write_405(self):
         response = self.client.get(reverse("osquery:distributed_write"))
         self.assertEqual(response.status_code, 405)
@@ -453,6 +540,40 @@ class OsqueryAPIViewsTestCase(TestCase):
         dqr_qs = DistributedQueryResult.objects.filter(distributed_query=dq, serial_number=em.serial_number)
         self.assertEqual(dqr_qs.count(), 1)
         self.assertEqual(dqr_qs.first().row, {"username": "godzilla"})
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_column_names, ["username"])
+
+    def test_distributed_write_result_columns(self):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select * from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        self.post_as_json("distributed_write",
+                          {"node_key": em.node_key,
+                           "queries": {str(dqm.pk): [{"username": "godzilla", "uid": "501"},
+                                                     {"username": "mothra", "shell": "/bin/zsh"}]},
+                           "statuses": {str(dqm.pk): 0}})
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_column_names, ["shell", "uid", "username"])
+        self.assertEqual(dq.result_columns(), ["shell", "uid", "username"])
+        # new column merged
+        em2 = self.force_enrolled_machine()
+        dqm2 = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em2.serial_number)
+        self.post_as_json("distributed_write",
+                          {"node_key": em2.node_key,
+                           "queries": {str(dqm2.pk): [{"username": "ghidorah", "description": "yolo"}]},
+                           "statuses": {str(dqm2.pk): 0}})
+        dq.refresh_from_db()
+        self.assertEqual(dq.result_column_names, ["description", "shell", "uid", "username"])
+        # not overwritten by a distributed query update
+        stale_dq = DistributedQuery.objects.get(pk=dq.pk)
+        stale_dq.result_column_names = []
+        stale_dq.shard = 50
+        stale_dq.save()
+        dq.refresh_from_db()
+        self.assertEqual(dq.shard, 50)
+        self.assertEqual(dq.result_column_names, ["description", "shell", "uid", "username"])
 
     # log
 
@@ -548,3 +669,60 @@ class OsqueryAPIViewsTestCase(TestCase):
         response = self.post_as_json("log", post_data)
         json_response = response.json()
         self.assertEqual(json_response, {})
+
+    @patch("zentral.contrib.osquery.views.api.get_log_processing_mode")
+    @patch("zentral.contrib.osquery.events.queues.post_raw_event")
+    def test_log_default_inventory_query_async(self, post_raw_event, get_log_processing_mode):
+        get_log_processing_mode.return_value = "async"
+        em = self.force_enrolled_machine()
+        response = self.post_default_inventory_query_snapshot(em.node_key, platform="macos", with_app=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {})
+        # nothing committed by the view
+        self.assertFalse(MachineSnapshot.objects.current().filter(serial_number=em.serial_number).exists())
+        post_raw_event.assert_called_once()
+        routing_key, raw_event = post_raw_event.call_args[0]
+        self.assertEqual(routing_key, "osquery_logs")
+        self.assertEqual(raw_event["serial_number"], em.serial_number)
+        self.assertEqual(raw_event["node_key"], em.node_key)
+        self.assertEqual(raw_event["log_type"], "result")
+        # processed by the preprocessor
+        events = list(OsqueryLogPreprocessor().process_raw_event(json.loads(json.dumps(raw_event))))
+        self.assertTrue(len(events) > 0)
+        self.assertTrue(all(e.metadata.machine_serial_number == em.serial_number for e in events))
+        ms = MachineSnapshot.objects.current().get(serial_number=em.serial_number, reference=em.node_key)
+        self.assertEqual(ms.os_version.build, INVENTORY_QUERY_SNAPSHOT[0]["build"])
+        self.assertEqual(list(ms.osx_app_instances.values_list("app__bundle_name", flat=True)),
+                         [OSX_APP_INSTANCE["bundle_name"]])
+
+    @patch("zentral.contrib.osquery.views.api.get_log_processing_mode")
+    @patch("zentral.contrib.osquery.events.queues.post_raw_event")
+    def test_log_status_async(self, post_raw_event, get_log_processing_mode):
+        get_log_processing_mode.return_value = "async"
+        em = self.force_enrolled_machine()
+        record = {'filename': 'scheduler.cpp',
+                  'line': '63',
+                  'message': 'Executing scheduled query',
+                  'severity': '0',
+                  'version': '2.1.2',
+                  'unixTime': '1480605737'}
+        response = self.post_as_json("log", {"node_key": em.node_key, "log_type": "status", "data": [record]})
+        self.assertEqual(response.json(), {})
+        _, raw_event = post_raw_event.call_args[0]
+        events = list(OsqueryLogPreprocessor().process_raw_event(raw_event))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].event_type, "osquery_status")
+        self.assertEqual(events[0].payload["message"], record["message"])
+
+    # prometheus
+
+    def test_prometheus_metrics_403(self):
+        response = self.client.get(reverse("osquery:prometheus_metrics"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_prometheus_metrics_200(self):
+        em = self.force_enrolled_machine()
+        self.post_as_json("log", {"node_key": em.node_key, "log_type": "status", "data": []})
+        response = self.client.get(reverse("osquery:prometheus_metrics"),
+                                   HTTP_AUTHORIZATION="Bearer CHANGE ME!!!")
+        self.assertContains(response, "zentral_osquery_log_duration_seconds", status_code=200)
@@ -1,9 +1,10 @@
+from unittest.mock import patch
 from django.test import TestCase
 from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
 from zentral.core.events import event_types
 from zentral.core.events.base import BaseEvent, EventMetadata
 from zentral.core.incidents.models import SEVERITY_CRITICAL
-from zentral.core.probes.base import BaseProbe, get_flattened_payload_values
+from zentral.core.probes.base import BaseProbe, compile_payload_values_getter, get_flattened_payload_values
 from zentral.core.probes.models import ProbeSource
 from tests.inventory.utils import MockMetaMachine
 
@@ -317,6 +318,24 @@ class PayloadFilterBaseProbeTestCase(TestCase):
                                        ({"a": [{"b": [2, 3, 3]}]}, ["a", "b"], {"2", "3"})):
             self.assertEqual(set(get_flattened_payload_values(payload, attrs)), result)
 
+    def test_compile_payload_values_getter(self):
+        getter = compile_payload_values_getter("a.b")
+        for payload, result in (({"a": 1}, []),
+                                ({"a": {"b": None}}, []),
+                                ({"a": {"b": 1}}, ["1"]),
+                                ({"a": [{"b": [2, 3]}, {"c": 4}, {"b": 5}]}, ["2", "3", "5"]),
+                                ([{"a": [[{"b": True}]]}], ["True"])):
+            self.assertEqual(list(getter(payload)), result)
+
+    @patch("zentral.core.probes.base.logger.warning")
+    def test_payload_filter_stops_at_first_matching_value(self, logger_warning):
+        payload_filter = self.probe.payload_filters[2]
+        self.assertTrue(payload_filter.test_event_payload({"a": [{"b": {"c": "abc"}}, {"b": 1}]}))
+        # the second item, with the wrong attribute, is never reached
+        logger_warning.assert_not_called()
+        self.assertTrue(payload_filter.test_event_payload({"a": [{"b": 1}, {"b": {"c": "abc"}}]}))
+        logger_warning.assert_called_once()
+
     def test_dotted_payload_attribute(self):
         payload_filter = self.probe.payload_filters[2]
         for payload, result in (({"a": 1}, False),
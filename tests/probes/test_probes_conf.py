@@ -1,6 +1,7 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 from django.utils.crypto import get_random_string
-from zentral.core.probes.conf import all_probes, all_probes_dict
+from zentral.core.events.base import BaseEvent, EventMetadata
+from zentral.core.probes.conf import all_probes, all_probes_dict, ProbeList
 from zentral.core.probes.models import ProbeSource
 
 
@@ -27,3 +28,74 @@ class ProbesConfTestCase(TestCase):
         self.assertEqual(all_probes_dict[self.probe.pk], self.probe)
         with self.assertRaises(KeyError):
             all_probes_dict[self.inactive_probe.pk]
+
+
+def _build_event(event_type, payload=None, tags=None):
+    cls = type("".join(w.title() for w in event_type.split("_")),
+               (BaseEvent,),
+               {"event_type": event_type,
+                "tags": tags or []})
+    return cls(EventMetadata(), payload or {})
+
+
+def _build_probe(pk, body):
+    return ProbeSource(pk=pk, model="BaseProbe", name=get_random_string(),
+                       status=ProbeSource.ACTIVE, body=body).load()
+
+
+class ProbeEventIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.catch_all_probe = _build_probe(1, {})
+        self.event_type_probe = _build_probe(2, {"filters": {"metadata": [{"event_types": ["zentral_login"]}]}})
+        self.event_tag_probe = _build_probe(3, {"filters": {"metadata": [{"event_tags": ["santa"]}]}})
+        self.event_type_and_tag_probe = _build_probe(
+            4, {"filters": {"metadata": [{"event_types": ["zentral_login"], "event_tags": ["santa"]}]}}
+        )
+        self.payload_probe = _build_probe(
+            5, {"filters": {"metadata": [{"event_types": ["zentral_logout"]},
+                                         {"event_tags": ["munki"]}],
+                            "payload": [[{"attribute": "user.name", "operator": "IN", "values": ["yolo"]}]]}}
+        )
+        self.error_probe = _build_probe(6, {"filters": {"inventory": [{}]}})
+        self.probe_list = ProbeList(parent=[self.catch_all_probe,
+                                            self.event_type_probe,
+                                            self.event_tag_probe,
+                                            self.event_type_and_tag_probe,
+                                            self.payload_probe,
+                                            self.error_probe])
+
+    def test_index_buckets(self):
+        index = self.probe_list.event_index()
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.catch_all, {0})
+        self.assertEqual(index.event_type_buckets, {"zentral_login": {1, 3}, "zentral_logout": {4}})
+        self.assertEqual(index.event_tag_buckets, {"santa": {2}, "munki": {4}})
+
+    def test_event_filtered_catch_all(self):
+        self.assertEqual(self.probe_list.event_filtered(_build_event("yolo")),
+                         [self.catch_all_probe])
+
+    def test_event_filtered_event_type(self):
+        self.assertEqual(self.probe_list.event_filtered(_build_event("zentral_login")),
+                         [self.catch_all_probe, self.event_type_probe])
+
+    def test_event_filtered_event_type_and_tag(self):
+        self.assertEqual(self.probe_list.event_filtered(_build_event("zentral_login", tags=["santa"])),
+                         [self.catch_all_probe, self.event_type_probe,
+                          self.event_tag_probe, self.event_type_and_tag_probe])
+
+    def test_event_filtered_payload(self):
+        self.assertEqual(self.probe_list.event_filtered(_build_event("zentral_logout")),
+                         [self.catch_all_probe])
+        self.assertEqual(self.probe_list.event_filtered(_build_event("zentral_logout",
+                                                                     payload={"user": {"name": "yolo"}})),
+                         [self.catch_all_probe, self.payload_probe])
+        self.assertEqual(self.probe_list.event_filtered(_build_event("yolo", tags=["munki"],
+                                                                     payload={"user": [{"name": "yolo"}]})),
+                         [self.catch_all_probe, self.payload_probe])
+
+    def test_event_index_cleared(self):
+        index = self.probe_list.event_index()
+        self.assertIs(self.probe_list.event_index(), index)
+        self.probe_list.clear()
+        self.assertIsNot(self.probe_list.event_index(), index)
@@ -1,16 +1,53 @@
+from unittest.mock import patch
 import uuid
+from django.db import connection
 from django.db.models import F
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import EnrollmentSecret, MetaBusinessUnit, Tag
 from zentral.contrib.santa.models import (Bundle, Configuration, EnrolledMachine, Enrollment,
-                                          MachineRule, Rule, Target, translate_rule_policy)
+                                          MachineRule, ResolvedRuleSetCache, Rule, Target,
+                                          translate_rule_policy)
 
 
 def new_sha256():
     return get_random_string(length=64, allowed_chars='abcdef0123456789')
 
 
+class ResolvedRuleSetCacheTestCase(SimpleTestCase):
+    def test_get_or_set(self):
+        cache = ResolvedRuleSetCache(max_size=2)
+        calls = []
+
+        def func(value):
+            def inner():
+                calls.append(value)
+                return value
+            return inner
+
+        self.assertEqual(cache.get_or_set("un", func(1)), 1)
+        self.assertEqual(cache.get_or_set("un", func(2)), 1)
+        self.assertEqual(cache.get_or_set("deux", func(2)), 2)
+        self.assertEqual(cache.get_or_set("un", func(3)), 1)
+        # LRU eviction
+        self.assertEqual(cache.get_or_set("trois", func(3)), 3)
+        self.assertEqual(cache.get_or_set("deux", func(4)), 4)
+        self.assertEqual(cache.get_or_set("trois", func(5)), 3)
+        self.assertEqual(calls, [1, 2, 3, 4])
+        cache.clear()
+        self.assertEqual(cache.get_or_set("trois", func(5)), 5)
+
+    def test_tags_match(self):
+        self.assertTrue(MachineRule.objects._tags_match(frozenset(), set(), set()))
+        self.assertTrue(MachineRule.objects._tags_match(frozenset(), set(), {1}))
+        self.assertFalse(MachineRule.objects._tags_match(frozenset(), {1}, set()))
+        self.assertTrue(MachineRule.objects._tags_match(frozenset([1, 2]), {2, 3}, set()))
+        self.assertFalse(MachineRule.objects._tags_match(frozenset([1, 2]), {3}, set()))
+        self.assertFalse(MachineRule.objects._tags_match(frozenset([1, 2]), {1}, {2}))
+        self.assertTrue(MachineRule.objects._tags_match(frozenset([1, 2]), set(), {3}))
+
+
 class SantaRuleEngineTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -563,3 +600,41 @@ class SantaRuleEngineTestCase(TestCase):
         # rule added noop
         rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tags[0].pk, tags[-2].pk])
         self.assertEqual(rule_batch, [])
+
+    def test_resolved_rule_set_cache(self):
+        target, rule, result = self.create_and_serialize_for_iter_rule()
+        with patch.object(MachineRule.objects, "_fetch_configuration_rules",
+                          wraps=MachineRule.objects._fetch_configuration_rules) as fetch_configuration_rules:
+            self.assertEqual(list(MachineRule.objects._iter_new_rules(self.enrolled_machine, [])), [result])
+            self.assertEqual(list(MachineRule.objects._iter_new_rules(self.enrolled_machine2, [])), [result])
+            self.assertEqual(fetch_configuration_rules.call_count, 1)
+            # tags change → new digest
+            tag = Tag.objects.create(name=get_random_string(32))
+            rule.tags.set([tag])
+            self.assertEqual(list(MachineRule.objects._iter_new_rules(self.enrolled_machine, [])), [])
+            self.assertEqual(list(MachineRule.objects._iter_new_rules(self.enrolled_machine, [tag.pk])), [result])
+            self.assertEqual(fetch_configuration_rules.call_count, 2)
+            # bundle binary targets change → new digest
+            bundle_target, bundle, bundle_rule = self.create_bundle_rule()
+            self.assertEqual(len(list(MachineRule.objects._iter_new_rules(self.enrolled_machine, []))), 3)
+            bundle.binary_targets.add(Target.objects.create(type=Target.BINARY, sha256=new_sha256()))
+            self.assertEqual(len(list(MachineRule.objects._iter_new_rules(self.enrolled_machine, []))), 4)
+            self.assertEqual(fetch_configuration_rules.call_count, 4)
+
+    def test_next_rule_batch_bulk_upsert(self):
+        for _ in range(5):
+            self.create_rule()
+        with CaptureQueriesContext(connection) as ctx:
+            rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(len(rule_batch), 5)
+        # cleanup, digest, configuration rules, machine rules, single upsert
+        self.assertEqual(len([q for q in ctx.captured_queries if "santa_machinerule" in q["sql"]]), 3)
+        self.assertTrue(len(ctx.captured_queries) <= 6)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine,
+                                                    cursor=response_cursor).count(), 5)
+        # lost response → the unacknowledged rules are replaced
+        rule_batch2, response_cursor2 = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch2, rule_batch)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine,
+                                                    cursor=response_cursor2).count(), 5)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine).count(), 5)
@@ -1,4 +1,5 @@
 import json
+from unittest.mock import patch
 import uuid
 from django.db.models import F
 from django.urls import reverse
@@ -6,6 +7,7 @@ from django.test import TestCase, override_settings
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import EnrollmentSecret, File, MetaBusinessUnit
 from zentral.contrib.santa.models import Bundle, Configuration, EnrolledMachine, Enrollment, Rule, Target
+from zentral.contrib.santa.preprocessors.event_upload import SantaEventUploadPreprocessor
 
 
 @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
@@ -321,6 +323,130 @@ class SantaAPIViewsTestCase(TestCase):
         self.assertIsNotNone(b.uploaded_at)
         self.assertEqual(list(b.binary_targets.all()), [Target.objects.get(type=Target.BINARY, sha256=f.sha_256)])
 
+    def test_eventupload_bundle_binaries_bulk(self):
+        bundle_sha256 = get_random_string(64, "0123456789abcdef")
+        binary_sha256_list = [get_random_string(64, "0123456789abcdef") for _ in range(20)]
+        base_event_d = {
+            'decision': 'ALLOW_UNKNOWN',
+            'execution_time': 2242783327.585212,
+            'file_bundle_binary_count': len(binary_sha256_list),
+            'file_bundle_hash': bundle_sha256,
+            'file_bundle_id': 'io.zentral.bulk',
+            'file_bundle_name': 'Bulk',
+            'file_bundle_path': '/Applications/Bulk.app',
+            'file_name': 'bulk',
+            'file_path': '/Applications/Bulk.app/Contents/MacOS',
+            'file_sha256': binary_sha256_list[0],
+        }
+        url = reverse("santa:eventupload", args=(self.enrollment_secret.secret, self.enrolled_machine.hardware_uuid))
+        # same event twice → one bundle, one file
+        response = self.post_as_json(url, {"events": [base_event_d, base_event_d.copy()]})
+        self.assertEqual(response.json(), {"event_upload_bundle_binaries": [bundle_sha256]})
+        self.assertEqual(File.objects.filter(sha_256=binary_sha256_list[0]).count(), 1)
+        b = Bundle.objects.get(target__type=Target.BUNDLE, target__sha256=bundle_sha256)
+        self.assertIsNone(b.uploaded_at)
+        # all the bundle binaries in one upload, one of them already known
+        Target.objects.create(type=Target.BINARY, sha256=binary_sha256_list[1])
+        events = []
+        for idx, binary_sha256 in enumerate(binary_sha256_list):
+            event_d = base_event_d.copy()
+            event_d["decision"] = "BUNDLE_BINARY"
+            event_d["file_name"] = "bulk{}".format(idx)
+            event_d["file_sha256"] = binary_sha256
+            events.append(event_d)
+        response = self.post_as_json(url, {"events": events})
+        self.assertEqual(response.json(), {})
+        b.refresh_from_db()
+        self.assertIsNotNone(b.uploaded_at)
+        self.assertEqual(sorted(t.sha256 for t in b.binary_targets.all()), sorted(binary_sha256_list))
+        self.assertEqual(File.objects.filter(sha_256__in=binary_sha256_list).count(), 20)
+        self.assertEqual(Target.objects.filter(type=Target.BINARY, sha256__in=binary_sha256_list).count(), 20)
+
+    def test_eventupload_bundle_binaries_before_bundle(self):
+        bundle_sha256 = get_random_string(64, "0123456789abcdef")
+        binary_sha256_list = [get_random_string(64, "0123456789abcdef") for _ in range(3)]
+        events = [{
+            'decision': 'BUNDLE_BINARY',
+            'execution_time': 2242783327.585212,
+            'file_bundle_binary_count': len(binary_sha256_list),
+            'file_bundle_hash': bundle_sha256,
+            'file_bundle_id': 'io.zentral.early',
+            'file_bundle_name': 'Early',
+            'file_bundle_path': '/Applications/Early.app',
+            'file_name': 'early{}'.format(idx),
+            'file_path': '/Applications/Early.app/Contents/MacOS',
+            'file_sha256': binary_sha256,
+        } for idx, binary_sha256 in enumerate(binary_sha256_list)]
+        url = reverse("santa:eventupload", args=(self.enrollment_secret.secret, self.enrolled_machine.hardware_uuid))
+        response = self.post_as_json(url, {"events": events})
+        self.assertEqual(response.json(), {})
+        # the unknown bundle is created from its binaries, the binaries are not dropped
+        b = Bundle.objects.get(target__type=Target.BUNDLE, target__sha256=bundle_sha256)
+        self.assertEqual(b.bundle_id, "io.zentral.early")
+        self.assertEqual(b.path, "/Applications/Early.app")
+        self.assertEqual(b.binary_count, 3)
+        self.assertIsNotNone(b.uploaded_at)
+        self.assertEqual(sorted(t.sha256 for t in b.binary_targets.all()), sorted(binary_sha256_list))
+        # the bundle event → bundle already uploaded
+        event_d = events[0].copy()
+        event_d["decision"] = "ALLOW_UNKNOWN"
+        response = self.post_as_json(url, {"events": [event_d]})
+        self.assertEqual(response.json(), {})
+
+    @patch("zentral.contrib.santa.views.get_event_upload_mode")
+    @patch("zentral.contrib.santa.events.queues.post_raw_event")
+    def test_eventupload_async(self, post_raw_event, get_event_upload_mode):
+        get_event_upload_mode.return_value = "async"
+        bundle_sha256 = get_random_string(64, "0123456789abcdef")
+        event_d = {
+            'decision': 'ALLOW_UNKNOWN',
+            'execution_time': 2242783327.585212,
+            'file_bundle_binary_count': 1,
+            'file_bundle_hash': bundle_sha256,
+            'file_bundle_id': 'io.zentral.async',
+            'file_bundle_name': 'Async',
+            'file_bundle_path': '/Applications/Async.app',
+            'file_name': 'async',
+            'file_path': '/Applications/Async.app/Contents/MacOS',
+            'file_sha256': get_random_string(64, "0123456789abcdef"),
+        }
+        url = reverse("santa:eventupload", args=(self.enrollment_secret.secret, self.enrolled_machine.hardware_uuid))
+        response = self.post_as_json(url, {"events": [event_d]})
+        self.assertEqual(response.json(), {"event_upload_bundle_binaries": [bundle_sha256]})
+        # nothing written by the view
+        self.assertFalse(Bundle.objects.filter(target__sha256=bundle_sha256).exists())
+        self.assertFalse(File.objects.filter(sha_256=event_d["file_sha256"]).exists())
+        post_raw_event.assert_called_once()
+        routing_key, raw_event = post_raw_event.call_args[0]
+        self.assertEqual(routing_key, "santa_event_uploads")
+        self.assertEqual(raw_event["serial_number"], self.machine_serial_number)
+        # processed by the preprocessor
+        events = list(SantaEventUploadPreprocessor().process_raw_event(json.loads(json.dumps(raw_event))))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].event_type, "santa_event")
+        self.assertEqual(events[0].metadata.machine_serial_number, self.machine_serial_number)
+        b = Bundle.objects.get(target__type=Target.BUNDLE, target__sha256=bundle_sha256)
+        self.assertIsNone(b.uploaded_at)
+        self.assertEqual(File.objects.filter(sha_256=event_d["file_sha256"]).count(), 1)
+        # bundle uploaded → not requested anymore, and cached
+        Bundle.objects.filter(pk=b.pk).update(uploaded_at=F("created_at"))
+        response = self.post_as_json(url, {"events": [event_d]})
+        self.assertEqual(response.json(), {})
+        Bundle.objects.filter(pk=b.pk).update(uploaded_at=None)
+        response = self.post_as_json(url, {"events": [event_d]})
+        self.assertEqual(response.json(), {})
+
+    def test_prometheus_metrics_403(self):
+        response = self.client.get(reverse("santa:prometheus_metrics"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_prometheus_metrics_200(self):
+        url = reverse("santa:eventupload", args=(self.enrollment_secret.secret, self.enrolled_machine.hardware_uuid))
+        self.post_as_json(url, {"events": []})
+        response = self.client.get(reverse("santa:prometheus_metrics"),
+                                   HTTP_AUTHORIZATION="Bearer CHANGE ME!!!")
+        self.assertContains(response, "zentral_santa_event_upload_duration_seconds", status_code=200)
+
     def test_rule_postflight_not_enrolled(self):
         url = reverse("santa:postflight", args=(self.enrollment_secret.secret, uuid.uuid4()))
         response = self.post_as_json(url, {})
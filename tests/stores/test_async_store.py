@@ -0,0 +1,124 @@
+import asyncio
+import json
+import queue
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.test import SimpleTestCase
+import httpx
+from zentral.core.queues.backends.aws_sns_sqs.consumer import AsyncConcurrentConsumer
+from zentral.core.stores.backends.base import async_post_with_retries
+from zentral.core.stores.backends.datadog import EventStore as DatadogEventStore
+from zentral.core.stores.backends.http import EventStore as HTTPEventStore
+from zentral.core.stores.backends.splunk import EventStore as SplunkEventStore
+from . import make_event
+
+
+class TestAsyncConsumer(AsyncConcurrentConsumer):
+    name = "test async consumer"
+
+    def __init__(self, event_store, transport):
+        self.event_store = event_store
+        self.transport = transport
+        with patch("zentral.core.queues.backends.aws_sns_sqs.consumer.SQSReceiveThread"), \
+             patch("zentral.core.queues.backends.aws_sns_sqs.consumer.SQSDeleteThread"):
+            super().__init__("https://www.example.com/queue", event_store.concurrency)
+        # no SQS threads and no final thread in the tests
+        self.process_message_queue = queue.Queue()
+        self.delete_message_queue = queue.Queue()
+        self.processed_event_queue = queue.Queue()
+
+    def update_metrics(self, success, event_type, process_time):
+        pass
+
+    def skip_event(self, receipt_handle, event_d):
+        return event_d["_zentral"]["type"] != "event_type_1"
+
+    def get_async_client(self):
+        return httpx.AsyncClient(transport=self.transport)
+
+    async def async_process_event(self, client, routing_key, event_d):
+        await self.event_store.async_store(client, event_d)
+
+
+class AsyncStoreTestCase(SimpleTestCase):
+    def test_concurrency(self):
+        http_store = HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                                     "concurrency": 300})
+        self.assertFalse(http_store.asyncio)
+        self.assertEqual(http_store.concurrency, 20)
+        http_store = HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                                     "concurrency": 300, "asyncio": True})
+        self.assertTrue(http_store.asyncio)
+        self.assertEqual(http_store.concurrency, 300)
+        datadog_store = DatadogEventStore({"store_name": "datadog", "api_key": "yolo", "concurrency": 300})
+        self.assertEqual(datadog_store.concurrency, 1)
+
+    def test_async_client(self):
+        splunk_store = SplunkEventStore({"store_name": "splunk", "hec_url": "https://www.example.com",
+                                         "hec_token": "yolo", "concurrency": 10, "asyncio": True})
+        client = splunk_store.get_async_client()
+        self.assertEqual(client.headers["Authorization"], "Splunk yolo")
+        asyncio.run(client.aclose())
+
+    @patch("zentral.core.stores.backends.base.asyncio.sleep")
+    def test_async_post_with_retries(self, sleep):
+        responses = [httpx.Response(503), httpx.Response(200)]
+
+        def handler(request):
+            return responses.pop(0)
+
+        async def post():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await async_post_with_retries(client, "https://www.example.com", 3, json={"un": 1})
+
+        r = asyncio.run(post())
+        self.assertEqual(r.status_code, 200)
+        sleep.assert_called_once()
+
+    def test_async_post_with_retries_status_code_only(self):
+        # the httpx 0.19 responses have no is_success attribute
+        class Client:
+            async def post(self, url, **kwargs):
+                return SimpleNamespace(status_code=204)
+
+        r = asyncio.run(async_post_with_retries(Client(), "https://www.example.com", 3, json={"un": 1}))
+        self.assertEqual(r.status_code, 204)
+
+    def test_async_concurrent_consumer(self):
+        event_store = HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                                      "concurrency": 5, "asyncio": True})
+        in_flight = {"current": 0, "max": 0}
+        posted_idx = []
+
+        async def handler(request):
+            in_flight["current"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["current"])
+            await asyncio.sleep(0.01)
+            in_flight["current"] -= 1
+            idx = json.loads(request.content)["ns_event_type_1"]["idx"]
+            posted_idx.append(idx)
+            return httpx.Response(400 if idx == 3 else 200)
+
+        consumer = TestAsyncConsumer(event_store, httpx.MockTransport(handler))
+        for idx in range(20):
+            event_d = make_event(idx=idx, first_type=idx % 4 != 1).serialize(machine_metadata=False)
+            consumer.process_message_queue.put((f"rh{idx}", None, event_d))
+        consumer.stop_receiving_event.set()
+        with patch("zentral.core.queues.backends.aws_sns_sqs.consumer.logger"):
+            consumer.start_run_loop()
+
+        # skipped events
+        skipped = []
+        while not consumer.delete_message_queue.empty():
+            skipped.append(consumer.delete_message_queue.get_nowait()[0])
+        self.assertEqual(sorted(skipped), sorted(f"rh{idx}" for idx in range(20) if idx % 4 == 1))
+        # processed events
+        processed = {}
+        while not consumer.processed_event_queue.empty():
+            receipt_handle, success, event_type, _ = consumer.processed_event_queue.get_nowait()
+            self.assertEqual(event_type, "event_type_1")
+            processed[receipt_handle] = success
+        self.assertEqual(processed, {f"rh{idx}": idx != 3 for idx in range(20) if idx % 4 != 1})
+        self.assertEqual(sorted(posted_idx), [idx for idx in range(20) if idx % 4 != 1])
+        # bounded concurrency
+        self.assertTrue(1 < in_flight["max"] <= 5)
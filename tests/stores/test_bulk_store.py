@@ -0,0 +1,178 @@
+import base64
+import copy
+import gzip
+import json
+from unittest.mock import Mock, patch
+import zlib
+from django.test import SimpleTestCase
+import requests
+from zentral.core.stores.backends.azure_log_analytics import EventStore as AzureLogAnalyticsEventStore
+from zentral.core.stores.backends.base import iter_bulk_chunks, post_with_retries
+from zentral.core.stores.backends.datadog import EventStore as DatadogEventStore
+from zentral.core.stores.backends.http import EventStore as HTTPEventStore
+from zentral.core.stores.backends.humio import EventStore as HumioEventStore
+from zentral.core.stores.backends.kinesis import EventStore as KinesisEventStore
+from . import make_event
+
+
+def make_event_d(idx):
+    return make_event(idx=idx, first_type=idx % 2 == 0).serialize(machine_metadata=False)
+
+
+def event_key(event_d):
+    return event_d["_zentral"]["id"], event_d["_zentral"]["index"]
+
+
+def make_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+class BulkStoreHelpersTestCase(SimpleTestCase):
+    def test_iter_bulk_chunks_max_count(self):
+        chunks = list(iter_bulk_chunks(((i, b"a") for i in range(5)), 2, 100))
+        self.assertEqual([[k for k, _ in chunk] for chunk in chunks], [[0, 1], [2, 3], [4]])
+
+    def test_iter_bulk_chunks_max_size(self):
+        items = [(0, b"aaaa"), (1, b"bbbb"), (2, b"cccccccc"), (3, b"d" * 20), (4, b"e")]
+        chunks = list(iter_bulk_chunks(items, 10, 10))
+        # item 3 is too big and dropped
+        self.assertEqual([[k for k, _ in chunk] for chunk in chunks], [[0, 1], [2], [4]])
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_post_with_retries_temporary_error(self, sleep):
+        session = Mock()
+        session.post.side_effect = [make_response(503), make_response(429), make_response(200)]
+        r = post_with_retries(session, "https://www.example.com", 3, data=b"yolo")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(session.post.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_post_with_retries_client_error(self, sleep):
+        session = Mock()
+        session.post.return_value = make_response(400)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            post_with_retries(session, "https://www.example.com", 3, data=b"yolo")
+        self.assertEqual(session.post.call_count, 1)
+        sleep.assert_not_called()
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_post_with_retries_too_many_errors(self, sleep):
+        session = Mock()
+        session.post.side_effect = requests.exceptions.ConnectionError
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            post_with_retries(session, "https://www.example.com", 2, data=b"yolo")
+        self.assertEqual(session.post.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+
+class HTTPFamilyBulkStoreTestCase(SimpleTestCase):
+    def _patch_session(self, event_store, session, status_codes):
+        session.post = Mock(side_effect=[make_response(status_code) for status_code in status_codes])
+        return session.post
+
+    def test_bulk_store_not_available(self):
+        event_store = HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com"})
+        with self.assertRaises(RuntimeError):
+            list(event_store.bulk_store([make_event_d(0)]))
+
+    def test_datadog_bulk_store(self):
+        event_store = DatadogEventStore({"store_name": "datadog", "api_key": "yolo", "batch_size": 2})
+        post = self._patch_session(event_store, event_store._session, [200, 400])
+        events = [make_event_d(i) for i in range(3)]
+        keys = [event_key(e) for e in events]
+        self.assertEqual(list(event_store.bulk_store(events)), keys[:2])
+        self.assertEqual(post.call_count, 2)
+        body = json.loads(zlib.decompress(post.call_args_list[0].kwargs["data"]))
+        self.assertEqual([ddevent["ns_event_type_1"]["idx"] for ddevent in body[:1]], [0])
+        self.assertEqual(body[1]["logger"]["name"], "event_type_2")
+
+    def test_humio_bulk_store_gzip(self):
+        event_store = HumioEventStore({"store_name": "humio", "base_url": "https://www.example.com",
+                                       "ingest_token": "yolo", "batch_size": 3, "gzip": True})
+        post = self._patch_session(event_store, event_store._session, [200])
+        events = [make_event_d(i) for i in range(3)]
+        keys = [event_key(e) for e in events]
+        self.assertEqual(list(event_store.bulk_store(events)), keys)
+        kwargs = post.call_args.kwargs
+        self.assertEqual(kwargs["headers"], {"Content-Encoding": "gzip"})
+        body = json.loads(gzip.decompress(kwargs["data"]))
+        self.assertEqual(
+            [(entry["tags"]["event_type"], len(entry["events"])) for entry in body],
+            [("event_type_1", 2), ("event_type_2", 1)]
+        )
+
+    def test_http_bulk_store_size_capped(self):
+        event_store = HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                                      "batch_size": 10})
+        event_store.max_request_body_size = 1000
+        post = self._patch_session(event_store, event_store.client.session, [200, 200, 200])
+        events = [make_event_d(i) for i in range(6)]
+        keys = [event_key(e) for e in events]
+        self.assertEqual(list(event_store.bulk_store(events)), keys)
+        self.assertTrue(post.call_count > 1)
+        payloads = []
+        for call in post.call_args_list:
+            data = call.kwargs["data"]
+            self.assertTrue(len(data) <= 1000)
+            payloads.extend(json.loads(data))
+        self.assertEqual([(p["id"], p["index"]) for p in payloads], keys)
+
+    def test_bulk_store_does_not_modify_events(self):
+        for event_store, session in (
+            (DatadogEventStore({"store_name": "datadog", "api_key": "yolo", "batch_size": 3}), "_session"),
+            (HumioEventStore({"store_name": "humio", "base_url": "https://www.example.com",
+                              "ingest_token": "yolo", "batch_size": 3}), "_session"),
+            (HTTPEventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                             "batch_size": 3}), None),
+        ):
+            self._patch_session(event_store,
+                                getattr(event_store, session) if session else event_store.client.session,
+                                [200])
+            events = [make_event_d(i) for i in range(3)]
+            original_events = copy.deepcopy(events)
+            self.assertEqual(list(event_store.bulk_store(events)), [event_key(e) for e in original_events])
+            # the queue workers need the _zentral metadata after the store
+            self.assertEqual(events, original_events)
+
+    @patch("zentral.core.stores.backends.base.time.sleep")
+    def test_azure_log_analytics_bulk_store_retry(self, sleep):
+        event_store = AzureLogAnalyticsEventStore({"store_name": "azure", "customer_id": "yolo",
+                                                   "shared_key": base64.b64encode(b"fomo").decode("ascii"),
+                                                   "batch_size": 5})
+        post = self._patch_session(event_store, event_store._session, [500, 200])
+        events = [make_event_d(i) for i in range(2)]
+        self.assertEqual(list(event_store.bulk_store(events)), [event_key(e) for e in events])
+        self.assertEqual(post.call_count, 2)
+        sleep.assert_called_once()
+        body = json.loads(post.call_args.kwargs["data"])
+        self.assertEqual([azure_event["Properties"]["idx"] for azure_event in body], [0, 1])
+        self.assertTrue(post.call_args.kwargs["headers"]["Authorization"].startswith("SharedKey yolo:"))
+
+
+class KinesisBulkStoreTestCase(SimpleTestCase):
+    @patch("zentral.core.stores.backends.kinesis.time.sleep")
+    def test_bulk_store_partial_failure(self, sleep):
+        event_store = KinesisEventStore({"store_name": "kinesis", "stream": "yolo",
+                                         "region_name": "us-east-1", "batch_size": 10})
+        event_store.client = Mock()
+        event_store.configured = True
+        event_store.client.put_records.side_effect = [
+            {"FailedRecordCount": 1,
+             "Records": [{"SequenceNumber": "1"},
+                         {"ErrorCode": "ProvisionedThroughputExceededException"},
+                         {"SequenceNumber": "2"}]},
+            {"FailedRecordCount": 0,
+             "Records": [{"SequenceNumber": "3"}]},
+        ]
+        events = [make_event_d(i) for i in range(3)]
+        keys = [event_key(e) for e in events]
+        self.assertEqual(list(event_store.bulk_store(events)), [keys[0], keys[2], keys[1]])
+        self.assertEqual(event_store.client.put_records.call_count, 2)
+        sleep.assert_called_once()
+        retried_records = event_store.client.put_records.call_args.kwargs["Records"]
+        self.assertEqual(len(retried_records), 1)
+        self.assertEqual(retried_records[0]["PartitionKey"], keys[1][0])
+        self.assertEqual(json.loads(retried_records[0]["Data"])["idx"], 1)
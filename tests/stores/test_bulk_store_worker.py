@@ -0,0 +1,117 @@
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from zentral.core.queues.backends.kombu import BulkStoreWorker, EventQueues, StoreWorker
+from . import make_event
+
+
+class FakeBulkEventStore:
+    name = "fake"
+    batch_size = 3
+
+    def __init__(self, fail_indexes=None, exception=None):
+        self.fail_indexes = fail_indexes or set()
+        self.exception = exception
+        self.batches = []
+
+    def is_event_type_included(self, event_type):
+        return event_type == "event_type_1"
+
+    def bulk_store(self, events):
+        if self.exception:
+            raise self.exception
+        batch = list(events)
+        self.batches.append(batch)
+        for event_d in batch:
+            # consume the metadata, like the serializations of some stores
+            event_metadata = event_d.pop("_zentral")
+            if event_d["idx"] not in self.fail_indexes:
+                yield event_metadata["id"], event_metadata["index"]
+
+
+class KombuBulkStoreWorkerTestCase(SimpleTestCase):
+    def _build_worker(self, event_store):
+        worker = BulkStoreWorker(Mock(), event_store)
+        worker.setup_metrics_exporter()
+        return worker
+
+    def _send_events(self, worker, count, first_type=True):
+        messages = []
+        for idx in range(count):
+            event_d = make_event(idx=idx, first_type=first_type).serialize(machine_metadata=False)
+            message = Mock()
+            worker.do_batch_store_event(event_d, message)
+            messages.append(message)
+        return messages
+
+    def test_get_store_worker(self):
+        event_queues = EventQueues({"backend_url": "memory://"})
+        self.assertIsInstance(event_queues.get_store_worker(FakeBulkEventStore()), BulkStoreWorker)
+        simple_store = FakeBulkEventStore()
+        simple_store.batch_size = 1
+        self.assertNotIsInstance(event_queues.get_store_worker(simple_store), BulkStoreWorker)
+        self.assertIsInstance(event_queues.get_store_worker(simple_store), StoreWorker)
+
+    def test_prefetch_count(self):
+        worker = self._build_worker(FakeBulkEventStore())
+        consumer = worker.get_consumers(None, Mock())[0]
+        self.assertEqual(consumer.prefetch_count, 3)
+
+    def test_skipped_events_acked(self):
+        event_store = FakeBulkEventStore()
+        worker = self._build_worker(event_store)
+        messages = self._send_events(worker, 4, first_type=False)
+        for message in messages:
+            message.ack.assert_called_once()
+        self.assertEqual(worker.batch, [])
+        self.assertEqual(event_store.batches, [])
+
+    def test_full_batch_stored(self):
+        event_store = FakeBulkEventStore()
+        worker = self._build_worker(event_store)
+        messages = self._send_events(worker, 4)
+        self.assertEqual(len(event_store.batches), 1)
+        self.assertEqual(len(event_store.batches[0]), 3)
+        for message in messages[:3]:
+            message.ack.assert_called_once()
+            message.requeue.assert_not_called()
+            message.reject.assert_not_called()
+        messages[3].ack.assert_not_called()
+        self.assertEqual(len(worker.batch), 1)
+
+    def test_max_batch_age_flush(self):
+        event_store = FakeBulkEventStore()
+        worker = self._build_worker(event_store)
+        messages = self._send_events(worker, 2)
+        worker.on_iteration()
+        self.assertEqual(event_store.batches, [])
+        worker.batch_start_ts -= worker.max_batch_age_seconds + 1
+        worker.on_iteration()
+        self.assertEqual(len(event_store.batches), 1)
+        for message in messages:
+            message.ack.assert_called_once()
+            message.requeue.assert_not_called()
+        self.assertEqual(worker.batch, [])
+        self.assertIsNone(worker.batch_start_ts)
+
+    @patch("zentral.core.queues.backends.kombu.save_dead_letter")
+    def test_partial_failure(self, save_dead_letter):
+        worker = self._build_worker(FakeBulkEventStore(fail_indexes={1}))
+        messages = self._send_events(worker, 3)
+        messages[0].ack.assert_called_once()
+        messages[1].ack.assert_not_called()
+        messages[1].reject.assert_called_once()
+        messages[2].ack.assert_called_once()
+        for message in messages:
+            message.requeue.assert_not_called()
+        save_dead_letter.assert_called_once()
+
+    @patch("zentral.core.queues.backends.kombu.logger.exception")
+    @patch("zentral.core.queues.backends.kombu.time.sleep")
+    def test_bulk_store_exception(self, sleep, logger_exception):
+        worker = self._build_worker(FakeBulkEventStore(exception=ValueError("yolo")))
+        messages = self._send_events(worker, 3)
+        logger_exception.assert_called_once()
+        sleep.assert_called_once_with(1)
+        for message in messages:
+            message.ack.assert_not_called()
+            message.requeue.assert_called_once()
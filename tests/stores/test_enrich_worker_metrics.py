@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+from django.test import SimpleTestCase
+from zentral.contrib.inventory.models import MetaMachine
+from zentral.core.queues.backends.kombu import EnrichWorker
+
+
+class EnrichWorkerMetricsTestCase(SimpleTestCase):
+    def test_machine_info_cache_counted_once(self):
+        worker = EnrichWorker.__new__(EnrichWorker)
+        counts = []
+        worker.inc_counter = lambda name, label: counts.append((name, label))
+        machine = MetaMachine("012345678910")
+        machine.event_info_cache_results.extend(["miss", "hit"])
+        # two events sharing the same machine
+        for _ in range(2):
+            worker.inc_machine_info_cache_counters(SimpleNamespace(metadata=SimpleNamespace(machine=machine)))
+        self.assertEqual(counts, [("machine_info_cache", "miss"), ("machine_info_cache", "hit")])
+        self.assertEqual(machine.event_info_cache_results, [])
+
+    def test_no_machine(self):
+        worker = EnrichWorker.__new__(EnrichWorker)
+        counts = []
+        worker.inc_counter = lambda name, label: counts.append((name, label))
+        worker.inc_machine_info_cache_counters(SimpleNamespace(metadata=SimpleNamespace(machine=None)))
+        self.assertEqual(counts, [])
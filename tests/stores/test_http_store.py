@@ -0,0 +1,110 @@
+import queue
+import threading
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+import requests
+from zentral.core.stores.backends.http import DelayQueue, EventStore, EventStoreThread, TemporaryError
+from zentral.utils.statsd import StatsdMetricsExporter
+from . import make_event
+
+
+def make_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+class HTTPStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.event_store = EventStore({"store_name": "http", "endpoint_url": "https://www.example.com",
+                                       "concurrency": 5})
+        self.in_queue = queue.Queue()
+        self.out_queue = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def _build_thread(self, thread_id=1):
+        return EventStoreThread(self.event_store, thread_id, self.in_queue, self.out_queue, self.stop_event)
+
+    def test_delay_queue(self):
+        delay_queue = DelayQueue()
+        self.assertEqual(delay_queue.get_wait_time(1), 1)
+        delay_queue.put("later", 60)
+        delay_queue.put("now", 0)
+        self.assertEqual(len(delay_queue), 2)
+        self.assertEqual(delay_queue.get_nowait(), "now")
+        with self.assertRaises(queue.Empty):
+            delay_queue.get_nowait()
+        self.assertEqual(delay_queue.get_wait_time(1), 1)
+        self.assertTrue(delay_queue.get_wait_time(120) > 59)
+
+    def test_shared_pooled_session(self):
+        thread1 = self._build_thread(1)
+        thread2 = self._build_thread(2)
+        self.assertIs(thread1.client, thread2.client)
+        self.assertIs(thread1.retry_queue, thread2.retry_queue)
+        adapter = thread1.client.session.get_adapter(self.event_store.endpoint_url)
+        self.assertEqual(adapter._pool_maxsize, 5)
+
+    def test_post_payload_temporary_error(self):
+        client = self.event_store.client
+        for side_effect in (make_response(429), make_response(502), requests.exceptions.ConnectionError()):
+            with patch.object(client.session, "post", side_effect=[side_effect]):
+                with self.assertRaises(TemporaryError):
+                    client.post_payload({"un": 1})
+        with patch.object(client.session, "post", return_value=make_response(400)):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                client.post_payload({"un": 1})
+
+    @patch("zentral.core.stores.backends.http.logger")
+    def test_retry_scheduled_without_blocking(self, logger):
+        thread = self._build_thread()
+        thread.client.session.post = Mock(side_effect=[make_response(503), make_response(200), make_response(200)])
+        thread.store("rh1", "event_type_1", {"un": 1}, 0, 0)
+        # not processed yet, the retry is scheduled
+        self.assertTrue(self.out_queue.empty())
+        self.assertEqual(len(thread.retry_queue), 1)
+        # the thread is free to store another event
+        thread.store("rh2", "event_type_1", {"deux": 2}, 0, 0)
+        receipt_handle, success, event_type, _ = self.out_queue.get_nowait()
+        self.assertEqual((receipt_handle, success, event_type), ("rh2", True, "event_type_1"))
+        # retry
+        with patch("zentral.core.stores.backends.http.time.monotonic", return_value=10 ** 9):
+            item = thread.retry_queue.get_nowait()
+        self.assertEqual(item[:4], ("rh1", "event_type_1", {"un": 1}, 1))
+        thread.store(*item)
+        receipt_handle, success, _, _ = self.out_queue.get_nowait()
+        self.assertEqual((receipt_handle, success), ("rh1", True))
+
+    @patch("zentral.core.stores.backends.http.logger")
+    def test_max_retries(self, logger):
+        thread = self._build_thread()
+        thread.client.session.post = Mock(return_value=make_response(503))
+        thread.store("rh1", "event_type_1", {"un": 1}, thread.client.max_retries - 1, 0)
+        self.assertEqual(len(thread.retry_queue), 0)
+        receipt_handle, success, _, _ = self.out_queue.get_nowait()
+        self.assertEqual((receipt_handle, success), ("rh1", False))
+
+    def test_run(self):
+        thread = self._build_thread()
+        thread.max_wait_time = 0.01
+        thread.client.session.post = Mock(return_value=make_response(200))
+        event_d = make_event().serialize(machine_metadata=False)
+        self.in_queue.put(("rh1", None, event_d))
+        thread.start()
+        receipt_handle, success, event_type, _ = self.out_queue.get(timeout=5)
+        self.stop_event.set()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual((receipt_handle, success, event_type), ("rh1", True, "event_type_1"))
+        self.assertEqual(thread.client.session.post.call_args.kwargs["json"]["ns_event_type_1"], {"idx": 0})
+
+
+class StatsdMetricsExporterTestCase(SimpleTestCase):
+    def test_observe(self):
+        exporter = StatsdMetricsExporter(prefix="ztl")
+        exporter._socket = Mock()
+        exporter._addr = ("127.0.0.1", 9125)
+        exporter.add_histogram("store_latency_seconds", ["store"])
+        exporter.observe("store_latency_seconds", 0.25, "http")
+        exporter._socket.sendto.assert_called_once_with(b"ztl.store_latency_seconds:250.000|ms|#store:http",
+                                                        ("127.0.0.1", 9125))
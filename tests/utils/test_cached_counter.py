@@ -0,0 +1,33 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.parser import text_string_to_metric_families
+from zentral.utils.prometheus import CachedCounter
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CachedCounterTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_samples(self, counter, label_values):
+        registry = CollectorRegistry()
+        counter.register(registry, label_values)
+        families = list(text_string_to_metric_families(generate_latest(registry).decode("utf-8")))
+        self.assertEqual(len(families), 1)
+        return families[0].samples
+
+    def test_no_increments(self):
+        counter = CachedCounter("zentral_test_attempts", "Test attempts", "mode")
+        self.assertEqual(self.get_samples(counter, ("sync", "async")), [])
+
+    def test_increments(self):
+        counter = CachedCounter("zentral_test_attempts", "Test attempts", "mode")
+        counter.inc("sync")
+        counter.inc("sync", 3)
+        counter.inc("async")
+        counter.inc("unknown")
+        samples = {(s.name, s.labels["mode"]): s.value
+                   for s in self.get_samples(counter, ("sync", "async"))}
+        self.assertEqual(samples, {("zentral_test_attempts_total", "sync"): 4,
+                                   ("zentral_test_attempts_total", "async"): 1})
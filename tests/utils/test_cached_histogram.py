@@ -0,0 +1,56 @@
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.parser import text_string_to_metric_families
+from zentral.utils.prometheus import CachedHistogram
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CachedHistogramTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_samples(self, histogram, label_values):
+        registry = CollectorRegistry()
+        histogram.register(registry, label_values)
+        families = list(text_string_to_metric_families(generate_latest(registry).decode("utf-8")))
+        self.assertEqual(len(families), 1)
+        return families[0].samples
+
+    def test_no_observations(self):
+        histogram = CachedHistogram("zentral_test_duration_seconds", "Test duration", "mode", buckets=(0.1, 1))
+        self.assertEqual(self.get_samples(histogram, ("sync", "async")), [])
+
+    def test_observations(self):
+        histogram = CachedHistogram("zentral_test_duration_seconds", "Test duration", "mode", buckets=(1, 0.1))
+        histogram.observe("sync", 0.05)
+        histogram.observe("sync", 0.5)
+        histogram.observe("sync", 5)
+        histogram.observe("async", 0.01)
+        samples = {(s.name, s.labels["mode"], s.labels.get("le")): s.value
+                   for s in self.get_samples(histogram, ("sync", "async"))}
+        self.assertEqual(samples[("zentral_test_duration_seconds_bucket", "sync", "0.1")], 1)
+        self.assertEqual(samples[("zentral_test_duration_seconds_bucket", "sync", "1.0")], 2)
+        self.assertEqual(samples[("zentral_test_duration_seconds_bucket", "sync", "+Inf")], 3)
+        self.assertEqual(samples[("zentral_test_duration_seconds_count", "sync", None)], 3)
+        self.assertAlmostEqual(samples[("zentral_test_duration_seconds_sum", "sync", None)], 5.55)
+        self.assertEqual(samples[("zentral_test_duration_seconds_bucket", "async", "0.1")], 1)
+        self.assertEqual(samples[("zentral_test_duration_seconds_count", "async", None)], 1)
+
+    def test_concurrent_observations(self):
+        histogram = CachedHistogram("zentral_test_duration_seconds", "Test duration", "mode", buckets=(0.1, 1))
+        cache_add = cache.add
+
+        def add(key, value, timeout):
+            # another process creates the missing counters first
+            cache_add(key, value, timeout)
+            return cache_add(key, value, timeout)
+
+        with patch.object(cache, "add", side_effect=add):
+            histogram.observe("sync", 0.05)
+        samples = {(s.name, s.labels.get("le")): s.value
+                   for s in self.get_samples(histogram, ("sync",))}
+        self.assertEqual(samples[("zentral_test_duration_seconds_bucket", "0.1")], 2)
+        self.assertEqual(samples[("zentral_test_duration_seconds_count", None)], 2)
+        self.assertAlmostEqual(samples[("zentral_test_duration_seconds_sum", None)], 0.1)
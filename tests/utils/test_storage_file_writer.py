@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.test import SimpleTestCase
+from zentral.utils.storage import StorageFileWriter, get_storage_write_mode
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.files = {}
+
+    def _save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def _open(self, name, mode="rb"):
+        return ContentFile(self.files[name], name=name)
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+
+class StorageFileWriterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_storage_write_mode(self):
+        self.assertEqual(get_storage_write_mode(self.storage), "local")
+        self.assertEqual(get_storage_write_mode(MemoryStorage()), "buffered")
+
+    def test_local(self):
+        with StorageFileWriter("a/b/archive.tar", self.storage) as writer:
+            writer.write(b"yolo")
+            writer.write(b"fomo")
+        self.assertEqual(writer.mode, "local")
+        self.assertEqual(writer.name, "a/b/archive.tar")
+        self.assertEqual(writer.size, 8)
+        with self.storage.open(writer.name) as f:
+            self.assertEqual(f.read(), b"yolofomo")
+
+    def test_local_available_name(self):
+        self.storage.save("archive.tar", ContentFile(b"1"))
+        with StorageFileWriter("archive.tar", self.storage) as writer:
+            writer.write(b"2")
+        self.assertNotEqual(writer.name, "archive.tar")
+        with self.storage.open("archive.tar") as f:
+            self.assertEqual(f.read(), b"1")
+        with self.storage.open(writer.name) as f:
+            self.assertEqual(f.read(), b"2")
+
+    def test_local_error_partial_file_deleted(self):
+        with self.assertRaises(ValueError):
+            with StorageFileWriter("a/archive.tar", self.storage) as writer:
+                writer.write(b"yolo")
+                raise ValueError
+        self.assertFalse(os.path.exists(os.path.join(self.location, "a/archive.tar")))
+
+    def test_buffered(self):
+        storage = MemoryStorage()
+        with StorageFileWriter("archive.tar", storage) as writer:
+            writer.write(b"yolo")
+            self.assertEqual(storage.files, {})
+        self.assertEqual(writer.mode, "buffered")
+        self.assertEqual(storage.files, {"archive.tar": b"yolo"})
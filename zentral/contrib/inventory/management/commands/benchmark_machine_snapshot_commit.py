@@ -0,0 +1,131 @@
+import copy
+from datetime import datetime, timedelta
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MachineSnapshot
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Compare the duration and number of queries of the recursive and bulk machine snapshot commits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apps', type=int, default=800)
+        parser.add_argument('--certificates', type=int, default=60)
+        parser.add_argument('--network-interfaces', type=int, default=8)
+
+    def build_tree(self, options):
+        # realistic large macOS snapshot
+        prefix = get_random_string(8)
+        root_ca = {"common_name": "{} Root CA".format(prefix),
+                   "organization": "Apple Inc.",
+                   "organizational_unit": "Apple Certification Authority",
+                   "sha_1": get_random_string(40, "0123456789abcdef"),
+                   "valid_from": datetime(2006, 4, 25, 21, 40, 36),
+                   "valid_until": datetime(2035, 2, 9, 21, 40, 36)}
+        developer_id_ca = {"common_name": "{} Developer ID Certification Authority".format(prefix),
+                           "organization": "Apple Inc.",
+                           "organizational_unit": "Apple Certification Authority",
+                           "sha_1": get_random_string(40, "0123456789abcdef"),
+                           "valid_from": datetime(2012, 2, 1, 22, 12, 15),
+                           "valid_until": datetime(2027, 2, 1, 22, 12, 15),
+                           "signed_by": root_ca}
+        signing_certificates = [
+            {"common_name": "Developer ID Application: {} {} ({})".format(prefix, i, get_random_string(10)),
+             "organization": "{} {}".format(prefix, i),
+             "organizational_unit": get_random_string(10),
+             "sha_1": get_random_string(40, "0123456789abcdef"),
+             "valid_from": datetime(2019, 1, 1) + timedelta(days=i),
+             "valid_until": datetime(2024, 1, 1) + timedelta(days=i),
+             "signed_by": developer_id_ca}
+            for i in range(max(1, options["certificates"] // 2))
+        ]
+        certificates = [
+            {"common_name": "{} certificate {}".format(prefix, i),
+             "sha_1": get_random_string(40, "0123456789abcdef"),
+             "valid_from": datetime(2020, 1, 1),
+             "valid_until": datetime(2030, 1, 1),
+             "signed_by": root_ca}
+            for i in range(options["certificates"])
+        ]
+        osx_app_instances = []
+        for i in range(options["apps"]):
+            bundle_name = "{} App {}.app".format(prefix, i)
+            osx_app_instances.append({
+                "app": {"bundle_id": "com.example.{}.app{}".format(prefix, i),
+                        "bundle_name": bundle_name,
+                        "bundle_version": str(i),
+                        "bundle_version_str": "1.{}.0".format(i)},
+                "bundle_path": "/Applications/{}".format(bundle_name),
+                "signed_by": signing_certificates[i % len(signing_certificates)]
+            })
+        return {
+            "source": {"module": "zentral.contrib.inventory.benchmark", "name": "Benchmark"},
+            "serial_number": "{}{}".format(prefix, get_random_string(4)).upper(),
+            "os_version": {"name": "macOS", "major": 11, "minor": 2, "patch": 3, "build": "20D91"},
+            "system_info": {"computer_name": "{} MacBook Pro".format(prefix),
+                            "hardware_model": "MacBookPro16,1",
+                            "cpu_brand": "Intel(R) Core(TM) i9-9880H CPU @ 2.30GHz",
+                            "cpu_physical_cores": 8,
+                            "cpu_logical_cores": 16,
+                            "physical_memory": 34359738368},
+            "platform": "MACOS",
+            "type": "LAPTOP",
+            "network_interfaces": [
+                {"interface": "en{}".format(i),
+                 "mac": "00:11:22:33:44:{:02x}".format(i),
+                 "address": "192.168.{}.10".format(i),
+                 "mask": "255.255.255.0",
+                 "broadcast": "192.168.{}.255".format(i)}
+                for i in range(options["network_interfaces"])
+            ],
+            "osx_app_instances": osx_app_instances,
+            "certificates": certificates,
+        }
+
+    def commit(self, commit_func, tree, setup_tree=None):
+        # everything is rolled back
+        counter = QueryCounter()
+        try:
+            with transaction.atomic():
+                if setup_tree is not None:
+                    commit_func(copy.deepcopy(setup_tree))
+                with connection.execute_wrapper(counter):
+                    start = time.perf_counter()
+                    commit_func(copy.deepcopy(tree))
+                    duration = time.perf_counter() - start
+                raise Rollback
+        except Rollback:
+            pass
+        return duration, counter.count
+
+    def handle(self, *args, **options):
+        tree = self.build_tree(options)
+        updated_tree = copy.deepcopy(tree)
+        updated_tree["osx_app_instances"][0]["app"]["bundle_version_str"] = "2.0.0"
+        scenarios = (
+            ("new snapshot", tree, None),
+            ("unchanged snapshot", tree, tree),
+            ("one app updated", updated_tree, tree),
+        )
+        for name, scenario_tree, setup_tree in scenarios:
+            for commit_name, commit_func in (("recursive", MachineSnapshot.objects.commit),
+                                             ("bulk", MachineSnapshot.objects.bulk_commit)):
+                duration, query_count = self.commit(commit_func, scenario_tree, setup_tree)
+                self.stdout.write("{:<20} {:<10} {:>8.3f}s {:>6} queries".format(
+                    name, commit_name, duration, query_count
+                ))
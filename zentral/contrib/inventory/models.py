@@ -1,6 +1,8 @@
 import base64
 from collections import Counter
 from datetime import datetime, timedelta
+import hashlib
+import json
 import logging
 import re
 import urllib.parse
@@ -13,6 +15,8 @@ from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import connection, IntegrityError, models, transaction
 from django.db.models import Count, F, Q, Max
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
@@ -62,6 +66,13 @@ class MetaBusinessUnit(models.Model):
     def get_absolute_url(self):
         return reverse('inventory:mbu_machines', args=(self.id,))
 
+    def save(self, *args, **kwargs):
+        update = self.pk is not None
+        super().save(*args, **kwargs)
+        if update:
+            # the meta business unit names are included in the event info of the machines
+            _invalidate_meta_business_units_event_info_cache_on_commit([self.pk])
+
     def get_current_business_units(self):
         # !!! api enrollment business unit excluded !!!
         return BusinessUnit.objects.current().exclude(
@@ -195,7 +206,14 @@ class AbstractMachineGroup(AbstractMTObject):
 
     def save(self, *args, **kwargs):
         self.key = self.generate_key()
+        update = self.pk is not None
         super(AbstractMachineGroup, self).save()
+        if update:
+            # the group names are included in the event info of the machines
+            self.invalidate_event_info_cache_on_commit()
+
+    def invalidate_event_info_cache_on_commit(self):
+        raise NotImplementedError
 
     def get_short_key(self):
         return self.key[:8]
@@ -250,10 +268,16 @@ class BusinessUnit(AbstractMachineGroup):
     def can_be_deleted(self):
         return not self.machinesnapshot_set.count()
 
+    def invalidate_event_info_cache_on_commit(self):
+        _invalidate_current_machine_snapshots_event_info_cache_on_commit(machine_snapshot__business_unit=self)
+
 
 class MachineGroup(AbstractMachineGroup):
     machine_links = models.ManyToManyField(Link, related_name="+")  # tmpl for links to machine in a group
 
+    def invalidate_event_info_cache_on_commit(self):
+        _invalidate_current_machine_snapshots_event_info_cache_on_commit(machine_snapshot__groups=self)
+
 
 class OSVersion(AbstractMTObject):
     name = models.TextField(blank=True, null=True)
@@ -552,7 +576,76 @@ class MachineSnapshot(AbstractMTObject):
             pass
 
 
+MACHINE_SNAPSHOT_COMMIT_RESULTS = ("committed", "heartbeat", "skipped")
+
+
 class MachineSnapshotCommitManager(models.Manager):
+    commit_cache_timeout = 86400
+
+    @staticmethod
+    def get_heartbeat_resolution():
+        return int(settings["apps"]["zentral.contrib.inventory"].get("machine_snapshot_heartbeat_resolution", 0))
+
+    @staticmethod
+    def get_commit_cache_key(tree):
+        serial_number = tree.get("serial_number")
+        source = tree.get("source")
+        if not serial_number or not isinstance(source, dict):
+            return
+        source_h = hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return "msc-last_{}_{}".format(source_h, MetaMachine.make_urlsafe_serial_number(serial_number))
+
+    @staticmethod
+    def get_tree_fingerprint(tree):
+        # one hash over the whole tree, much cheaper than the MT hashes of all the nodes
+        return hashlib.sha1(json.dumps(tree, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_commit_result_counter_key(result):
+        return "msc-results_{}".format(result)
+
+    def incr_commit_result_counter(self, result):
+        key = self.get_commit_result_counter_key(result)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+    def get_commit_result_counts(self):
+        keys = {self.get_commit_result_counter_key(result): result for result in MACHINE_SNAPSHOT_COMMIT_RESULTS}
+        return {keys[key]: count for key, count in cache.get_many(list(keys.keys())).items()}
+
+    def _commit_unchanged_machine_snapshot_tree(self, last_commit, last_seen, system_uptime):
+        # verifies that the current machine snapshot is still the last committed one,
+        # and fetches it with its source
+        try:
+            cms = (CurrentMachineSnapshot.objects.select_related("machine_snapshot__source")
+                                                 .get(serial_number=last_commit["serial_number"],
+                                                      source__pk=last_commit["source_pk"],
+                                                      machine_snapshot__pk=last_commit["machine_snapshot_pk"]))
+        except CurrentMachineSnapshot.DoesNotExist:
+            return
+        machine_snapshot = cms.machine_snapshot
+        if last_commit["last_seen"] == last_seen and last_commit["system_uptime"] == system_uptime:
+            return "skipped", None, machine_snapshot
+        heartbeat_resolution = self.get_heartbeat_resolution()
+        if heartbeat_resolution and last_commit["last_seen"] \
+           and timedelta(0) <= last_seen - last_commit["last_seen"] < timedelta(seconds=heartbeat_resolution):
+            return "skipped", None, machine_snapshot
+        try:
+            with transaction.atomic():
+                new_msc = self.create(serial_number=machine_snapshot.serial_number,
+                                      source=machine_snapshot.source,
+                                      version=last_commit["version"] + 1,
+                                      machine_snapshot=machine_snapshot,
+                                      parent_id=last_commit["pk"],
+                                      last_seen=last_seen,
+                                      system_uptime=system_uptime)
+        except IntegrityError:
+            # concurrent commit → full commit
+            return
+        return "heartbeat", new_msc, machine_snapshot
+
     def commit_machine_snapshot_tree(self, tree):
         last_seen = tree.pop('last_seen', None)
         if not last_seen:
@@ -562,7 +655,43 @@ class MachineSnapshotCommitManager(models.Manager):
         system_uptime = tree.pop('system_uptime', None)
         update_ms_tree_platform(tree)
         update_ms_tree_type(tree)
-        machine_snapshot, _ = MachineSnapshot.objects.commit(tree)
+        # identical tree → no MT hashing and commit
+        cache_key = self.get_commit_cache_key(tree)
+        fingerprint = None
+        if cache_key:
+            fingerprint = self.get_tree_fingerprint(tree)
+            last_commit = cache.get(cache_key)
+            if last_commit and last_commit["fingerprint"] == fingerprint:
+                cached_commit = self._commit_unchanged_machine_snapshot_tree(last_commit, last_seen, system_uptime)
+                if cached_commit:
+                    result, new_msc, machine_snapshot = cached_commit
+                    if new_msc:
+                        self.set_last_commit_cache(cache_key, fingerprint, new_msc)
+                    self.incr_commit_result_counter(result)
+                    return new_msc, machine_snapshot
+                cache.delete(cache_key)
+        new_msc, machine_snapshot = self._commit_machine_snapshot_tree(tree, last_seen, system_uptime)
+        if cache_key:
+            last_msc = new_msc or machine_snapshot.last_commit
+            if last_msc and last_msc.machine_snapshot_id == machine_snapshot.pk:
+                self.set_last_commit_cache(cache_key, fingerprint, last_msc)
+        self.incr_commit_result_counter("committed")
+        return new_msc, machine_snapshot
+
+    def set_last_commit_cache(self, cache_key, fingerprint, msc):
+        cache.set(cache_key,
+                  {"fingerprint": fingerprint,
+                   "pk": msc.pk,
+                   "version": msc.version,
+                   "serial_number": msc.serial_number,
+                   "source_pk": msc.source_id,
+                   "machine_snapshot_pk": msc.machine_snapshot_id,
+                   "last_seen": msc.last_seen,
+                   "system_uptime": msc.system_uptime},
+                  self.commit_cache_timeout)
+
+    def _commit_machine_snapshot_tree(self, tree, last_seen, system_uptime):
+        machine_snapshot, _ = MachineSnapshot.objects.bulk_commit(tree)
         serial_number = machine_snapshot.serial_number
         source = machine_snapshot.source
         new_version = new_parent = None
@@ -588,9 +717,16 @@ class MachineSnapshotCommitManager(models.Manager):
                                                                    parent=new_parent,
                                                                    last_seen=last_seen,
                                                                    system_uptime=system_uptime)
-                CurrentMachineSnapshot.objects.update_or_create(serial_number=serial_number,
-                                                                source=source,
-                                                                defaults={'machine_snapshot': machine_snapshot})
+                _, cms_created = CurrentMachineSnapshot.objects.update_or_create(
+                    serial_number=serial_number,
+                    source=source,
+                    defaults={'machine_snapshot': machine_snapshot}
+                )
+                if cms_created or (
+                    new_version and (new_parent is None or new_parent.machine_snapshot != machine_snapshot)
+                ):
+                    # the machine info used in the events has changed
+                    MetaMachine.invalidate_event_info_cache_on_commit([serial_number])
                 return new_msc, machine_snapshot
         except IntegrityError:
             msc = MachineSnapshotCommit.objects.get(serial_number=serial_number,
@@ -741,7 +877,11 @@ class Tag(models.Model):
 
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
+        update = self.pk is not None
         super(Tag, self).save(*args, **kwargs)
+        if update:
+            # the tag names are included in the event info of the machines
+            _invalidate_tags_event_info_cache_on_commit([self.pk])
 
     def links(self):
         known_models = {
@@ -768,23 +908,93 @@ class Tag(models.Model):
         return link_list
 
 
+class MachineTagQuerySet(models.QuerySet):
+    def delete(self):
+        serial_numbers = set(self.values_list("serial_number", flat=True))
+        deleted = super().delete()
+        MetaMachine.invalidate_event_info_cache_on_commit(serial_numbers)
+        return deleted
+
+
 class MachineTag(models.Model):
     serial_number = models.TextField()
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
 
+    objects = MachineTagQuerySet.as_manager()
+
     class Meta:
         unique_together = (('serial_number', 'tag'),)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        MetaMachine.invalidate_event_info_cache_on_commit([self.serial_number])
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        MetaMachine.invalidate_event_info_cache_on_commit([self.serial_number])
+        return deleted
+
+
+def _invalidate_current_machine_snapshots_event_info_cache_on_commit(**lookup):
+    serial_numbers = set(CurrentMachineSnapshot.objects.filter(**lookup).values_list("serial_number", flat=True))
+    MetaMachine.invalidate_event_info_cache_on_commit(serial_numbers)
+
+
+def _invalidate_meta_business_units_event_info_cache_on_commit(meta_business_unit_ids):
+    if not meta_business_unit_ids:
+        return
+    _invalidate_current_machine_snapshots_event_info_cache_on_commit(
+        machine_snapshot__business_unit__meta_business_unit__in=meta_business_unit_ids
+    )
+
+
+class MetaBusinessUnitTagQuerySet(models.QuerySet):
+    def delete(self):
+        meta_business_unit_ids = set(self.values_list("meta_business_unit_id", flat=True))
+        deleted = super().delete()
+        _invalidate_meta_business_units_event_info_cache_on_commit(meta_business_unit_ids)
+        return deleted
+
 
 class MetaBusinessUnitTag(models.Model):
     meta_business_unit = models.ForeignKey(MetaBusinessUnit, on_delete=models.CASCADE)
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
 
+    objects = MetaBusinessUnitTagQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _invalidate_meta_business_units_event_info_cache_on_commit([self.meta_business_unit_id])
+
+    def delete(self, *args, **kwargs):
+        meta_business_unit_id = self.meta_business_unit_id
+        deleted = super().delete(*args, **kwargs)
+        _invalidate_meta_business_units_event_info_cache_on_commit([meta_business_unit_id])
+        return deleted
+
+
+def _invalidate_tags_event_info_cache_on_commit(tag_ids):
+    MetaMachine.invalidate_event_info_cache_on_commit(
+        MachineTag.objects.filter(tag__in=tag_ids).values_list("serial_number", flat=True)
+    )
+    _invalidate_meta_business_units_event_info_cache_on_commit(
+        set(MetaBusinessUnitTag.objects.filter(tag__in=tag_ids).values_list("meta_business_unit_id", flat=True))
+    )
+
+
+@receiver(pre_delete, sender=Tag)
+def invalidate_deleted_tag_event_info_cache(sender, instance, **kwargs):
+    # the MachineTag and MetaBusinessUnitTag rows are deleted in cascade by the collector,
+    # without going through their model or queryset delete methods
+    _invalidate_tags_event_info_cache_on_commit([instance.pk])
+
 
 class MetaMachine:
     """Simplified access to the ms."""
     def __init__(self, serial_number, snapshots=None):
         self.serial_number = serial_number
+        # "hit" or "miss" for each event info cache lookup, for the metrics
+        self.event_info_cache_results = []
 
     @cached_property
     def _event_serialization_options(self):
@@ -985,6 +1195,7 @@ class MetaMachine:
 
     def archive(self):
         CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number).delete()
+        self.invalidate_event_info_cache_on_commit([self.serial_number])
 
     def has_recent_source_snapshot(self, source_module, max_age=3600):
         query = (
@@ -1001,35 +1212,36 @@ class MetaMachine:
 
     # events related methods
 
-    @cached_property
-    def _raw_info_for_event(self):
-        """Returns all the machine info necessary for the events in 1 DB query.
+    @staticmethod
+    def _iter_raw_info_for_event(serial_numbers, include_groups=True, include_principal_user=True):
+        """Yields all the machine info necessary for the events in 1 DB query.
 
-        This is used in get_probe_filtering_values and get_serialized_info_for_event. Both of them are used during
-        the event enrichment pipeline step, thus the use of the single cached property as source.
+        The rows are (serial number, source, key, aggregation) tuples.
         """
         query = (
             "with ms as ("
-            "  select s.name as src, ms.id, ms.type, ms.platform,"
+            "  select cms.serial_number, s.name as src, ms.id, ms.type, ms.platform,"
             "  ms.business_unit_id, ms.os_version_id, ms.system_info_id, ms.principal_user_id"
             "  from inventory_machinesnapshot as ms"
             "  join inventory_currentmachinesnapshot as cms on (cms.machine_snapshot_id = ms.id)"
             "  join inventory_source as s on (ms.source_id = s.id)"
-            "  where cms.serial_number = %s"
+            "  where cms.serial_number = ANY(%(serial_numbers)s)"
             "), bu as ("
-            "  select s.name as src, s.module, bu.id, bu.key, bu.meta_business_unit_id, bu.name, bu.reference"
+            "  select ms.serial_number, s.name as src, s.module,"
+            "  bu.id, bu.key, bu.meta_business_unit_id, bu.name, bu.reference"
             "  from inventory_businessunit as bu"
             "  join ms on (ms.business_unit_id = bu.id)"
             "  join inventory_source as s on (s.id = bu.source_id)"
             "), t as ("
-            "  select mt.tag_id as id from inventory_machinetag as mt where mt.serial_number = %s"
+            "  select mt.serial_number, mt.tag_id as id from inventory_machinetag as mt"
+            "  where mt.serial_number = ANY(%(serial_numbers)s)"
             "  union"
-            "  select mbut.tag_id as id from inventory_metabusinessunittag as mbut"
+            "  select bu.serial_number, mbut.tag_id as id from inventory_metabusinessunittag as mbut"
             "  join bu on (bu.meta_business_unit_id = mbut.meta_business_unit_id)"
             ") "
 
             # hostnames
-            "select ms.src, 'system_info' as key,"
+            "select ms.serial_number, ms.src, 'system_info' as key,"
             "jsonb_build_object('computer_name', si.computer_name, 'hostname', si.hostname) "
             "from inventory_systeminfo as si "
             "join ms on ms.system_info_id = si.id "
@@ -1038,7 +1250,7 @@ class MetaMachine:
             "union "
 
             # business units not API only
-            "select bu.src, 'business_unit' as key,"
+            "select bu.serial_number, bu.src, 'business_unit' as key,"
             "jsonb_build_object('reference', bu.reference, 'name', bu.name, 'key', substring(bu.key, 0, 9)) "
             "from bu "
             "where bu.module <> 'zentral.contrib.inventory'"
@@ -1046,14 +1258,14 @@ class MetaMachine:
             "union "
 
             # tags
-            "select null, 'tags' as key,"
+            "select t.serial_number, null, 'tags' as key,"
             "jsonb_build_object('id', t.id, 'name', it.name) "
             "from t join inventory_tag as it on (it.id = t.id) "
 
             "union "
 
             # os versions
-            "select ms.src, 'os_version' as key,"
+            "select ms.serial_number, ms.src, 'os_version' as key,"
             "jsonb_build_object("
             "  'name', osv.name, 'major', osv.major, 'minor', osv.minor, 'patch', osv.patch, 'build', osv.build"
             ") "
@@ -1062,55 +1274,71 @@ class MetaMachine:
             "union "
 
             # platforms
-            "select null, 'platforms' as key,"
-            "jsonb_agg(distinct ms.platform) from ms where ms.platform is not null "
+            "select ms.serial_number, null, 'platforms' as key,"
+            "jsonb_agg(distinct ms.platform) from ms where ms.platform is not null group by ms.serial_number "
 
             "union "
 
             # types
-            "select null, 'types' as key,"
-            "jsonb_agg(distinct ms.type) from ms where ms.type is not null "
+            "select ms.serial_number, null, 'types' as key,"
+            "jsonb_agg(distinct ms.type) from ms where ms.type is not null group by ms.serial_number "
 
             "union "
 
             # meta business units
-            "select null, 'meta_business_units' as key,"
+            "select bu.serial_number, null, 'meta_business_units' as key,"
             "jsonb_build_object('id', mbu.id, 'name', mbu.name) "
             "from inventory_metabusinessunit as mbu "
             "join bu on (bu.meta_business_unit_id = mbu.id)"
         )
-        if self._include_groups_in_serialized_info_for_event():
+        if include_groups:
             query += (
                 "union "
 
                 # groups
-                "select ms.src, 'groups' as key, "
+                "select ms.serial_number, ms.src, 'groups' as key, "
                 "jsonb_build_object('reference', g.reference, 'name', g.name, 'key', substring(g.key, 0, 9)) "
                 "from inventory_machinegroup as g "
                 "join inventory_machinesnapshot_groups as msg on (msg.machinegroup_id = g.id) "
                 "join ms on (ms.id = msg.machinesnapshot_id) "
             )
-        if self._include_principal_user_in_serialized_info_for_event():
+        if include_principal_user:
             query += (
                 "union "
 
                 # principal user
-                "select ms.src, 'principal_user' as key,"
+                "select ms.serial_number, ms.src, 'principal_user' as key,"
                 "jsonb_build_object('id', pu.id, 'unique_id', pu.unique_id, 'principal_name', pu.principal_name) "
                 "from ms join inventory_principaluser as pu on (ms.principal_user_id = pu.id) "
             )
 
-        cursor = connection.cursor()
-        cursor.execute(query, [self.serial_number, self.serial_number])
-        return cursor.fetchall()
+        with connection.cursor() as cursor:
+            cursor.execute(query, {"serial_numbers": list(serial_numbers)})
+            yield from cursor.fetchall()
 
-    def get_probe_filtering_values(self):
-        """Returns the values used by the probe inventory filters."""
+    @cached_property
+    def _raw_info_for_event(self):
+        """Returns all the machine info necessary for the events in 1 DB query.
+
+        This is used in get_probe_filtering_values and get_serialized_info_for_event. Both of them are used during
+        the event enrichment pipeline step, thus the use of the single cached property as source.
+        """
+        return [
+            (src, key, agg)
+            for _, src, key, agg in self._iter_raw_info_for_event(
+                [self.serial_number],
+                self._include_groups_in_serialized_info_for_event(),
+                self._include_principal_user_in_serialized_info_for_event()
+            )
+        ]
+
+    @staticmethod
+    def _probe_filtering_values_from_raw_info(raw_info):
         platform_fv = None
         type_fv = None
         mbu_ids = set([])
         tag_ids = set([])
-        for src, key, agg in self._raw_info_for_event:
+        for src, key, agg in raw_info:
             if not agg:
                 continue
             if key == "platforms":
@@ -1123,15 +1351,35 @@ class MetaMachine:
                 tag_ids.add(agg["id"])
         return (platform_fv, type_fv, mbu_ids, tag_ids)
 
+    def get_probe_filtering_values(self):
+        """Returns the values used by the probe inventory filters."""
+        return self._probe_filtering_values_from_raw_info(self._raw_info_for_event)
+
+    @classmethod
+    def _probe_filtering_values_cache_key(cls, serial_number):
+        return "mm-probe-fvs_{}".format(cls.make_urlsafe_serial_number(serial_number))
+
+    @staticmethod
+    def get_event_info_cache_timeout():
+        return int(settings["apps"]["zentral.contrib.inventory"].get("event_info_cache_timeout", 3600))
+
+    def _get_cached_event_info(self, cache_key, func):
+        value = cache.get(cache_key)
+        if value is None:
+            self.event_info_cache_results.append("miss")
+            value = func()
+            cache.set(cache_key, value, self.get_event_info_cache_timeout())
+        else:
+            self.event_info_cache_results.append("hit")
+        return value
+
     @cached_property
     def cached_probe_filtering_values(self):
         """Cached version of get_probe_filtering_values"""
-        cache_key = "mm-probe-fvs_{}".format(self.get_urlsafe_serial_number())
-        filtering_values = cache.get(cache_key)
-        if filtering_values is None:
-            filtering_values = self.get_probe_filtering_values()
-            cache.set(cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
-        return filtering_values
+        return self._get_cached_event_info(
+            self._probe_filtering_values_cache_key(self.serial_number),
+            self.get_probe_filtering_values
+        )
 
     def get_legacy_serialized_info_for_event(self):
         """Serialize the machine information to be included in the events.
@@ -1174,13 +1422,10 @@ class MetaMachine:
             machine_d['type'] = self.type
         return machine_d
 
-    def get_serialized_info_for_event(self):
-        """Serialize the machine information to be included in the events.
-
-        Legacy ouput. Only 1 DB query.
-        """
+    @staticmethod
+    def _serialized_info_for_event_from_raw_info(raw_info):
         machine_d = {}
-        for src, key, agg in self._raw_info_for_event:
+        for src, key, agg in raw_info:
             if not agg:
                 continue
             if src:
@@ -1207,15 +1452,82 @@ class MetaMachine:
                 d.setdefault(key, []).append(agg)
         return machine_d
 
+    def get_serialized_info_for_event(self):
+        """Serialize the machine information to be included in the events.
+
+        Legacy ouput. Only 1 DB query.
+        """
+        return self._serialized_info_for_event_from_raw_info(self._raw_info_for_event)
+
+    @classmethod
+    def _serialized_info_for_event_cache_key(cls, serial_number):
+        return "mm-si_{}".format(cls.make_urlsafe_serial_number(serial_number))
+
     @cached_property
     def cached_serialized_info_for_event(self):
         """Cached version of get_serialized_info_for_event"""
-        cache_key = "mm-si_{}".format(self.get_urlsafe_serial_number())
-        serialized_info = cache.get(cache_key)
-        if serialized_info is None:
-            serialized_info = self.get_serialized_info_for_event()
-            cache.set(cache_key, serialized_info, 60)  # TODO: Hard coded timeout value
-        return serialized_info
+        return self._get_cached_event_info(
+            self._serialized_info_for_event_cache_key(self.serial_number),
+            self.get_serialized_info_for_event
+        )
+
+    def pop_event_info_cache_results(self):
+        results, self.event_info_cache_results = self.event_info_cache_results, []
+        return results
+
+    @classmethod
+    def invalidate_event_info_cache(cls, serial_numbers):
+        cache_keys = []
+        for serial_number in set(serial_numbers):
+            if not serial_number:
+                continue
+            cache_keys.append(cls._probe_filtering_values_cache_key(serial_number))
+            cache_keys.append(cls._serialized_info_for_event_cache_key(serial_number))
+        if cache_keys:
+            cache.delete_many(cache_keys)
+
+    @classmethod
+    def invalidate_event_info_cache_on_commit(cls, serial_numbers):
+        serial_numbers = set(serial_numbers)
+        if serial_numbers:
+            transaction.on_commit(lambda: cls.invalidate_event_info_cache(serial_numbers))
+
+    @classmethod
+    def prefetch_info_for_event(cls, serial_numbers):
+        """Fill the event info caches for many machines, with only 1 DB query for the cache misses.
+
+        Returns the number of machines for which the info had to be fetched from the DB.
+        """
+        cache_keys = {}
+        for serial_number in set(serial_numbers):
+            if not serial_number:
+                continue
+            cache_keys[cls._probe_filtering_values_cache_key(serial_number)] = serial_number
+            cache_keys[cls._serialized_info_for_event_cache_key(serial_number)] = serial_number
+        if not cache_keys:
+            return 0
+        cached_keys = cache.get_many(list(cache_keys.keys()))
+        missing_serial_numbers = {serial_number
+                                  for cache_key, serial_number in cache_keys.items()
+                                  if cache_key not in cached_keys}
+        if not missing_serial_numbers:
+            return 0
+        event_serialization_options = settings["apps"]["zentral.contrib.inventory"].get("event_serialization", {})
+        raw_infos = {serial_number: [] for serial_number in missing_serial_numbers}
+        for serial_number, src, key, agg in cls._iter_raw_info_for_event(
+            missing_serial_numbers,
+            event_serialization_options.get("include_groups", True),
+            event_serialization_options.get("include_principal_user", True)
+        ):
+            raw_infos[serial_number].append((src, key, agg))
+        data = {}
+        for serial_number, raw_info in raw_infos.items():
+            data[cls._probe_filtering_values_cache_key(serial_number)] = \
+                cls._probe_filtering_values_from_raw_info(raw_info)
+            data[cls._serialized_info_for_event_cache_key(serial_number)] = \
+                cls._serialized_info_for_event_from_raw_info(raw_info)
+        cache.set_many(data, cls.get_event_info_cache_timeout())
+        return len(missing_serial_numbers)
 
 
 class MACAddressBlockAssignmentOrganization(models.Model):
@@ -17,11 +17,12 @@ from django.db import connection, transaction
 from django.http import QueryDict
 from django.urls import reverse
 from django.utils.text import slugify
-from prometheus_client import CollectorRegistry, Gauge
+from prometheus_client import CollectorRegistry, Counter, Gauge
 import xlsxwriter
 from zentral.core.incidents.models import OPEN_STATUSES, SEVERITY_CHOICES
 from zentral.utils.json import save_dead_letter
-from .events import (post_enrollment_secret_verification_failure, post_enrollment_secret_verification_success,
+from .events import (build_inventory_events,
+                     post_enrollment_secret_verification_failure, post_enrollment_secret_verification_success,
                      post_inventory_events)
 from .exceptions import EnrollmentSecretVerificationFailed
 from .models import EnrollmentSecret, MachineSnapshotCommit, MetaMachine
@@ -1344,6 +1345,11 @@ def get_prometheus_inventory_metrics():
     for r in os_version_count():
         count = r.pop('count')
         g.labels(**r).set(count)
+    c = Counter('zentral_inventory_machine_snapshot_commits', 'Zentral inventory machine snapshot commits',
+                ['result'],
+                registry=registry)
+    for result, count in MachineSnapshotCommit.objects.get_commit_result_counts().items():
+        c.labels(result=result).inc(count)
     return registry
 
 
@@ -1418,6 +1424,19 @@ def commit_machine_snapshot_and_trigger_events(tree):
         return machine_snapshot
 
 
+def commit_machine_snapshot_and_yield_events(tree):
+    # for the preprocessors, that yield the events instead of posting them
+    try:
+        machine_snapshot_commit, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+    except Exception:
+        logger.exception("Could not commit machine snapshot")
+        save_dead_letter(tree, "machine snapshot commit error")
+    else:
+        if machine_snapshot_commit:
+            yield from build_inventory_events(machine_snapshot_commit.serial_number,
+                                              inventory_events_from_machine_snapshot_commit(machine_snapshot_commit))
+
+
 def verify_enrollment_secret(model, secret,
                              user_agent, public_ip_address,
                              serial_number=None, udid=None,
@@ -1,22 +1,97 @@
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from datetime import timezone
 import logging
 import random
 from tempfile import NamedTemporaryFile
+import threading
 import time
+import uuid
 import httpx
 from zentral.core.events.base import EventMetadata
 from .events import MDMDeviceNotificationEvent
+from .utils import (apns_notification_attempts_counter,
+                    apns_notification_failures_counter,
+                    apns_notification_throttles_counter)
 
 
 logger = logging.getLogger('zentral.contrib.mdm.apns')
 
 
+# a device, or a user if user_id is not None
+APNSTarget = namedtuple("APNSTarget", ("serial_number", "udid", "push_magic", "token", "user_id"))
+
+
+# a notification for a target, with the same apns-id and expiration across the attempts
+APNSNotification = namedtuple("APNSNotification", ("target", "apns_id", "expiration", "attempt"))
+
+
+# the result of a notification attempt. status is success, failure, or retry.
+# retry_delay is the minimum number of seconds to wait before the next attempt.
+APNSResult = namedtuple("APNSResult", ("notification", "status", "status_code", "retry_delay"))
+
+
+def get_device_target(enrolled_device):
+    return APNSTarget(enrolled_device.serial_number, enrolled_device.udid, enrolled_device.push_magic,
+                      bytes(enrolled_device.token), None)
+
+
+def get_user_target(enrolled_user):
+    enrolled_device = enrolled_user.enrolled_device
+    return APNSTarget(enrolled_device.serial_number, enrolled_device.udid, enrolled_device.push_magic,
+                      bytes(enrolled_user.token), enrolled_user.user_id)
+
+
+def serialize_notification(notification):
+    target = notification.target
+    return {"serial_number": target.serial_number,
+            "udid": target.udid,
+            "push_magic": target.push_magic,
+            "token": target.token.hex(),
+            "user_id": target.user_id,
+            "apns_id": notification.apns_id,
+            "expiration": notification.expiration,
+            "attempt": notification.attempt}
+
+
+def deserialize_notification(data):
+    target = APNSTarget(data["serial_number"], data["udid"], data["push_magic"],
+                        bytes.fromhex(data["token"]), data["user_id"])
+    return APNSNotification(target, data["apns_id"], data["expiration"], data["attempt"])
+
+
+def parse_retry_after(value):
+    """Return the number of seconds to wait from a Retry-After header value, or None"""
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_after = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.warning("Invalid Retry-After header value: %s", value)
+        return None
+    if retry_after.tzinfo is None:
+        retry_after = retry_after.replace(tzinfo=timezone.utc)
+    return max(0, retry_after.timestamp() - time.time())
+
+
 class APNSClient(object):
     apns_production_base_url = "https://api.push.apple.com"
     timeout = 5
-    max_retries = 2
+    # the retries are not done by the client, but scheduled by the caller
+    max_retries = 4
+    retry_base_delay = 2
+    retry_max_delay = 300
+    # max concurrent HTTP/2 streams over the client connection, for all the calls
+    max_concurrent_streams = 20
 
-    def __init__(self, push_certificate):
+    def __init__(self, push_certificate, base_url=None, verify=True):
         self.push_certificate = push_certificate
+        self._streams_semaphore = threading.BoundedSemaphore(self.max_concurrent_streams)
         # We have to materialize the certificate
         # Python SSL contexts cannot load cert and key from memory
         # TODO update when the Python API is available
@@ -26,50 +101,94 @@ class APNSClient(object):
             with NamedTemporaryFile() as tmp_key_file:
                 tmp_key_file.write(self.push_certificate.private_key.tobytes())
                 tmp_key_file.flush()
-                self.client = httpx.Client(base_url=self.apns_production_base_url,
+                self.client = httpx.Client(base_url=base_url or self.apns_production_base_url,
                                            http2=True,
-                                           verify=True,
+                                           verify=verify,
                                            cert=(tmp_cert_file.name, tmp_key_file.name),
                                            timeout=self.timeout)
 
-    def _send_notification(self, enrolled_device, target, priority, expiration_seconds):
-        logger.debug("APNS notify device %s, target %s", enrolled_device, target)
+    def build_notifications(self, targets, expiration_seconds=3600):
+        expiration = int(time.time()) + expiration_seconds
+        return [APNSNotification(target, str(uuid.uuid4()), expiration, 0) for target in targets]
+
+    def _get_retry_delay(self, notification, retry_after):
+        delay = min(self.retry_base_delay * 2 ** notification.attempt * (1 + random.random()),
+                    self.retry_max_delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _post_notification(self, notification, priority, schedule_retry):
+        target = notification.target
+        logger.debug("APNS notify device %s, user %s, apns-id %s, attempt %s",
+                     target.udid, target.user_id, notification.apns_id, notification.attempt)
         path = "/3/device/{}".format(target.token.hex())
-        json_data = {"mdm": enrolled_device.push_magic}
-        headers = {"apns-expiration": str(int(time.time()) + expiration_seconds),
+        json_data = {"mdm": target.push_magic}
+        headers = {"apns-expiration": str(notification.expiration),
+                   "apns-id": notification.apns_id,
                    "apns-priority": str(priority),
                    "apns-topic": self.push_certificate.topic}
-
-        status = "failure"
-        for retry_num in range(self.max_retries + 1):
+        status_code = retry_after = None
+        with self._streams_semaphore:
             try:
                 r = self.client.post(path, json=json_data, headers=headers)
             except Exception:
-                logger.exception("Could not send notification")
+                logger.exception("Could not send notification %s", notification.apns_id)
             else:
-                if r.status_code == httpx.codes.OK:
-                    status = "success"
-                    break
-                elif r.status_code < 500:
-                    # only retry 500s
-                    break
-                else:
-                    logger.error("Status code: %s", r.status_code)
-
-            sleep_time = random.random() * 2 ** retry_num
-            logger.warning("Could not send notification. Sleep %.2f seconds before retry %s of %s.",
-                           sleep_time, retry_num, self.MAX_RETRIES)
-            time.sleep(sleep_time)
-
-        event_metadata = EventMetadata(machine_serial_number=enrolled_device.serial_number)
-        event_payload = {"status": status, "udid": enrolled_device.udid,
-                         "apns_priority": priority, "apns_expiration_seconds": expiration_seconds}
-        if target != enrolled_device:
+                status_code = r.status_code
+        if status_code == httpx.codes.OK:
+            return APNSResult(notification, "success", status_code, None)
+        if status_code is not None:
+            try:
+                reason = r.json().get("reason")
+            except Exception:
+                reason = None
+            logger.error("Notification %s: status code %s, reason %s",
+                         r.headers.get("apns-id", notification.apns_id), status_code, reason)
+            if status_code != httpx.codes.TOO_MANY_REQUESTS and status_code < 500:
+                # only retry the throttled requests and the server errors
+                return APNSResult(notification, "failure", status_code, None)
+            retry_after = parse_retry_after(r.headers.get("retry-after"))
+        if not schedule_retry or notification.attempt >= self.max_retries:
+            return APNSResult(notification, "failure", status_code, None)
+        retry_delay = self._get_retry_delay(notification, retry_after)
+        if time.time() + retry_delay >= notification.expiration:
+            logger.error("Notification %s would expire before the next attempt", notification.apns_id)
+            return APNSResult(notification, "failure", status_code, None)
+        return APNSResult(notification, "retry", status_code, retry_delay)
+
+    def _post_event(self, result, priority):
+        notification = result.notification
+        target = notification.target
+        event_metadata = EventMetadata(machine_serial_number=target.serial_number)
+        event_payload = {"status": result.status, "udid": target.udid,
+                         "apns_id": notification.apns_id,
+                         "apns_priority": priority,
+                         "apns_expiration_seconds": max(0, notification.expiration - int(time.time()))}
+        if target.user_id is not None:
             event_payload["user_id"] = target.user_id
         event = MDMDeviceNotificationEvent(event_metadata, event_payload)
         event.post()
 
-        return status
+    def _update_metrics(self, results):
+        label_value = str(self.push_certificate.pk)
+        counts = Counter()
+        for result in results:
+            counts["attempts"] += 1
+            if result.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                counts["throttles"] += 1
+            if result.status == "failure":
+                counts["failures"] += 1
+        for key, counter in (("attempts", apns_notification_attempts_counter),
+                             ("throttles", apns_notification_throttles_counter),
+                             ("failures", apns_notification_failures_counter)):
+            if counts[key]:
+                counter.inc(label_value, counts[key])
+
+    def _send_notification(self, target, priority, expiration_seconds):
+        # no retry scheduling for the single notifications
+        notification = self.build_notifications([target], expiration_seconds)[0]
+        return self.send_apns_notifications([notification], priority, schedule_retries=False)[0].status
 
     def _verify_enrolled_device(self, enrolled_device):
         if enrolled_device.push_certificate != self.push_certificate:
@@ -79,9 +198,34 @@ class APNSClient(object):
 
     def send_device_notification(self, enrolled_device, priority=10, expiration_seconds=3600):
         self._verify_enrolled_device(enrolled_device)
-        return self._send_notification(enrolled_device, enrolled_device, priority, expiration_seconds)
+        return self._send_notification(get_device_target(enrolled_device), priority, expiration_seconds)
 
     def send_user_notification(self, enrolled_user, priority=10, expiration_seconds=3600):
-        enrolled_device = enrolled_user.enrolled_device
-        self._verify_enrolled_device(enrolled_device)
-        return self._send_notification(enrolled_device, enrolled_user, priority, expiration_seconds)
+        self._verify_enrolled_device(enrolled_user.enrolled_device)
+        return self._send_notification(get_user_target(enrolled_user), priority, expiration_seconds)
+
+    def send_apns_notifications(self, notifications, priority=10, schedule_retries=True):
+        """Make one attempt for each notification, concurrently, as HTTP/2 streams of the client connection
+
+        The targets must be verified. Never waits between the attempts.
+        The throttled requests and the server errors get a retry status and a retry delay,
+        if schedule_retries is true and the maximum number of retries is not reached.
+        The retries have to be scheduled by the caller, with the same notifications and an incremented attempt.
+        Returns a list of APNSResult, in the order of the notifications.
+        """
+        notifications = list(notifications)
+        if not notifications:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent_streams, len(notifications))) as executor:
+            results = list(executor.map(lambda n: self._post_notification(n, priority, schedule_retries),
+                                        notifications))
+        # events and metrics from the calling thread
+        for result in results:
+            if result.status != "retry":
+                self._post_event(result, priority)
+        self._update_metrics(results)
+        return results
+
+    def send_notifications(self, targets, priority=10, expiration_seconds=3600):
+        """Send the notifications for the targets. See send_apns_notifications."""
+        return self.send_apns_notifications(self.build_notifications(targets, expiration_seconds), priority)
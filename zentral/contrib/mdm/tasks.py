@@ -1,8 +1,13 @@
+from collections import Counter
 import logging
+import math
 from celery import shared_task
-from .apns import APNSClient
+from django.db.models import Q
+from django.utils import timezone
+from .apns import (APNSClient, APNSTarget, deserialize_notification, get_user_target,
+                   serialize_notification)
 from .dep import sync_dep_virtual_server_devices, DEPClientError
-from .models import Artifact, Blueprint, DEPVirtualServer, EnrolledDevice, EnrolledUser
+from .models import Blueprint, DEPVirtualServer, EnrolledDevice, EnrolledUser, PushCertificate
 
 
 logger = logging.getLogger("zentral.contrib.mdm.tasks")
@@ -23,26 +28,111 @@ def get_apns_client(push_certificate):
     return client
 
 
-# devices
+def get_notification_targets(enrolled_device_pk_list=None, blueprint_pk_list=None, artifact_pk_list=None,
+                             notify_users=False):
+    """Deduplicated notification targets, grouped by push certificate pk
+
+    The devices that can be poked, and their users, are fetched in one query.
+    """
+    scope = Q()
+    if enrolled_device_pk_list:
+        scope |= Q(pk__in=enrolled_device_pk_list)
+    if blueprint_pk_list:
+        scope |= Q(blueprint__pk__in=blueprint_pk_list)
+    if artifact_pk_list:
+        scope |= Q(blueprint__in=Blueprint.objects.filter(blueprintartifact__artifact__pk__in=artifact_pk_list))
+    if not scope:
+        return {}
+    now = timezone.now()
+    fields = ["push_certificate_id", "serial_number", "udid", "push_magic", "token"]
+    if notify_users:
+        fields.extend(["enrolleduser__user_id", "enrolleduser__token"])
+    targets = {}
+    for row in (EnrolledDevice.objects.filter(scope)
+                                      .filter(checkout_at__isnull=True,
+                                              push_certificate__not_before__lt=now,
+                                              push_certificate__not_after__gt=now,
+                                              token__isnull=False,
+                                              push_magic__isnull=False)
+                                      .order_by()
+                                      .values_list(*fields)):
+        push_certificate_pk, serial_number, udid, push_magic, token = row[:5]
+        push_certificate_targets = targets.setdefault(push_certificate_pk, {})
+        push_certificate_targets[(udid, None)] = APNSTarget(serial_number, udid, push_magic, bytes(token), None)
+        if notify_users:
+            user_id, user_token = row[5:]
+            if user_id is not None:
+                push_certificate_targets[(udid, user_id)] = APNSTarget(serial_number, udid, push_magic,
+                                                                       bytes(user_token), user_id)
+    return {push_certificate_pk: list(push_certificate_targets.values())
+            for push_certificate_pk, push_certificate_targets in targets.items()}
+
+
+def _schedule_notification_retries(push_certificate, results):
+    retries = [result for result in results if result.status == "retry"]
+    if not retries:
+        return
+    # one delayed batch, once the retry delays of all the notifications have elapsed
+    countdown = math.ceil(max(result.retry_delay for result in retries))
+    logger.warning("Push certificate %s: retry %s notification(s) in %s second(s)",
+                   push_certificate.pk, len(retries), countdown)
+    send_notifications_retry_task.apply_async(
+        (push_certificate.pk,
+         [serialize_notification(result.notification._replace(attempt=result.notification.attempt + 1))
+          for result in retries]),
+        countdown=countdown
+    )
+
+
+def send_notifications(targets):
+    """Send the notifications for the targets returned by get_notification_targets
 
+    The notifications that can be retried are re-dispatched as delayed batch tasks.
+    Returns a list of APNSResult.
+    """
+    results = []
+    if not targets:
+        return results
+    for push_certificate in PushCertificate.objects.filter(pk__in=targets.keys()):
+        client = get_apns_client(push_certificate)
+        push_certificate_results = client.send_notifications(targets[push_certificate.pk])
+        _schedule_notification_retries(push_certificate, push_certificate_results)
+        results.extend(push_certificate_results)
+    return results
 
-def _send_enrolled_device_notification(enrolled_device, notify_users):
-    if not enrolled_device.can_be_poked():
-        logger.error("Enrolled device %s cannot be poked", enrolled_device.udid)
+
+def _log_notification_results(results):
+    statuses = Counter(result.status for result in results)
+    logger.info("Sent %s notification(s), %s failure(s), %s retry(ies)",
+                len(results), statuses["failure"], statuses["retry"])
+
+
+@shared_task(ignore_result=True)
+def send_notifications_retry_task(push_certificate_pk, serialized_notifications):
+    try:
+        push_certificate = PushCertificate.objects.get(pk=push_certificate_pk)
+    except PushCertificate.DoesNotExist:
+        logger.error("Unknown push certificate %s: drop %s notification(s)",
+                     push_certificate_pk, len(serialized_notifications))
         return
-    client = get_apns_client(enrolled_device.push_certificate)
-    client.send_device_notification(enrolled_device)
-    if notify_users:
-        for enrolled_user in enrolled_device.enrolleduser_set.all():
-            client.send_user_notification(enrolled_user)
+    client = get_apns_client(push_certificate)
+    results = client.send_apns_notifications([deserialize_notification(data) for data in serialized_notifications])
+    _schedule_notification_retries(push_certificate, results)
+    _log_notification_results(results)
+
+
+# devices
 
 
 @shared_task(ignore_result=True)
 def send_enrolled_devices_notifications_task(enrolled_device_pk_list, notify_users=False):
-    for enrolled_device in (EnrolledDevice.objects.select_related("push_certificate")
-                                                  .prefetch_related("enrolleduser_set")
-                                                  .filter(pk__in=enrolled_device_pk_list)):
-        _send_enrolled_device_notification(enrolled_device, notify_users)
+    targets = get_notification_targets(enrolled_device_pk_list=enrolled_device_pk_list, notify_users=notify_users)
+    poked_udids = set(target.udid for push_certificate_targets in targets.values()
+                      for target in push_certificate_targets)
+    for udid in EnrolledDevice.objects.filter(pk__in=enrolled_device_pk_list).values_list("udid", flat=True):
+        if udid not in poked_udids:
+            logger.error("Enrolled device %s cannot be poked", udid)
+    _log_notification_results(send_notifications(targets))
 
 
 def send_enrolled_device_notification(enrolled_device, notify_users=False, delay=0):
@@ -55,20 +145,17 @@ def send_enrolled_device_notification(enrolled_device, notify_users=False, delay
 # users
 
 
-def _send_enrolled_user_notification(enrolled_user):
-    enrolled_device = enrolled_user.enrolled_device
-    if not enrolled_device.can_be_poked():
-        logger.error("Enrolled user %s device %s cannot be poked", enrolled_device.udid, enrolled_user.user_id)
-        return
-    client = get_apns_client(enrolled_device.push_certificate)
-    client.send_user_notification(enrolled_user)
-
-
 @shared_task(ignore_result=True)
 def send_enrolled_users_notifications_task(enrolled_user_pk_list):
-    for enrolled_user in (EnrolledUser.objects.select_related("enrolled_user__push_certificate")
+    targets = {}
+    for enrolled_user in (EnrolledUser.objects.select_related("enrolled_device__push_certificate")
                                               .filter(pk__in=enrolled_user_pk_list)):
-        _send_enrolled_user_notification(enrolled_user)
+        enrolled_device = enrolled_user.enrolled_device
+        if not enrolled_device.can_be_poked():
+            logger.error("Enrolled user %s device %s cannot be poked", enrolled_user.user_id, enrolled_device.udid)
+            continue
+        targets.setdefault(enrolled_device.push_certificate_id, []).append(get_user_target(enrolled_user))
+    _log_notification_results(send_notifications(targets))
 
 
 def send_enrolled_user_notification(enrolled_user, delay=0):
@@ -81,18 +168,10 @@ def send_enrolled_user_notification(enrolled_user, delay=0):
 # blueprints
 
 
-def _send_blueprint_notifications(blueprint):
-    # TODO optimize. Platform? Channel?
-    for enrolled_device in (blueprint.enrolleddevice_set.select_related("push_certificate")
-                                                        .prefetch_related("enrolleduser_set")
-                                                        .all()):
-        _send_enrolled_device_notification(enrolled_device, True)
-
-
 @shared_task(ignore_result=True)
 def send_blueprints_notifications_task(blueprint_pk_list):
-    for blueprint in Blueprint.objects.filter(pk__in=blueprint_pk_list):
-        _send_blueprint_notifications(blueprint)
+    targets = get_notification_targets(blueprint_pk_list=blueprint_pk_list, notify_users=True)
+    _log_notification_results(send_notifications(targets))
 
 
 def send_blueprints_notifications(blueprints, delay=0):
@@ -103,22 +182,16 @@ def send_blueprints_notifications(blueprints, delay=0):
 
 
 def send_blueprint_notifications(blueprint, delay=0):
-    send_blueprints_notifications([blueprint])
+    send_blueprints_notifications([blueprint], delay)
 
 
 # artifacts
 
 
-def _send_artifact_notifications(artifact):
-    # TODO optimize. Platform? Channel? One DB call?
-    for blueprint in Blueprint.objects.filter(blueprintartifact__artifact=artifact):
-        _send_blueprint_notifications(blueprint)
-
-
 @shared_task(ignore_result=True)
 def send_artifacts_notifications_task(artifact_pk_list):
-    for artifact in Artifact.objects.filter(pk__in=artifact_pk_list):
-        _send_artifact_notifications(artifact)
+    targets = get_notification_targets(artifact_pk_list=artifact_pk_list, notify_users=True)
+    _log_notification_results(send_notifications(targets))
 
 
 def send_artifact_notifications(artifact, delay=0):
@@ -222,6 +222,9 @@ urlpatterns = [
     path('profiles/<uuid:pk>/',
          views.ProfileDownloadView.as_view(),
          name="profile_download_view"),
+
+    # prometheus
+    path('prometheus_metrics/', views.PrometheusMetricsView.as_view(), name='prometheus_metrics'),
 ]
 
 setup_menu_cfg = {
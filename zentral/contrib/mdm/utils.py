@@ -0,0 +1,32 @@
+from prometheus_client import CollectorRegistry
+from zentral.utils.prometheus import CachedCounter
+
+
+# APNs notifications, per push certificate
+
+apns_notification_attempts_counter = CachedCounter(
+    "zentral_mdm_apns_notification_attempts",
+    "APNs notification attempts",
+    "push_certificate"
+)
+apns_notification_throttles_counter = CachedCounter(
+    "zentral_mdm_apns_notification_throttles",
+    "APNs notification attempts throttled by APNs",
+    "push_certificate"
+)
+apns_notification_failures_counter = CachedCounter(
+    "zentral_mdm_apns_notification_failures",
+    "APNs notifications that could not be delivered",
+    "push_certificate"
+)
+
+
+def get_prometheus_mdm_metrics():
+    from .models import PushCertificate
+    registry = CollectorRegistry()
+    label_values = [str(pk) for pk in PushCertificate.objects.values_list("pk", flat=True)]
+    for counter in (apns_notification_attempts_counter,
+                    apns_notification_throttles_counter,
+                    apns_notification_failures_counter):
+        counter.register(registry, label_values)
+    return registry
@@ -3,6 +3,7 @@ from .inventory import *  # NOQA
 from .management import *  # NOQA
 from .mdm import *  # NOQA
 from .ota import *  # NOQA
+from .prometheus import *  # NOQA
 from .scep import *  # NOQA
 from .setup import *  # NOQA
 from .user import *  # NOQA
@@ -0,0 +1,7 @@
+from zentral.contrib.mdm.utils import get_prometheus_mdm_metrics
+from zentral.utils.prometheus import BasePrometheusMetricsView
+
+
+class PrometheusMetricsView(BasePrometheusMetricsView):
+    def get_registry(self):
+        return get_prometheus_mdm_metrics()
@@ -0,0 +1,107 @@
+import random
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
+from zentral.contrib.monolith.models import (Catalog, Manifest, ManifestCatalog, ManifestSnapshot,
+                                             ManifestSubManifest, PkgInfo, PkgInfoName, SubManifest)
+from zentral.contrib.monolith.snapshots import get_manifest_snapshot
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Replay munki catalog and manifest requests across varied machine tag sets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--pkginfos', type=int, default=2000)
+        parser.add_argument('--catalogs', type=int, default=4)
+        parser.add_argument('--sub-manifests', type=int, default=10)
+        parser.add_argument('--tags', type=int, default=50)
+        parser.add_argument('--manifest-tags', type=int, default=5)
+        parser.add_argument('--max-machine-tags', type=int, default=6)
+
+    def seed(self, options):
+        prefix = get_random_string(8)
+        meta_business_unit = MetaBusinessUnit.objects.create(name="Benchmark {}".format(prefix))
+        manifest = Manifest.objects.create(meta_business_unit=meta_business_unit, name="Benchmark {}".format(prefix))
+        tags = Tag.objects.bulk_create(Tag(name="Benchmark {} {}".format(prefix, i)) for i in range(options["tags"]))
+        # only a few tags are used to scope the manifest M2M rows
+        manifest_tags = tags[:options["manifest_tags"]]
+        catalogs = []
+        for i in range(options["catalogs"]):
+            catalog = Catalog.objects.create(name="Benchmark {} {}".format(prefix, i))
+            catalogs.append(catalog)
+            mc = ManifestCatalog.objects.create(manifest=manifest, catalog=catalog)
+            if i:
+                mc.tags.set([manifest_tags[i % len(manifest_tags)]])
+        for i in range(options["sub_manifests"]):
+            sub_manifest = SubManifest.objects.create(name="Benchmark {} {}".format(prefix, i))
+            msm = ManifestSubManifest.objects.create(manifest=manifest, sub_manifest=sub_manifest)
+            if i % 2:
+                msm.tags.set([manifest_tags[i % len(manifest_tags)]])
+        pkg_info_names = PkgInfoName.objects.bulk_create(
+            PkgInfoName(name="{}_{}".format(prefix, i)) for i in range(options["pkginfos"])
+        )
+        pkg_infos = PkgInfo.objects.bulk_create(
+            PkgInfo(name=pkg_info_name, version="1.0",
+                    data={"name": pkg_info_name.name, "version": "1.0",
+                          "installer_item_location": "{}.pkg".format(pkg_info_name.name)})
+            for pkg_info_name in pkg_info_names
+        )
+        PkgInfo.catalogs.through.objects.bulk_create(
+            PkgInfo.catalogs.through(pkginfo_id=pkg_info.pk, catalog_id=catalogs[i % len(catalogs)].pk)
+            for i, pkg_info in enumerate(pkg_infos)
+        )
+        return manifest, tags
+
+    def replay(self, manifest, machine_tags, get_documents):
+        # cold local memory cache
+        cache.clear()
+        start = time.perf_counter()
+        for tags in machine_tags:
+            get_documents(manifest, tags)
+        return time.perf_counter() - start
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                manifest, tags = self.seed(options)
+                machine_tags = [random.sample(tags, random.randint(0, options["max_machine_tags"]))
+                                for _ in range(options["requests"])]
+                distinct_tag_sets = len({frozenset(t.pk for t in mt) for mt in machine_tags})
+
+                # previous behavior: one cache entry per manifest version and machine tags
+                def cached_render(manifest, tags):
+                    key = "benchmark.{}.{}".format(manifest.pk, ".".join(sorted(str(t.pk) for t in tags)))
+                    if cache.get(key) is None:
+                        cache.set(key, (manifest.serialize_catalog(tags), manifest.serialize(tags)))
+
+                def snapshot_render(manifest, tags):
+                    get_manifest_snapshot(manifest, ManifestSnapshot.CATALOG, tags)
+                    get_manifest_snapshot(manifest, ManifestSnapshot.MANIFEST, tags)
+
+                cached_duration = self.replay(manifest, machine_tags, cached_render)
+                snapshot_duration = self.replay(manifest, machine_tags, snapshot_render)
+                snapshot_count = ManifestSnapshot.objects.filter(manifest=manifest).count()
+                # snapshots already materialized, cold cache after a deploy
+                warm_snapshot_duration = self.replay(manifest, machine_tags, snapshot_render)
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write("{} requests, {} distinct machine tag sets, {} snapshots".format(
+            len(machine_tags), distinct_tag_sets, snapshot_count
+        ))
+        for name, duration in (("tag set cache", cached_duration),
+                               ("snapshots", snapshot_duration),
+                               ("materialized snapshots", warm_snapshot_duration)):
+            self.stdout.write("{:<25} {:>8.3f}s {:>8.3f}ms/request".format(
+                name, duration, duration * 1000 / len(machine_tags)
+            ))
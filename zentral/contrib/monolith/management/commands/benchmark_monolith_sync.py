@@ -0,0 +1,72 @@
+import os
+import plistlib
+import random
+import tempfile
+import time
+from unittest.mock import patch
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from zentral.contrib.monolith.repository_backends.local import Repository
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Sync a generated local munki repository'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pkginfos', type=int, default=50000)
+        parser.add_argument('--catalogs', type=int, default=4)
+        parser.add_argument('--changes', type=float, default=0.01,
+                            help="Ratio of pkginfos updated or removed between the syncs")
+
+    def generate_repository(self, options):
+        prefix = get_random_string(8)
+        catalogs = ["{}_{}".format(prefix, i) for i in range(options["catalogs"])]
+        pkg_info_data_list = []
+        for i in range(options["pkginfos"]):
+            name = "{}_{}".format(prefix, i // 3)
+            version = "{}.0".format(i % 3)
+            pkg_info_data = {"name": name,
+                             "version": version,
+                             "catalogs": [random.choice(catalogs)],
+                             "installer_item_location": "{}-{}.pkg".format(name, version)}
+            if i > 3:
+                pkg_info_data["requires"] = ["{}_{}".format(prefix, random.randrange(i // 3))]
+            pkg_info_data_list.append(pkg_info_data)
+        return pkg_info_data_list
+
+    def sync(self, repository, pkg_info_data_list):
+        with open(repository.get_all_catalog_local_path(), "wb") as f:
+            plistlib.dump(pkg_info_data_list, f)
+        start = time.perf_counter()
+        summary = repository.sync_catalogs()
+        return time.perf_counter() - start, summary
+
+    def handle(self, *args, **options):
+        pkg_info_data_list = self.generate_repository(options)
+        change_count = int(len(pkg_info_data_list) * options["changes"])
+        results = []
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "catalogs"))
+            repository = Repository({"root": root})
+            try:
+                # no events for the generated pkginfos
+                with transaction.atomic(), \
+                     patch("zentral.contrib.monolith.repository_backends.base.post_monolith_repository_updates"):
+                    results.append(("initial sync",) + self.sync(repository, pkg_info_data_list))
+                    results.append(("no-op sync",) + self.sync(repository, pkg_info_data_list))
+                    for pkg_info_data in random.sample(pkg_info_data_list, change_count):
+                        pkg_info_data["description"] = get_random_string(32)
+                    results.append(("updates",) + self.sync(repository, pkg_info_data_list[change_count:]))
+                    raise Rollback
+            except Rollback:
+                pass
+        self.stdout.write("{} pkginfos, {} changes".format(len(pkg_info_data_list), change_count))
+        for name, duration, summary in results:
+            self.stdout.write("{:<15} {:>8.3f}s catalogs {} pkginfos {}".format(
+                name, duration, summary["catalogs"], summary["pkg_infos"]
+            ))
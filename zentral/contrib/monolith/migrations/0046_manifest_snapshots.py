@@ -0,0 +1,37 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0045_auto_20210407_0656'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifest',
+            name='catalog_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ManifestSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_type', models.CharField(choices=[('catalog', 'Catalog'), ('manifest', 'Manifest')],
+                                                   max_length=16)),
+                ('source_version', models.PositiveIntegerField()),
+                ('tag_set', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(),
+                                                                      default=list, size=None)),
+                ('content_sha256', models.CharField(max_length=64)),
+                ('content', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('manifest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                               to='monolith.Manifest')),
+            ],
+            options={
+                'unique_together': {('manifest', 'document_type', 'source_version', 'tag_set')},
+            },
+        ),
+    ]
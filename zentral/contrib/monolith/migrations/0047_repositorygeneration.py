@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def create_repository_generation(apps, schema_editor):
+    RepositoryGeneration = apps.get_model("monolith", "RepositoryGeneration")
+    RepositoryGeneration.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0046_manifest_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepositoryGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_repository_generation, migrations.RunPython.noop),
+    ]
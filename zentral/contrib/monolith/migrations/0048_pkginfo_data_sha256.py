@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0047_repositorygeneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pkginfo',
+            name='data_sha256',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
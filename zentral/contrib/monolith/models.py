@@ -185,6 +185,8 @@ class PkgInfo(models.Model):
     requires = models.ManyToManyField(PkgInfoName, related_name="required_by")
     update_for = models.ManyToManyField(PkgInfoName, related_name="updated_by")
     data = JSONField()
+    # sha256 of the data, to skip the unchanged pkginfos during the repository syncs
+    data_sha256 = models.CharField(max_length=64, blank=True, default="", editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     archived_at = models.DateTimeField(blank=True, null=True)
@@ -219,6 +221,28 @@ class PkgInfo(models.Model):
         return "{}#{}".format(reverse("monolith:pkg_info_name", args=(self.name.id,)), self.pk)
 
 
+class RepositoryGenerationManager(models.Manager):
+    def current(self):
+        return self.filter(pk=1).values_list("generation", flat=True).first() or 0
+
+    def current_version(self):
+        # a rolled back bump can be followed by a bump to the same generation,
+        # but not to the same updated_at
+        return self.filter(pk=1).values_list("generation", "updated_at").first() or (0, None)
+
+    def bump(self):
+        if not self.filter(pk=1).update(generation=F("generation") + 1, updated_at=timezone.now()):
+            self.get_or_create(pk=1, defaults={"generation": 1})
+
+
+class RepositoryGeneration(models.Model):
+    """Single row, bumped when the pkginfos, their dependencies or their catalogs change"""
+    generation = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = RepositoryGenerationManager()
+
+
 SUB_MANIFEST_PKG_INFO_KEY_CHOICES = (
     ('managed_installs', 'Managed Installs'),
     ('managed_uninstalls', 'Managed Uninstalls'),
@@ -461,13 +485,23 @@ class SubManifestAttachment(models.Model):
         self.save()
 
 
+class ManifestManager(models.Manager):
+    def bump_catalog_versions(self, catalogs):
+        return (self.filter(pk__in=ManifestCatalog.objects.filter(catalog__in=catalogs).values("manifest_id"))
+                    .update(catalog_version=F("catalog_version") + 1))
+
+
 class Manifest(models.Model):
     meta_business_unit = models.ForeignKey(MetaBusinessUnit, on_delete=models.PROTECT)
     name = models.CharField(max_length=256)
     version = models.PositiveIntegerField(default=1)
+    # bumped when only the catalog changes
+    catalog_version = models.PositiveIntegerField(default=1, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ManifestManager()
+
     class Meta:
         ordering = ('name', 'meta_business_unit__name',)
 
@@ -477,9 +511,33 @@ class Manifest(models.Model):
     def get_absolute_url(self):
         return reverse('monolith:manifest', args=(self.pk,))
 
-    def bump_version(self):
+    def bump_version(self, catalog=True):
         self.version = F("version") + 1
-        self.save()
+        if catalog:
+            self.catalog_version = F("catalog_version") + 1
+            self.save()
+        else:
+            self.save(update_fields=["version", "updated_at"])
+
+    def bump_catalog_version(self):
+        self.catalog_version = F("catalog_version") + 1
+        self.save(update_fields=["catalog_version", "updated_at"])
+
+    def snapshot_tag_ids(self):
+        """Ids of the tags scoping the catalogs, sub manifests, enrollment packages and printers
+
+        Only the intersection of these tags and the machine tags changes the manifest and the catalog.
+        """
+        return set(chain(
+            ManifestCatalog.tags.through.objects.filter(manifestcatalog__manifest=self)
+                                                .values_list("tag_id", flat=True),
+            ManifestSubManifest.tags.through.objects.filter(manifestsubmanifest__manifest=self)
+                                                    .values_list("tag_id", flat=True),
+            ManifestEnrollmentPackage.tags.through.objects.filter(manifestenrollmentpackage__manifest=self)
+                                                          .values_list("tag_id", flat=True),
+            Printer.tags.through.objects.filter(printer__manifest=self, printer__trashed_at__isnull=True)
+                                        .values_list("tag_id", flat=True),
+        ))
 
     def catalogs(self, tags=None):
         if tags is None:
@@ -549,87 +607,43 @@ class Manifest(models.Model):
                   .filter(trashed_at__isnull=True))
         return list(qs)
 
+    def _pkginfo_deps_and_updates(self, tags, package_names=None, pkg_info_name_ids=None):
+        """PkgInfos for the names, with their dependencies and updates, in the manifest catalogs"""
+        from .pkginfo_graph import get_pkginfo_graph
+        graph = get_pkginfo_graph()
+        pkg_info_name_ids = set(pkg_info_name_ids or [])
+        if package_names:
+            pkg_info_name_ids.update(graph.get_name_ids(package_names))
+        if not pkg_info_name_ids:
+            return PkgInfo.objects.none()
+        pkg_info_ids = graph.pkginfo_ids_with_deps_and_updates(pkg_info_name_ids,
+                                                               [c.pk for c in self.catalogs(tags)])
+        if not pkg_info_ids:
+            return PkgInfo.objects.none()
+        return PkgInfo.objects.select_related("name").filter(pk__in=pkg_info_ids)
+
     def pkginfos_with_deps_and_updates(self, tags=None):
         """PkgInfos linked to a manifest for a given set of tags"""
-        if tags:
-            m2mt_filter = "OR m2mt.tag_id in ({})".format(",".join(str(int(t.id)) for t in tags))
-        else:
-            m2mt_filter = ""
-        query = (
-            "WITH RECURSIVE pkginfos_with_deps_and_updates AS ( "
-            "SELECT pi.id as pi_id, pi.version as pi_version, pn.id AS pn_id, pn.name as pn_name "
-            "FROM monolith_pkginfo pi "
-            "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "JOIN monolith_submanifestpkginfo sm ON (pn.id=pkg_info_name_id) "
-            "JOIN monolith_manifestsubmanifest ms ON (sm.sub_manifest_id=ms.sub_manifest_id) "
-            "LEFT JOIN monolith_manifestsubmanifest_tags m2mt ON (ms.id=m2mt.manifestsubmanifest_id) "
-            "WHERE ms.manifest_id = {manifest_id} "
-            "AND (m2mt.tag_id IS NULL {m2mt_filter}) "
-            "UNION "
-            "SELECT pi.id, pi.version, pn.id, pn.name "
-            "FROM monolith_pkginfo pi "
-            "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_requires pr ON (pr.pkginfoname_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_update_for pu ON (pu.pkginfo_id=pi.id) "
-            "JOIN pkginfos_with_deps_and_updates rec ON (pr.pkginfo_id=rec.pi_id OR pu.pkginfoname_id=rec.pn_id) "
-            ") "
-            "SELECT pi_id as id, pi_version as version from pkginfos_with_deps_and_updates "
-            "JOIN monolith_pkginfo_catalogs pc ON (pi_id=pc.pkginfo_id) "
-            "JOIN monolith_manifestcatalog mc ON (pc.catalog_id=mc.catalog_id) "
-            "LEFT JOIN monolith_manifestcatalog_tags m2mt ON (mc.id=m2mt.manifestcatalog_id) "
-            "WHERE mc.manifest_id = {manifest_id} "
-            "AND (m2mt.tag_id IS NULL {m2mt_filter});"
-        ).format(manifest_id=int(self.id), m2mt_filter=m2mt_filter)
-        return PkgInfo.objects.raw(query)
-
-    def _pkginfo_deps_and_updates(self, package_names, tags):
-        package_names = ",".join("'{}'".format(package_name)
-                                 for package_name in set(package_names))
-        if not package_names:
-            return PkgInfo.objects.none()
-        if tags:
-            m2mt_filter = "OR m2mt.tag_id in ({})".format(",".join(str(int(t.id)) for t in tags))
-        else:
-            m2mt_filter = ""
-        query = (
-            "WITH RECURSIVE pkginfos_with_deps_and_updates AS ( "
-            "SELECT pi.id as pi_id, pi.version as pi_version, pn.id AS pn_id, pn.name as pn_name "
-            "FROM monolith_pkginfo pi "
-            "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "WHERE pn.name in ({package_names}) "
-            "UNION "
-            "SELECT pi.id, pi.version, pn.id, pn.name "
-            "FROM monolith_pkginfo pi "
-            "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_requires pr ON (pr.pkginfoname_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_update_for pu ON (pu.pkginfo_id=pi.id) "
-            "JOIN pkginfos_with_deps_and_updates rec ON (pr.pkginfo_id=rec.pi_id OR pu.pkginfoname_id=rec.pn_id) "
-            ") "
-            "SELECT pi_id as id, pi_version as version from pkginfos_with_deps_and_updates "
-            "JOIN monolith_pkginfo_catalogs pc ON (pi_id=pc.pkginfo_id) "
-            "JOIN monolith_manifestcatalog mc ON (pc.catalog_id=mc.catalog_id) "
-            "LEFT JOIN monolith_manifestcatalog_tags m2mt ON (mc.id=m2mt.manifestcatalog_id) "
-            "WHERE mc.manifest_id = {manifest_id} "
-            "AND (m2mt.tag_id IS NULL {m2mt_filter});"
-        ).format(package_names=package_names, manifest_id=int(self.id), m2mt_filter=m2mt_filter)
-        return PkgInfo.objects.raw(query)
+        pkg_info_name_ids = (SubManifestPkgInfo.objects.filter(sub_manifest__in=self.sub_manifests(tags))
+                                                       .values_list("pkg_info_name_id", flat=True))
+        return self._pkginfo_deps_and_updates(tags, pkg_info_name_ids=pkg_info_name_ids)
 
     def enrollment_packages_pkginfo_deps(self, tags=None):
         """PkgInfos that enrollment packages require, with their dependencies"""
         required_packages_iter = chain.from_iterable(ep.get_requires()
                                                      for ep in self.enrollment_packages(tags).values())
-        return self._pkginfo_deps_and_updates(required_packages_iter, tags)
+        return self._pkginfo_deps_and_updates(tags, package_names=required_packages_iter)
 
     def printers_pkginfo_deps(self, tags=None):
         """PkgInfos that printers require, with their dependencies"""
         required_packages_gen = (p.required_package.name
                                  for p in self.printers(tags)
                                  if p.required_package)
-        return self._pkginfo_deps_and_updates(required_packages_gen, tags)
+        return self._pkginfo_deps_and_updates(tags, package_names=required_packages_gen)
 
     def default_managed_installs_deps(self, tags=None):
         """PkgInfos installed per default, with their dependencies"""
-        return self._pkginfo_deps_and_updates(monolith_conf.get_default_managed_installs(), tags)
+        return self._pkginfo_deps_and_updates(tags, package_names=monolith_conf.get_default_managed_installs())
 
     # the manifest catalog - for a given set of tags
 
@@ -703,6 +717,26 @@ class Manifest(models.Model):
         return plistlib.dumps(data)
 
 
+class ManifestSnapshot(models.Model):
+    """Rendered manifest or catalog, for a manifest version and a set of tags"""
+    CATALOG = "catalog"
+    MANIFEST = "manifest"
+    DOCUMENT_TYPE_CHOICES = (
+        (CATALOG, "Catalog"),
+        (MANIFEST, "Manifest"),
+    )
+    manifest = models.ForeignKey(Manifest, on_delete=models.CASCADE)
+    document_type = models.CharField(max_length=16, choices=DOCUMENT_TYPE_CHOICES)
+    source_version = models.PositiveIntegerField()
+    tag_set = ArrayField(models.IntegerField(), default=list)
+    content_sha256 = models.CharField(max_length=64)
+    content = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (("manifest", "document_type", "source_version", "tag_set"),)
+
+
 class ManifestCatalog(models.Model):
     manifest = models.ForeignKey(Manifest, on_delete=models.CASCADE)
     catalog = models.ForeignKey(Catalog, on_delete=models.PROTECT)
@@ -0,0 +1,104 @@
+from collections import deque
+import logging
+import threading
+from .models import PkgInfo, RepositoryGeneration
+
+
+logger = logging.getLogger("zentral.contrib.monolith.pkginfo_graph")
+
+
+class PkgInfoGraph:
+    """In-memory dependency and update graph of the repository pkginfos
+
+    PkgInfoName → PkgInfo, requires and update_for edges, and catalog membership,
+    for a given repository generation. The archived pkginfos are included.
+    """
+    def __init__(self, generation, pkginfos, requires, update_for, catalogs):
+        self.generation = generation
+        self.name_ids = {}  # PkgInfoName name → id
+        self.name_pkginfo_ids = {}  # PkgInfoName id → PkgInfo ids
+        self.pkginfo_name_ids = {}  # PkgInfo id → PkgInfoName id
+        for pkginfo_id, name_id, name in pkginfos:
+            self.name_ids[name] = name_id
+            self.name_pkginfo_ids.setdefault(name_id, []).append(pkginfo_id)
+            self.pkginfo_name_ids[pkginfo_id] = name_id
+        self.requires = {}  # PkgInfo id → required PkgInfoName ids
+        for pkginfo_id, name_id in requires:
+            self.requires.setdefault(pkginfo_id, []).append(name_id)
+        self.updated_by = {}  # PkgInfoName id → ids of the PkgInfos updating it
+        for pkginfo_id, name_id in update_for:
+            self.updated_by.setdefault(name_id, []).append(pkginfo_id)
+        self.pkginfo_catalog_ids = {}  # PkgInfo id → Catalog ids
+        for pkginfo_id, catalog_id in catalogs:
+            self.pkginfo_catalog_ids.setdefault(pkginfo_id, set()).add(catalog_id)
+
+    @classmethod
+    def from_db(cls, generation):
+        return cls(
+            generation,
+            PkgInfo.objects.values_list("id", "name_id", "name__name").iterator(),
+            PkgInfo.requires.through.objects.values_list("pkginfo_id", "pkginfoname_id").iterator(),
+            PkgInfo.update_for.through.objects.values_list("pkginfo_id", "pkginfoname_id").iterator(),
+            PkgInfo.catalogs.through.objects.values_list("pkginfo_id", "catalog_id").iterator(),
+        )
+
+    def get_name_ids(self, names):
+        return {self.name_ids[name] for name in names if name in self.name_ids}
+
+    def pkginfo_ids_with_deps_and_updates(self, name_ids, catalog_ids):
+        """Ids of the pkginfos for the names, with their dependencies and updates, in the catalogs
+
+        All the pkginfos of the names, and of the names they require, are visited.
+        The pkginfos with an update_for one of the names of the visited pkginfos are visited too.
+        """
+        visited = set()
+        expanded_names = set()
+        updated_names = set()
+        queue = deque()
+
+        def expand_name(name_id):
+            if name_id not in expanded_names:
+                expanded_names.add(name_id)
+                queue.extend(self.name_pkginfo_ids.get(name_id, []))
+
+        for name_id in name_ids:
+            expand_name(name_id)
+        while queue:
+            pkginfo_id = queue.popleft()
+            if pkginfo_id in visited:
+                continue
+            visited.add(pkginfo_id)
+            for name_id in self.requires.get(pkginfo_id, []):
+                expand_name(name_id)
+            name_id = self.pkginfo_name_ids[pkginfo_id]
+            if name_id not in updated_names:
+                updated_names.add(name_id)
+                queue.extend(self.updated_by.get(name_id, []))
+
+        catalog_ids = set(catalog_ids)
+        return {pkginfo_id for pkginfo_id in visited
+                if not self.pkginfo_catalog_ids.get(pkginfo_id, set()).isdisjoint(catalog_ids)}
+
+
+_graph = None  # (repository version, graph)
+_graph_lock = threading.Lock()
+
+
+def get_pkginfo_graph():
+    """Return the process graph, rebuilt if the repository version has changed"""
+    global _graph
+    version = RepositoryGeneration.objects.current_version()
+    cached = _graph
+    if cached is None or cached[0] != version:
+        with _graph_lock:
+            cached = _graph
+            if cached is None or cached[0] != version:
+                logger.info("Build pkginfo graph for repository generation %s", version[0])
+                cached = _graph = (version, PkgInfoGraph.from_db(version[0]))
+    return cached[1]
+
+
+def clear_pkginfo_graph():
+    global _graph
+    with _graph_lock:
+        _graph = None
@@ -1,14 +1,31 @@
 from datetime import datetime
+import hashlib
+import json
 import logging
 import os.path
 import plistlib
+from django.db import transaction
 from zentral.contrib.monolith.events import post_monolith_repository_updates
-from zentral.contrib.monolith.models import Catalog, Manifest, PkgInfo, PkgInfoCategory, PkgInfoName
+from zentral.contrib.monolith.models import (Catalog, Manifest, PkgInfo, PkgInfoCategory, PkgInfoName,
+                                             RepositoryGeneration)
 from zentral.utils.local_dir import get_and_create_local_dir
 
 logger = logging.getLogger('zentral.contrib.monolith.repository_backends.base')
 
 
+BULK_BATCH_SIZE = 1000
+PKG_INFO_M2M_FIELDS = (
+    # attribute, through model target attribute, related model
+    ("catalogs", "catalog_id", Catalog),
+    ("requires", "pkginfoname_id", PkgInfoName),
+    ("update_for", "pkginfoname_id", PkgInfoName),
+)
+
+
+def get_pkg_info_data_sha256(pkg_info_data):
+    return hashlib.sha256(json.dumps(pkg_info_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 class BaseRepository(object):
     def __init__(self, config):
         self.manual_catalog_management = config.get("manual_catalog_management", False)
@@ -23,187 +40,326 @@ class BaseRepository(object):
     def get_all_catalog_local_path(self):
         return os.path.join(get_and_create_local_dir("monolith", "repository"), "all_catalog.xml")
 
-    def _import_pkg_info_data_catalogs(self, pkg_info_data, event_payloads):
-        catalogs = []
+    # repository pkg infos
+
+    def _get_pkg_info_data_catalog_names(self, pkg_info_data):
         if self.default_catalog_name:
             # force the catalog to the default catalog
             pkg_info_catalogs = [self.default_catalog_name]
         else:
             # take the catalogs from the pkg info data
             pkg_info_catalogs = pkg_info_data.get("catalogs", [])
+        catalog_names = []
         for catalog_name in pkg_info_catalogs:
             catalog_name = catalog_name.strip()
-            event_payload = {"catalog": {"name": catalog_name},
-                             "type": "catalog"}
-            try:
-                catalog = Catalog.objects.get(name=catalog_name)
-            except Catalog.DoesNotExist:
-                catalog = Catalog.objects.create(name=catalog_name)
-                event_payload["action"] = "added"
+            if catalog_name not in catalog_names:
+                catalog_names.append(catalog_name)
+        return catalog_names
+
+    def _load_repository_pkg_infos(self, catalog_plist):
+        """Index the pkg infos of the catalog plist by (name, version)
+
+        Also return the names of the catalogs found in the repository.
+        """
+        pkg_infos = {}
+        found_catalog_names = set()
+        for pkg_info_data in catalog_plist:
+            name = pkg_info_data['name']
+            version = pkg_info_data['version']
+            logger.debug('PKGINFO %s %s', name, version)
+            catalog_names = self._get_pkg_info_data_catalog_names(pkg_info_data)
+            if not catalog_names:
+                logger.warning('PKGINFO %s %s w/o catalogs', name, version)
+                continue
+            found_catalog_names.update(catalog_names)
+            # serialize pkg_info_data
+            for key, val in pkg_info_data.items():
+                if isinstance(val, datetime):
+                    pkg_info_data[key] = val.isoformat()
+            key = (name, version)
+            if key in pkg_infos:
+                logger.warning('PKGINFO %s %s already found', name, version)
+            pkg_infos[key] = {
+                "data": pkg_info_data,
+                "data_sha256": get_pkg_info_data_sha256(pkg_info_data),
+                "category": pkg_info_data.get("category") or None,
+                "catalogs": catalog_names,
+                "requires": pkg_info_data.get("requires", []),
+                "update_for": pkg_info_data.get("update_for", []),
+            }
+        return pkg_infos, found_catalog_names
+
+    # DB updates
+
+    def _sync_db_catalogs(self, found_catalog_names, now, summary, event_payloads):
+        catalogs = {c.name: c for c in Catalog.objects.all()}
+        # new catalogs
+        new_catalogs = Catalog.objects.bulk_create(
+            [Catalog(name=name) for name in sorted(found_catalog_names - set(catalogs))],
+            batch_size=BULK_BATCH_SIZE
+        )
+        # unarchived catalogs
+        unarchived_catalogs = [catalogs[name] for name in sorted(found_catalog_names)
+                               if name in catalogs and catalogs[name].archived_at]
+        if unarchived_catalogs:
+            (Catalog.objects.filter(pk__in=[c.pk for c in unarchived_catalogs])
+                            .update(archived_at=None, updated_at=now))
+        # archive old catalogs if auto catalog management
+        archived_catalogs = []
+        if not self.manual_catalog_management:
+            archived_catalogs = [c for name, c in sorted(catalogs.items())
+                                 if name not in found_catalog_names and not c.archived_at]
+            if archived_catalogs:
+                (Catalog.objects.filter(pk__in=[c.pk for c in archived_catalogs])
+                                .update(archived_at=now, updated_at=now))
+        for action, action_catalogs in (("added", new_catalogs),
+                                        ("unarchived", unarchived_catalogs),
+                                        ("archived", archived_catalogs)):
+            summary["catalogs"][action] = len(action_catalogs)
+            for catalog in action_catalogs:
+                catalogs[catalog.name] = catalog
+                summary["catalog_ids"].add(catalog.pk)
+                event_payloads.append({"catalog": {"name": catalog.name,
+                                                   "id": catalog.pk},
+                                       "type": "catalog",
+                                       "action": action})
+        return {name: c.pk for name, c in catalogs.items()}
+
+    def _sync_db_names(self, model, names):
+        name_ids = dict(model.objects.values_list("name", "id"))
+        new_objects = model.objects.bulk_create(
+            [model(name=name) for name in sorted(set(names) - set(name_ids))],
+            batch_size=BULK_BATCH_SIZE
+        )
+        name_ids.update((o.name, o.pk) for o in new_objects)
+        return name_ids, new_objects
+
+    def _get_pkg_info_m2m_diff(self, old_values, new_values, related_objects):
+        attr_diff = {}
+        removed = old_values - new_values
+        if removed:
+            attr_diff["removed"] = sorted(str(related_objects[pk]) for pk in removed)
+        added = new_values - old_values
+        if added:
+            attr_diff["added"] = sorted(str(related_objects[pk]) for pk in added)
+        return attr_diff
+
+    def _sync_db_pkg_infos(self, pkg_infos, catalog_ids, now, summary, event_payloads):
+        # names & categories
+        names = set()
+        categories = set()
+        for (name, _), pkg_info in pkg_infos.items():
+            names.add(name)
+            names.update(pkg_info["requires"])
+            names.update(pkg_info["update_for"])
+            if pkg_info["category"]:
+                categories.add(pkg_info["category"])
+        name_ids, _ = self._sync_db_names(PkgInfoName, names)
+        category_ids, new_categories = self._sync_db_names(PkgInfoCategory, categories)
+        for category in new_categories:
+            event_payloads.append({"category": {"name": category.name,
+                                                "id": category.pk},
+                                   "type": "category",
+                                   "action": "added"})
+        # to render the m2m diffs
+        related_objects = {
+            Catalog: {pk: name for name, pk in catalog_ids.items()},
+            PkgInfoName: {pk: name for name, pk in name_ids.items()},
+        }
+
+        # diff with the current DB pkg infos
+        existing_keys = set()
+        changed_pks = {}
+        archived_pks = []
+        for pk, name_id, name, version, data_sha256, archived_at in PkgInfo.objects.values_list(
+            "pk", "name_id", "name__name", "version", "data_sha256", "archived_at"
+        ).iterator():
+            key = (name, version)
+            existing_keys.add(key)
+            pkg_info = pkg_infos.get(key)
+            if pkg_info is None:
+                if archived_at is None:
+                    archived_pks.append((pk, name_id, name, version))
+            elif archived_at is not None or data_sha256 != pkg_info["data_sha256"]:
+                changed_pks[pk] = key
             else:
-                if catalog.archived_at:
-                    catalog.archived_at = None
-                    catalog.save()
-                    event_payload["action"] = "unarchived"
-            catalogs.append(catalog)
-            if "action" in event_payload:
-                event_payload["catalog"]["id"] = catalog.id
-                event_payloads.append(event_payload)
-        return catalogs
-
-    def _import_pkg_info_data(self, pkg_info_data, event_payloads):
-        name = pkg_info_data['name']
-        version = pkg_info_data['version']
-        logger.debug('PKGINFO %s %s', name, version)
-        # catalogs
-        catalogs = self._import_pkg_info_data_catalogs(pkg_info_data, event_payloads)
-        if not catalogs:
-            logger.warning('PKGINFO %s %s w/o catalogs', name, version)
-            return catalogs, None
-        # name
-        pkg_info_name, _ = PkgInfoName.objects.get_or_create(name=name)
-        # category
-        pkg_info_category = None
-        category = pkg_info_data.get('category', None)
-        if category:
-            pkg_info_category, pkg_info_category_created = PkgInfoCategory.objects.get_or_create(name=category)
-            if pkg_info_category_created:
-                event_payloads.append({"category": {"name": pkg_info_category.name,
-                                                    "id": pkg_info_category.id},
-                                       "type": "category",
-                                       "action": "added"})
-        # requires
-        requires = [pif for pif, created in (PkgInfoName.objects.get_or_create(name=n)
-                                             for n in pkg_info_data.get('requires', []))]
-        # update_for
-        update_for = [pif for pif, created in (PkgInfoName.objects.get_or_create(name=n)
-                                               for n in pkg_info_data.get('update_for', []))]
-        # serialize pkg_info_data
-        for key, val in pkg_info_data.items():
-            if isinstance(val, datetime):
-                pkg_info_data[key] = val.isoformat()
-        # save PkgInfo in db
-        event_payload = {"pkg_info": {"name": name,
-                                      "version": version},
-                         "type": "pkg_info"}
-        try:
-            pkg_info = (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                       .get(name=pkg_info_name, version=version))
-        except PkgInfo.DoesNotExist:
-            pkg_info = PkgInfo.objects.create(name=pkg_info_name,
-                                              version=version,
-                                              category=pkg_info_category,
-                                              data=pkg_info_data)
-            pkg_info.catalogs.set(catalogs)
-            pkg_info.requires.set(requires)
-            pkg_info.update_for.set(update_for)
-            event_payload["action"] = "added"
-        else:
+                summary["pkg_infos"]["unchanged"] += 1
+        new_keys = [key for key in pkg_infos if key not in existing_keys]
+
+        m2m_additions = {attr: [] for attr, _, _ in PKG_INFO_M2M_FIELDS}
+        m2m_deletions = {attr: [] for attr, _, _ in PKG_INFO_M2M_FIELDS}
+
+        # new pkg infos
+        new_pkg_infos = []
+        for name, version in new_keys:
+            pkg_info = pkg_infos[(name, version)]
+            new_pkg_infos.append(PkgInfo(name_id=name_ids[name],
+                                         version=version,
+                                         category_id=category_ids.get(pkg_info["category"]),
+                                         data=pkg_info["data"],
+                                         data_sha256=pkg_info["data_sha256"]))
+        PkgInfo.objects.bulk_create(new_pkg_infos, batch_size=BULK_BATCH_SIZE)
+        for pkg_info_obj, (name, version) in zip(new_pkg_infos, new_keys):
+            pkg_info = pkg_infos[(name, version)]
+            m2m_additions["catalogs"].extend((pkg_info_obj.pk, catalog_ids[n]) for n in pkg_info["catalogs"])
+            m2m_additions["requires"].extend((pkg_info_obj.pk, name_ids[n]) for n in set(pkg_info["requires"]))
+            m2m_additions["update_for"].extend((pkg_info_obj.pk, name_ids[n]) for n in set(pkg_info["update_for"]))
+            summary["catalog_ids"].update(catalog_ids[n] for n in pkg_info["catalogs"])
+            summary["pkg_info_name_ids"].add(pkg_info_obj.name_id)
+            event_payloads.append({"pkg_info": {"name": name,
+                                                "version": version},
+                                   "type": "pkg_info",
+                                   "action": "added"})
+        summary["pkg_infos"]["added"] = len(new_pkg_infos)
+
+        # changed pkg infos
+        m2m_values = {}
+        for attr, target_attr, _ in PKG_INFO_M2M_FIELDS:
+            through = getattr(PkgInfo, attr).through
+            for through_pk, pkg_info_pk, target_pk in (through.objects.filter(pkginfo_id__in=list(changed_pks))
+                                                                      .values_list("pk", "pkginfo_id", target_attr)
+                                                                      .iterator()):
+                m2m_values.setdefault((attr, pkg_info_pk), {})[target_pk] = through_pk
+        updated_pkg_infos = []
+        for pkg_info_obj in (PkgInfo.objects.select_related("category")
+                                            .filter(pk__in=list(changed_pks))
+                                            .iterator()):
+            name, version = changed_pks[pkg_info_obj.pk]
+            pkg_info = pkg_infos[(name, version)]
+            event_payload = {"pkg_info": {"name": name,
+                                          "version": version},
+                             "type": "pkg_info"}
             # if the pkg exists, but is archived, consider it like a new pkg
-            if pkg_info.archived_at:
+            if pkg_info_obj.archived_at:
                 diff = None
-                pkg_info.archived_at = None
+                pkg_info_obj.archived_at = None
                 event_payload["action"] = "added"
             else:
                 diff = {}
 
             # update category if necessary
-            pkg_info_old_category = pkg_info.category
-            if pkg_info_old_category != pkg_info_category:
-                pkg_info.category = pkg_info_category
+            pkg_info_old_category = pkg_info_obj.category
+            pkg_info_category_id = category_ids.get(pkg_info["category"])
+            if pkg_info_obj.category_id != pkg_info_category_id:
+                pkg_info_obj.category_id = pkg_info_category_id
                 if diff is not None:
                     attr_diff = {}
                     if pkg_info_old_category:
                         attr_diff["removed"] = str(pkg_info_old_category)
-                    if pkg_info_category:
-                        attr_diff["added"] = str(pkg_info_category)
+                    if pkg_info["category"]:
+                        attr_diff["added"] = pkg_info["category"]
                     diff["category"] = attr_diff
                     event_payload["action"] = "updated"
 
             # update data if necessary
-            pkg_info_old_data = pkg_info.data
-            if pkg_info_old_data != pkg_info_data:
-                pkg_info.data = pkg_info_data
+            pkg_info_old_data = pkg_info_obj.data
+            if pkg_info_old_data != pkg_info["data"]:
+                pkg_info_obj.data = pkg_info["data"]
                 if diff is not None:
                     attr_diff = {}
                     if pkg_info_old_data:
                         attr_diff["removed"] = pkg_info_old_data
-                    if pkg_info_data:
-                        attr_diff["added"] = pkg_info_data
+                    if pkg_info["data"]:
+                        attr_diff["added"] = pkg_info["data"]
                     diff["data"] = attr_diff
                     event_payload["action"] = "updated"
 
-            # save updates
             if event_payload.get("action"):
-                pkg_info.save()
+                pkg_info_obj.updated_at = now
+            pkg_info_obj.data_sha256 = pkg_info["data_sha256"]
+            updated_pkg_infos.append(pkg_info_obj)
 
             # update m2m attributes
-            pkg_info_m2m_updates = [("requires", requires),
-                                    ("update_for", update_for)]
-            if not self.manual_catalog_management:
-                # need to update the pkg info catalogs too
-                pkg_info_m2m_updates.append(("catalogs", catalogs))
-
-            for pkg_info_attr, pkg_info_values in pkg_info_m2m_updates:
-                pkg_info_old_values = set(getattr(pkg_info, pkg_info_attr).all())
-                pkg_info_values = set(pkg_info_values)
-                if pkg_info_old_values != pkg_info_values:
-                    getattr(pkg_info, pkg_info_attr).set(pkg_info_values)
+            old_catalog_ids = set(m2m_values.get(("catalogs", pkg_info_obj.pk), {}))
+            for attr, _, related_model in PKG_INFO_M2M_FIELDS:
+                if attr == "catalogs":
+                    if self.manual_catalog_management:
+                        continue
+                    new_values = set(catalog_ids[n] for n in pkg_info["catalogs"])
+                else:
+                    new_values = set(name_ids[n] for n in pkg_info[attr])
+                old_values = m2m_values.get((attr, pkg_info_obj.pk), {})
+                if set(old_values) != new_values:
+                    m2m_deletions[attr].extend(old_values[pk] for pk in set(old_values) - new_values)
+                    m2m_additions[attr].extend((pkg_info_obj.pk, pk) for pk in new_values - set(old_values))
+                    if attr == "catalogs":
+                        summary["catalog_ids"].update(new_values)
                     if diff is not None:
-                        attr_diff = {}
-                        removed = pkg_info_old_values - pkg_info_values
-                        if removed:
-                            attr_diff = {"removed": sorted(str(r) for r in removed)}
-                        added = pkg_info_values - pkg_info_old_values
-                        if added:
-                            attr_diff = {"added": sorted(str(a) for a in added)}
-                        diff[pkg_info_attr] = attr_diff
+                        diff[attr] = self._get_pkg_info_m2m_diff(set(old_values), new_values,
+                                                                 related_objects[related_model])
                         event_payload["action"] = "updated"
 
-            # include the updates in the event payload
-            if diff:
-                event_payload["pkg_info"]["diff"] = diff
+            if "action" not in event_payload:
+                # only the data hash was missing
+                summary["pkg_infos"]["unchanged"] += 1
+            else:
+                summary["pkg_infos"]["updated" if diff is not None else "added"] += 1
+                summary["catalog_ids"].update(old_catalog_ids)
+                summary["pkg_info_name_ids"].add(pkg_info_obj.name_id)
+                # include the updates in the event payload
+                if diff:
+                    event_payload["pkg_info"]["diff"] = diff
+                event_payloads.append(event_payload)
+        PkgInfo.objects.bulk_update(updated_pkg_infos,
+                                    ["category", "data", "data_sha256", "archived_at", "updated_at"],
+                                    batch_size=BULK_BATCH_SIZE)
 
-        if "action" in event_payload:
-            event_payloads.append(event_payload)
+        # m2m updates
+        for attr, target_attr, _ in PKG_INFO_M2M_FIELDS:
+            through = getattr(PkgInfo, attr).through
+            if m2m_deletions[attr]:
+                through.objects.filter(pk__in=m2m_deletions[attr]).delete()
+            through.objects.bulk_create(
+                [through(pkginfo_id=pkg_info_pk, **{target_attr: target_pk})
+                 for pkg_info_pk, target_pk in m2m_additions[attr]],
+                batch_size=BULK_BATCH_SIZE
+            )
 
-        return catalogs, pkg_info.get_key()
+        # archive old pkg infos
+        if archived_pks:
+            archived_pk_list = [pk for pk, _, _, _ in archived_pks]
+            PkgInfo.objects.filter(pk__in=archived_pk_list).update(archived_at=now, updated_at=now)
+            summary["catalog_ids"].update(
+                PkgInfo.catalogs.through.objects.filter(pkginfo_id__in=archived_pk_list)
+                                                .values_list("catalog_id", flat=True)
+                                                .distinct()
+            )
+            for _, name_id, name, version in archived_pks:
+                summary["pkg_info_name_ids"].add(name_id)
+                event_payloads.append({"pkg_info": {"name": name,
+                                                    "version": version},
+                                       "type": "pkg_info",
+                                       "action": "archived"})
+        summary["pkg_infos"]["archived"] = len(archived_pks)
 
     def sync_catalogs(self):
+        """Sync the repository catalogs and pkg infos with the DB
+
+        The pkg infos are compared with the DB using the sha256 of their data,
+        and only the new, changed, or missing ones are written, in bulk, in a single transaction.
+
+        Returns a summary of the changes, with the ids of the changed catalogs and pkg info names.
+        """
         with open(self.download_all_catalog(), "rb") as f:
             catalog_plist = plistlib.load(f)
-        found_pkg_infos = set([])
-        found_catalogs = set([])
+        pkg_infos, found_catalog_names = self._load_repository_pkg_infos(catalog_plist)
+        now = datetime.now()
+        summary = {"catalogs": {"added": 0, "unarchived": 0, "archived": 0},
+                   "pkg_infos": {"added": 0, "updated": 0, "archived": 0, "unchanged": 0},
+                   "catalog_ids": set(),
+                   "pkg_info_name_ids": set()}
         event_payloads = []
-        # update or create current pkg_infos
-        for pkg_info_data in catalog_plist:
-            catalogs, pkg_info_key = self._import_pkg_info_data(pkg_info_data, event_payloads)
-            found_catalogs.update(catalogs)
-            if pkg_info_key:
-                if pkg_info_key in found_pkg_infos:
-                    logger.warning('PKGINFO %s %s already found', pkg_info_key[0], pkg_info_key[1])
-                else:
-                    found_pkg_infos.update([pkg_info_key])
-        # archive old catalogs if auto catalog management
-        if not self.manual_catalog_management:
-            for c in Catalog.objects.filter(archived_at__isnull=True):
-                if c not in found_catalogs:
-                    c.archived_at = datetime.now()
-                    c.save()
-                    event_payloads.append({"catalog": {"name": c.name,
-                                                       "id": c.id},
-                                           "type": "catalog",
-                                           "action": "archived"})
-        # archive old pkg_infos
-        for pkg_info in PkgInfo.objects.select_related("name").filter(archived_at__isnull=True):
-            if pkg_info.get_key() not in found_pkg_infos:
-                pkg_info.archived_at = datetime.now()
-                pkg_info.save()
-                event_payloads.append({"pkg_info": {"name": pkg_info.name.name,
-                                                    "version": pkg_info.version},
-                                       "type": "pkg_info",
-                                       "action": "archived"})
-        # bump versions of manifests connected to found catalogs
-        for manifest in Manifest.objects.distinct().filter(manifestcatalog__catalog__in=found_catalogs):
-            manifest.bump_version()
+        with transaction.atomic():
+            catalog_ids = self._sync_db_catalogs(found_catalog_names, now, summary, event_payloads)
+            self._sync_db_pkg_infos(pkg_infos, catalog_ids, now, summary, event_payloads)
+            if summary["catalog_ids"]:
+                # bump the catalog versions of the manifests connected to the changed catalogs
+                Manifest.objects.bump_catalog_versions(summary["catalog_ids"])
+            # all the pkginfo, dependency and catalog changes are recorded in the event payloads
+            if event_payloads:
+                RepositoryGeneration.objects.bump()
+        summary["catalog_ids"] = sorted(summary["catalog_ids"])
+        summary["pkg_info_name_ids"] = sorted(summary["pkg_info_name_ids"])
+        logger.info("Repository sync: catalogs %s, pkg infos %s", summary["catalogs"], summary["pkg_infos"])
         post_monolith_repository_updates(self, event_payloads)
+        return summary
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+from django.core.cache import cache
+from django.db import connection, transaction
+from .models import ManifestSnapshot
+
+
+logger = logging.getLogger("zentral.contrib.monolith.snapshots")
+
+
+def get_manifest_snapshot_tag_ids(manifest):
+    cache_key = f"monolith.{manifest.pk}.{manifest.version}.{manifest.catalog_version}.snapshot-tag-ids"
+    tag_ids = cache.get(cache_key)
+    if tag_ids is None:
+        tag_ids = manifest.snapshot_tag_ids()
+        cache.set(cache_key, tag_ids, timeout=None)
+    return tag_ids
+
+
+def get_effective_tags(manifest, tags):
+    """Machine tags with an effect on the manifest and catalog, sorted by id"""
+    tag_ids = get_manifest_snapshot_tag_ids(manifest)
+    return sorted((t for t in tags if t.id in tag_ids), key=lambda t: t.id)
+
+
+def _get_content_cache_key(content_sha256):
+    return f"monolith.snapshot-content.{content_sha256}"
+
+
+def _lock(key):
+    # transaction level advisory lock, to build each snapshot only once
+    lock_id = int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big", signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_id])
+
+
+def _build_manifest_snapshot(manifest, document_type, source_version, effective_tags):
+    if document_type == ManifestSnapshot.CATALOG:
+        content = manifest.serialize_catalog(effective_tags)
+    else:
+        content = manifest.serialize(effective_tags)
+    snapshot = ManifestSnapshot.objects.create(
+        manifest=manifest,
+        document_type=document_type,
+        source_version=source_version,
+        tag_set=[t.id for t in effective_tags],
+        content_sha256=hashlib.sha256(content).hexdigest(),
+        content=content
+    )
+    # the snapshots of the previous versions will never be used again
+    ManifestSnapshot.objects.filter(manifest=manifest,
+                                    document_type=document_type,
+                                    source_version__lt=source_version).delete()
+    return snapshot
+
+
+def get_manifest_snapshot(manifest, document_type, tags):
+    """Return the rendered manifest or catalog for the machine tags, and if it was already materialized
+
+    The snapshots are stored in the DB, for the manifest version (or catalog version)
+    and the set of machine tags with an effect on the manifest. The content is cached by hash.
+    Concurrent misses for the same snapshot are serialized, and only the first one builds the snapshot.
+    """
+    if document_type == ManifestSnapshot.CATALOG:
+        source_version = manifest.catalog_version
+    else:
+        source_version = manifest.version
+    effective_tags = get_effective_tags(manifest, tags)
+    tag_set = [t.id for t in effective_tags]
+    key = "monolith.{}.{}.{}.snapshot.{}".format(manifest.pk, document_type, source_version,
+                                                 ".".join(str(i) for i in tag_set))
+
+    # cache
+    content_sha256 = cache.get(key)
+    if content_sha256:
+        content = cache.get(_get_content_cache_key(content_sha256))
+        if content is not None:
+            return content, True
+
+    # DB
+    snapshot_qs = ManifestSnapshot.objects.filter(manifest=manifest,
+                                                  document_type=document_type,
+                                                  source_version=source_version,
+                                                  tag_set=tag_set)
+    materialized = True
+    snapshot = snapshot_qs.first()
+    if snapshot is None:
+        with transaction.atomic():
+            _lock(key)
+            snapshot = snapshot_qs.first()
+            if snapshot is None:
+                materialized = False
+                snapshot = _build_manifest_snapshot(manifest, document_type, source_version, effective_tags)
+    content = bytes(snapshot.content)
+    cache.set_many({key: snapshot.content_sha256,
+                    _get_content_cache_key(snapshot.content_sha256): content},
+                   timeout=None)
+    return content, materialized
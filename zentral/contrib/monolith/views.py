@@ -36,10 +36,11 @@ from .forms import (AddManifestCatalogForm, EditManifestCatalogForm, DeleteManif
 from .models import (MunkiNameError, parse_munki_name,
                      Catalog, CacheServer,
                      EnrolledMachine, Enrollment,
-                     Manifest, ManifestEnrollmentPackage, PkgInfo, PkgInfoName,
-                     Printer, PrinterPPD,
+                     Manifest, ManifestEnrollmentPackage, ManifestSnapshot, PkgInfo, PkgInfoName,
+                     Printer, PrinterPPD, RepositoryGeneration,
                      Condition,
                      SUB_MANIFEST_PKG_INFO_KEY_CHOICES, SubManifest, SubManifestAttachment, SubManifestPkgInfo)
+from .snapshots import get_manifest_snapshot
 from .utils import build_configuration_plist, build_configuration_profile
 
 logger = logging.getLogger('zentral.contrib.monolith.views')
@@ -105,6 +106,10 @@ class UpdatePkgInfoCatalogView(PermissionRequiredMixin, UpdateView):
         response = super().form_valid(form)
         new_catalogs = set(self.object.catalogs.all())
         if old_catalogs != new_catalogs:
+            Manifest.objects.bump_catalog_versions(old_catalogs | new_catalogs)
+            RepositoryGeneration.objects.bump()
+            # force the comparison of the catalogs during the next repository sync
+            self.model.objects.filter(pk=self.object.pk).update(data_sha256="")
             attr_diff = {}
             removed = old_catalogs - new_catalogs
             if removed:
@@ -381,7 +386,7 @@ class UpdateConditionView(PermissionRequiredMixin, UpdateView):
     def form_valid(self, form):
         condition = form.save()
         for manifest in condition.manifests():
-            manifest.bump_version()
+            manifest.bump_version(catalog=False)
         return redirect(condition)
 
 
@@ -476,6 +481,12 @@ class UpdateSubManifestView(PermissionRequiredMixin, UpdateView):
         context['monolith'] = True
         return context
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        for _, manifest in self.object.manifests_with_tags():
+            manifest.bump_version(catalog=False)
+        return response
+
 
 class DeleteSubManifestView(PermissionRequiredMixin, DeleteView):
     permission_required = "monolith.delete_submanifest"
@@ -508,7 +519,7 @@ class SubManifestAddPkgInfoView(PermissionRequiredMixin, FormView):
         smpi.sub_manifest = self.sub_manifest
         smpi.save()
         for _, manifest in self.sub_manifest.manifests_with_tags():
-            manifest.bump_version()
+            manifest.bump_version(catalog=False)
         return redirect(self.sub_manifest)
 
 
@@ -527,7 +538,7 @@ class UpdateSubManifestPkgInfoView(PermissionRequiredMixin, UpdateView):
     def form_valid(self, form):
         smpi = form.save()
         for _, manifest in smpi.sub_manifest.manifests_with_tags():
-            manifest.bump_version()
+            manifest.bump_version(catalog=False)
         return redirect(smpi.sub_manifest)
 
 
@@ -546,7 +557,7 @@ class DeleteSubManifestPkgInfoView(PermissionRequiredMixin, DeleteView):
         sub_manifest = smpi.sub_manifest
         smpi.delete()
         for _, manifest in sub_manifest.manifests_with_tags():
-            manifest.bump_version()
+            manifest.bump_version(catalog=False)
         return redirect(sub_manifest)
 
 
@@ -856,6 +867,7 @@ class ManifestEnrollmentConfigurationProfileView(PermissionRequiredMixin, View):
 
 class BaseManifestM2MView(FormView):
     m2m_model = None
+    catalog_only = False
 
     def dispatch(self, request, *args, **kwargs):
         self.manifest = Manifest.objects.get(pk=kwargs['pk'])
@@ -882,12 +894,16 @@ class BaseManifestM2MView(FormView):
 
     def form_valid(self, form):
         form.save()
-        self.manifest.bump_version()
+        if self.catalog_only:
+            self.manifest.bump_catalog_version()
+        else:
+            self.manifest.bump_version()
         return HttpResponseRedirect(self.get_success_url())
 
 
 class AddManifestCatalogView(PermissionRequiredMixin, BaseManifestM2MView):
     permission_required = "monolith.add_manifestcatalog"
+    catalog_only = True
     form_class = AddManifestCatalogForm
     template_name = "monolith/manifest_catalog_form.html"
 
@@ -899,6 +915,7 @@ class AddManifestCatalogView(PermissionRequiredMixin, BaseManifestM2MView):
 
 class EditManifestCatalogView(PermissionRequiredMixin, BaseManifestM2MView):
     permission_required = "monolith.change_manifestcatalog"
+    catalog_only = True
     form_class = EditManifestCatalogForm
     template_name = "monolith/manifest_catalog_form.html"
     m2m_model = Catalog
@@ -916,6 +933,7 @@ class EditManifestCatalogView(PermissionRequiredMixin, BaseManifestM2MView):
 
 class DeleteManifestCatalogView(PermissionRequiredMixin, BaseManifestM2MView):
     permission_required = "monolith.delete_manifestcatalog"
+    catalog_only = True
     form_class = EditManifestCatalogForm
     form_class = DeleteManifestCatalogForm
     template_name = "monolith/delete_manifest_catalog.html"
@@ -1334,12 +1352,9 @@ class MRCatalogView(MRNameView):
 
     def do_get(self, model, key, cache_key, event_payload):
         if model == "manifest_catalog" and key == self.manifest.pk:
-            catalog_data = cache.get(cache_key)
-            if catalog_data is None:
-                catalog_data = self.manifest.serialize_catalog(self.tags)
-                cache.set(cache_key, catalog_data, timeout=None)
-            else:
-                event_payload["cache"]["hit"] = True
+            catalog_data, event_payload["cache"]["hit"] = get_manifest_snapshot(
+                self.manifest, ManifestSnapshot.CATALOG, self.tags
+            )
             return HttpResponse(catalog_data, content_type="application/xml")
 
 
@@ -1358,12 +1373,9 @@ class MRManifestView(MRNameView):
     def do_get(self, model, key, cache_key, event_payload):
         manifest_data = None
         if model == "manifest":
-            manifest_data = cache.get(cache_key)
-            if manifest_data is None:
-                manifest_data = self.manifest.serialize(self.tags)
-                cache.set(cache_key, manifest_data, timeout=None)
-            else:
-                event_payload["cache"]["hit"] = True
+            manifest_data, event_payload["cache"]["hit"] = get_manifest_snapshot(
+                self.manifest, ManifestSnapshot.MANIFEST, self.tags
+            )
         elif model == "sub_manifest":
             sm_id = key
             event_payload["sub_manifest"] = {"id": sm_id}
@@ -1389,6 +1401,10 @@ class MRManifestView(MRNameView):
 class MRPackageView(MRNameView):
     event_payload_type = "package"
 
+    def get_cache_key(self, model, key):
+        # the repository packages depend on the catalogs
+        return "{}.{}".format(super().get_cache_key(model, key), self.manifest.catalog_version)
+
     def _get_cache_server(self):
         cache_key = f"monolith.{self.manifest.pk}.cache-servers"
         cache_servers = cache.get(cache_key)
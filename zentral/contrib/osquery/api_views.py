@@ -17,7 +17,7 @@ from zentral.utils.drf import DefaultDjangoModelPermissions, DjangoPermissionReq
 from .events import post_osquery_pack_update_events
 from .models import Configuration, Enrollment, Pack, PackQuery, Query
 from .serializers import ConfigurationSerializer, EnrollmentSerializer, OsqueryPackSerializer
-from .tasks import export_distributed_query_results
+from .tasks import DQR_EXPORT_FORMATS, export_distributed_query_results
 
 
 class ConfigurationList(generics.ListCreateAPIView):
@@ -299,7 +299,7 @@ class ExportDistributedQueryResults(APIView):
 
     def post(self, request, *args, **kwargs):
         export_format = request.GET.get("export_format", "csv")
-        if export_format not in ("csv", "ndjson", "xlsx"):
+        if export_format not in DQR_EXPORT_FORMATS:
             raise ValidationError("Unknown export format")
         result = export_distributed_query_results.apply_async((int(kwargs["pk"]), f".{export_format}"))
         return Response({"task_id": result.id,
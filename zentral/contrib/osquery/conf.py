@@ -1,6 +1,11 @@
+import hashlib
+import json
 import logging
-from zentral.contrib.inventory.conf import LINUX, MACOS, WINDOWS
+import uuid
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Q
+from zentral.contrib.inventory.conf import LINUX, MACOS, WINDOWS
 
 
 logger = logging.getLogger('zentral.contrib.osquery.conf')
@@ -174,3 +179,48 @@ def build_osquery_conf(machine, enrollment):
         conf.setdefault("packs", {})[pack.configuration_key()] = pack.serialize()
 
     return conf
+
+
+# cached configurations
+
+
+OSQUERY_CONF_VERSION_CACHE_KEY = "osquery-conf-version"
+OSQUERY_CONF_CACHE_TIMEOUT = 3600
+
+
+def _set_new_osquery_conf_version():
+    cache.set(OSQUERY_CONF_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def bump_osquery_conf_version():
+    _set_new_osquery_conf_version()
+    # again, once the changes are visible to the other DB connections,
+    # in case a configuration was cached in between with the previous state
+    transaction.on_commit(_set_new_osquery_conf_version)
+
+
+def get_osquery_conf_version():
+    return cache.get_or_set(OSQUERY_CONF_VERSION_CACHE_KEY, lambda: uuid.uuid4().hex, None)
+
+
+def get_osquery_conf_cache_key(machine, configuration, version):
+    # the configuration only depends on the configuration, its packs,
+    # the machine tags, and the machine platform for the inventory query
+    h = hashlib.sha1()
+    if configuration.inventory:
+        h.update(get_inventory_query_for_machine(machine, configuration.inventory_apps).encode("utf-8"))
+    h.update(b"|")
+    h.update(",".join(str(pk) for pk in sorted(t.pk for t in machine.tags)).encode("utf-8"))
+    return "osquery-conf_{}_{}_{}".format(configuration.pk, version, h.hexdigest())
+
+
+def get_serialized_osquery_conf(machine, enrollment):
+    # version read before the configuration is built,
+    # so that a configuration built during a change is not cached with the new version
+    version = get_osquery_conf_version()
+    cache_key = get_osquery_conf_cache_key(machine, enrollment.configuration, version)
+    serialized_conf = cache.get(cache_key)
+    if serialized_conf is None:
+        serialized_conf = json.dumps(build_osquery_conf(machine, enrollment)).encode("utf-8")
+        cache.set(cache_key, serialized_conf, OSQUERY_CONF_CACHE_TIMEOUT)
+    return serialized_conf
@@ -0,0 +1,202 @@
+import logging
+import threading
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from zentral.core.probes.conf import zentral_probes_sync
+from zentral.core.probes.sync import ProbeViewSync, signal_change
+from zentral.utils.text import shard
+from .models import DistributedQuery, DistributedQueryMachine
+
+
+logger = logging.getLogger("zentral.contrib.osquery.distributed_query_index")
+
+
+postgresql_channel = "osquery_distributed_query_change"
+
+
+class DistributedQueryIndexSync(ProbeViewSync):
+    postgresql_channel = postgresql_channel
+
+
+class IndexedDistributedQuery:
+    __slots__ = ("pk", "sql", "valid_from", "valid_until",
+                 "platforms", "serial_numbers", "tag_ids", "minimum_osquery_version_tuple", "shard")
+
+    def __init__(self, distributed_query):
+        self.pk = distributed_query.pk
+        self.sql = distributed_query.sql
+        self.valid_from = distributed_query.valid_from
+        self.valid_until = distributed_query.valid_until
+        self.platforms = frozenset(distributed_query.platforms)
+        self.serial_numbers = frozenset(distributed_query.serial_numbers)
+        self.tag_ids = frozenset(t.pk for t in distributed_query.tags.all())
+        self.minimum_osquery_version_tuple = distributed_query.minimum_osquery_version_tuple
+        self.shard = distributed_query.shard
+
+    def is_active(self, now):
+        return self.valid_from <= now and (self.valid_until is None or self.valid_until >= now)
+
+    def matches(self, enrolled_machine, machine_platforms, get_machine_tag_ids):
+        # same filters as DistributedQuery.objects.iter_queries_for_enrolled_machine
+        serial_number = enrolled_machine.serial_number
+        if self.platforms and not self.platforms.intersection(machine_platforms):
+            return False
+        if self.serial_numbers and serial_number not in self.serial_numbers:
+            return False
+        if self.minimum_osquery_version_tuple > enrolled_machine.osquery_version_tuple:
+            return False
+        if self.shard != 100 and shard(serial_number, self.pk) > self.shard:
+            return False
+        # last, because the machine tags are fetched from the DB
+        if self.tag_ids and not self.tag_ids.intersection(get_machine_tag_ids()):
+            return False
+        return True
+
+
+class DistributedQueryIndex:
+    """In-memory index of the active and upcoming distributed queries
+
+    Cleared when a distributed query changes, using a postgresql LISTEN/NOTIFY channel.
+    """
+    def __init__(self, with_sync=False):
+        self._queries = None
+        self._lock = threading.Lock()
+        self.with_sync = with_sync
+        self.sync = None
+
+    def clear(self):
+        with self._lock:
+            self._queries = None
+
+    def _start_sync(self):
+        if self.with_sync:
+            if self.sync is not None:
+                if self.sync.is_alive():
+                    return
+                else:
+                    logger.error("Sync thread is not alive. Last heartbeat %s.", self.sync.last_heartbeat or "-")
+            self.sync = DistributedQueryIndexSync(self)
+            self.sync.start()
+
+    def _load(self):
+        self._start_sync()
+        if self._queries is None:
+            self._queries = [
+                IndexedDistributedQuery(dq)
+                for dq in (DistributedQuery.objects.filter(Q(valid_until__isnull=True)
+                                                           | Q(valid_until__gte=timezone.now()))
+                                                   .prefetch_related("tags")
+                                                   .order_by("pk"))
+            ]
+
+    def get_queries(self):
+        with self._lock:
+            self._load()
+            return self._queries
+
+    def iter_queries_for_machine(self, enrolled_machine, machine):
+        queries = self.get_queries()
+        if not queries:
+            return
+        now = timezone.now()
+        machine_platforms = set(enrolled_machine.platforms)
+        machine_tag_ids = None
+
+        def get_machine_tag_ids():
+            nonlocal machine_tag_ids
+            if machine_tag_ids is None:
+                machine_tag_ids = {t.pk for t in machine.tags}
+            return machine_tag_ids
+
+        for query in queries:
+            if query.is_active(now) and query.matches(enrolled_machine, machine_platforms, get_machine_tag_ids):
+                yield query
+
+
+distributed_query_index = DistributedQueryIndex(with_sync=zentral_probes_sync)
+
+
+def signal_distributed_query_change():
+    distributed_query_index.clear()
+    transaction.on_commit(lambda: signal_change(postgresql_channel))
+
+
+class ServedDistributedQueries:
+    """Compact set of the pks of the distributed queries already served to a machine
+
+    Bitmap of the pks, starting at an offset, kept in the Django cache.
+    Only an optimization: the distributed query machines in the DB are the reference.
+    """
+    cache_key_prefix = "osquery-dq-served_"
+    cache_timeout = 7 * 86400
+
+    def __init__(self, serial_number, offset=0, bitmap=0):
+        self.serial_number = serial_number
+        self.offset = offset
+        self.bitmap = bitmap
+
+    @classmethod
+    def get_cache_key(cls, serial_number):
+        return "{}{}".format(cls.cache_key_prefix, serial_number)
+
+    @classmethod
+    def load(cls, serial_number):
+        try:
+            offset, bitmap = cache.get(cls.get_cache_key(serial_number))
+        except TypeError:
+            offset = bitmap = 0
+        return cls(serial_number, offset, bitmap)
+
+    def __contains__(self, pk):
+        return pk >= self.offset and bool(self.bitmap >> (pk - self.offset) & 1)
+
+    def add(self, pk):
+        if not self.bitmap:
+            self.offset = pk
+        elif pk < self.offset:
+            self.bitmap <<= self.offset - pk
+            self.offset = pk
+        self.bitmap |= 1 << (pk - self.offset)
+
+    def save(self, min_pk):
+        # the bits below the smallest pk of the active queries for the machine are not needed anymore
+        if min_pk > self.offset:
+            self.bitmap >>= min_pk - self.offset
+            self.offset = min_pk
+        cache.set(self.get_cache_key(self.serial_number), (self.offset, self.bitmap), self.cache_timeout)
+
+
+def get_distributed_queries_for_machine(enrolled_machine, machine, batch_size):
+    """Return the new distributed queries for a machine, as a {dqm pk: sql} dict
+
+    No DB queries if there are no active distributed queries for the machine,
+    or if they have all been served already.
+    """
+    queries = list(distributed_query_index.iter_queries_for_machine(enrolled_machine, machine))
+    if not queries:
+        return {}
+    min_pk = queries[0].pk
+    serial_number = enrolled_machine.serial_number
+    served = ServedDistributedQueries.load(serial_number)
+    queries = [query for query in queries if query.pk not in served]
+    if not queries:
+        return {}
+    # verify in the DB, the served queries could have been evicted from the cache
+    for dq_pk in (DistributedQueryMachine.objects.filter(serial_number=serial_number,
+                                                         distributed_query__pk__in=[q.pk for q in queries])
+                                                 .values_list("distributed_query__pk", flat=True)):
+        served.add(dq_pk)
+    queries = [query for query in queries if query.pk not in served][:batch_size]
+    response = {}
+    if queries:
+        dqm_list = DistributedQueryMachine.objects.bulk_create([
+            DistributedQueryMachine(distributed_query_id=query.pk, serial_number=serial_number)
+            for query in queries
+        ])
+        for dqm, query in zip(dqm_list, queries):
+            response[str(dqm.pk)] = query.sql
+            served.add(query.pk)
+    served.save(min_pk)
+    return response
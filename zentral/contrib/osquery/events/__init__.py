@@ -160,32 +160,64 @@ def _get_osquery_log_record_created_at(payload):
     return datetime.utcfromtimestamp(float(payload.pop('unixTime')))
 
 
-def _post_events_from_osquery_log(msn, user_agent, ip, event_cls, records):
+def _clean_osquery_log_records(records):
     for record in records:
         for k in ("decorations", "numerics", "calendarTime", "hostIdentifier"):
             if k in record:
                 del record[k]
+
+
+def _post_events_from_osquery_log(msn, user_agent, ip, event_cls, records):
+    _clean_osquery_log_records(records)
     event_cls.post_machine_request_payloads(msn, user_agent, ip, records, _get_osquery_log_record_created_at)
 
 
+def _build_events_from_osquery_log(msn, user_agent, ip, event_cls, records):
+    _clean_osquery_log_records(records)
+    yield from event_cls.build_from_machine_request_payloads(msn, user_agent, ip, records,
+                                                             _get_osquery_log_record_created_at)
+
+
 def post_results(msn, user_agent, ip, results):
     _post_events_from_osquery_log(msn, user_agent, ip, OsqueryResultEvent, results)
 
 
+def build_results_events(msn, user_agent, ip, results):
+    yield from _build_events_from_osquery_log(msn, user_agent, ip, OsqueryResultEvent, results)
+
+
 def post_status_logs(msn, user_agent, ip, logs):
     _post_events_from_osquery_log(msn, user_agent, ip, OsqueryStatusEvent, logs)
 
 
+def build_status_logs_events(msn, user_agent, ip, logs):
+    yield from _build_events_from_osquery_log(msn, user_agent, ip, OsqueryStatusEvent, logs)
+
+
+def post_log_raw_event(msn, user_agent, ip, node_key, business_unit, log_type, records):
+    queues.post_raw_event(
+        "osquery_logs",
+        {"request": {"user_agent": user_agent, "ip": ip},
+         "serial_number": msn,
+         "node_key": node_key,
+         "business_unit": business_unit,
+         "log_type": log_type,
+         "records": records}
+    )
+
+
 # Utility function for the audit trail
 
 
 def post_osquery_pack_update_events(request, pack_data, pack_queries_data):
     event_request = EventRequest.build_from_request(request)
     pack_update_event_metadata = EventMetadata(request=event_request)
-    pack_update_event = OsqueryPackUpdateEvent(pack_update_event_metadata, pack_data)
-    pack_update_event.post()
-    for idx, pack_query_data in enumerate(pack_queries_data):
-        pack_query_update_event_metadata = EventMetadata(request=event_request,
-                                                         uuid=pack_update_event_metadata.uuid, index=idx + 1)
-        pack_query_update_event = OsqueryPackQueryUpdateEvent(pack_query_update_event_metadata, pack_query_data)
-        pack_query_update_event.post()
+
+    def iter_events():
+        yield OsqueryPackUpdateEvent(pack_update_event_metadata, pack_data)
+        for idx, pack_query_data in enumerate(pack_queries_data):
+            pack_query_update_event_metadata = EventMetadata(request=event_request,
+                                                             uuid=pack_update_event_metadata.uuid, index=idx + 1)
+            yield OsqueryPackQueryUpdateEvent(pack_query_update_event_metadata, pack_query_data)
+
+    queues.post_events(iter_events())
@@ -0,0 +1,53 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from django.core.files.storage import default_storage
+from zentral.utils.storage import StorageFileWriter
+from .utils import file_carving_archive_duration_histogram, file_carving_archive_throughput_histogram
+
+
+logger = logging.getLogger("zentral.contrib.osquery.file_carving")
+
+
+def _read_storage_file(name):
+    with default_storage.open(name, "rb") as f:
+        return f.read()
+
+
+def iter_file_carving_session_blocks(file_carving_session, max_workers=4, window_size=16):
+    """Yield the data of the blocks of a file carving session, in order
+
+    The blocks are read concurrently from the storage, at most window_size blocks ahead.
+    """
+    block_names = (file_carving_session.filecarvingblock_set.all()
+                                                            .order_by("block_id")
+                                                            .values_list("file", flat=True))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for block_name in block_names.iterator():
+            futures.append(executor.submit(_read_storage_file, block_name))
+            if len(futures) >= window_size:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def build_file_carving_session_archive_file(file_carving_session, max_workers=4, window_size=16):
+    """Assemble the blocks of a file carving session into the archive file in the storage
+
+    Returns the storage name and the size of the archive.
+    """
+    archive_name = file_carving_session.archive.field.generate_filename(file_carving_session, "archive.tar")
+    start = time.perf_counter()
+    with StorageFileWriter(archive_name) as writer:
+        for block_data in iter_file_carving_session_blocks(file_carving_session, max_workers, window_size):
+            writer.write(block_data)
+    duration = time.perf_counter() - start
+    file_carving_archive_duration_histogram.observe(writer.mode, duration)
+    if duration > 0:
+        throughput = writer.size / duration
+        file_carving_archive_throughput_histogram.observe(writer.mode, throughput)
+        logger.info("Archive %s built in %.1fs, %d bytes, %.0f bytes/s, %s mode",
+                    writer.name, duration, writer.size, throughput, writer.mode)
+    return writer.name, writer.size
@@ -0,0 +1,116 @@
+from datetime import datetime
+from itertools import islice
+import time
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import EnrollmentSecret, MachineTag, MetaBusinessUnit, MetaMachine, Tag
+from zentral.contrib.osquery.distributed_query_index import (distributed_query_index,
+                                                             get_distributed_queries_for_machine,
+                                                             ServedDistributedQueries)
+from zentral.contrib.osquery.models import (Configuration, DistributedQuery, DistributedQueryMachine,
+                                            EnrolledMachine, Enrollment)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare the distributed read polls/sec of the DB queries and of the in-memory distributed query index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machines', type=int, default=10000)
+        parser.add_argument('--queries', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=10)
+
+    def seed(self, options):
+        prefix = get_random_string(8)
+        configuration = Configuration.objects.create(name="Benchmark {}".format(prefix))
+        meta_business_unit = MetaBusinessUnit.objects.create(name="Benchmark {}".format(prefix))
+        enrollment_secret = EnrollmentSecret.objects.create(meta_business_unit=meta_business_unit)
+        enrollment = Enrollment.objects.create(configuration=configuration, secret=enrollment_secret)
+        tag = Tag.objects.create(name="Benchmark {}".format(prefix))
+        enrolled_machines = EnrolledMachine.objects.bulk_create(
+            EnrolledMachine(enrollment=enrollment,
+                            serial_number="{}{:06d}".format(prefix, i).upper(),
+                            node_key=get_random_string(32),
+                            osquery_version="4.7.0",
+                            platform_mask=21)
+            for i in range(options["machines"])
+        )
+        # 1 machine out of 10 tagged
+        MachineTag.objects.bulk_create(
+            MachineTag(serial_number=em.serial_number, tag=tag)
+            for em in enrolled_machines[::10]
+        )
+        for i in range(options["queries"]):
+            dq = DistributedQuery.objects.create(
+                sql="select {} from osquery_info;".format(i),
+                valid_from=datetime.utcnow(),
+                query_version=1,
+                platforms=["linux"] if i % 3 == 2 else [],
+                shard=50 if i % 2 else 100,
+            )
+            if i % 4 == 3:
+                dq.tags.add(tag)
+        distributed_query_index.clear()
+        return enrolled_machines
+
+    def db_poll(self, enrolled_machine, batch_size):
+        # previous distributed read view implementation
+        machine = MetaMachine(enrolled_machine.serial_number)
+        dqm_list = [
+            DistributedQueryMachine(distributed_query=distributed_query, serial_number=machine.serial_number)
+            for distributed_query in islice(
+                DistributedQuery.objects.iter_queries_for_enrolled_machine(enrolled_machine, machine.tags),
+                batch_size
+            )
+        ]
+        if dqm_list:
+            DistributedQueryMachine.objects.bulk_create(dqm_list)
+        return {str(dqm.pk): dqm.distributed_query.sql for dqm in dqm_list}
+
+    def index_poll(self, enrolled_machine, batch_size):
+        return get_distributed_queries_for_machine(enrolled_machine,
+                                                   MetaMachine(enrolled_machine.serial_number),
+                                                   batch_size)
+
+    def run(self, poll_func, enrolled_machines, batch_size):
+        durations = []
+        served = 0
+        try:
+            with transaction.atomic():
+                # first round → queries served, second round → empty polls
+                for _ in range(2):
+                    start = time.perf_counter()
+                    for enrolled_machine in enrolled_machines:
+                        served += len(poll_func(enrolled_machine, batch_size))
+                    durations.append(time.perf_counter() - start)
+                raise Rollback
+        except Rollback:
+            pass
+        return durations, served
+
+    def handle(self, *args, **options):
+        enrolled_machines = []
+        try:
+            with transaction.atomic():
+                enrolled_machines = self.seed(options)
+                for name, poll_func in (("DB", self.db_poll), ("index", self.index_poll)):
+                    (first_round, second_round), served = self.run(poll_func, enrolled_machines,
+                                                                   options["batch_size"])
+                    self.stdout.write("{:<6} {} queries served, first round {:>8.0f} polls/s, "
+                                      "empty polls {:>8.0f} polls/s".format(
+                                          name, served,
+                                          len(enrolled_machines) / first_round,
+                                          len(enrolled_machines) / second_round
+                                      ))
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            distributed_query_index.clear()
+            cache.delete_many([ServedDistributedQueries.get_cache_key(em.serial_number)
+                               for em in enrolled_machines])
@@ -0,0 +1,31 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+BACKFILL_RESULT_COLUMN_NAMES = """
+UPDATE osquery_distributedquery dq
+SET result_column_names = dqr.column_names
+FROM (
+  SELECT distributed_query_id, array_agg(DISTINCT k ORDER BY k) column_names
+  FROM osquery_distributedqueryresult, jsonb_object_keys(row) k
+  GROUP BY distributed_query_id
+) dqr
+WHERE dq.id = dqr.distributed_query_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0010_auto_20210629_0723'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='distributedquery',
+            name='result_column_names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), default=list,
+                                                            editable=False, size=None),
+        ),
+        migrations.RunSQL(BACKFILL_RESULT_COLUMN_NAMES, migrations.RunSQL.noop),
+    ]
@@ -12,6 +12,7 @@ from zentral.conf import settings
 from zentral.contrib.inventory.models import BaseEnrollment, Tag
 from zentral.utils.sql import tables_in_query, format_sql
 from zentral.utils.text import shard
+from .conf import bump_osquery_conf_version
 from .specs import cli_only_flags
 
 
@@ -114,6 +115,15 @@ class Query(models.Model):
             d["value"] = self.value
         return d
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 class Pack(models.Model):
     DELIMITER = "/"
@@ -168,6 +178,15 @@ class Pack(models.Model):
             d["shard"] = self.shard
         return d
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 class PackQueryManager(models.Manager):
     def get_with_config_key(self, key):
@@ -249,6 +268,15 @@ class PackQuery(models.Model):
             d["shard"] = self.shard
         return d
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 class FileCategory(models.Model):
     name = models.CharField(max_length=256, unique=True)
@@ -269,6 +297,15 @@ class FileCategory(models.Model):
     def get_absolute_url(self):
         return reverse("osquery:file_category", args=(self.pk,))
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 class AutomaticTableConstruction(models.Model):
     name = models.CharField(max_length=256, unique=True)
@@ -300,6 +337,15 @@ class AutomaticTableConstruction(models.Model):
     def get_query_html(self):
         return format_sql(self.query)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 class Configuration(models.Model):
     name = models.CharField(max_length=256, unique=True)
@@ -390,6 +436,12 @@ class Configuration(models.Model):
             # per default, will bump the enrollment version
             # and notify their distributors
             enrollment.save()
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
 
     def can_be_deleted(self):
         return self.enrollment_set.all().count() == 0
@@ -406,6 +458,15 @@ class ConfigurationPack(models.Model):
     def get_absolute_url(self):
         return "{}#cp{}".format(self.configuration.get_absolute_url(), self.pk)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_osquery_conf_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        bump_osquery_conf_version()
+        return deleted
+
 
 # Enrollment
 
@@ -485,6 +546,18 @@ class DistributedQueryManager(models.Manager):
             if dq.shard == 100 or shard(serial_number, dq.pk) <= dq.shard:
                 yield dq
 
+    def add_result_columns(self, pk, columns):
+        # atomic merge of the new columns into the sorted result column names
+        query = (
+            "update osquery_distributedquery "
+            "set result_column_names = ("
+            "  select array_agg(distinct c order by c) from unnest(result_column_names || %s::text[]) c"
+            ") where id = %s and not result_column_names @> %s::text[]"
+        )
+        columns = sorted(columns)
+        with connection.cursor() as cursor:
+            cursor.execute(query, [columns, pk, columns])
+
 
 class DistributedQuery(models.Model):
     query = models.ForeignKey(Query, on_delete=models.SET_NULL, null=True, editable=False)
@@ -513,6 +586,9 @@ class DistributedQuery(models.Model):
         help_text="Restrict this query to a percentage (1-100) of target hosts"
     )
 
+    # maintained by the distributed write view
+    result_column_names = ArrayField(models.TextField(), default=list, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -521,6 +597,21 @@ class DistributedQuery(models.Model):
     def __str__(self):
         return str(self.pk)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and "update_fields" not in kwargs:
+            # do not overwrite the result column names updated concurrently by the distributed write view
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != "result_column_names"]
+        super().save(*args, **kwargs)
+        from .distributed_query_index import signal_distributed_query_change
+        signal_distributed_query_change()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        from .distributed_query_index import signal_distributed_query_change
+        signal_distributed_query_change()
+        return deleted
+
     def get_absolute_url(self):
         return reverse("osquery:distributed_query", args=(self.pk,))
 
@@ -547,14 +638,7 @@ class DistributedQuery(models.Model):
             return (0, 0, 0)
 
     def result_columns(self):
-        query = (
-            "select distinct jsonb_object_keys(row) as col "
-            "from osquery_distributedqueryresult where distributed_query_id = %s "
-            "order by col"
-        )
-        cursor = connection.cursor()
-        cursor.execute(query, [self.pk])
-        return [t[0] for t in cursor.fetchall()]
+        return sorted(self.result_column_names)
 
 
 class DistributedQueryMachine(models.Model):
@@ -626,6 +710,10 @@ class FileCarvingSession(models.Model):
     def get_archive_name(self):
         return f"{self}.tar"
 
+    def get_archive_url(self):
+        return "{}{}".format(settings["api"]["tls_hostname"],
+                             reverse("osquery:download_file_carving_session_archive", args=(self.pk,)))
+
 
 def file_carving_block_path(instance, filename):
     return os.path.join(file_carving_session_dir_path(instance.file_carving_session), str(instance.block_id))
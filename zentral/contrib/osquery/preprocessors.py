@@ -0,0 +1,46 @@
+import logging
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_yield_events
+from zentral.utils.json import save_dead_letter
+from .events import build_results_events, build_status_logs_events
+from .views.utils import build_tree_from_inventory_query_snapshot, split_results_and_last_inventory_snapshot
+
+
+logger = logging.getLogger("zentral.contrib.osquery.preprocessors")
+
+
+class OsqueryLogPreprocessor(object):
+    routing_key = "osquery_logs"
+
+    def iter_events(self, raw_event):
+        serial_number = raw_event["serial_number"]
+        request_d = raw_event["request"]
+        user_agent = request_d["user_agent"]
+        ip = request_d["ip"]
+        log_type = raw_event["log_type"]
+        records = raw_event["records"]
+        if log_type == "result":
+            results, last_inventory_snapshot = split_results_and_last_inventory_snapshot(records)
+            if last_inventory_snapshot:
+                tree = build_tree_from_inventory_query_snapshot(
+                    serial_number, raw_event["node_key"], ip,
+                    raw_event.get("business_unit"), last_inventory_snapshot
+                )
+                yield from commit_machine_snapshot_and_yield_events(tree)
+            yield from build_results_events(serial_number, user_agent, ip, results)
+        elif log_type == "status":
+            yield from build_status_logs_events(serial_number, user_agent, ip, records)
+        else:
+            logger.error("Unknown log type %s", log_type)
+
+    def process_raw_event(self, raw_event):
+        try:
+            events = list(self.iter_events(raw_event))
+        except Exception:
+            logger.exception("Could not process osquery_logs raw event")
+            save_dead_letter(raw_event, "osquery log preprocessing error")
+        else:
+            yield from events
+
+
+def get_preprocessors():
+    yield OsqueryLogPreprocessor()
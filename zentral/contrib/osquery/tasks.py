@@ -5,17 +5,28 @@ import logging
 import os
 import tempfile
 from celery import shared_task
-from django.core.files import File
 from django.core.files.storage import default_storage
+from django.db import connection, transaction
 from django.utils.text import slugify
 import xlsxwriter
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 from zentral.core.events import event_cls_from_type
+from .file_carving import build_file_carving_session_archive_file
 from .models import DistributedQuery, FileCarvingSession
 
 
 logger = logging.getLogger("zentral.contrib.osquery.tasks")
 
 
+DQR_EXPORT_FORMATS = ("csv", "ndjson", "xlsx")
+if pyarrow is not None:
+    DQR_EXPORT_FORMATS += ("parquet",)
+
+
 @shared_task(ignore_result=True)
 def build_file_carving_session_archive(session_id):
     # get the carve session
@@ -25,18 +36,10 @@ def build_file_carving_session_archive(session_id):
         logger.error("Archive already exists for session %s", session_id)
         return
 
-    # build archive file from carve blocks
-    archive_size = 0
-    tmp_fh, tmp_path = tempfile.mkstemp(suffix="_osquery_file_carving_archive.tar")
-    logger.info("Start building archive %s %s", session_id, tmp_path)
-    with os.fdopen(tmp_fh, "wb") as f:
-        for file_carving_block in file_carving_session.filecarvingblock_set.all().order_by("block_id"):
-            for chunk in file_carving_block.file.chunks():
-                f.write(chunk)
-                archive_size += len(chunk)
-    with open(tmp_path, "rb") as f:
-        file_carving_session.archive.save("archive.tar", File(f))
-    os.unlink(tmp_path)
+    # stream the carve blocks into the archive file
+    logger.info("Start building archive %s", session_id)
+    file_carving_session.archive, archive_size = build_file_carving_session_archive_file(file_carving_session)
+    file_carving_session.save()
 
     # post osquery file carve event
     event_cls = event_cls_from_type("osquery_file_carving")
@@ -53,16 +56,38 @@ def build_file_carving_session_archive(session_id):
 # distributed query result exports
 
 
+def _iter_dqr_batches(distributed_query, window_size=5000):
+    # iter all (serial number, row) tuples over a server-side cursor, in batches
+    query = (
+        "select serial_number, row "
+        "from osquery_distributedqueryresult where distributed_query_id = %s "
+        "order by id"
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DECLARE dqr_export_cursor CURSOR FOR {query}", [distributed_query.pk])
+        while True:
+            cursor.execute("FETCH %s FROM dqr_export_cursor", [window_size])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield rows
+
+
+def _iter_dqr_rows(distributed_query):
+    for rows in _iter_dqr_batches(distributed_query):
+        yield from rows
+
+
 def _export_dqr_to_tmp_csv_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "w", newline='') as tmp_f:
         csv_w = csv.writer(tmp_f)
         columns = distributed_query.result_columns()
         csv_w.writerow(["serial number"] + columns)
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
-            row = [dqr.serial_number]
+        for serial_number, dqr_row in _iter_dqr_rows(distributed_query):
+            row = [serial_number]
             for column in columns:
-                row.append(dqr.row.get(column) or "")
+                row.append(dqr_row.get(column) or "")
             csv_w.writerow(row)
     return tmp_fp
 
@@ -70,8 +95,8 @@ def _export_dqr_to_tmp_csv_file(distributed_query):
 def _export_dqr_to_tmp_ndjson_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "w") as tmp_f:
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
-            json.dump({"serial_number": dqr.serial_number, "row": dqr.row}, tmp_f)
+        for serial_number, dqr_row in _iter_dqr_rows(distributed_query):
+            json.dump({"serial_number": serial_number, "row": dqr_row}, tmp_f)
             tmp_f.write("\n")
     return tmp_fp
 
@@ -79,7 +104,7 @@ def _export_dqr_to_tmp_ndjson_file(distributed_query):
 def _export_dqr_to_tmp_xlsx_file(distributed_query):
     tmp_fh, tmp_fp = tempfile.mkstemp()
     with os.fdopen(tmp_fh, "wb") as tmp_f:
-        workbook = xlsxwriter.Workbook(tmp_f)
+        workbook = xlsxwriter.Workbook(tmp_f, {"constant_memory": True})
         worksheet = workbook.add_worksheet("Results")
         columns = distributed_query.result_columns()
         row_idx = col_idx = 0
@@ -88,13 +113,13 @@ def _export_dqr_to_tmp_xlsx_file(distributed_query):
             col_idx += 1
             worksheet.write_string(row_idx, col_idx, column)
         worksheet.freeze_panes(1, 0)
-        for dqr in distributed_query.distributedqueryresult_set.iterator():
+        for serial_number, dqr_row in _iter_dqr_rows(distributed_query):
             row_idx += 1
             col_idx = 0
-            worksheet.write_string(row_idx, col_idx, dqr.serial_number)
+            worksheet.write_string(row_idx, col_idx, serial_number)
             for column in columns:
                 col_idx += 1
-                val = dqr.row.get(column)
+                val = dqr_row.get(column)
                 if not val:
                     worksheet.write_blank(row_idx, col_idx, "")
                 elif isinstance(val, (int, float)):
@@ -109,6 +134,28 @@ def _export_dqr_to_tmp_xlsx_file(distributed_query):
     return tmp_fp
 
 
+def _export_dqr_to_tmp_parquet_file(distributed_query):
+    # one row group per server-side cursor window, all the values as strings, like in the osquery results
+    columns = distributed_query.result_columns()
+    schema = pyarrow.schema([("serial number", pyarrow.string())]
+                            + [(column, pyarrow.string()) for column in columns])
+    tmp_fh, tmp_fp = tempfile.mkstemp()
+    with os.fdopen(tmp_fh, "wb") as tmp_f:
+        writer = pyarrow.parquet.ParquetWriter(tmp_f, schema)
+        for rows in _iter_dqr_batches(distributed_query):
+            data = {"serial number": [serial_number for serial_number, _ in rows]}
+            for column in columns:
+                values = data[column] = []
+                for _, dqr_row in rows:
+                    val = dqr_row.get(column)
+                    if val is not None and not isinstance(val, str):
+                        val = str(val)
+                    values.append(val)
+            writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))
+        writer.close()
+    return tmp_fp
+
+
 def _dqr_export_filename_filepath(distributed_query, extension):
     filename_items = []
     if distributed_query.query:
@@ -131,6 +178,9 @@ def _export_distributed_query_results(distributed_query, extension):
     elif extension == ".xlsx":
         content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         exporter = _export_dqr_to_tmp_xlsx_file
+    elif extension == ".parquet" and pyarrow is not None:
+        content_type = "application/vnd.apache.parquet"
+        exporter = _export_dqr_to_tmp_parquet_file
     else:
         raise ValueError(f"Unsupported distributed query results export extension: {extension}")
 
@@ -92,6 +92,9 @@ urlpatterns = [
     path('distributed/read', csrf_exempt(views.DistributedReadView.as_view()), name='distributed_read'),
     path('distributed/write', csrf_exempt(views.DistributedWriteView.as_view()), name='distributed_write'),
     path('log', csrf_exempt(views.LogView.as_view()), name='log'),
+
+    # prometheus
+    path('prometheus_metrics/', views.PrometheusMetricsView.as_view(), name='prometheus_metrics'),
 ]
 
 
@@ -0,0 +1,41 @@
+from prometheus_client import CollectorRegistry
+from zentral.conf import settings
+from zentral.utils.prometheus import CachedHistogram
+
+
+log_latency_histogram = CachedHistogram(
+    "zentral_osquery_log_duration_seconds",
+    "Zentral osquery log request duration",
+    "mode"
+)
+
+
+file_carving_archive_duration_histogram = CachedHistogram(
+    "zentral_osquery_file_carving_archive_duration_seconds",
+    "Zentral osquery file carving archive build duration",
+    "mode",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+
+
+file_carving_archive_throughput_histogram = CachedHistogram(
+    "zentral_osquery_file_carving_archive_throughput_bytes_per_second",
+    "Zentral osquery file carving archive build throughput",
+    "mode",
+    buckets=tuple(2 ** 20 * i for i in (1, 5, 10, 25, 50, 100, 250, 500))
+)
+
+
+def get_log_processing_mode():
+    if settings["apps"]["zentral.contrib.osquery"].get("async_log_processing", False):
+        return "async"
+    else:
+        return "sync"
+
+
+def get_prometheus_osquery_metrics():
+    registry = CollectorRegistry()
+    log_latency_histogram.register(registry, ("sync", "async"))
+    for histogram in (file_carving_archive_duration_histogram, file_carving_archive_throughput_histogram):
+        histogram.register(registry, ("local", "stream", "buffered"))
+    return registry
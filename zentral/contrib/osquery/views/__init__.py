@@ -8,4 +8,5 @@ from .file_carving_sessions import *  # NOQA
 from .index import *  # NOQA
 from .inventory import *  # NOQA
 from .packs import *  # NOQA
+from .prometheus import *  # NOQA
 from .queries import *  # NOQA
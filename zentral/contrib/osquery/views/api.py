@@ -3,20 +3,22 @@ from gzip import GzipFile
 from itertools import chain, islice
 import json
 import logging
+import time
 import uuid
 from django.core.exceptions import SuspiciousOperation, PermissionDenied
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
-from django.http import Http404, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.utils.crypto import get_random_string
 from django.views.generic import View
 from zentral.contrib.inventory.exceptions import EnrollmentSecretVerificationFailed
 from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine, MachineTag
 from zentral.contrib.inventory.utils import (commit_machine_snapshot_and_trigger_events,
                                              verify_enrollment_secret)
-from zentral.contrib.osquery.conf import build_osquery_conf, INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.conf import get_serialized_osquery_conf
+from zentral.contrib.osquery.distributed_query_index import get_distributed_queries_for_machine
 from zentral.contrib.osquery.events import (post_enrollment_event,
-                                            post_file_carve_events,
+                                            post_file_carve_events, post_log_raw_event,
                                             post_request_event, post_results, post_status_logs)
 from zentral.contrib.osquery.models import (DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
                                             EnrolledMachine,
@@ -26,7 +28,9 @@ from zentral.contrib.osquery.tasks import build_file_carving_session_archive
 from zentral.core.events.base import post_machine_conflict_event
 from zentral.utils.http import user_agent_and_ip_address_from_request
 from zentral.utils.json import remove_null_character
-from .utils import update_tree_with_enrollment_host_details, update_tree_with_inventory_query_snapshot
+from zentral.contrib.osquery.utils import get_log_processing_mode, log_latency_histogram
+from .utils import (build_tree_from_inventory_query_snapshot, split_results_and_last_inventory_snapshot,
+                    update_tree_with_enrollment_host_details)
 
 
 logger = logging.getLogger('zentral.contrib.osquery.views.api')
@@ -46,7 +50,10 @@ class BaseJsonPostView(View):
             raise SuspiciousOperation("Could not read JSON data")
         self.user_agent, self.ip = user_agent_and_ip_address_from_request(request)
         self.authenticate()
-        return JsonResponse(self.do_post())
+        response = self.do_post()
+        if isinstance(response, HttpResponse):
+            return response
+        return JsonResponse(response)
 
 
 class EnrollView(BaseJsonPostView):
@@ -174,7 +181,8 @@ class ConfigView(BaseNodeView):
     request_type = "config"
 
     def do_node_post(self):
-        return build_osquery_conf(self.machine, self.enrollment)
+        return HttpResponse(get_serialized_osquery_conf(self.machine, self.enrollment),
+                            content_type="application/json")
 
 
 class StartFileCarvingView(BaseNodeView):
@@ -282,23 +290,7 @@ class DistributedReadView(BaseNodeView):
     batch_size = 10  # TODO: hard coded
 
     def do_node_post(self):
-        dqm_list = []
-        for distributed_query in islice(
-            DistributedQuery.objects.iter_queries_for_enrolled_machine(self.enrolled_machine, self.machine.tags),
-            self.batch_size
-        ):
-            dqm_list.append(
-                DistributedQueryMachine(
-                    distributed_query=distributed_query,
-                    serial_number=self.machine.serial_number
-                )
-            )
-        queries = {}
-        if dqm_list:
-            DistributedQueryMachine.objects.bulk_create(dqm_list)
-            for dqm in dqm_list:
-                queries[str(dqm.pk)] = dqm.distributed_query.sql
-        return {'queries': queries}
+        return {'queries': get_distributed_queries_for_machine(self.enrolled_machine, self.machine, self.batch_size)}
 
 
 class DistributedWriteView(BaseNodeView):
@@ -327,27 +319,45 @@ class DistributedWriteView(BaseNodeView):
             dqm.save()
 
         # save_results
-        dq_results = (
-            DistributedQueryResult(
-                distributed_query=dqm.distributed_query,
-                serial_number=self.machine.serial_number,
-                row=remove_null_character(row)
-            )
-            for dqm_pk, dqm in dqm_cache.items()
-            for row in results.get(dqm_pk, [])
-        )
+        result_columns = {}
+
+        def iter_dq_results():
+            for dqm_pk, dqm in dqm_cache.items():
+                for row in results.get(dqm_pk, []):
+                    row = remove_null_character(row)
+                    if isinstance(row, dict):
+                        result_columns.setdefault(dqm.distributed_query, set()).update(row.keys())
+                    yield DistributedQueryResult(
+                        distributed_query=dqm.distributed_query,
+                        serial_number=self.machine.serial_number,
+                        row=row
+                    )
+
+        dq_results = iter_dq_results()
         while True:
             batch = list(islice(dq_results, self.batch_size))
             if not batch:
                 break
             DistributedQueryResult.objects.bulk_create(batch, self.batch_size)
 
+        # update the result columns of the distributed queries, only if new columns are found
+        for distributed_query, columns in result_columns.items():
+            if not columns.issubset(distributed_query.result_column_names):
+                DistributedQuery.objects.add_result_columns(distributed_query.pk, columns)
+
         return {}
 
 
 class LogView(BaseNodeView):
     request_type = "log"
 
+    def post(self, request, *args, **kwargs):
+        self.mode = get_log_processing_mode()
+        start = time.perf_counter()
+        response = super().post(request, *args, **kwargs)
+        log_latency_histogram.observe(self.mode, time.perf_counter() - start)
+        return response
+
     def process_decorations(self, records):
         if not records:
             return
@@ -380,24 +390,20 @@ class LogView(BaseNodeView):
         self.process_decorations(records)
 
         log_type = self.data.get("log_type")
-        if log_type == "result":
-            results = []
-            last_inventory_snapshot = None
-            for record in records:
-                if record.get("name") == INVENTORY_QUERY_NAME:
-                    last_inventory_snapshot = record.get("snapshot")
-                else:
-                    results.append(record)
+        business_unit = self.enrollment.secret.get_api_enrollment_business_unit()
+        if business_unit:
+            business_unit = business_unit.serialize()
+        if self.mode == "async":
+            # the inventory commit and the events are done by the osquery_logs preprocessor
+            post_log_raw_event(self.machine.serial_number, self.user_agent, self.ip,
+                               self.enrolled_machine.node_key, business_unit, log_type, records)
+        elif log_type == "result":
+            results, last_inventory_snapshot = split_results_and_last_inventory_snapshot(records)
             if last_inventory_snapshot:
-                tree = {"source": {"module": "zentral.contrib.osquery",
-                                   "name": "osquery"},
-                        "serial_number": self.machine.serial_number,
-                        "reference": self.enrolled_machine.node_key,
-                        "public_ip_address": self.ip}
-                business_unit = self.enrollment.secret.get_api_enrollment_business_unit()
-                if business_unit:
-                    tree["business_unit"] = business_unit.serialize()
-                update_tree_with_inventory_query_snapshot(tree, last_inventory_snapshot)
+                tree = build_tree_from_inventory_query_snapshot(
+                    self.machine.serial_number, self.enrolled_machine.node_key, self.ip,
+                    business_unit, last_inventory_snapshot
+                )
                 commit_machine_snapshot_and_trigger_events(tree)
             post_results(self.machine.serial_number, self.user_agent, self.ip, results)
         elif log_type == "status":
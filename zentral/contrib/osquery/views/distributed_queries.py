@@ -9,6 +9,7 @@ from django.views.generic import CreateView, DeleteView, DetailView, ListView, U
 from zentral.contrib.osquery.forms import DistributedQueryForm
 from zentral.contrib.osquery.models import (DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
                                             FileCarvingSession, Query)
+from zentral.contrib.osquery.tasks import DQR_EXPORT_FORMATS
 
 
 logger = logging.getLogger('zentral.contrib.osquery.views.distributed_queries')
@@ -216,7 +217,7 @@ class DistributedQueryResultListView(PermissionRequiredMixin, ListView):
         # export links
         ctx['export_links'] = []
         export_path = reverse("osquery_api:export_distributed_query_results", args=(self.distributed_query.pk,))
-        for fmt in ("csv", "ndjson", "xlsx"):
+        for fmt in DQR_EXPORT_FORMATS:
             export_qd = {"export_format": fmt}
             ctx['export_links'].append((fmt, "{}?{}".format(export_path, urlencode(export_qd))))
 
@@ -0,0 +1,7 @@
+from zentral.contrib.osquery.utils import get_prometheus_osquery_metrics
+from zentral.utils.prometheus import BasePrometheusMetricsView
+
+
+class PrometheusMetricsView(BasePrometheusMetricsView):
+    def get_registry(self):
+        return get_prometheus_osquery_metrics()
@@ -1,6 +1,7 @@
 from datetime import datetime
 import logging
 from zentral.contrib.inventory.models import PrincipalUserSource
+from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
 from zentral.utils.certificates import parse_text_dn
 
 
@@ -230,3 +231,26 @@ def update_tree_with_inventory_query_snapshot(tree, snapshot):
         tree["principal_user"] = principal_user
     if certificates:
         tree["certificates"] = certificates
+
+
+def split_results_and_last_inventory_snapshot(records):
+    results = []
+    last_inventory_snapshot = None
+    for record in records:
+        if record.get("name") == INVENTORY_QUERY_NAME:
+            last_inventory_snapshot = record.get("snapshot")
+        else:
+            results.append(record)
+    return results, last_inventory_snapshot
+
+
+def build_tree_from_inventory_query_snapshot(serial_number, node_key, ip, business_unit, snapshot):
+    tree = {"source": {"module": "zentral.contrib.osquery",
+                       "name": "osquery"},
+            "serial_number": serial_number,
+            "reference": node_key,
+            "public_ip_address": ip}
+    if business_unit:
+        tree["business_unit"] = business_unit
+    update_tree_with_inventory_query_snapshot(tree, snapshot)
+    return tree
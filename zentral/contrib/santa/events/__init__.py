@@ -1,8 +1,12 @@
 from datetime import datetime
 import logging
+from django.core.cache import cache
+from django.db.models import Count
 from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
 from zentral.contrib.inventory.models import File
 from zentral.contrib.santa.models import Bundle, Target
+from zentral.core.queues import queues
+from zentral.utils.mt_models import prepare_commit_tree
 
 
 logger = logging.getLogger('zentral.contrib.santa.events')
@@ -145,6 +149,19 @@ def _is_bundle_binary_pseudo_event(event_d):
     return event_d.get('decision') == "BUNDLE_BINARY"
 
 
+def _get_or_create_targets(target_type, sha256_set):
+    # one query for the existing targets, one bulk insert for the missing ones
+    targets = dict(Target.objects.filter(type=target_type, sha256__in=sha256_set).values_list("sha256", "pk"))
+    missing_sha256_set = set(sha256_set) - set(targets.keys())
+    if missing_sha256_set:
+        Target.objects.bulk_create([Target(type=target_type, sha256=sha256) for sha256 in missing_sha256_set],
+                                   ignore_conflicts=True)
+        # the primary keys are not returned when the conflicts are ignored
+        targets.update(Target.objects.filter(type=target_type, sha256__in=missing_sha256_set)
+                                     .values_list("sha256", "pk"))
+    return targets
+
+
 def _create_missing_bundles(events):
     bundle_events = {
         sha256: event_d
@@ -165,10 +182,18 @@ def _create_missing_bundles(events):
         ).values_list("target__sha256", flat=True)
     )
     unknown_file_bundle_hashes = list(set(bundle_events.keys()) - existing_sha256_set)
-    for sha256 in unknown_file_bundle_hashes:
-        target, _ = Target.objects.get_or_create(type=Target.BUNDLE, sha256=sha256)
-        defaults = {}
-        event_d = bundle_events[sha256]
+    if not unknown_file_bundle_hashes:
+        return unknown_file_bundle_hashes
+    _bulk_create_bundles({sha256: bundle_events[sha256] for sha256 in unknown_file_bundle_hashes})
+    return unknown_file_bundle_hashes
+
+
+def _bulk_create_bundles(bundle_events):
+    """Create the bundles from the bundle attributes of the events, indexed by bundle sha256"""
+    targets = _get_or_create_targets(Target.BUNDLE, set(bundle_events.keys()))
+    bundles = []
+    for sha256, event_d in bundle_events.items():
+        bundle_kwargs = {"target_id": targets[sha256]}
         for event_attr, bundle_attr in (("file_bundle_path", "path"),
                                         ("file_bundle_executable_rel_path", "executable_rel_path"),
                                         ("file_bundle_id", "bundle_id"),
@@ -182,9 +207,16 @@ def _create_missing_bundles(events):
                     val = 0
                 else:
                     val = ""
-            defaults[bundle_attr] = val
-        Bundle.objects.get_or_create(target=target, defaults=defaults)
-    return unknown_file_bundle_hashes
+            bundle_kwargs[bundle_attr] = val
+        bundles.append(Bundle(**bundle_kwargs))
+    # the existing bundles, not uploaded yet, are left untouched
+    Bundle.objects.bulk_create(bundles, ignore_conflicts=True)
+
+
+def _get_bundles(sha256_set):
+    return {bundle.target.sha256: bundle
+            for bundle in Bundle.objects.select_related("target").filter(target__type=Target.BUNDLE,
+                                                                         target__sha256__in=sha256_set)}
 
 
 def _create_bundle_binaries(events):
@@ -192,34 +224,56 @@ def _create_bundle_binaries(events):
     for event_d in events:
         if _is_bundle_binary_pseudo_event(event_d):
             bundle_sha256 = event_d.get("file_bundle_hash")
-            if bundle_sha256:
+            if bundle_sha256 and event_d.get("file_sha256"):
                 bundle_binary_events.setdefault(bundle_sha256, []).append(event_d)
-    for bundle_sha256, events in bundle_binary_events.items():
-        try:
-            bundle = Bundle.objects.get(target__type=Target.BUNDLE, target__sha256=bundle_sha256)
-        except Bundle.DoesNotExist:
-            logger.error("Unknown bundle: %s", bundle_sha256)
-            continue
+    if not bundle_binary_events:
+        return
+    found_bundles = _get_bundles(bundle_binary_events.keys())
+    unknown_bundle_sha256_set = set(bundle_binary_events.keys()) - set(found_bundles.keys())
+    if unknown_bundle_sha256_set:
+        # the bundle binaries can arrive before the bundle events, in another upload
+        # the bundle binary events have the same bundle attributes
+        logger.info("Create %s unknown bundle(s) from their binaries", len(unknown_bundle_sha256_set))
+        _bulk_create_bundles({bundle_sha256: bundle_binary_events[bundle_sha256][0]
+                              for bundle_sha256 in unknown_bundle_sha256_set})
+        found_bundles.update(_get_bundles(unknown_bundle_sha256_set))
+    bundles = {}
+    for bundle_sha256, bundle in found_bundles.items():
         if bundle.uploaded_at:
             logger.info("Bundle %s already uploaded", bundle_sha256)
-            continue
-        binary_targets = []
-        binary_count = bundle.binary_count
-        for event_d in events:
-            if not binary_count:
+        else:
+            bundles[bundle_sha256] = bundle
+    if not bundles:
+        return
+    binary_targets = _get_or_create_targets(
+        Target.BINARY,
+        {event_d.get("file_sha256") for bundle_sha256 in bundles for event_d in bundle_binary_events[bundle_sha256]}
+    )
+    # one bulk insert for all the bundle binary targets
+    through = Bundle.binary_targets.through
+    through.objects.bulk_create(
+        [through(bundle_id=bundle.pk, target_id=binary_targets[event_d.get("file_sha256")])
+         for bundle_sha256, bundle in bundles.items()
+         for event_d in bundle_binary_events[bundle_sha256]],
+        ignore_conflicts=True
+    )
+    binary_target_counts = dict(
+        through.objects.filter(bundle__in=bundles.values())
+                       .values("bundle_id")
+                       .annotate(binary_target_count=Count("target_id"))
+                       .values_list("bundle_id", "binary_target_count")
+    )
+    for bundle_sha256, bundle in bundles.items():
+        save_bundle = False
+        if not bundle.binary_count:
+            for event_d in bundle_binary_events[bundle_sha256]:
                 event_binary_count = event_d.get("file_bundle_binary_count")
                 if event_binary_count:
-                    binary_count = event_binary_count
-            binary_sha256 = event_d.get("file_sha256")
-            binary_target, _ = Target.objects.get_or_create(type=Target.BINARY, sha256=binary_sha256)
-            binary_targets.append(binary_target)
-        bundle.binary_targets.add(*binary_targets)
-        save_bundle = False
-        if not bundle.binary_count and binary_count:
-            bundle.binary_count = binary_count
-            save_bundle = True
+                    bundle.binary_count = event_binary_count
+                    save_bundle = True
+                    break
         if bundle.binary_count:
-            binary_target_count = bundle.binary_targets.count()
+            binary_target_count = binary_target_counts.get(bundle.pk, 0)
             if binary_target_count > bundle.binary_count:
                 logger.error("Bundle %s as wrong number of binary targets", bundle_sha256)
             elif binary_target_count == bundle.binary_count:
@@ -230,26 +284,38 @@ def _create_bundle_binaries(events):
 
 
 def _commit_files(events):
+    # deduplicate the file trees, using their MT hashes
+    file_trees = {}
     for event_d in events:
         try:
             file_d = _build_file_tree_from_santa_event(event_d)
+            prepare_commit_tree(file_d)
         except Exception:
             logger.exception("Could not build app tree from santa event")
         else:
+            file_trees.setdefault(file_d["mt_hash"], file_d)
+    if not file_trees:
+        return
+    try:
+        File.objects.bulk_commit_many(list(file_trees.values()))
+    except Exception:
+        logger.exception("Could not bulk commit files")
+        for file_d in file_trees.values():
             try:
                 File.objects.commit(file_d)
             except Exception:
                 logger.exception("Could not commit file")
 
 
-def _post_santa_events(enrolled_machine, user_agent, ip, events):
-    def get_created_at(payload):
-        return datetime.utcfromtimestamp(payload['execution_time'])
+def _get_santa_event_created_at(payload):
+    return datetime.utcfromtimestamp(payload['execution_time'])
+
 
+def _post_santa_events(enrolled_machine, user_agent, ip, events):
     SantaEventEvent.post_machine_request_payloads(
         enrolled_machine.serial_number, user_agent, ip,
         (event_d for event_d in events if not _is_bundle_binary_pseudo_event(event_d)),
-        get_created_at
+        _get_santa_event_created_at
     )
 
 
@@ -264,6 +330,67 @@ def process_events(enrolled_machine, user_agent, ip, data):
     return unknown_file_bundle_hashes
 
 
+# async event uploads
+
+
+UPLOADED_BUNDLE_CACHE_KEY_PREFIX = "santa-bundle-uploaded_"
+UPLOADED_BUNDLE_CACHE_TIMEOUT = 86400
+
+
+def get_unknown_file_bundle_hashes(events):
+    """Return the hashes of the event bundles that have not been uploaded yet
+
+    Same answer as process_events, without the DB writes. The uploaded bundles are cached.
+    """
+    file_bundle_hashes = {
+        event_d["file_bundle_hash"]
+        for event_d in events
+        if event_d.get("file_bundle_hash") and not _is_bundle_binary_pseudo_event(event_d)
+    }
+    if not file_bundle_hashes:
+        return []
+    cache_keys = {"{}{}".format(UPLOADED_BUNDLE_CACHE_KEY_PREFIX, sha256): sha256 for sha256 in file_bundle_hashes}
+    uploaded_sha256_set = {cache_keys[key] for key in cache.get_many(cache_keys.keys())}
+    missing_sha256_set = file_bundle_hashes - uploaded_sha256_set
+    if missing_sha256_set:
+        found_sha256_set = set(
+            Bundle.objects.filter(
+                target__type=Target.BUNDLE,
+                target__sha256__in=missing_sha256_set,
+                uploaded_at__isnull=False,
+            ).values_list("target__sha256", flat=True)
+        )
+        if found_sha256_set:
+            cache.set_many({"{}{}".format(UPLOADED_BUNDLE_CACHE_KEY_PREFIX, sha256): True
+                            for sha256 in found_sha256_set},
+                           UPLOADED_BUNDLE_CACHE_TIMEOUT)
+        missing_sha256_set -= found_sha256_set
+    return sorted(missing_sha256_set)
+
+
+def post_event_upload_raw_event(enrolled_machine, user_agent, ip, data):
+    events = data.get("events", [])
+    if not events:
+        return
+    queues.post_raw_event(
+        "santa_event_uploads",
+        {"request": {"user_agent": user_agent, "ip": ip},
+         "serial_number": enrolled_machine.serial_number,
+         "events": events}
+    )
+
+
+def build_events_from_event_upload(serial_number, user_agent, ip, events):
+    _create_missing_bundles(events)
+    _create_bundle_binaries(events)
+    _commit_files(events)
+    yield from SantaEventEvent.build_from_machine_request_payloads(
+        serial_number, user_agent, ip,
+        (event_d for event_d in events if not _is_bundle_binary_pseudo_event(event_d)),
+        _get_santa_event_created_at
+    )
+
+
 def post_preflight_event(msn, user_agent, ip, data):
     SantaPreflightEvent.post_machine_request_payloads(msn, user_agent, ip, [data])
 
@@ -281,10 +408,12 @@ def post_santa_rule_update_event(request, data):
 def post_santa_ruleset_update_events(request, ruleset_data, rules_data):
     event_request = EventRequest.build_from_request(request)
     ruleset_update_event_metadata = EventMetadata(request=event_request)
-    ruleset_update_event = SantaRuleSetUpdateEvent(ruleset_update_event_metadata, ruleset_data)
-    ruleset_update_event.post()
-    for idx, rule_data in enumerate(rules_data):
-        rule_update_event_metadata = EventMetadata(request=event_request,
-                                                   uuid=ruleset_update_event_metadata.uuid, index=idx + 1)
-        rule_update_event = SantaRuleUpdateEvent(rule_update_event_metadata, rule_data)
-        rule_update_event.post()
+
+    def iter_events():
+        yield SantaRuleSetUpdateEvent(ruleset_update_event_metadata, ruleset_data)
+        for idx, rule_data in enumerate(rules_data):
+            rule_update_event_metadata = EventMetadata(request=event_request,
+                                                       uuid=ruleset_update_event_metadata.uuid, index=idx + 1)
+            yield SantaRuleUpdateEvent(rule_update_event_metadata, rule_data)
+
+    queues.post_events(iter_events())
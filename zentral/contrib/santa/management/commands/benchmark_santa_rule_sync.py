@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import EnrollmentSecret, MetaBusinessUnit, Tag
+from zentral.contrib.santa.models import (Configuration, EnrolledMachine, Enrollment,
+                                          MachineRule, Rule, Target)
+
+
+class Command(BaseCommand):
+    help = 'Simulate concurrent Santa clean syncs against a seeded configuration'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=20000)
+        parser.add_argument('--tagged-rules', type=int, default=1000)
+        parser.add_argument('--machines', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--batch-size', type=int, default=Configuration.DEFAULT_BATCH_SIZE)
+
+    def seed(self, options):
+        prefix = get_random_string(8)
+        configuration = Configuration.objects.create(name="Benchmark {}".format(prefix),
+                                                     batch_size=options["batch_size"])
+        meta_business_unit = MetaBusinessUnit.objects.create(name="Benchmark {}".format(prefix))
+        enrollment_secret = EnrollmentSecret.objects.create(meta_business_unit=meta_business_unit)
+        enrollment = Enrollment.objects.create(configuration=configuration, secret=enrollment_secret)
+        tag = Tag.objects.create(name="Benchmark {}".format(prefix))
+        targets = Target.objects.bulk_create(
+            Target(type=Target.BINARY, sha256=get_random_string(64, "0123456789abcdef"))
+            for _ in range(options["rules"])
+        )
+        rules = Rule.objects.bulk_create(
+            Rule(configuration=configuration, target=target, policy=Rule.BLOCKLIST)
+            for target in targets
+        )
+        Rule.tags.through.objects.bulk_create(
+            Rule.tags.through(rule_id=rule.pk, tag_id=tag.pk)
+            for rule in rules[:options["tagged_rules"]]
+        )
+        enrolled_machines = EnrolledMachine.objects.bulk_create(
+            EnrolledMachine(enrollment=enrollment,
+                            hardware_uuid=uuid.uuid4(),
+                            serial_number="{}{:06d}".format(prefix, i).upper(),
+                            client_mode=Configuration.MONITOR_MODE,
+                            santa_version="2021.1")
+            for i in range(options["machines"])
+        )
+        # half of the machines are tagged
+        tag_ids = [[tag.pk] if i % 2 else [] for i in range(len(enrolled_machines))]
+        enrolled_machines = list(EnrolledMachine.objects.select_related("enrollment__configuration")
+                                                        .filter(enrollment=enrollment)
+                                                        .order_by("pk"))
+        seeded_objects = (configuration, enrollment_secret, meta_business_unit, tag, targets)
+        return seeded_objects, list(zip(enrolled_machines, tag_ids))
+
+    def clean_sync(self, enrolled_machine, tag_ids):
+        durations = []
+        rule_count = 0
+        cursor = None
+        try:
+            while True:
+                start = time.perf_counter()
+                with transaction.atomic():
+                    rules, cursor = MachineRule.objects.get_next_rule_batch(enrolled_machine, tag_ids, cursor)
+                durations.append(time.perf_counter() - start)
+                rule_count += len(rules)
+                if not cursor:
+                    break
+        finally:
+            connection.close()
+        return durations, rule_count
+
+    def cleanup(self, configuration, enrollment_secret, meta_business_unit, tag, targets):
+        configuration.delete()
+        enrollment_secret.delete()
+        Target.objects.filter(pk__in=[t.pk for t in targets]).delete()
+        tag.delete()
+        meta_business_unit.delete()
+
+    def handle(self, *args, **options):
+        seeded_objects, machines = self.seed(options)
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+                results = list(executor.map(lambda args: self.clean_sync(*args), machines))
+            total_duration = time.perf_counter() - start
+        finally:
+            self.cleanup(*seeded_objects)
+        durations = sorted(d for batch_durations, _ in results for d in batch_durations)
+        rule_count = sum(c for _, c in results)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(len(durations) * p / 100))] * 1000
+
+        self.stdout.write("{} clean syncs, {} rules, {} batches in {:.1f}s".format(
+            len(machines), rule_count, len(durations), total_duration
+        ))
+        self.stdout.write("batch p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+            percentile(50), percentile(90), percentile(99), durations[-1] * 1000
+        ))
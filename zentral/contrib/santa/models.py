@@ -1,4 +1,8 @@
+from collections import OrderedDict
+import heapq
+import itertools
 import logging
+import threading
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.postgres.fields import ArrayField
 from django.db import connection, models
@@ -479,8 +483,67 @@ class Rule(models.Model):
         return d
 
 
+class ResolvedRuleSetCache:
+    """Process local LRU cache of the configuration rule sets
+
+    The keys contain a digest of the configuration rules, computed in the DB,
+    so the cached values never need to be invalidated.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, func):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                pass
+        value = func()
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+resolved_rule_set_cache = ResolvedRuleSetCache()
+
+
 class MachineRuleManager(models.Manager):
-    def _iter_new_rules(self, enrolled_machine, tags):
+    rule_info_keys = ("target_id", "rule_type", "sha256", "policy", "custom_msg", "version",
+                      "file_bundle_binary_count", "file_bundle_hash")
+
+    def _get_rules_digest(self, configuration_pk):
+        # cheap digest of everything used to resolve the configuration rules
+        query = (
+            "select md5(concat_ws('|',"
+            "(select string_agg(concat_ws(',', r.id, r.target_id, r.updated_at), ';' order by r.id)"
+            " from santa_rule as r where r.configuration_id = %(configuration_pk)s),"
+            "(select string_agg(concat_ws(',', srt.rule_id, srt.tag_id), ';' order by srt.id)"
+            " from santa_rule_tags as srt join santa_rule as r on (r.id = srt.rule_id)"
+            " where r.configuration_id = %(configuration_pk)s),"
+            "(select string_agg(concat_ws(',', sret.rule_id, sret.tag_id), ';' order by sret.id)"
+            " from santa_rule_excluded_tags as sret join santa_rule as r on (r.id = sret.rule_id)"
+            " where r.configuration_id = %(configuration_pk)s),"
+            "(select string_agg(concat_ws(',', b.id, b.binary_count, bt.target_id), ';' order by b.id, bt.id)"
+            " from santa_bundle as b"
+            " join santa_rule as r on (r.target_id = b.target_id)"
+            " left join santa_bundle_binary_targets as bt on (bt.bundle_id = b.id)"
+            " where r.configuration_id = %(configuration_pk)s)"
+            "))"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, {"configuration_pk": configuration_pk})
+            return cursor.fetchone()[0]
+
+    def _fetch_configuration_rules(self, configuration_pk):
         query = (
             "WITH prepared_rules as ("  # aggregate the tag ids
             "  select r.target_id, r.policy, r.custom_msg, r.version,"
@@ -495,84 +558,136 @@ class MachineRuleManager(models.Manager):
             "  group by r.target_id, r.policy, r.custom_msg, r.version,"
             "  r.serial_numbers, r.excluded_serial_numbers,"
             "  r.primary_users, r.excluded_primary_users"
-            "), filtered_rules as ("  # filter the configured rules for the enrolled machine
-            "  select pr.target_id, pr.policy, pr.custom_msg, pr.version"
-            "  from prepared_rules as pr"
-            "  where ("
-            "    {wheres}"
-            "  )"
             "), expanded_rules as ("  # expand the bundle rules
-            "   select case when bt.target_id is not null then bt.target_id else fr.target_id end as target_id,"
-            "   fr.policy, fr.custom_msg, fr.version,"
-            "   b.binary_count as file_bundle_binary_count, b.target_id as file_bundle_target_id"
-            "   from filtered_rules as fr"
-            "   left join santa_bundle as b on (b.target_id = fr.target_id)"
+            "   select case when bt.target_id is not null then bt.target_id else pr.target_id end as target_id,"
+            "   pr.policy, pr.custom_msg, pr.version,"
+            "   b.binary_count as file_bundle_binary_count, b.target_id as file_bundle_target_id,"
+            "   pr.serial_numbers, pr.excluded_serial_numbers, pr.primary_users, pr.excluded_primary_users,"
+            "   pr.tag_ids, pr.excluded_tag_ids"
+            "   from prepared_rules as pr"
+            "   left join santa_bundle as b on (b.target_id = pr.target_id)"
             "   left join santa_bundle_binary_targets as bt on (bt.bundle_id = b.id)"
-            "), machine_rules as ("  # current enrolled machine machine rules
-            "   select target_id, policy, version"
-            "   from santa_machinerule"
-            "   where enrolled_machine_id = %(enrolled_machine_pk)s"
-            "), rule_product as ("  # full product of the configured rules and the machine rules
-            "  select er.target_id as rule_target_id, er.policy as rule_policy,"
-            "  er.custom_msg as rule_custom_msg, er.version as rule_version,"
-            "  er.file_bundle_binary_count, er.file_bundle_target_id,"
-            "  mr.target_id as machine_rule_target_id, mr.policy as machine_rule_policy,"
-            "  mr.version as machine_rule_version"
-            "  from expanded_rules as er"
-            "  full outer join machine_rules as mr on (mr.target_id = er.target_id)"
-            "), changed_rules as ("  # filter the product to get the changes
-            "  select rule_target_id as target_id, rule_policy as policy,"
-            "  rule_custom_msg as custom_msg, rule_version as version,"
-            "  file_bundle_binary_count, file_bundle_target_id"
-            "  from rule_product where ("
-            "    (machine_rule_target_id is null)"
-            "    or (rule_target_id is not null"
-            "        and (rule_policy <> machine_rule_policy or rule_version <> machine_rule_version)))"
-            "  union"
-            "  select machine_rule_target_id as target_id, 4 as policy, null as custom_msg, 1 as version,"
-            "  null as file_bundle_binary_count, null as file_bundle_target_id"
-            "  from rule_product where rule_target_id is null"
-            ") "  # limit, order and join with target to get all the necessary info
-            "select t.id as target_id, t.type as rule_type, t.sha256, cr.policy, cr.custom_msg, cr.version,"
-            "cr.file_bundle_binary_count, t2.sha256 as file_bundle_hash "
-            "from changed_rules as cr "
-            "join santa_target as t on (t.id = cr.target_id) "
-            "left join santa_target as t2 on (t2.id = cr.file_bundle_target_id) "
-            "order by t.sha256 limit %(batch_size)s"
+            ") "
+            "select t.id as target_id, t.type as rule_type, t.sha256, er.policy, er.custom_msg, er.version,"
+            "er.file_bundle_binary_count, t2.sha256 as file_bundle_hash,"
+            "er.serial_numbers, er.excluded_serial_numbers, er.primary_users, er.excluded_primary_users,"
+            "er.tag_ids, er.excluded_tag_ids "
+            "from expanded_rules as er "
+            "join santa_target as t on (t.id = er.target_id) "
+            "left join santa_target as t2 on (t2.id = er.file_bundle_target_id) "
+            "order by t.sha256"
         )
-        configuration = enrolled_machine.enrollment.configuration
-        # machine specific rules
-        wheres = ["(cardinality(pr.serial_numbers) = 0 or %(serial_number)s = ANY(pr.serial_numbers))",
-                  "%(serial_number)s <> ALL(pr.excluded_serial_numbers)"]
-        kwargs = {"configuration_pk": configuration.pk,
-                  "serial_number": enrolled_machine.serial_number,
-                  "enrolled_machine_pk": enrolled_machine.pk,
-                  "batch_size": configuration.batch_size}
-        if enrolled_machine.primary_user:
-            # user specific rules
-            wheres.extend(["(cardinality(pr.primary_users) = 0 or %(primary_user)s = ANY(pr.primary_users))",
-                           "%(primary_user)s <> ALL(pr.excluded_primary_users)"])
-            kwargs["primary_user"] = enrolled_machine.primary_user
-        else:
-            wheres.extend(["cardinality(pr.primary_users) = 0",
-                           "cardinality(pr.excluded_primary_users) = 0"])
+        with connection.cursor() as cursor:
+            cursor.execute(query, {"configuration_pk": configuration_pk})
+            rows = cursor.fetchall()
+        # split the rules scoped by serial numbers or primary users, that need to be filtered for each machine
+        common_rules = []
+        scoped_rules = []
+        for row in rows:
+            rule_info = row[:8]
+            serial_numbers, excluded_serial_numbers, primary_users, excluded_primary_users = row[8:12]
+            tag_ids, excluded_tag_ids = set(row[12]), set(row[13])
+            if serial_numbers or excluded_serial_numbers or primary_users or excluded_primary_users:
+                scoped_rules.append((rule_info,
+                                     set(serial_numbers), set(excluded_serial_numbers),
+                                     set(primary_users), set(excluded_primary_users),
+                                     tag_ids, excluded_tag_ids))
+            else:
+                common_rules.append((rule_info, tag_ids, excluded_tag_ids))
+        return common_rules, scoped_rules
+
+    @staticmethod
+    def _tags_match(tags, tag_ids, excluded_tag_ids):
         if tags:
-            # tag specific rules
-            wheres.extend(["(cardinality(pr.tag_ids) = 0 or %(tags)s && pr.tag_ids)",
-                           "not (%(tags)s && pr.excluded_tag_ids)"])
-            kwargs["tags"] = tags
+            return (not tag_ids or not tag_ids.isdisjoint(tags)) and excluded_tag_ids.isdisjoint(tags)
         else:
-            wheres.append("cardinality(pr.tag_ids) = 0")
-        query = query.format(wheres=" and ".join(wheres))
-        cursor = connection.cursor()
-        cursor.execute(query, kwargs)
-        columns = [col[0] for col in cursor.description]
-        for row in cursor.fetchall():
-            rule_info_d = {}
-            for key, val in zip(columns, row):
-                if val is not None:
-                    rule_info_d[key] = val
-            yield rule_info_d
+            return not tag_ids
+
+    def _get_resolved_common_rules(self, configuration_pk, tags):
+        """Return the configuration rules for the tags, not scoped by serial numbers or primary users
+
+        The materializations of the configuration rules, and of the resolved rules for each set of tags,
+        are cached using a digest of the configuration rules.
+        """
+        digest = self._get_rules_digest(configuration_pk)
+        common_rules, scoped_rules = resolved_rule_set_cache.get_or_set(
+            (configuration_pk, digest),
+            lambda: self._fetch_configuration_rules(configuration_pk)
+        )
+        tags = frozenset(tags or [])
+
+        def resolve_common_rules():
+            resolved_rules = [rule_info for rule_info, tag_ids, excluded_tag_ids in common_rules
+                              if self._tags_match(tags, tag_ids, excluded_tag_ids)]
+            return resolved_rules, {rule_info[0] for rule_info in resolved_rules}
+
+        resolved_common_rules = resolved_rule_set_cache.get_or_set((configuration_pk, digest, tags),
+                                                                   resolve_common_rules)
+        return resolved_common_rules, scoped_rules
+
+    def _iter_resolved_rules(self, enrolled_machine, tags):
+        configuration = enrolled_machine.enrollment.configuration
+        (common_rules, common_target_ids), scoped_rules = self._get_resolved_common_rules(configuration.pk, tags)
+        serial_number = enrolled_machine.serial_number
+        primary_user = enrolled_machine.primary_user
+        tags = frozenset(tags or [])
+        resolved_scoped_rules = []
+        for (rule_info,
+             serial_numbers, excluded_serial_numbers,
+             primary_users, excluded_primary_users,
+             tag_ids, excluded_tag_ids) in scoped_rules:
+            if serial_numbers and serial_number not in serial_numbers or serial_number in excluded_serial_numbers:
+                continue
+            if primary_user:
+                if primary_users and primary_user not in primary_users or primary_user in excluded_primary_users:
+                    continue
+            elif primary_users or excluded_primary_users:
+                continue
+            if not self._tags_match(tags, tag_ids, excluded_tag_ids):
+                continue
+            resolved_scoped_rules.append(rule_info)
+        target_ids = common_target_ids.union(rule_info[0] for rule_info in resolved_scoped_rules)
+        return heapq.merge(common_rules, resolved_scoped_rules, key=lambda rule_info: rule_info[2]), target_ids
+
+    def _iter_new_rules(self, enrolled_machine, tags):
+        resolved_rules, target_ids = self._iter_resolved_rules(enrolled_machine, tags)
+        current_machine_rules = {}
+        removed_rules = []
+        for target_id, rule_type, sha256, policy, version in (
+            self.filter(enrolled_machine=enrolled_machine)
+                .order_by("target__sha256")
+                .values_list("target_id", "target__type", "target__sha256", "policy", "version")
+        ):
+            current_machine_rules[target_id] = (policy, version)
+            if target_id not in target_ids:
+                removed_rules.append((target_id, rule_type, sha256, MachineRule.REMOVE, None, 1, None, None))
+
+        def iter_changed_rules():
+            seen_target_ids = set()
+            for rule_info in resolved_rules:
+                target_id = rule_info[0]
+                if target_id in seen_target_ids:
+                    continue
+                seen_target_ids.add(target_id)
+                if current_machine_rules.get(target_id) != (rule_info[3], rule_info[5]):
+                    yield rule_info
+
+        changed_rules = heapq.merge(iter_changed_rules(), removed_rules, key=lambda rule_info: rule_info[2])
+        for rule_info in itertools.islice(changed_rules, enrolled_machine.enrollment.configuration.batch_size):
+            yield {key: val for key, val in zip(self.rule_info_keys, rule_info) if val is not None}
+
+    def _bulk_upsert(self, enrolled_machine, machine_rules, cursor):
+        query = (
+            "insert into santa_machinerule (enrolled_machine_id, target_id, policy, version, cursor) "
+            "values {} "
+            "on conflict (enrolled_machine_id, target_id) do update "
+            "set policy = excluded.policy, version = excluded.version, cursor = excluded.cursor"
+        ).format(", ".join(["(%s, %s, %s, %s, %s)"] * len(machine_rules)))
+        args = []
+        for target_id, policy, version in machine_rules:
+            args.extend([enrolled_machine.pk, target_id, policy, version, cursor])
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(query, args)
 
     def get_next_rule_batch(self, enrolled_machine, tags, cursor=None):
         qs = self.filter(enrolled_machine=enrolled_machine).select_for_update()
@@ -596,27 +711,20 @@ class MachineRuleManager(models.Manager):
 
         # return next batch
         rules = []
-        new_cursor = None
+        machine_rules = []
         for rule in self._iter_new_rules(enrolled_machine, tags):
-            if new_cursor is None:
-                new_cursor = get_random_string(8)
             target_id = rule.pop("target_id")
             policy = rule.pop("policy")  # need a translation
             rule["policy"] = translate_rule_policy(policy)
             version = rule.pop("version")
             if policy == MachineRule.REMOVE or not rule["custom_msg"]:
                 rule.pop("custom_msg", None)
-            self.update_or_create(enrolled_machine=enrolled_machine,
-                                  target=Target(pk=target_id),
-                                  defaults={
-                                      "policy": policy,
-                                      "version": version,
-                                      "cursor": new_cursor,
-                                  })
+            machine_rules.append((target_id, policy, version))
             rules.append(rule)
         response_cursor = None
         if len(rules):
-            response_cursor = new_cursor
+            response_cursor = get_random_string(8)
+            self._bulk_upsert(enrolled_machine, machine_rules, response_cursor)
         return rules, response_cursor
 
 
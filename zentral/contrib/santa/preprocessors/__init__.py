@@ -1,4 +1,5 @@
 import logging
+from .event_upload import SantaEventUploadPreprocessor
 try:
     from .log import SantaLogPreprocessor
 except RuntimeError:
@@ -10,6 +11,7 @@ logger = logging.getLogger("zentral.contrib.santa.preprocessors")
 
 
 def get_preprocessors():
+    yield SantaEventUploadPreprocessor()
     if SantaLogPreprocessor is not None:
         yield SantaLogPreprocessor()
     else:
@@ -0,0 +1,23 @@
+import logging
+from zentral.contrib.santa.events import build_events_from_event_upload
+from zentral.utils.json import save_dead_letter
+
+
+logger = logging.getLogger("zentral.contrib.santa.preprocessors.event_upload")
+
+
+class SantaEventUploadPreprocessor(object):
+    routing_key = "santa_event_uploads"
+
+    def process_raw_event(self, raw_event):
+        try:
+            serial_number = raw_event["serial_number"]
+            request_d = raw_event["request"]
+            events = list(build_events_from_event_upload(serial_number,
+                                                         request_d["user_agent"], request_d["ip"],
+                                                         raw_event["events"]))
+        except Exception:
+            logger.exception("Could not process santa_event_uploads raw event")
+            save_dead_letter(raw_event, "santa event upload preprocessing error")
+        else:
+            yield from events
@@ -59,6 +59,11 @@ urlpatterns = [
         csrf_exempt(views.EventUploadView.as_view()), name='eventupload'),
     url(r'^sync/(?P<enrollment_secret>\S+)/postflight/(?P<machine_id>\S+)$',
         csrf_exempt(views.PostflightView.as_view()), name='postflight'),
+
+    # prometheus
+    url(r'^prometheus_metrics/$',
+        views.PrometheusMetricsView.as_view(),
+        name='prometheus_metrics'),
 ]
 
 
@@ -1,6 +1,8 @@
 import plistlib
 from dateutil import parser
+from prometheus_client import CollectorRegistry
 from zentral.conf import settings
+from zentral.utils.prometheus import CachedHistogram
 from zentral.utils.payloads import generate_payload_uuid, get_payload_identifier, sign_payload
 
 
@@ -95,3 +97,26 @@ def parse_santa_log_message(message):
     if args:
         d["args"] = args.split()
     return d
+
+
+# event upload metrics
+
+
+event_upload_latency_histogram = CachedHistogram(
+    "zentral_santa_event_upload_duration_seconds",
+    "Zentral Santa event upload request duration",
+    "mode"
+)
+
+
+def get_event_upload_mode():
+    if settings["apps"]["zentral.contrib.santa"].get("async_event_upload", False):
+        return "async"
+    else:
+        return "sync"
+
+
+def get_prometheus_santa_metrics():
+    registry = CollectorRegistry()
+    event_upload_latency_histogram.register(registry, ("sync", "async"))
+    return registry
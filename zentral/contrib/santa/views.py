@@ -1,5 +1,6 @@
 import json
 import logging
+import time
 from uuid import UUID
 import zlib
 from django.contrib.auth.mixins import PermissionRequiredMixin
@@ -20,11 +21,15 @@ from zentral.contrib.inventory.utils import (commit_machine_snapshot_and_trigger
                                              verify_enrollment_secret)
 from zentral.utils.certificates import parse_dn
 from zentral.utils.http import user_agent_and_ip_address_from_request
-from .events import post_enrollment_event, process_events, post_preflight_event, post_santa_rule_update_event
+from zentral.utils.prometheus import BasePrometheusMetricsView
+from .events import (get_unknown_file_bundle_hashes,
+                     post_enrollment_event, post_event_upload_raw_event, process_events,
+                     post_preflight_event, post_santa_rule_update_event)
 from .forms import (BinarySearchForm, BundleSearchForm, CertificateSearchForm,
                     ConfigurationForm, EnrollmentForm, RuleForm, RuleSearchForm, UpdateRuleForm)
 from .models import Bundle, Configuration, EnrolledMachine, Enrollment, MachineRule, Rule, Target
-from .utils import build_configuration_plist, build_configuration_profile
+from .utils import (build_configuration_plist, build_configuration_profile,
+                    event_upload_latency_histogram, get_event_upload_mode, get_prometheus_santa_metrics)
 
 logger = logging.getLogger('zentral.contrib.santa.views')
 
@@ -666,13 +671,25 @@ class RuleDownloadView(BaseSyncView):
 
 
 class EventUploadView(BaseSyncView):
+    def post(self, request, *args, **kwargs):
+        self.mode = get_event_upload_mode()
+        start = time.perf_counter()
+        response = super().post(request, *args, **kwargs)
+        event_upload_latency_histogram.observe(self.mode, time.perf_counter() - start)
+        return response
+
     def do_post(self):
-        unknown_file_bundle_hashes = process_events(
-            self.enrolled_machine,
-            self.user_agent,
-            self.ip,
-            self.request_data
-        )
+        if self.mode == "async":
+            # the DB work is done by the santa_event_uploads preprocessor
+            unknown_file_bundle_hashes = get_unknown_file_bundle_hashes(self.request_data.get("events", []))
+            post_event_upload_raw_event(self.enrolled_machine, self.user_agent, self.ip, self.request_data)
+        else:
+            unknown_file_bundle_hashes = process_events(
+                self.enrolled_machine,
+                self.user_agent,
+                self.ip,
+                self.request_data
+            )
         response_dict = {}
         if unknown_file_bundle_hashes:
             response_dict["event_upload_bundle_binaries"] = unknown_file_bundle_hashes
@@ -683,3 +700,8 @@ class PostflightView(BaseSyncView):
     def do_post(self):
         cache.delete(self.cache_key)
         return {}
+
+
+class PrometheusMetricsView(BasePrometheusMetricsView):
+    def get_registry(self):
+        return get_prometheus_santa_metrics()
@@ -15,7 +15,7 @@ from zentral.core.queues import queues
 from zentral.utils.http import user_agent_and_ip_address_from_request
 from .template_loader import TemplateLoader
 from .utils import decode_args, encode_args
-from . import register_event_type
+from . import event_from_event_d, register_event_type
 
 logger = logging.getLogger('zentral.core.events.base')
 
@@ -23,6 +23,23 @@ logger = logging.getLogger('zentral.core.events.base')
 template_loader = TemplateLoader([os.path.join(os.path.dirname(__file__), 'templates')])
 
 
+def parse_created_at(created_at):
+    # fast path for the values produced by EventMetadata.serialize
+    try:
+        return datetime.fromisoformat(created_at)
+    except ValueError:
+        return parser.parse(created_at)
+
+
+def iter_loaded_probes(serialized_probes, event_uuid, event_index):
+    for serialized_probe in serialized_probes:
+        probe_pk = serialized_probe["pk"]
+        try:
+            yield all_probes_dict[probe_pk]
+        except KeyError:
+            logger.error("Event %s/%s: unknown probe %s", event_uuid, event_index, probe_pk)
+
+
 def render_notification_part(ctx, event_type, part):
     template = template_loader.load(event_type, part)
     if template:
@@ -231,12 +248,8 @@ class EventMetadata(object):
         if self.created_at is None:
             self.created_at = datetime.utcnow()
         elif isinstance(self.created_at, str):
-            self.created_at = parser.parse(self.created_at)
+            self.created_at = parse_created_at(self.created_at)
         self.machine_serial_number = kwargs.pop('machine_serial_number', None)
-        if self.machine_serial_number:
-            self.machine = MetaMachine(self.machine_serial_number)
-        else:
-            self.machine = None
         self.observer = kwargs.pop('observer', None)
         self.request = kwargs.pop('request', None)
         self.probes = kwargs.pop('probes', [])
@@ -244,6 +257,11 @@ class EventMetadata(object):
         self.tags = kwargs.pop('tags', [])
         self.objects = {k: [decode_args(args) for args in v] for k, v in kwargs.pop('objects', {}).items()}
 
+    @cached_property
+    def machine(self):
+        if self.machine_serial_number:
+            return MetaMachine(self.machine_serial_number)
+
     @property
     def event_type(self):
         return self.event.event_type
@@ -309,12 +327,55 @@ class EventMetadata(object):
         self.incidents.append(incident.serialize_for_event_metadata())
 
     def iter_loaded_probes(self):
-        for serialized_probe in self.probes:
-            probe_pk = serialized_probe["pk"]
-            try:
-                yield all_probes_dict[probe_pk]
-            except KeyError:
-                logger.error("Event %s/%s: unknown probe %s", self.uuid, self.index, probe_pk)
+        yield from iter_loaded_probes(self.probes, self.uuid, self.index)
+
+
+class EventView:
+    """Read-only view of a serialized event
+
+    The metadata are read from the serialized event on access, and the event object
+    is only built when needed. As long as it is not the case, the serialized event
+    is passed through untouched.
+    """
+    __slots__ = ("event_d", "_created_at", "_event")
+
+    def __init__(self, event_d):
+        self.event_d = event_d
+        self._created_at = None
+        self._event = None
+
+    @property
+    def metadata_d(self):
+        return self.event_d["_zentral"]
+
+    @property
+    def event_type(self):
+        return self.metadata_d["type"]
+
+    @property
+    def machine_serial_number(self):
+        return self.metadata_d.get("machine_serial_number")
+
+    @property
+    def created_at(self):
+        if self._created_at is None:
+            self._created_at = parse_created_at(self.metadata_d["created_at"])
+        return self._created_at
+
+    @property
+    def event(self):
+        if self._event is None:
+            self._event = event_from_event_d(self.event_d)
+        return self._event
+
+    def iter_loaded_probes(self):
+        metadata_d = self.metadata_d
+        yield from iter_loaded_probes(metadata_d.get("probes", []), metadata_d["id"], metadata_d.get("index", 0))
+
+    def serialize(self, machine_metadata=True):
+        if self._event is None:
+            return self.event_d
+        return self._event.serialize(machine_metadata)
 
 
 class BaseEvent(object):
@@ -347,8 +408,9 @@ class BaseEvent(object):
 
     @classmethod
     def post_machine_request_payloads(cls, msn, user_agent, ip, payloads, get_created_at=None, observer=None):
-        for event in cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at, observer):
-            event.post()
+        queues.post_events(
+            cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at, observer)
+        )
 
     def __init__(self, metadata, payload):
         metadata.event = weakref.proxy(self)
@@ -1,10 +1,12 @@
 import logging
 import geoip2.database
 from . import event_from_event_d
+from .base import EventView
 from zentral.conf import settings
+from zentral.contrib.inventory.models import MetaMachine
 from zentral.core.probes.conf import all_probes
 from zentral.core.incidents.events import build_incident_events
-from zentral.core.incidents.utils import update_or_create_open_incident, update_or_create_open_machine_incident
+from zentral.core.incidents.utils import IncidentUpdateCoalescer
 
 logger = logging.getLogger('zentral.core.events.pipeline')
 
@@ -21,6 +23,12 @@ else:
         logger.info("Could not open Geolite2 city database")
 
 
+# coalesce the incident updates of the enrichment worker
+incident_coalescer = IncidentUpdateCoalescer(
+    settings.get("events", {}).get("incident_update_window_seconds", 5)
+)
+
+
 def get_city(ip):
     try:
         return city_db_reader.city(ip)
@@ -41,15 +49,16 @@ def enrich_event(event):
         if incident_severity is None:
             continue
         if event.metadata.machine_serial_number is not None:
-            machine_incident, incident_event_payloads = update_or_create_open_machine_incident(
+            machine_incident, incident_event_payloads = incident_coalescer.update_or_create_open_machine_incident(
                 probe.source,
                 incident_severity,
                 event.metadata.machine_serial_number,
                 event.metadata.uuid
             )
-            event.metadata.add_incident(machine_incident)
+            if machine_incident is not None:
+                event.metadata.add_incident(machine_incident)
         else:
-            incident, incident_event_payloads = update_or_create_open_incident(
+            incident, incident_event_payloads = incident_coalescer.update_or_create_open_incident(
                 probe.source,
                 incident_severity,
                 event.metadata.uuid
@@ -62,10 +71,22 @@ def enrich_event(event):
     yield event
 
 
+def prefetch_machine_info(serial_numbers):
+    """Fill the machine info caches used during the enrichment of a batch of events"""
+    return MetaMachine.prefetch_info_for_event(serial_numbers)
+
+
 def process_event(event):
     if isinstance(event, dict):
-        event = event_from_event_d(event)
-    for probe in event.metadata.iter_loaded_probes():
+        # most events have no probes, and do not need to be deserialized
+        event_view = EventView(event)
+        loaded_probes = event_view.iter_loaded_probes()
+    else:
+        event_view = None
+        loaded_probes = event.metadata.iter_loaded_probes()
+    for probe in loaded_probes:
+        if event_view is not None:
+            event = event_view.event
         for action, action_config_d in probe.actions:
             try:
                 action.trigger(event, probe, action_config_d)
@@ -1,4 +1,5 @@
 import logging
+import time
 from django.db import connection, IntegrityError, transaction
 from prometheus_client import CollectorRegistry, Gauge
 from .models import (Incident, MachineIncident,
@@ -46,6 +47,27 @@ def _update_or_create_open_incident(probe_source, severity, event_id):
     return incident, event_payload
 
 
+def _get_or_create_open_machine_incident(incident, serial_number, event_id):
+    # the one_open_machine_incident_per_incident constraint prevents the duplicates,
+    # get_or_create falls back to a get if another worker has created the machine incident
+    event_payloads = []
+    machine_incident, created = MachineIncident.objects.get_or_create(
+        incident=incident,
+        serial_number=serial_number,
+        status__in=OPEN_STATUSES,
+        defaults={
+            "status": STATUS_OPEN,
+            "event_id": event_id,
+        }
+    )
+    machine_incident.incident = incident
+    if created:
+        machine_incident_event_payload = machine_incident.serialize_for_event()
+        machine_incident_event_payload["action"] = "created"
+        event_payloads.append(machine_incident_event_payload)
+    return machine_incident, event_payloads
+
+
 def update_or_create_open_incident(probe_source, severity, event_id):
     event_payloads = []
     with transaction.atomic():
@@ -100,22 +122,124 @@ def update_or_create_open_machine_incident(probe_source, severity, serial_number
             incident, incident_event_payload = _update_or_create_open_incident(probe_source, severity, event_id)
             if incident_event_payload:
                 event_payloads.append(incident_event_payload)
-            machine_incident, created = MachineIncident.objects.get_or_create(
-                incident=incident,
-                serial_number=serial_number,
-                status__in=OPEN_STATUSES,
-                defaults={
-                    "status": STATUS_OPEN,
-                    "event_id": event_id,
-                }
+            machine_incident, machine_incident_event_payloads = _get_or_create_open_machine_incident(
+                incident, serial_number, event_id
             )
-            if created:
-                machine_incident_event_payload = machine_incident.serialize_for_event()
-                machine_incident_event_payload["action"] = "created"
-                event_payloads.append(machine_incident_event_payload)
+            event_payloads.extend(machine_incident_event_payloads)
     return machine_incident, event_payloads
 
 
+class IncidentUpdateCoalescer:
+    """Coalesce the no-op open incident updates of a worker over a short window
+
+    The open incidents and machine incidents are remembered for window_seconds.
+    During that time, the updates that would not change anything are skipped,
+    once a non-locking read has confirmed that the remembered incidents are still open.
+    They could have been closed by another worker or by a user.
+    The new machine incidents of a remembered open incident are created without locking the incident,
+    if the incident severity does not change.
+    All the other updates use the locking transactions above.
+    """
+
+    def __init__(self, window_seconds=5):
+        self.window_seconds = window_seconds
+        self._incidents = {}
+        self._machine_incidents = {}
+        self._last_purge = 0
+
+    def clear(self):
+        self._incidents.clear()
+        self._machine_incidents.clear()
+
+    def _purge(self, now):
+        for cache in (self._incidents, self._machine_incidents):
+            for key in [key for key, (_, expiry) in cache.items() if now > expiry]:
+                del cache[key]
+        self._last_purge = now
+
+    def _get(self, cache, key):
+        value, expiry = cache[key]
+        if time.monotonic() > expiry:
+            del cache[key]
+            raise KeyError(key)
+        return value
+
+    def _set(self, cache, key, value):
+        if self.window_seconds <= 0:
+            return
+        now = time.monotonic()
+        if now > self._last_purge + self.window_seconds:
+            self._purge(now)
+        cache[key] = (value, now + self.window_seconds)
+
+    def _get_open_incident(self, probe_source, severity):
+        """Return the remembered incident if its severity is high enough and it is still open"""
+        try:
+            incident = self._get(self._incidents, probe_source.pk)
+        except KeyError:
+            return
+        if (
+            incident.severity >= severity
+            and Incident.objects.filter(pk=incident.pk, status__in=OPEN_STATUSES).exists()
+        ):
+            return incident
+
+    def update_or_create_open_incident(self, probe_source, severity, event_id):
+        incident = self._get_open_incident(probe_source, severity)
+        if incident is not None:
+            return incident, []
+        incident, event_payloads = update_or_create_open_incident(probe_source, severity, event_id)
+        self._set(self._incidents, probe_source.pk, incident)
+        return incident, event_payloads
+
+    def update_or_create_open_machine_incident(self, probe_source, severity, serial_number, event_id):
+        machine_incident_key = (probe_source.pk, serial_number)
+        try:
+            machine_incident = self._get(self._machine_incidents, machine_incident_key)
+        except KeyError:
+            pass
+        else:
+            if severity == 0:
+                if (
+                    machine_incident is None
+                    and not MachineIncident.objects.filter(incident__probe_source=probe_source,
+                                                           serial_number=serial_number,
+                                                           status=STATUS_OPEN).exists()
+                ):
+                    # no open machine incident to close
+                    return None, []
+            elif (
+                machine_incident is not None
+                and machine_incident.incident.severity >= severity
+                and MachineIncident.objects.filter(pk=machine_incident.pk,
+                                                   status__in=OPEN_STATUSES,
+                                                   incident__status__in=OPEN_STATUSES).exists()
+            ):
+                return machine_incident, []
+        if severity > 0:
+            incident = self._get_open_incident(probe_source, severity)
+            if incident is not None:
+                # no incident update, no need to lock it
+                machine_incident, event_payloads = _get_or_create_open_machine_incident(
+                    incident, serial_number, event_id
+                )
+                self._set(self._machine_incidents, machine_incident_key, machine_incident)
+                return machine_incident, event_payloads
+        machine_incident, event_payloads = update_or_create_open_machine_incident(
+            probe_source, severity, serial_number, event_id
+        )
+        if severity == 0:
+            if event_payloads:
+                # the incident could have been closed too
+                self._incidents.pop(probe_source.pk, None)
+            # no open machine incident anymore
+            self._set(self._machine_incidents, machine_incident_key, None)
+        else:
+            self._set(self._incidents, probe_source.pk, machine_incident.incident)
+            self._set(self._machine_incidents, machine_incident_key, machine_incident)
+        return machine_incident, event_payloads
+
+
 def update_incident_status(incident, new_status):
     event_payloads = []
     with transaction.atomic():
@@ -136,24 +136,41 @@ class MetadataFiltersSerializer(serializers.Serializer):
         raise serializers.ValidationError("No event types or tags")
 
 
-def get_flattened_payload_values(payload, attrs):
-    if isinstance(payload, list):
-        for nested_payload in payload:
-            yield from get_flattened_payload_values(nested_payload, list(attrs))
-    elif isinstance(payload, dict):
-        attr = attrs.pop(0)
-        val = payload.get(attr)
-        if val is None:
+def _iter_payload_values(payload, attrs, index):
+    while True:
+        if isinstance(payload, list):
+            for nested_payload in payload:
+                yield from _iter_payload_values(nested_payload, attrs, index)
             return
-        if not attrs:
-            if isinstance(val, (set, list)):
-                yield from (str(v) for v in val)
-            else:
-                yield str(val)
+        elif isinstance(payload, dict):
+            val = payload.get(attrs[index])
+            if val is None:
+                return
+            index += 1
+            if index == len(attrs):
+                if isinstance(val, (set, list)):
+                    for v in val:
+                        yield str(v)
+                else:
+                    yield str(val)
+                return
+            payload = val
         else:
-            yield from get_flattened_payload_values(val, attrs)
-    else:
-        logger.warning("Wrong payload filter attribute %s", attrs)
+            logger.warning("Wrong payload filter attribute %s", attrs[index:])
+            return
+
+
+def get_flattened_payload_values(payload, attrs):
+    yield from _iter_payload_values(payload, tuple(attrs), 0)
+
+
+def compile_payload_values_getter(attribute):
+    attrs = tuple(attribute.split("."))
+
+    def getter(payload):
+        return _iter_payload_values(payload, attrs, 0)
+
+    return getter
 
 
 class PayloadFilter(object):
@@ -177,12 +194,15 @@ class PayloadFilter(object):
                 continue
             self.items.append((attribute, operator, values))
         self.items.sort()
+        # compiled items, to avoid parsing the attributes for each event
+        self._compiled_items = [(compile_payload_values_getter(attribute), operator == self.IN, frozenset(values))
+                                for attribute, operator, values in self.items]
 
     def test_event_payload(self, payload):
-        for payload_attribute, operator, filter_value_set in self.items:
-            payload_value_set = set(get_flattened_payload_values(payload, payload_attribute.split(".")))
-            common_values = filter_value_set & payload_value_set
-            if (operator == self.IN and not common_values) or (operator == self.NOT_IN and common_values):
+        for getter, expected_match, filter_values in self._compiled_items:
+            # stop at the first matching value
+            match = any(value in filter_values for value in getter(payload))
+            if match is not expected_match:
                 # AND: all items of a payload filter must match
                 return False
         return True
@@ -374,13 +394,14 @@ class BaseProbe(object):
         if not self.loaded:
             return False
         metadata = event.metadata
-        if metadata.machine_serial_number and not self.test_machine(metadata.machine):
-            return False
+        # cheap metadata tests first, before the machine filtering values are fetched
         if self.forced_event_type:
             if event.event_type != self.forced_event_type:
                 return False
         elif not self._test_event_metadata(metadata):
             return False
+        if metadata.machine_serial_number and not self.test_machine(metadata.machine):
+            return False
         if not self._test_event_payload(event.payload):
             return False
         return True
@@ -86,15 +86,69 @@ class ProbesDict(ProbeView):
             return self._probes.get(*args, **kwargs)
 
 
+class ProbeEventIndex(object):
+    """Probes bucketed by the event types and tags their metadata filters can match
+
+    Only the candidate probes for an event are tested, in the original probe order.
+    """
+    def __init__(self, probes):
+        self.probes = []
+        catch_all = set()
+        event_type_buckets = {}
+        event_tag_buckets = {}
+        for probe in probes:
+            if not probe.loaded:
+                # never matches
+                continue
+            position = len(self.probes)
+            self.probes.append(probe)
+            if probe.forced_event_type:
+                event_type_buckets.setdefault(probe.forced_event_type, set()).add(position)
+                continue
+            if not probe.metadata_filters:
+                catch_all.add(position)
+                continue
+            for metadata_filter in probe.metadata_filters:
+                if metadata_filter.event_types:
+                    # the event tags, if any, are tested with the full probe test
+                    for event_type in metadata_filter.event_types:
+                        event_type_buckets.setdefault(event_type, set()).add(position)
+                elif metadata_filter.event_tags:
+                    for event_tag in metadata_filter.event_tags:
+                        event_tag_buckets.setdefault(event_tag, set()).add(position)
+                else:
+                    catch_all.add(position)
+        self.catch_all = frozenset(catch_all)
+        self.event_type_buckets = {k: frozenset(v) for k, v in event_type_buckets.items()}
+        self.event_tag_buckets = {k: frozenset(v) for k, v in event_tag_buckets.items()}
+
+    def __len__(self):
+        return len(self.probes)
+
+    def iter_candidate_probes(self, event):
+        positions = set(self.catch_all)
+        positions.update(self.event_type_buckets.get(event.event_type, ()))
+        if self.event_tag_buckets:
+            for event_tag in event.metadata.all_tags:
+                positions.update(self.event_tag_buckets.get(event_tag, ()))
+        for position in sorted(positions):
+            yield self.probes[position]
+
+    def event_filtered(self, event):
+        return [probe for probe in self.iter_candidate_probes(event) if probe.test_event(event)]
+
+
 class ProbeList(ProbeView):
     def __init__(self, parent=None, filter_func=None, with_sync=False):
         super(ProbeList, self).__init__(parent, with_sync=with_sync)
         self.filter_func = filter_func
         self._children = weakref.WeakSet()
+        self._event_index = None
 
     def clear(self):
         with self._lock:
             self._probes = None
+            self._event_index = None
             for child in self._children:
                 child.clear()
 
@@ -116,10 +170,15 @@ class ProbeList(ProbeView):
         self._children.add(child)
         return child
 
+    def event_index(self):
+        with self._lock:
+            self._load()
+            if self._event_index is None:
+                self._event_index = ProbeEventIndex(self._probes)
+            return self._event_index
+
     def event_filtered(self, event):
-        def _filter(probe):
-            return probe.test_event(event)
-        return self.filter(_filter)
+        return self.event_index().event_filtered(event)
 
 
 # used for the tests, to avoid having an extra DB connection
@@ -0,0 +1,70 @@
+import random
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from zentral.core.events import event_types
+from zentral.core.events.base import EventMetadata
+from zentral.core.probes.conf import ProbeList
+from zentral.core.probes.models import ProbeSource
+
+
+class Command(BaseCommand):
+    help = 'Compare the events/sec of the linear probe scan and of the probe event index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--probes', type=int, nargs="+", default=[10, 100, 1000])
+        parser.add_argument('--events', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def build_probes(self, count, event_type_names, rng):
+        probes = []
+        for i in range(count):
+            filters = {}
+            r = rng.random()
+            if r < 0.7:
+                filters["metadata"] = [{"event_types": rng.sample(event_type_names, 2)}]
+            elif r < 0.9:
+                filters["metadata"] = [{"event_tags": [rng.choice(["santa", "osquery", "munki", "zentral"])]}]
+            # else: catch-all probe
+            filters["payload"] = [[{"attribute": "name",
+                                    "operator": "IN",
+                                    "values": ["value{}".format(rng.randrange(20))]}]]
+            probe_source = ProbeSource(pk=i + 1, model="BaseProbe", name="probe {}".format(i),
+                                       status=ProbeSource.ACTIVE, body={"filters": filters})
+            probes.append(probe_source.load())
+        return probes
+
+    def build_events(self, count, event_type_names, rng):
+        events = []
+        for _ in range(count):
+            event_cls = event_types[rng.choice(event_type_names)]
+            metadata = EventMetadata(uuid=uuid.uuid4())
+            events.append(event_cls(metadata, {"name": "value{}".format(rng.randrange(20))}))
+        return events
+
+    def run(self, events, func):
+        matches = 0
+        start = time.perf_counter()
+        for event in events:
+            matches += len(func(event))
+        duration = time.perf_counter() - start
+        return len(events) / duration, matches
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        event_type_names = sorted(event_types.keys())
+        events = self.build_events(options["events"], event_type_names, rng)
+        for probe_count in options["probes"]:
+            probes = self.build_probes(probe_count, event_type_names, rng)
+            probe_list = ProbeList(parent=probes)
+
+            def linear_scan(event):
+                return [probe for probe in probes if probe.test_event(event)]
+
+            linear_eps, linear_matches = self.run(events, linear_scan)
+            indexed_eps, indexed_matches = self.run(events, probe_list.event_filtered)
+            if linear_matches != indexed_matches:
+                self.stderr.write("Match count mismatch {} != {}".format(linear_matches, indexed_matches))
+            self.stdout.write("{:>6} probes: linear {:>10.0f} events/s, indexed {:>10.0f} events/s, x{:.1f}".format(
+                probe_count, linear_eps, indexed_eps, indexed_eps / linear_eps
+            ))
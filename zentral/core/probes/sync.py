@@ -15,6 +15,8 @@ postgresql_channel = "probe_change"
 
 
 class ProbeViewSync(threading.Thread):
+    postgresql_channel = postgresql_channel
+
     def __init__(self, probe_view):
         self.probe_view = weakref.ref(probe_view)
         super().__init__(daemon=True)
@@ -27,7 +29,7 @@ class ProbeViewSync(threading.Thread):
             # LISTEN query
             try:
                 cur = connection.cursor()
-                cur.execute('LISTEN {}'.format(postgresql_channel))
+                cur.execute('LISTEN {}'.format(self.postgresql_channel))
                 connection.commit()
             except Exception as db_err:
                 connection.close_if_unusable_or_obsolete()
@@ -47,11 +49,11 @@ class ProbeViewSync(threading.Thread):
                 else:
                     logger.error("Could not get probe view. "
                                  "Stop error recovery for notifications on channel '%s'.",
-                                 postgresql_channel)
+                                 self.postgresql_channel)
                     break
                 self.error_state = False
 
-            logger.info("Waiting for notifications on channel '%s'", postgresql_channel)
+            logger.info("Waiting for notifications on channel '%s'", self.postgresql_channel)
             pg_con = connection.connection
             while True:
                 self.last_heartbeat = datetime.utcnow()
@@ -69,22 +71,26 @@ class ProbeViewSync(threading.Thread):
                         # clear notifications
                         while pg_con.notifies:
                             pg_con.notifies.pop()
-                        logger.info("Received notification on channel '%s'", postgresql_channel)
+                        logger.info("Received notification on channel '%s'", self.postgresql_channel)
                         probe_view = self.probe_view()
                         if probe_view is not None:
                             probe_view.clear()
                         else:
                             logger.error("Could not get probe view. "
                                          "Stop waiting for notifications on channel '%s'.",
-                                         postgresql_channel)
+                                         self.postgresql_channel)
                             return
 
 
-def signal_probe_change():
+def signal_change(channel):
     try:
         cur = connection.cursor()
-        cur.execute('NOTIFY {}'.format(postgresql_channel))
+        cur.execute('NOTIFY {}'.format(channel))
         connection.commit()
     except Exception as db_err:
-        logger.error("Could not signal probe change: %s", db_err)
+        logger.error("Could not signal change on channel '%s': %s", channel, db_err)
         connection.close_if_unusable_or_obsolete()
+
+
+def signal_probe_change():
+    signal_change(postgresql_channel)
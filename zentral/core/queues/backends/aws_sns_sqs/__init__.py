@@ -11,7 +11,8 @@ from botocore.config import Config
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from zentral.conf import settings
-from .consumer import BatchConsumer, ConcurrentConsumer, Consumer, ConsumerProducer
+from zentral.core.queues.backends.base import MachineInfoCacheCountersMixin
+from .consumer import AsyncConcurrentConsumer, BatchConsumer, ConcurrentConsumer, Consumer, ConsumerProducer
 from .sns import SNSPublishThread
 from .sqs import SQSSendThread
 
@@ -31,18 +32,25 @@ logger = logging.getLogger('zentral.core.queues.backends.aws_sns_sqs')
 class WorkerMixin:
     name = "UNDEFINED"
     counters = []
+    histograms = []
 
     def setup_metrics_exporter(self, *args, **kwargs):
         self.metrics_exporter = kwargs.pop("metrics_exporter", None)
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            for name, label in self.histograms:
+                self.metrics_exporter.add_histogram(name, [label])
             self.metrics_exporter.start()
 
     def inc_counter(self, name, label):
         if self.metrics_exporter:
             self.metrics_exporter.inc(name, label)
 
+    def observe_histogram(self, name, value, label):
+        if self.metrics_exporter:
+            self.metrics_exporter.observe(name, value, label)
+
     def log(self, msg, level, *args):
         logger.log(level, "{} - {}".format(self.name, msg), *args)
 
@@ -108,11 +116,12 @@ class PreprocessWorker(WorkerMixin, ConsumerProducer):
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
 
 
-class EnrichWorker(WorkerMixin, ConsumerProducer):
+class EnrichWorker(MachineInfoCacheCountersMixin, WorkerMixin, ConsumerProducer):
     name = "enrich worker"
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("machine_info_cache", "result"),
     )
     publish_thread_number = 10
 
@@ -141,6 +150,7 @@ class EnrichWorker(WorkerMixin, ConsumerProducer):
         for event in self._enrich_event(event_d):
             yield None, event.serialize(machine_metadata=True)
             self.inc_counter("produced_events", event.event_type)
+            self.inc_machine_info_cache_counters(event)
         self.inc_counter("enriched_events", event.event_type)
 
 
@@ -177,6 +187,9 @@ class SimpleStoreWorker(WorkerMixin, Consumer):
         ("skipped_events", "event_type"),
         ("stored_events", "event_type"),
     )
+    histograms = (
+        ("store_latency_seconds", "store"),
+    )
 
     def __init__(self, event_queues, event_store):
         super().__init__(
@@ -207,7 +220,9 @@ class SimpleStoreWorker(WorkerMixin, Consumer):
     def process_event(self, routing_key, event_d):
         self.log_debug("store event")
         event_type = event_d['_zentral']['type']
+        start_time = time.monotonic()
         self.event_store.store(event_d)
+        self.observe_histogram("store_latency_seconds", time.monotonic() - start_time, self.event_store.name)
         self.inc_counter("stored_events", event_type)
 
 
@@ -216,6 +231,9 @@ class ConcurrentStoreWorker(WorkerMixin, ConcurrentConsumer):
         ("skipped_events", "event_type"),
         ("stored_events", "event_type"),
     )
+    histograms = (
+        ("store_latency_seconds", "store"),
+    )
 
     def __init__(self, event_queues, event_store):
         self.event_store = event_store
@@ -248,6 +266,55 @@ class ConcurrentStoreWorker(WorkerMixin, ConcurrentConsumer):
         return self.event_store.get_process_thread_constructor()
 
     def update_metrics(self, success, event_type, process_time):
+        self.observe_histogram("store_latency_seconds", process_time, self.event_store.name)
+        if success:
+            self.inc_counter("stored_events", event_type)
+
+
+class AsyncConcurrentStoreWorker(WorkerMixin, AsyncConcurrentConsumer):
+    counters = (
+        ("skipped_events", "event_type"),
+        ("stored_events", "event_type"),
+    )
+    histograms = (
+        ("store_latency_seconds", "store"),
+    )
+
+    def __init__(self, event_queues, event_store):
+        self.event_store = event_store
+        super().__init__(
+            event_queues.setup_queue(
+                "store-enriched-events-{}".format(slugify(event_store.name)),
+                "enriched-events",
+                included_event_types=event_store.included_event_types,
+                excluded_event_types=event_store.excluded_event_types
+            ),
+            event_store.concurrency,
+            event_queues.client_kwargs
+        )
+        self.name = f"store worker {event_store.name}"
+
+    def skip_event(self, receipt_handle, event_d):
+        event_type = event_d['_zentral']['type']
+        if not self.event_store.is_event_type_included(event_type):
+            self.inc_counter("skipped_events", event_type)
+            return True
+        else:
+            return False
+
+    def run(self, *args, **kwargs):
+        self.log_info("run")
+        super().setup_metrics_exporter(*args, **kwargs)
+        super().run(*args, **kwargs)
+
+    def get_async_client(self):
+        return self.event_store.get_async_client()
+
+    async def async_process_event(self, client, routing_key, event_d):
+        await self.event_store.async_store(client, event_d)
+
+    def update_metrics(self, success, event_type, process_time):
+        self.observe_histogram("store_latency_seconds", process_time, self.event_store.name)
         if success:
             self.inc_counter("stored_events", event_type)
 
@@ -257,6 +324,9 @@ class BulkStoreWorker(WorkerMixin, BatchConsumer):
         ("skipped_events", "event_type"),
         ("stored_events", "event_type"),
     )
+    histograms = (
+        ("bulk_store_latency_seconds", "store"),
+    )
 
     def __init__(self, event_queues, event_store):
         super().__init__(
@@ -302,6 +372,7 @@ class BulkStoreWorker(WorkerMixin, BatchConsumer):
                 yield event_d
 
         stored_event_count = 0
+        start_time = time.monotonic()
         for stored_event_key in self.event_store.bulk_store(iter_events()):
             try:
                 receipt_handle, event_type = self.event_info[stored_event_key]
@@ -311,6 +382,7 @@ class BulkStoreWorker(WorkerMixin, BatchConsumer):
                 yield receipt_handle
                 self.inc_counter("stored_events", event_type)
                 stored_event_count += 1
+        self.observe_histogram("bulk_store_latency_seconds", time.monotonic() - start_time, self.event_store.name)
 
         if stored_event_count < batch_size:
             self.log_error("only %s/%s event(s) stored", stored_event_count, batch_size)
@@ -457,7 +529,8 @@ class EventQueues(object):
     def get_preprocess_worker(self):
         return PreprocessWorker(self)
 
-    def get_enrich_worker(self, enrich_event):
+    def get_enrich_worker(self, enrich_event, prefetch_machine_info=None):
+        # no batch enrichment mode with this backend
         return EnrichWorker(self, enrich_event)
 
     def get_process_worker(self, process_event):
@@ -466,6 +539,8 @@ class EventQueues(object):
     def get_store_worker(self, event_store):
         if event_store.batch_size > 1:
             return BulkStoreWorker(self, event_store)
+        elif event_store.concurrency > 1 and event_store.asyncio:
+            return AsyncConcurrentStoreWorker(self, event_store)
         elif event_store.concurrency > 1:
             return ConcurrentStoreWorker(self, event_store)
         else:
@@ -514,7 +589,7 @@ class EventQueues(object):
             self._threads.append(thread)
         self._raw_events_queue.put((None, routing_key, raw_event, time.monotonic()))
 
-    def post_event(self, event):
+    def _get_events_queue(self):
         self._setup_graceful_stop()
         if self._events_queue is None:
             self._events_queue = queue.Queue(maxsize=20)
@@ -527,4 +602,14 @@ class EventQueues(object):
             )
             thread.start()
             self._threads.append(thread)
-        self._events_queue.put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
+        return self._events_queue
+
+    def post_event(self, event):
+        self._get_events_queue().put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
+
+    def post_events(self, events):
+        events_queue = self._get_events_queue()
+        for event in events:
+            events_queue.put((None, None, event.serialize(machine_metadata=False), time.monotonic()))
+        # send the last incomplete batch without waiting for the max event age
+        events_queue.put(SQSSendThread.flush)
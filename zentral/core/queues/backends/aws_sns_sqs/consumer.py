@@ -1,3 +1,4 @@
+import asyncio
 from collections import deque, OrderedDict
 import logging
 import queue
@@ -158,6 +159,89 @@ class ConcurrentConsumer(BaseConsumer):
                     self.process_event_queue.put((receipt_handle, routing_key, event_d))
 
 
+# AsyncConcurrentConsumer
+
+
+class AsyncConcurrentConsumer(BaseConsumer):
+    """Process up to concurrency events at the same time in an asyncio event loop
+
+    The processed events are sent to the same final thread as in the ConcurrentConsumer.
+    """
+
+    def __init__(self, queue_url, concurrency, client_kwargs=None):
+        super().__init__(queue_url, client_kwargs)
+        self.concurrency = concurrency
+        self.processed_event_queue = queue.Queue(maxsize=concurrency)
+        self._threads.append(ConcurrentConsumerFinalThread(self))
+
+    def start_run_loop(self):
+        asyncio.run(self.async_run_loop())
+
+    def _get_message(self):
+        return self.process_message_queue.get(block=True, timeout=1)
+
+    async def _put(self, thread_queue, item):
+        # do not block the event loop if the queue is full
+        try:
+            thread_queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, thread_queue.put, item)
+
+    async def async_run_loop(self):
+        loop = asyncio.get_running_loop()
+        # bound the number of in-flight events
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        async with self.get_async_client() as client:
+            while True:
+                try:
+                    receipt_handle, routing_key, event_d = await loop.run_in_executor(None, self._get_message)
+                except queue.Empty:
+                    logger.debug("no new event to process")
+                    if self.stop_receiving_event.is_set():
+                        break
+                    continue
+                if self.skip_event(receipt_handle, event_d):
+                    logger.debug("receipt handle %s: event skipped", receipt_handle[-7:])
+                    await self._put(self.delete_message_queue, (receipt_handle, time.monotonic()))
+                    continue
+                await semaphore.acquire()
+                logger.debug("receipt handle %s: process new event", receipt_handle[-7:])
+                task = asyncio.create_task(
+                    self._process_event(client, semaphore, receipt_handle, routing_key, event_d)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                logger.debug("wait for %s in-flight event(s)", len(tasks))
+                await asyncio.gather(*tasks)
+
+    async def _process_event(self, client, semaphore, receipt_handle, routing_key, event_d):
+        try:
+            event_type = event_d['_zentral']['type']
+            start_time = time.monotonic()
+            try:
+                await self.async_process_event(client, routing_key, event_d)
+            except Exception:
+                logger.exception("receipt handle %s: could not process event", receipt_handle[-7:])
+                success = False
+            else:
+                success = True
+            await self._put(self.processed_event_queue,
+                            (receipt_handle, success, event_type, time.monotonic() - start_time))
+        finally:
+            semaphore.release()
+
+    def get_async_client(self):
+        # to be implemented in the sub-classes
+        # must return an async context manager, passed to async_process_event
+        raise NotImplementedError
+
+    async def async_process_event(self, client, routing_key, event_d):
+        # to be implemented in the sub-classes
+        raise NotImplementedError
+
+
 # BatchConsumer
 
 
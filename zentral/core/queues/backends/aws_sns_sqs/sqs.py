@@ -147,6 +147,7 @@ class SQSDeleteThread(threading.Thread):
 class SQSSendThread(threading.Thread):
     max_number_of_messages = 10
     max_event_age_seconds = 5
+    flush = None  # in queue marker to send the current entries
 
     def __init__(self, queue_url, stop_event, in_queue, out_queue, client_kwargs=None):
         if client_kwargs is None:
@@ -165,7 +166,7 @@ class SQSSendThread(threading.Thread):
         while True:
             logger.debug("[%s] %s event(s) to send", self.name, len(self.entries))
             try:
-                receipt_handle, routing_key, event_d, event_ts = self.in_queue.get(block=True, timeout=1)
+                item = self.in_queue.get(block=True, timeout=1)
             except queue.Empty:
                 logger.debug("[%s] no new event to send", self.name)
                 if self.entries:
@@ -181,6 +182,12 @@ class SQSSendThread(threading.Thread):
                     logger.info("[%s] graceful exit", self.name)
                     break
             else:
+                if item is self.flush:
+                    if self.entries:
+                        logger.debug("[%s] send %s event(s) because flush requested", self.name, len(self.entries))
+                        self.send_entries()
+                    continue
+                receipt_handle, routing_key, event_d, event_ts = item
                 logger.debug("[%s] new event to send %s %s", self.name, routing_key, event_ts)
                 entry_id = str(uuid.uuid4())
                 entry = {"Id": entry_id,
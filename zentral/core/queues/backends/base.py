@@ -0,0 +1,11 @@
+class MachineInfoCacheCountersMixin:
+    """Count the machine info cache lookups of the enriched events
+
+    The worker must have a ("machine_info_cache", "result") counter.
+    """
+    def inc_machine_info_cache_counters(self, event):
+        machine = event.metadata.machine
+        if machine is not None:
+            # popped, to count each lookup once, even if the machine is shared by multiple events
+            for result in machine.pop_event_info_cache_results():
+                self.inc_counter("machine_info_cache", result)
@@ -7,6 +7,7 @@ from google.api_core.exceptions import AlreadyExists
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from zentral.conf import settings
+from zentral.core.queues.backends.base import MachineInfoCacheCountersMixin
 
 
 logger = logging.getLogger('zentral.core.queues.backends.google_pubsub')
@@ -114,11 +115,12 @@ class PreprocessWorker(BaseWorker):
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
 
 
-class EnrichWorker(BaseWorker):
+class EnrichWorker(MachineInfoCacheCountersMixin, BaseWorker):
     name = "enrich worker"
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("machine_info_cache", "result"),
     )
 
     def __init__(self, events_topic, enriched_events_topic, credentials, enrich_event):
@@ -166,6 +168,7 @@ class EnrichWorker(BaseWorker):
                 new_message = json.dumps(event.serialize(machine_metadata=True)).encode("utf-8")
                 self.publisher_client.publish(self.enriched_events_topic, new_message)
                 self.inc_counter("produced_events", event.event_type)
+                self.inc_machine_info_cache_counters(event)
         except Exception as exception:
             logger.exception("Requeuing message with 1s delay: %s", exception)
             time.sleep(1)
@@ -313,7 +316,8 @@ class EventQueues(object):
     def get_preprocess_worker(self):
         return PreprocessWorker(self.raw_events_topic, self.events_topic, self.credentials)
 
-    def get_enrich_worker(self, enrich_event):
+    def get_enrich_worker(self, enrich_event, prefetch_machine_info=None):
+        # no batch enrichment mode with this backend
         return EnrichWorker(self.events_topic, self.enriched_events_topic, self.credentials, enrich_event)
 
     def get_process_worker(self, process_event):
@@ -327,3 +331,8 @@ class EventQueues(object):
 
     def post_event(self, event):
         self._publish(self.events_topic, event.serialize(machine_metadata=False))
+
+    def post_events(self, events):
+        # the publisher client batches the messages published in a short time window
+        for event in events:
+            self._publish(self.events_topic, event.serialize(machine_metadata=False))
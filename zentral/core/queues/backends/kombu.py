@@ -5,6 +5,7 @@ from zentral.conf import settings
 from kombu import Connection, Consumer, Exchange, Queue
 from kombu.mixins import ConsumerMixin, ConsumerProducerMixin
 from kombu.pools import producers
+from zentral.core.queues.backends.base import MachineInfoCacheCountersMixin
 from zentral.utils.json import save_dead_letter
 
 
@@ -23,21 +24,41 @@ process_events_queue = Queue('process_events',
                              durable=True)
 
 
+def publish_events(producer, events):
+    """Publish the events with a single producer. Yield the published events."""
+    declare = [events_exchange]
+    for event in events:
+        producer.publish(event.serialize(machine_metadata=False),
+                         serializer='json',
+                         exchange=events_exchange,
+                         declare=declare)
+        # the exchange only needs to be declared once per batch
+        declare = None
+        yield event
+
+
 class BaseWorker:
     name = "UNDEFINED"
     counters = []
+    histograms = []
 
     def setup_metrics_exporter(self, *args, **kwargs):
         self.metrics_exporter = kwargs.pop("metrics_exporter", None)
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            for name, label in self.histograms:
+                self.metrics_exporter.add_histogram(name, [label])
             self.metrics_exporter.start()
 
     def inc_counter(self, name, label):
         if self.metrics_exporter:
             self.metrics_exporter.inc(name, label)
 
+    def observe_histogram(self, name, value, label):
+        if self.metrics_exporter:
+            self.metrics_exporter.observe(name, value, label)
+
     def log(self, msg, level, *args):
         logger.log(level, "{} - {}".format(self.name, msg), *args)
 
@@ -100,26 +121,31 @@ class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
             if not preprocessor:
                 logger.error("No preprocessor for routing key %s", routing_key)
             else:
-                for event in preprocessor.process_raw_event(body):
-                    self.producer.publish(event.serialize(machine_metadata=False),
-                                          serializer='json',
-                                          exchange=events_exchange,
-                                          declare=[events_exchange])
+                for event in publish_events(self.producer, preprocessor.process_raw_event(body)):
                     self.inc_counter("produced_events", event.event_type)
         message.ack()
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
 
 
-class EnrichWorker(ConsumerProducerMixin, BaseWorker):
+class EnrichWorker(MachineInfoCacheCountersMixin, ConsumerProducerMixin, BaseWorker):
     name = "enrich worker"
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("machine_info_prefetches", "source"),
+        ("machine_info_cache", "result"),
     )
+    max_batch_age_seconds = 1
 
-    def __init__(self, connection, enrich_event):
+    def __init__(self, connection, enrich_event, prefetch_machine_info=None, batch_size=1):
         self.connection = connection
         self.enrich_event = enrich_event
+        self.prefetch_machine_info = prefetch_machine_info
+        if prefetch_machine_info is None:
+            batch_size = 1
+        self.batch_size = max(1, batch_size)
+        self.batch = []
+        self.batch_start_ts = None
         self.name = "enrich worker"
 
     def run(self, *args, **kwargs):
@@ -128,10 +154,17 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
         super().run(*args, **kwargs)
 
     def get_consumers(self, _, default_channel):
+        if self.batch_size > 1:
+            callback = self.do_batch_enrich_event
+            prefetch_count = self.batch_size
+        else:
+            callback = self.do_enrich_event
+            prefetch_count = None
         return [Consumer(default_channel,
                          queues=[enrich_events_queue],
                          accept=['json'],
-                         callbacks=[self.do_enrich_event])]
+                         prefetch_count=prefetch_count,
+                         callbacks=[callback])]
 
     def do_enrich_event(self, body, message):
         self.log_debug("enrich event")
@@ -142,6 +175,7 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
                                       exchange=enriched_events_exchange,
                                       declare=[enriched_events_exchange])
                 self.inc_counter("produced_events", event.event_type)
+                self.inc_machine_info_cache_counters(event)
         except Exception as exception:
             logger.exception("Requeuing message with 1s delay: %s", exception)
             time.sleep(1)
@@ -150,6 +184,49 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
             message.ack()
             self.inc_counter("enriched_events", event.event_type)
 
+    # batch mode
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # the unacknowledged messages of a previous connection will be redelivered
+        self.batch = []
+        self.batch_start_ts = None
+        super().on_consume_ready(connection, channel, consumers, **kwargs)
+
+    def on_iteration(self):
+        super().on_iteration()
+        if self.batch and time.monotonic() > self.batch_start_ts + self.max_batch_age_seconds:
+            self.log_debug("process batch because max batch age reached")
+            self._process_batch()
+
+    def do_batch_enrich_event(self, body, message):
+        self.batch.append((body, message))
+        if self.batch_start_ts is None:
+            self.batch_start_ts = time.monotonic()
+        if len(self.batch) >= self.batch_size:
+            self._process_batch()
+
+    def _process_batch(self):
+        batch, self.batch, self.batch_start_ts = self.batch, [], None
+        self.log_debug("enrich %d events", len(batch))
+        # fill the machine info cache in one go
+        serial_numbers = set()
+        for body, _ in batch:
+            try:
+                serial_number = body["_zentral"].get("machine_serial_number")
+            except (KeyError, AttributeError):
+                continue
+            if serial_number:
+                serial_numbers.add(serial_number)
+        if serial_numbers:
+            try:
+                prefetched_machine_count = self.prefetch_machine_info(serial_numbers)
+            except Exception:
+                logger.exception("Could not prefetch the machine info")
+            else:
+                self.inc_counter("machine_info_prefetches", "db" if prefetched_machine_count else "cache")
+        for body, message in batch:
+            self.do_enrich_event(body, message)
+
 
 class ProcessWorker(ConsumerMixin, BaseWorker):
     name = "process worker"
@@ -184,6 +261,9 @@ class StoreWorker(ConsumerMixin, BaseWorker):
     counters = (
         ("stored_events", "event_type"),
     )
+    histograms = (
+        ("store_latency_seconds", "store"),
+    )
 
     def __init__(self, connection, event_store):
         self.connection = connection
@@ -211,6 +291,7 @@ class StoreWorker(ConsumerMixin, BaseWorker):
             self.log_debug("skip %s event", event_type)
             message.ack()
             return
+        start_time = time.monotonic()
         try:
             self.event_store.store(body)
         except Exception:
@@ -220,12 +301,95 @@ class StoreWorker(ConsumerMixin, BaseWorker):
         else:
             message.ack()
             self.inc_counter("stored_events", event_type)
+        finally:
+            self.observe_histogram("store_latency_seconds", time.monotonic() - start_time, self.event_store.name)
+
+
+class BulkStoreWorker(StoreWorker):
+    histograms = (
+        ("bulk_store_latency_seconds", "store"),
+    )
+    max_batch_age_seconds = 5
+
+    def __init__(self, connection, event_store):
+        super().__init__(connection, event_store)
+        self.batch_size = event_store.batch_size
+        self.batch = []
+        self.batch_start_ts = None
+
+    def get_consumers(self, _, default_channel):
+        # the broker will not deliver more unacknowledged messages than the batch size
+        return [Consumer(default_channel,
+                         queues=[self.input_queue],
+                         accept=['json'],
+                         prefetch_count=self.batch_size,
+                         callbacks=[self.do_batch_store_event])]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # the unacknowledged messages of a previous connection will be redelivered
+        self.batch = []
+        self.batch_start_ts = None
+        super().on_consume_ready(connection, channel, consumers, **kwargs)
+
+    def on_iteration(self):
+        super().on_iteration()
+        if self.batch and time.monotonic() > self.batch_start_ts + self.max_batch_age_seconds:
+            self.log_debug("store batch because max batch age reached")
+            self._store_batch()
+
+    def do_batch_store_event(self, body, message):
+        event_type = body['_zentral']['type']
+        if not self.event_store.is_event_type_included(event_type):
+            self.log_debug("skip %s event", event_type)
+            message.ack()
+            return
+        self.batch.append((body, message))
+        if self.batch_start_ts is None:
+            self.batch_start_ts = time.monotonic()
+        if len(self.batch) >= self.batch_size:
+            self._store_batch()
+
+    def _store_batch(self):
+        batch, self.batch, self.batch_start_ts = self.batch, [], None
+        batch_size = len(batch)
+        self.log_debug("store %d events", batch_size)
+        unstored_events = {}
+        for body, message in batch:
+            # the event metadata is read before the store, that could consume the body
+            event_metadata = body['_zentral']
+            unstored_events[(event_metadata["id"], event_metadata["index"])] = (event_metadata["type"], body, message)
+        start_time = time.monotonic()
+        try:
+            for stored_event_key in self.event_store.bulk_store(body for body, _ in batch):
+                try:
+                    event_type, _, message = unstored_events.pop(stored_event_key)
+                except KeyError:
+                    logger.error("Unknown stored event %s", stored_event_key)
+                else:
+                    message.ack()
+                    self.inc_counter("stored_events", event_type)
+        except Exception as exception:
+            self.observe_histogram("bulk_store_latency_seconds", time.monotonic() - start_time, self.event_store.name)
+            logger.exception("Requeuing %d message(s) with 1s delay: %s", len(unstored_events), exception)
+            time.sleep(1)
+            for _, _, message in unstored_events.values():
+                message.requeue()
+            return
+        self.observe_histogram("bulk_store_latency_seconds", time.monotonic() - start_time, self.event_store.name)
+        if unstored_events:
+            self.log_error("only %s/%s event(s) stored", batch_size - len(unstored_events), batch_size)
+            for _, body, message in unstored_events.values():
+                save_dead_letter(body, "event store {} error".format(self.event_store.name))
+                message.reject()
+        else:
+            self.log_debug("%s/%s events stored", batch_size, batch_size)
 
 
 class EventQueues(object):
     def __init__(self, config_d):
         self.backend_url = config_d['backend_url']
         self.transport_options = config_d.get('transport_options')
+        self.enrich_batch_size = int(config_d.get('enrich_batch_size', 1))
         self.connection = self._get_connection()
 
     def _get_connection(self):
@@ -234,14 +398,17 @@ class EventQueues(object):
     def get_preprocess_worker(self):
         return PreprocessWorker(self._get_connection())
 
-    def get_enrich_worker(self, enrich_event):
-        return EnrichWorker(self._get_connection(), enrich_event)
+    def get_enrich_worker(self, enrich_event, prefetch_machine_info=None):
+        return EnrichWorker(self._get_connection(), enrich_event, prefetch_machine_info, self.enrich_batch_size)
 
     def get_process_worker(self, process_event):
         return ProcessWorker(self._get_connection(), process_event)
 
     def get_store_worker(self, event_store):
-        return StoreWorker(self._get_connection(), event_store)
+        if event_store.batch_size > 1:
+            return BulkStoreWorker(self._get_connection(), event_store)
+        else:
+            return StoreWorker(self._get_connection(), event_store)
 
     def post_raw_event(self, routing_key, raw_event):
         with producers[self.connection].acquire(block=True) as producer:
@@ -252,8 +419,9 @@ class EventQueues(object):
                              declare=[raw_events_exchange])
 
     def post_event(self, event):
+        self.post_events([event])
+
+    def post_events(self, events):
         with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(event.serialize(machine_metadata=False),
-                             serializer='json',
-                             exchange=events_exchange,
-                             declare=[events_exchange])
+            for _ in publish_events(producer, events):
+                pass
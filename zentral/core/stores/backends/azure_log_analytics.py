@@ -7,8 +7,9 @@ import json
 import logging
 import pytz
 import requests
-from zentral.core.events import event_from_event_d
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.events.base import parse_created_at
+from zentral.core.stores.backends.base import (BaseEventStore, async_post_with_retries, get_event_key,
+                                               iter_bulk_chunks, post_with_retries)
 
 
 logger = logging.getLogger('zentral.core.stores.backends.azure_log_analytics')
@@ -41,6 +42,10 @@ def datetime_to_iso8601z_truncated_to_milliseconds(dt):
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500
+    max_request_body_size = 30000000  # Data Collector API limit, in bytes
+    max_retries = 3
+    max_async_concurrency = 500
     log_type = "ZentralEvent"
     content_type = "application/json"
     resource = "/api/logs"
@@ -76,15 +81,18 @@ class EventStore(BaseEventStore):
         return dict(items)
 
     def _prepare_event(self, event):
-        if not isinstance(event, dict):
-            event_d = event.serialize()
+        if isinstance(event, dict):
+            # do not modify the original serialized event
+            event_d = event.copy()
+            metadata = event_d.pop("_zentral").copy()
         else:
-            event_d = event
-
-        metadata = event_d.pop("_zentral")
+            event_d = event.serialize()
+            metadata = event_d.pop("_zentral")
 
         # fix created_at format for use as TimeGenerated field via the time-generated-field header
-        metadata["created_at"] = datetime_to_iso8601z_truncated_to_milliseconds(event.metadata.created_at)
+        metadata["created_at"] = datetime_to_iso8601z_truncated_to_milliseconds(
+            parse_created_at(metadata["created_at"])
+        )
 
         # flatten the metadata
         azure_event = self._flatten_metadata(metadata)
@@ -109,16 +117,52 @@ class EventStore(BaseEventStore):
                 digestmod=hashlib.sha256).digest()
         )
 
-    def store(self, event):
-        # Build and send a request to the POST API
-        if isinstance(event, dict):
-            event = event_from_event_d(event)
-        data = json.dumps(self._prepare_event(event)).encode("utf-8")
+    def _get_request_headers(self, data):
         rfc1123_date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
         signature = self._build_signature(rfc1123_date, len(data))
-        self._session.headers.update({
+        return {
             'Authorization': "SharedKey {}:{}".format(self.customer_id, signature.decode("utf-8")),
             'x-ms-date': rfc1123_date,
-        })
-        r = self._session.post(self._url, data=data)
-        r.raise_for_status()
+        }
+
+    def _post_data(self, data, max_retries=1):
+        return post_with_retries(self._session, self._url, max_retries,
+                                 data=data, headers=self._get_request_headers(data))
+
+    def store(self, event):
+        # Build and send a request to the POST API
+        data = json.dumps(self._prepare_event(event)).encode("utf-8")
+        self._post_data(data)
+
+    def get_async_client(self):
+        return super().get_async_client(headers={"Content-Type": self.content_type,
+                                                 "Log-Type": self.log_type,
+                                                 "time-generated-field": "CreatedAt"})
+
+    async def async_store(self, client, event):
+        data = json.dumps(self._prepare_event(event)).encode("utf-8")
+        await async_post_with_retries(client, self._url, self.max_retries,
+                                      content=data, headers=self._get_request_headers(data))
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+
+        def iter_serialized_events():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = event.serialize()
+                azure_event, = self._prepare_event(event)
+                event_key = get_event_key(event)
+                yield event_key, json.dumps(azure_event).encode("utf-8")
+
+        # 2 bytes for the array brackets
+        for chunk in iter_bulk_chunks(iter_serialized_events(), self.batch_size, self.max_request_body_size - 2):
+            data = b"[" + b",".join(data for _, data in chunk) + b"]"
+            try:
+                self._post_data(data, self.max_retries)
+            except Exception:
+                logger.exception("Could not store %s event(s)", len(chunk))
+            else:
+                for event_key, _ in chunk:
+                    yield event_key
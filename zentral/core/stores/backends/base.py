@@ -1,6 +1,90 @@
+import asyncio
+import logging
+import random
+import time
+import httpx
+import requests
+
+
+logger = logging.getLogger('zentral.core.stores.backends.base')
+
+
+def get_event_key(event_d):
+    event_metadata = event_d["_zentral"]
+    return event_metadata["id"], event_metadata["index"]
+
+
+def iter_bulk_chunks(serialized_events, max_count, max_size):
+    """Group the (event key, serialized event) tuples in chunks
+
+    Each chunk has at most max_count events, and the sum of the serialized event sizes,
+    plus 1 byte per event for a separator, is at most max_size.
+    The events bigger than max_size are dropped.
+    """
+    chunk = []
+    chunk_size = 0
+    for event_key, data in serialized_events:
+        data_size = len(data) + 1
+        if data_size > max_size:
+            logger.error("Event %s too big: %s bytes", event_key, data_size)
+            continue
+        if chunk and (len(chunk) >= max_count or chunk_size + data_size > max_size):
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append((event_key, data))
+        chunk_size += data_size
+    if chunk:
+        yield chunk
+
+
+def post_with_retries(session, url, max_retries=3, **kwargs):
+    """POST the request, retry with a backoff on connection errors, throttling and temporary server errors"""
+    for i in range(max_retries):
+        last_try = i + 1 >= max_retries
+        try:
+            r = session.post(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if last_try:
+                raise
+            logger.exception("Could not post to %s", url)
+        else:
+            if r.ok:
+                return r
+            if last_try or not (r.status_code == 429 or r.status_code >= 500):
+                r.raise_for_status()
+            logger.error("Temporary server error %s", r.status_code)
+        seconds = random.uniform(3, 4) * (i + 1)
+        logger.error("Retry in %.1fs", seconds)
+        time.sleep(seconds)
+
+
+async def async_post_with_retries(client, url, max_retries=3, **kwargs):
+    """asyncio version of post_with_retries, for the httpx.AsyncClient"""
+    for i in range(max_retries):
+        last_try = i + 1 >= max_retries
+        try:
+            r = await client.post(url, **kwargs)
+        except httpx.TransportError:
+            if last_try:
+                raise
+            logger.exception("Could not post to %s", url)
+        else:
+            if 200 <= r.status_code < 300:
+                return r
+            if last_try or not (r.status_code == 429 or r.status_code >= 500):
+                r.raise_for_status()
+            logger.error("Temporary server error %s", r.status_code)
+        seconds = random.uniform(3, 4) * (i + 1)
+        logger.error("Retry in %.1fs", seconds)
+        await asyncio.sleep(seconds)
+
+
 class BaseEventStore(object):
     max_batch_size = 1
     max_concurrency = 1
+    max_async_concurrency = 1  # > 1 if async_store is implemented
+    async_client_timeout = 30
     machine_events = False
     machine_events_url = False
     last_machine_heartbeats = False
@@ -16,7 +100,10 @@ class BaseEventStore(object):
         self.frontend = config_d.get('frontend', False)
         self.configured = False
         self.batch_size = min(self.max_batch_size, max(config_d.get("batch_size") or 1, 1))
-        self.concurrency = min(self.max_concurrency, max(config_d.get("concurrency") or 1, 1))
+        # asyncio concurrent storage of the events, if available
+        self.asyncio = self.max_async_concurrency > 1 and bool(config_d.get("asyncio", False))
+        max_concurrency = self.max_async_concurrency if self.asyncio else self.max_concurrency
+        self.concurrency = min(max_concurrency, max(config_d.get("concurrency") or 1, 1))
         # excluded / included event types
         for prefix in ("excluded", "included"):
             attr = f"{prefix}_event_types"
@@ -40,6 +127,22 @@ class BaseEventStore(object):
         if not self.configured:
             self.wait_and_configure()
 
+    # asyncio
+
+    def get_async_client(self, **kwargs):
+        # HTTP/2 if the server supports it, else one HTTP/1.1 connection per in-flight request
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency),
+            timeout=self.async_client_timeout,
+            **kwargs
+        )
+
+    async def async_store(self, client, event):
+        # to be implemented in the sub-classes, with max_async_concurrency > 1
+        raise NotImplementedError
+
     # machine events
 
     def fetch_machine_events(self, serial_number, from_dt, to_dt=None, event_type=None, limit=10, cursor=None):
@@ -7,13 +7,18 @@ import time
 import zlib
 from urllib.parse import urlencode
 from zentral.core.events import event_from_event_d
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import (BaseEventStore, async_post_with_retries, get_event_key,
+                                               iter_bulk_chunks, post_with_retries)
 
 
 logger = logging.getLogger('zentral.core.stores.backends.datadog')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 1000  # max number of logs in a single intake request
+    max_request_body_size = 5000000  # uncompressed, in bytes
+    max_retries = 3
+    max_async_concurrency = 500
     machine_events = True
     machine_events_url = True
     probe_events = True
@@ -34,11 +39,12 @@ class EventStore(BaseEventStore):
         self.source = config_d.get("source", "zentral")
 
         # requests session
-        self._session = requests.Session()
-        self._session.headers.update({
+        self._intake_headers = {
             'DD-API-KEY': config_d["api_key"],
             'Content-Type': 'application/json',
-        })
+        }
+        self._session = requests.Session()
+        self._session.headers.update(self._intake_headers)
         app_key = config_d.get("application_key")
         if app_key:
             self._session.headers.update({"DD-APPLICATION-KEY": app_key})
@@ -48,9 +54,13 @@ class EventStore(BaseEventStore):
         return "ztl-{}:{}".format(key, value)[:200]
 
     def _serialize_event(self, event):
-        if not isinstance(event, dict):
+        if isinstance(event, dict):
+            # do not modify the original serialized event
+            event = event.copy()
+            ddevent = event.pop("_zentral").copy()
+        else:
             event = event.serialize()
-        ddevent = event.pop("_zentral")
+            ddevent = event.pop("_zentral")
         event_type = ddevent.pop("type")
         namespace = ddevent.get("namespace", event_type)
         ddevent[namespace] = event
@@ -72,6 +82,8 @@ class EventStore(BaseEventStore):
         http = {}
         usr = {}
         if request:
+            # copies, because the nested dicts of the original event are shared
+            request = ddevent["request"] = request.copy()
             ip = request.pop("ip", None)
             if ip:
                 network_client["ip"] = ip
@@ -80,10 +92,11 @@ class EventStore(BaseEventStore):
                 http["useragent"] = user_agent
             user = request.get("user", None)
             if user:
+                user = request["user"] = user.copy()
                 for ztl_attr, dd_attr in (("id", "id"),
                                           ("email", "email"),
                                           ("username", "name")):
-                    val = user.pop(ztl_attr)
+                    val = user.pop(ztl_attr, None)
                     if val:
                         usr[dd_attr] = str(val)
                 if not user:
@@ -143,6 +156,43 @@ class EventStore(BaseEventStore):
         )
         r.raise_for_status()
 
+    def get_async_client(self):
+        return super().get_async_client(headers=self._intake_headers)
+
+    async def async_store(self, client, event):
+        ddevent = self._serialize_event(event)
+        await async_post_with_retries(
+            client, self.input_url, self.max_retries,
+            content=zlib.compress(json.dumps([ddevent]).encode("utf-8")),
+            headers={"Content-Encoding": "deflate"}
+        )
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+
+        def iter_serialized_events():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = event.serialize()
+                event_key = get_event_key(event)
+                yield event_key, json.dumps(self._serialize_event(event)).encode("utf-8")
+
+        # 2 bytes for the array brackets
+        for chunk in iter_bulk_chunks(iter_serialized_events(), self.batch_size, self.max_request_body_size - 2):
+            data = b"[" + b",".join(data for _, data in chunk) + b"]"
+            try:
+                post_with_retries(
+                    self._session, self.input_url, self.max_retries,
+                    data=zlib.compress(data),
+                    headers={"Content-Encoding": "deflate"}
+                )
+            except Exception:
+                logger.exception("Could not store %s event(s)", len(chunk))
+            else:
+                for event_key, _ in chunk:
+                    yield event_key
+
     @staticmethod
     def _prepare_datetime(dt, tick=1):
         return str(int(time.mktime(dt.timetuple())) * tick)
@@ -1,3 +1,7 @@
+import gzip
+import heapq
+import itertools
+import json
 import logging
 import queue
 import random
@@ -5,17 +9,54 @@ import threading
 import time
 from django.utils.functional import cached_property
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import (BaseEventStore, async_post_with_retries, get_event_key,
+                                               iter_bulk_chunks, post_with_retries)
 
 
 logger = logging.getLogger('zentral.core.stores.backends.http')
 
 
+class TemporaryError(Exception):
+    pass
+
+
+class DelayQueue:
+    """Thread safe queue of items that can only be taken after a delay"""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, item, delay):
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), item))
+
+    def get_nowait(self):
+        with self._lock:
+            if not self._heap or self._heap[0][0] > time.monotonic():
+                raise queue.Empty
+            return heapq.heappop(self._heap)[-1]
+
+    def get_wait_time(self, max_wait_time):
+        """Seconds to wait for the next item, at most max_wait_time"""
+        with self._lock:
+            if not self._heap:
+                return max_wait_time
+            return min(max_wait_time, max(0, self._heap[0][0] - time.monotonic()))
+
+
 class HTTPStoreClient:
     max_retries = 3
 
     def __init__(self, event_store, name="client"):
         self.endpoint_url = event_store.endpoint_url
+        self.batch_size = event_store.batch_size
+        self.max_request_body_size = event_store.max_request_body_size
+        self.gzip = event_store.gzip
         self.session = requests.Session()
         self.session.verify = event_store.verify_tls
         self.session.headers.update({'Content-Type': 'application/json'})
@@ -23,38 +64,75 @@ class HTTPStoreClient:
             self.session.headers.update(event_store.headers)
         if event_store.username and event_store.password:
             self.session.auth = (event_store.username, event_store.password)
+        # the session is shared by the store threads. One pooled connection per thread.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=event_store.concurrency,
+                                                pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.name = name
 
-    def _serialize_event(self, event):
-        if not isinstance(event, dict):
+    @staticmethod
+    def _serialize_event(event):
+        if isinstance(event, dict):
+            # do not modify the original serialized event
+            event = event.copy()
+            payload = event.pop("_zentral").copy()
+        else:
             event = event.serialize()
-        payload = event.pop("_zentral")
+            payload = event.pop("_zentral")
         event_type = payload.get("type")
         namespace = payload.get("namespace", event_type)
         payload[namespace] = event
         return payload
 
+    def post_payload(self, payload):
+        """Post the serialized event once, raise TemporaryError if the request can be retried"""
+        try:
+            r = self.session.post(self.endpoint_url, json=payload)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise TemporaryError(str(e))
+        if r.status_code == 429 or r.status_code >= 500:
+            raise TemporaryError(f"status code {r.status_code}")
+        r.raise_for_status()
+
     def store_event(self, event):
         payload = self._serialize_event(event)
-        for i in range(self.max_retries):
-            r = self.session.post(self.endpoint_url, json=payload)
-            if r.ok:
-                return
-            if r.status_code > 500:
-                logger.error("[%s] temporary server error", self.name)
-                if i + 1 < self.max_retries:
-                    seconds = random.uniform(3, 4) * (i + 1)
-                    logger.error("[%s] retry in %.1fs", self.name, seconds)
-                    time.sleep(seconds)
-                    continue
-            r.raise_for_status()
+        post_with_retries(self.session, self.endpoint_url, self.max_retries, json=payload)
+
+    def store_events(self, events):
+        def iter_serialized_events():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = event.serialize()
+                event_key = get_event_key(event)
+                yield event_key, json.dumps(self._serialize_event(event)).encode("utf-8")
+
+        # the events are posted in a JSON array. 2 bytes for the array brackets.
+        for chunk in iter_bulk_chunks(iter_serialized_events(), self.batch_size, self.max_request_body_size - 2):
+            data = b"[" + b",".join(data for _, data in chunk) + b"]"
+            kwargs = {"data": data}
+            if self.gzip:
+                kwargs["data"] = gzip.compress(data)
+                kwargs["headers"] = {"Content-Encoding": "gzip"}
+            try:
+                post_with_retries(self.session, self.endpoint_url, self.max_retries, **kwargs)
+            except Exception:
+                logger.exception("[%s] could not store %s event(s)", self.name, len(chunk))
+            else:
+                for event_key, _ in chunk:
+                    yield event_key
 
 
 class EventStoreThread(threading.Thread):
+    max_wait_time = 1
+
     def __init__(self, event_store, thread_id, in_queue, out_queue, stop_event):
         name = f"HTTP store thread {thread_id}"
         logger.debug("[%s] initialize", name)
-        self.client = HTTPStoreClient(event_store, name)
+        # shared by all the threads
+        self.client = event_store.client
+        self.retry_queue = event_store.retry_queue
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.stop_event = stop_event
@@ -64,28 +142,54 @@ class EventStoreThread(threading.Thread):
         logger.info("[%s] start", self.name)
         while True:
             try:
-                receipt_handle, routing_key, event_d = self.in_queue.get(block=True, timeout=1)
+                item = self.retry_queue.get_nowait()
             except queue.Empty:
-                logger.debug("[%s] no event to store", self.name)
-                if self.stop_event.is_set():
-                    logger.info("[%s] graceful exit", self.name)
-                    break
-            else:
+                try:
+                    receipt_handle, routing_key, event_d = self.in_queue.get(
+                        block=True, timeout=self.retry_queue.get_wait_time(self.max_wait_time)
+                    )
+                except queue.Empty:
+                    logger.debug("[%s] no event to store", self.name)
+                    if self.stop_event.is_set():
+                        if len(self.retry_queue):
+                            logger.error("[%s] graceful exit with %s event(s) to retry",
+                                         self.name, len(self.retry_queue))
+                        else:
+                            logger.info("[%s] graceful exit", self.name)
+                        break
+                    continue
                 event_type = event_d['_zentral']['type']
                 logger.debug("[%s] new %s event to store", self.name, event_type)
-                request_time = time.monotonic()
-                try:
-                    self.client.store_event(event_d)
-                except Exception:
-                    logger.exception("[%s] could not store event", self.name)
-                    self.out_queue.put((receipt_handle, False, event_type, time.monotonic() - request_time))
-                else:
-                    self.out_queue.put((receipt_handle, True, event_type, time.monotonic() - request_time))
+                payload = self.client._serialize_event(event_d)
+                item = (receipt_handle, event_type, payload, 0, time.monotonic())
+            self.store(*item)
+
+    def store(self, receipt_handle, event_type, payload, attempt, start_time):
+        try:
+            self.client.post_payload(payload)
+        except TemporaryError as e:
+            if attempt + 1 < self.client.max_retries:
+                # the retry is scheduled, the thread is free to store other events
+                seconds = random.uniform(3, 4) * (attempt + 1)
+                logger.error("[%s] temporary error: %s. Retry in %.1fs", self.name, e, seconds)
+                self.retry_queue.put((receipt_handle, event_type, payload, attempt + 1, start_time), seconds)
+                return
+            logger.error("[%s] could not store event: %s", self.name, e)
+            success = False
+        except Exception:
+            logger.exception("[%s] could not store event", self.name)
+            success = False
+        else:
+            success = True
+        self.out_queue.put((receipt_handle, success, event_type, time.monotonic() - start_time))
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500
+    max_request_body_size = 5000000  # uncompressed, in bytes
     max_retries = 3
     max_concurrency = 20
+    max_async_concurrency = 500
 
     def __init__(self, config_d):
         super().__init__(config_d)
@@ -94,6 +198,8 @@ class EventStore(BaseEventStore):
         self.headers = config_d.get("headers")
         self.username = config_d.get("username")
         self.password = config_d.get("password")
+        # gzip the bulk requests
+        self.gzip = config_d.get("gzip", False)
         if self.username and not self.password:
             logger.error("Username set without password")
         elif self.password and not self.username:
@@ -110,5 +216,27 @@ class EventStore(BaseEventStore):
     def client(self):
         return HTTPStoreClient(self)
 
+    @cached_property
+    def retry_queue(self):
+        return DelayQueue()
+
     def store(self, event):
         self.client.store_event(event)
+
+    def get_async_client(self):
+        headers = {'Content-Type': 'application/json'}
+        if self.headers:
+            headers.update(self.headers)
+        kwargs = {"headers": headers, "verify": self.verify_tls}
+        if self.username and self.password:
+            kwargs["auth"] = (self.username, self.password)
+        return super().get_async_client(**kwargs)
+
+    async def async_store(self, client, event):
+        payload = HTTPStoreClient._serialize_event(event)
+        await async_post_with_retries(client, self.endpoint_url, self.max_retries, json=payload)
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+        yield from self.client.store_events(events)
@@ -1,12 +1,19 @@
+import gzip
+import json
 import logging
 from urllib.parse import urljoin
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import (BaseEventStore, async_post_with_retries, get_event_key,
+                                               iter_bulk_chunks, post_with_retries)
 
 logger = logging.getLogger('zentral.core.stores.backends.humio')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500
+    max_request_body_size = 8000000  # uncompressed, in bytes
+    max_retries = 3
+    max_async_concurrency = 500
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -15,24 +22,77 @@ class EventStore(BaseEventStore):
         # ingest_token is a write only humio api token linked to a repository
         ingest_token = config_d.pop("ingest_token")
         self.ingest_url = urljoin(base_url, "/api/v1/ingest/humio-structured")
+        # gzip the bulk requests
+        self.gzip = config_d.get("gzip", False)
 
         # requests session
-        self._session = requests.Session()
-        self._session.headers.update({
+        self._headers = {
             'Content-Type': 'application/json',
             'Authorization': "Bearer {}".format(ingest_token)
-        })
+        }
+        self._session = requests.Session()
+        self._session.headers.update(self._headers)
 
-    def store(self, event):
-        if not isinstance(event, dict):
+    def _serialize_event(self, event):
+        if isinstance(event, dict):
+            # do not modify the original serialized event
+            event = event.copy()
+            humio_attributes = event.pop("_zentral").copy()
+        else:
             event = event.serialize()
-        humio_attributes = event.pop("_zentral")
+            humio_attributes = event.pop("_zentral")
         event_type = humio_attributes.pop("type")
-        humio_tags = {"event_type": event_type}
         namespace = humio_attributes.get("namespace", event_type)
         humio_attributes[namespace] = event
         created_at = humio_attributes.pop("created_at")
         timestamp = "{}Z".format(created_at[:-3])
-        data = [{"tags": humio_tags, "events": [{"timestamp": timestamp, "attributes": humio_attributes}]}]
+        return event_type, {"timestamp": timestamp, "attributes": humio_attributes}
+
+    def store(self, event):
+        event_type, humio_event = self._serialize_event(event)
+        data = [{"tags": {"event_type": event_type}, "events": [humio_event]}]
         r = self._session.post(self.ingest_url, json=data)
         r.raise_for_status()
+
+    def get_async_client(self):
+        return super().get_async_client(headers=self._headers)
+
+    async def async_store(self, client, event):
+        event_type, humio_event = self._serialize_event(event)
+        data = [{"tags": {"event_type": event_type}, "events": [humio_event]}]
+        await async_post_with_retries(client, self.ingest_url, self.max_retries, json=data)
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+
+        def iter_serialized_events():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = event.serialize()
+                event_key = get_event_key(event)
+                event_type, humio_event = self._serialize_event(event)
+                yield (event_key, event_type), json.dumps(humio_event).encode("utf-8")
+
+        # keep some room for the tags and the JSON structure
+        for chunk in iter_bulk_chunks(iter_serialized_events(), self.batch_size, self.max_request_body_size - 65536):
+            # one entry per event type, with the event type as tag
+            event_type_events = {}
+            for (_, event_type), data in chunk:
+                event_type_events.setdefault(event_type, []).append(data)
+            data = b"[" + b",".join(
+                b'{"tags":' + json.dumps({"event_type": event_type}).encode("utf-8")
+                + b',"events":[' + b",".join(event_data) + b"]}"
+                for event_type, event_data in event_type_events.items()
+            ) + b"]"
+            kwargs = {"data": data}
+            if self.gzip:
+                kwargs["data"] = gzip.compress(data)
+                kwargs["headers"] = {"Content-Encoding": "gzip"}
+            try:
+                post_with_retries(self._session, self.ingest_url, self.max_retries, **kwargs)
+            except Exception:
+                logger.exception("Could not store %s event(s)", len(chunk))
+            else:
+                for (event_key, _), _ in chunk:
+                    yield event_key
@@ -1,12 +1,19 @@
 import json
 import logging
+import random
+import time
 import boto3
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key, iter_bulk_chunks
 
 logger = logging.getLogger('zentral.core.stores.backends.kinesis')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500  # PutRecords max number of records
+    max_request_body_size = 5000000  # PutRecords max size is 5MiB, keep some room for the partition keys
+    max_record_size = 1000000  # 1MiB max, including the partition key
+    max_retries = 3
+
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
         self.stream = config_d["stream"]
@@ -29,3 +36,51 @@ class EventStore(BaseEventStore):
         self.client.put_record(StreamName=self.stream,
                                Data=data,
                                PartitionKey=event['_zentral']['id'])
+
+    def _put_records(self, chunk):
+        # returns the keys of the events stored, retries the failed records
+        records = chunk
+        for i in range(self.max_retries):
+            response = self.client.put_records(
+                StreamName=self.stream,
+                Records=[{"Data": data, "PartitionKey": event_key[0]} for event_key, data in records]
+            )
+            failed_records = []
+            error_code = None
+            for (event_key, data), record_result in zip(records, response["Records"]):
+                if record_result.get("ErrorCode"):
+                    error_code = record_result["ErrorCode"]
+                    failed_records.append((event_key, data))
+                else:
+                    yield event_key
+            if not failed_records:
+                return
+            logger.error("%s/%s record(s) failed. Last error code: %s", len(failed_records), len(records), error_code)
+            records = failed_records
+            if i + 1 < self.max_retries:
+                seconds = random.uniform(3, 4) * (i + 1)
+                logger.error("Retry in %.1fs", seconds)
+                time.sleep(seconds)
+        logger.error("Could not store %s event(s)", len(records))
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+        self.wait_and_configure_if_necessary()
+
+        def iter_serialized_events():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = event.serialize()
+                event_key = get_event_key(event)
+                data = json.dumps(event).encode('utf-8')
+                if len(data) > self.max_record_size:
+                    logger.error("Event %s too big: %s bytes", event_key, len(data))
+                    continue
+                yield event_key, data
+
+        for chunk in iter_bulk_chunks(iter_serialized_events(), self.batch_size, self.max_request_body_size):
+            try:
+                yield from self._put_records(chunk)
+            except Exception:
+                logger.exception("Could not store %s event(s)", len(chunk))
@@ -7,7 +7,7 @@ from urllib.parse import urlencode, urljoin
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, async_post_with_retries
 
 
 logger = logging.getLogger('zentral.core.stores.backends.splunk')
@@ -15,6 +15,7 @@ logger = logging.getLogger('zentral.core.stores.backends.splunk')
 
 class EventStore(BaseEventStore):
     max_batch_size = 100
+    max_async_concurrency = 500
     max_retries = 3
 
     def __init__(self, config_d):
@@ -37,14 +38,20 @@ class EventStore(BaseEventStore):
         self.source = config_d.get("source")
         self._collector_session = None
 
+    def _get_collector_headers(self):
+        return {'Authorization': f'Splunk {self.hec_token}',
+                'Content-Type': 'application/json'}
+
     @cached_property
     def collector_session(self):
         session = requests.Session()
         session.verify = self.verify_tls
-        session.headers.update({'Authorization': f'Splunk {self.hec_token}',
-                                'Content-Type': 'application/json'})
+        session.headers.update(self._get_collector_headers())
         return session
 
+    def get_async_client(self):
+        return super().get_async_client(headers=self._get_collector_headers(), verify=self.verify_tls)
+
     @staticmethod
     def _convert_datetime(dt):
         if isinstance(dt, str):
@@ -58,9 +65,13 @@ class EventStore(BaseEventStore):
         return "{:.3f}".format(ts)
 
     def _serialize_event(self, event):
-        if not isinstance(event, dict):
+        if isinstance(event, dict):
+            # do not modify the original serialized event
+            event = event.copy()
+            payload_event = event.pop("_zentral").copy()
+        else:
             event = event.serialize()
-        payload_event = event.pop("_zentral")
+            payload_event = event.pop("_zentral")
         created_at = payload_event.pop("created_at")
         event_type = payload_event.pop("type")
         namespace = payload_event.get("namespace", event_type)
@@ -107,6 +118,10 @@ class EventStore(BaseEventStore):
                     continue
             r.raise_for_status()
 
+    async def async_store(self, client, event):
+        payload = self._serialize_event(event)
+        await async_post_with_retries(client, self.collector_url, self.max_retries, json=payload)
+
     def bulk_store(self, events):
         if self.batch_size < 2:
             raise RuntimeError("bulk_store is not available when batch_size < 2")
@@ -150,6 +150,187 @@ class MTObjectManager(models.Manager):
                 created = True
         return obj, created
 
+    def bulk_commit(self, tree):
+        """Commit a tree with a few queries per tree level
+
+        Same result as commit, but the existing objects of each level are fetched with
+        one query per model, and the missing ones are created in bulk, with their
+        many to many relationships.
+        """
+        prepare_commit_tree(tree)
+        bulk_commit = MTBulkCommit()
+        with transaction.atomic():
+            pk, created = bulk_commit.commit(self.model, tree)
+        return self.get(pk=pk), created
+
+    def bulk_commit_many(self, trees):
+        """Commit multiple trees at once, with a few queries per tree level
+
+        The duplicated trees are only committed once.
+        Returns a {mt_hash: (pk, created)} dict.
+        """
+        for tree in trees:
+            prepare_commit_tree(tree)
+        bulk_commit = MTBulkCommit()
+        with transaction.atomic():
+            return bulk_commit.commit_many(self.model, trees)
+
+
+class MTBulkCommit(object):
+    def __init__(self):
+        self.field_getters = {}
+        self.pks = {}
+        self.missing_nodes = {}
+        self.missing_node_levels = {}
+
+    def _get_mt_field(self, model, name, **kwargs):
+        try:
+            obj = self.field_getters[model]
+        except KeyError:
+            obj = self.field_getters[model] = model()
+        return obj.get_mt_field(name, **kwargs)
+
+    def _parse_node(self, model, tree):
+        children = []
+        fk_fields = []
+        m2m_fields = []
+        values = []
+        for k, v in tree.items():
+            if k == 'mt_hash':
+                continue
+            elif isinstance(v, dict):
+                try:
+                    f = self._get_mt_field(model, k, many_to_one=True)
+                except MTOError:
+                    # JSONField ???
+                    f = self._get_mt_field(model, k)
+                    if isinstance(f, JSONField):
+                        t = copy.deepcopy(v)
+                        cleanup_commit_tree(t)
+                        values.append((k, t, v['mt_hash']))
+                    else:
+                        raise MTOError('Cannot set field "{}" to dict value'.format(k))
+                else:
+                    children.append((f.related_model, v))
+                    fk_fields.append((f, v['mt_hash']))
+            elif isinstance(v, list):
+                f = self._get_mt_field(model, k, many_to_many=True)
+                for sv in v:
+                    children.append((f.related_model, sv))
+                m2m_fields.append((f, [sv['mt_hash'] for sv in v]))
+            else:
+                self._get_mt_field(model, k)
+                values.append((k, v, None))
+        return tree, children, fk_fields, m2m_fields, values
+
+    def _fetch_pks(self, model, mt_hashes):
+        for mt_hash, pk in model.objects.filter(mt_hash__in=mt_hashes).values_list("mt_hash", "pk"):
+            self.pks[(model, mt_hash)] = pk
+
+    def _get_missing_node_level(self, key):
+        # 0 if the node only depends on existing nodes
+        try:
+            return self.missing_node_levels[key]
+        except KeyError:
+            pass
+        level = 0
+        for child_model, child_tree in self.missing_nodes[key][1]:
+            child_key = (child_model, child_tree['mt_hash'])
+            if child_key in self.missing_nodes:
+                level = max(level, self._get_missing_node_level(child_key) + 1)
+        self.missing_node_levels[key] = level
+        return level
+
+    def _build_obj(self, model, mt_hash):
+        _, _, fk_fields, m2m_fields, values = self.missing_nodes[(model, mt_hash)]
+        obj = model(mt_hash=mt_hash)
+        h = Hasher()
+        for f, fk_mt_hash in fk_fields:
+            setattr(obj, f.attname, self.pks[(f.related_model, fk_mt_hash)])
+            h.add_field(f.name, fk_mt_hash)
+        for f, m2m_mt_hashes in m2m_fields:
+            h.add_field(f.name, m2m_mt_hashes)
+        for k, v, _ in values:
+            setattr(obj, k, v)
+        obj.clean_fields(exclude=[f.name for f, _ in fk_fields] + [f.name for f, _ in m2m_fields])
+        # same as obj.hash(recursive=False), without the queries
+        json_mt_hashes = {k: json_mt_hash for k, _, json_mt_hash in values if json_mt_hash}
+        for f in model._meta.get_fields():
+            if f.auto_created or f.many_to_one or f.many_to_many or f.name in obj.mt_excluded_field_set:
+                continue
+            if isinstance(f, JSONField):
+                h.add_field(f.name, json_mt_hashes.get(f.name))
+            else:
+                h.add_field(f.name, getattr(obj, f.name))
+        if not h.hexdigest() == mt_hash:
+            raise MTOError('Obj {} Hash missmatch!!!'.format(obj))
+        return obj
+
+    def _create_missing_objs(self, model, mt_hashes):
+        if model.save is not models.Model.save:
+            # custom save method → regular commit
+            for mt_hash in mt_hashes:
+                obj, _ = model.objects.commit(self.missing_nodes[(model, mt_hash)][0])
+                self.pks[(model, mt_hash)] = obj.pk
+            return
+        model.objects.bulk_create([self._build_obj(model, mt_hash) for mt_hash in mt_hashes],
+                                  ignore_conflicts=True)
+        # the primary keys are not returned when the conflicts are ignored
+        self._fetch_pks(model, mt_hashes)
+        # many to many relationships
+        through_objs = {}
+        for mt_hash in mt_hashes:
+            try:
+                pk = self.pks[(model, mt_hash)]
+            except KeyError:
+                raise MTOError("Could not create {} {}".format(model._meta.object_name, mt_hash))
+            for f, m2m_mt_hashes in self.missing_nodes[(model, mt_hash)][3]:
+                through = f.remote_field.through
+                from_attname = "{}_id".format(f.m2m_field_name())
+                to_attname = "{}_id".format(f.m2m_reverse_field_name())
+                through_objs.setdefault(through, []).extend(
+                    through(**{from_attname: pk, to_attname: self.pks[(f.related_model, m2m_mt_hash)]})
+                    for m2m_mt_hash in m2m_mt_hashes
+                )
+        for through, objs in through_objs.items():
+            through.objects.bulk_create(objs, ignore_conflicts=True)
+
+    def commit(self, model, tree):
+        return self.commit_many(model, [tree])[tree['mt_hash']]
+
+    def commit_many(self, model, trees):
+        # top → bottom, one query per model and per level to find the missing nodes
+        # the subtrees of the existing nodes are skipped
+        nodes = {model: {tree['mt_hash']: tree for tree in trees}}
+        root_mt_hashes = list(nodes[model].keys())
+        while nodes:
+            children = {}
+            for node_model, node_trees in nodes.items():
+                self._fetch_pks(node_model, list(node_trees.keys()))
+                for mt_hash, node_tree in node_trees.items():
+                    key = (node_model, mt_hash)
+                    if key in self.pks or key in self.missing_nodes:
+                        continue
+                    node = self.missing_nodes[key] = self._parse_node(node_model, node_tree)
+                    for child_model, child_tree in node[1]:
+                        child_key = (child_model, child_tree['mt_hash'])
+                        if child_key not in self.pks and child_key not in self.missing_nodes:
+                            children.setdefault(child_model, {})[child_tree['mt_hash']] = child_tree
+            nodes = children
+        # bottom → top, one bulk insert per model and per level to create the missing nodes
+        levels = []
+        for key in self.missing_nodes:
+            level = self._get_missing_node_level(key)
+            while len(levels) <= level:
+                levels.append({})
+            node_model, mt_hash = key
+            levels[level].setdefault(node_model, []).append(mt_hash)
+        for level in levels:
+            for node_model, mt_hashes in level.items():
+                self._create_missing_objs(node_model, mt_hashes)
+        return {mt_hash: (self.pks[(model, mt_hash)], (model, mt_hash) in self.missing_nodes)
+                for mt_hash in root_mt_hashes}
+
 
 class AbstractMTObject(models.Model):
     mt_hash = models.CharField(max_length=40, unique=True)
@@ -1,7 +1,10 @@
 import logging
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseForbidden
 from django.views import View
-from prometheus_client import generate_latest, start_http_server, Counter, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, start_http_server, Counter, Histogram, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
 from zentral.conf import settings
 
 
@@ -12,6 +15,7 @@ class PrometheusMetricsExporter:
     def __init__(self, port):
         self.port = port
         self.counters = {}
+        self.histograms = {}
 
     def start(self):
         logger.info("Starting prometheus http server on port %s", self.port)
@@ -27,6 +31,112 @@ class PrometheusMetricsExporter:
         except KeyError:
             logger.error("Missing counter %s", counter_name)
 
+    def add_histogram(self, name, labels, buckets=None):
+        description = name.replace("_", " ").capitalize()
+        kwargs = {}
+        if buckets:
+            kwargs["buckets"] = buckets
+        self.histograms[name] = Histogram(name, description, labels, **kwargs)
+
+    def observe(self, histogram_name, value, *label_values):
+        try:
+            self.histograms[histogram_name].labels(*label_values).observe(value)
+        except KeyError:
+            logger.error("Missing histogram %s", histogram_name)
+
+
+def _cache_incr(key, value=1):
+    """Atomic increment of a cache counter, created if missing"""
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # missing counter, add is a no-op if another process has created it in the meantime
+        if not cache.add(key, value, None):
+            cache.incr(key, value)
+
+
+class CachedHistogram:
+    """Histogram shared by the web processes, using the Django cache
+
+    The bucket counts and the sum (in ms) are kept in cache counters.
+    The quantiles can be computed in Prometheus, with histogram_quantile.
+    """
+    def __init__(self, name, description, label, buckets=Histogram.DEFAULT_BUCKETS[:-1]):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = sorted(buckets)
+
+    def _get_cache_key(self, label_value, suffix):
+        return "{}_{}_{}".format(self.name, label_value, suffix)
+
+    def observe(self, label_value, value):
+        for idx, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                break
+        else:
+            idx = "inf"
+        try:
+            _cache_incr(self._get_cache_key(label_value, idx))
+            _cache_incr(self._get_cache_key(label_value, "sum"), int(value * 1000))
+        except Exception:
+            logger.exception("Could not update histogram %s", self.name)
+
+    def collect(self, label_values):
+        family = HistogramMetricFamily(self.name, self.description, labels=[self.label])
+        bucket_keys = list(range(len(self.buckets))) + ["inf"]
+        for label_value in label_values:
+            keys = [self._get_cache_key(label_value, k) for k in bucket_keys + ["sum"]]
+            values = cache.get_many(keys)
+            if not values:
+                continue
+            buckets = []
+            total = 0
+            for le, key in zip([floatToGoString(b) for b in self.buckets] + ["+Inf"], keys):
+                total += values.get(key, 0)
+                buckets.append((le, total))
+            family.add_metric([label_value], buckets, values.get(keys[-1], 0) / 1000)
+        return family
+
+    def register(self, registry, label_values):
+        registry.register(_CachedMetricCollector(self, label_values))
+
+
+class CachedCounter:
+    """Counter shared by the web and worker processes, using the Django cache"""
+    def __init__(self, name, description, label):
+        self.name = name
+        self.description = description
+        self.label = label
+
+    def _get_cache_key(self, label_value):
+        return "{}_{}_total".format(self.name, label_value)
+
+    def inc(self, label_value, value=1):
+        try:
+            _cache_incr(self._get_cache_key(label_value), value)
+        except Exception:
+            logger.exception("Could not update counter %s", self.name)
+
+    def collect(self, label_values):
+        family = CounterMetricFamily(self.name, self.description, labels=[self.label])
+        keys = {self._get_cache_key(label_value): label_value for label_value in label_values}
+        for key, value in cache.get_many(keys.keys()).items():
+            family.add_metric([keys[key]], value)
+        return family
+
+    def register(self, registry, label_values):
+        registry.register(_CachedMetricCollector(self, label_values))
+
+
+class _CachedMetricCollector:
+    def __init__(self, metric, label_values):
+        self.metric = metric
+        self.label_values = label_values
+
+    def collect(self):
+        yield self.metric.collect(self.label_values)
+
 
 class BasePrometheusMetricsView(View):
     def get_registry(self):
@@ -15,6 +15,7 @@ class StatsdMetricsExporter:
         self._ipv6 = ipv6
         self._socket = None
         self._counters = {}
+        self._histograms = {}
 
     def _open_socket(self):
         family, _, _, _, self._addr = socket.getaddrinfo(
@@ -31,11 +32,10 @@ class StatsdMetricsExporter:
     def add_counter(self, name, labels):
         self._counters[name] = [label.replace(":", ".") for label in labels]
 
-    def inc(self, counter_name, *label_values):
-        counter_name = counter_name.replace(":", ".")
-        data = "{}{}:1|c".format(self._prefix, counter_name)
+    def _send(self, metric_name, value, metric_type, metric_labels, label_values):
+        data = "{}{}:{}|{}".format(self._prefix, metric_name, value, metric_type)
         if label_values:
-            tags = zip(self._counters.get(counter_name, []),
+            tags = zip(metric_labels,
                        (s.replace(",", ".") for s in label_values))
             tags_data = ",".join("{}:{}".format(t, v) for t, v in tags)
             data = "{}|#{}".format(data, tags_data)
@@ -43,3 +43,17 @@ class StatsdMetricsExporter:
             self._socket.sendto(data.encode('ascii'), self._addr)
         except (socket.error, RuntimeError):
             pass
+
+    def inc(self, counter_name, *label_values):
+        counter_name = counter_name.replace(":", ".")
+        self._send(counter_name, 1, "c", self._counters.get(counter_name, []), label_values)
+
+    def add_histogram(self, name, labels, buckets=None):
+        # the buckets are configured in the statsd server
+        self._histograms[name] = [label.replace(":", ".") for label in labels]
+
+    def observe(self, histogram_name, value, *label_values):
+        # values in seconds are sent as timers, in milliseconds
+        histogram_name = histogram_name.replace(":", ".")
+        self._send(histogram_name, "{:.3f}".format(value * 1000), "ms",
+                   self._histograms.get(histogram_name, []), label_values)
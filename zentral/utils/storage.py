@@ -1,6 +1,73 @@
-from django.core.files.storage import get_storage_class
+import logging
+import os
+import tempfile
+from django.core.files import File
+from django.core.files.storage import default_storage, get_storage_class, FileSystemStorage
+
+
+logger = logging.getLogger("zentral.utils.storage")
+
+
+STREAMING_STORAGE_CLASS_NAMES = ('S3Boto3Storage', 'GoogleCloudStorage')
 
 
 def file_storage_has_signed_urls():
     # TODO better detection!
-    return get_storage_class().__name__ in ('S3Boto3Storage', 'GoogleCloudStorage')
+    return get_storage_class().__name__ in STREAMING_STORAGE_CLASS_NAMES
+
+
+def get_storage_write_mode(storage=default_storage):
+    if isinstance(storage, FileSystemStorage):
+        return "local"
+    elif storage.__class__.__name__ in STREAMING_STORAGE_CLASS_NAMES:
+        return "stream"
+    else:
+        return "buffered"
+
+
+class StorageFileWriter:
+    """Write a new storage file without a local copy when possible
+
+    - local: written in place, for the file system storage
+    - stream: written with the storage file object, multipart upload for the S3 storage
+    - buffered: written to a temporary file, saved in the storage on exit
+
+    The partial files are deleted if an exception is raised in the context.
+    """
+    def __init__(self, name, storage=default_storage):
+        self.storage = storage
+        self.mode = get_storage_write_mode(storage)
+        self.name = storage.get_available_name(name)
+        self.size = 0
+        self._file = None
+
+    def __enter__(self):
+        if self.mode == "local":
+            path = self.storage.path(self.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "wb")
+        elif self.mode == "stream":
+            self._file = self.storage.open(self.name, "wb")
+        else:
+            self._file = tempfile.TemporaryFile()
+        return self
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._file.close()
+            if self.mode != "buffered":
+                try:
+                    self.storage.delete(self.name)
+                except Exception:
+                    logger.exception("Could not delete partial storage file %s", self.name)
+            return
+        if self.mode == "buffered":
+            self._file.seek(0)
+            self.name = self.storage.save(self.name, File(self._file))
+        self._file.close()
+        if self.mode == "local" and self.storage.file_permissions_mode is not None:
+            os.chmod(self.storage.path(self.name), self.storage.file_permissions_mode)